@@ -148,6 +148,8 @@ _C.MODEL.RPN.ASPECT_RATIOS = (0.5, 1.0, 2.0)
 # Remove RPN anchors that go outside the image by RPN_STRADDLE_THRESH pixels
 # Set to -1 or a large value, e.g. 100000, to disable pruning anchors
 _C.MODEL.RPN.STRADDLE_THRESH = 0
+# Number of feature map sizes whose anchor grids are kept by the anchor generator, 0 to disable
+_C.MODEL.RPN.ANCHOR_CACHE_SIZE = 16
 # Minimum overlap required between an anchor and ground-truth box for the
 # (anchor, gt box) pair to be a positive example (IoU >= FG_IOU_THRESHOLD
 # ==> positive RPN example)
@@ -179,6 +181,8 @@ _C.MODEL.RPN.FPN_POST_NMS_TOP_N_TEST = 2000
 # Apply the post NMS per batch (default) or per image during training
 # (default is True to be consistent with Detectron, see Issue #672)
 _C.MODEL.RPN.FPN_POST_NMS_PER_BATCH = True
+# Decode and NMS the proposals of all the FPN levels and images at once
+_C.MODEL.RPN.BATCHED_POSTPROCESS = True
 # Custom rpn head, empty to use default conv or separable conv
 _C.MODEL.RPN.RPN_HEAD = "SingleConvRPNHead"
 
@@ -216,6 +220,15 @@ _C.MODEL.ROI_HEADS.NMS = 0.3
 _C.MODEL.ROI_HEADS.POST_NMS_PER_CLS_TOPN = 300
 # Remove duplicated assigned labels for a single bbox in nms
 _C.MODEL.ROI_HEADS.NMS_FILTER_DUPLICATES = False
+# Run the box head NMS of all the classes and images in a single call, instead of class by class
+_C.MODEL.ROI_HEADS.BATCHED_NMS = True
+# Keep the box regression deltas of the detections and decode the boxes of a class only when
+# it is read, instead of decoding the boxes of every proposal for every class. The box head only
+# decodes the candidates above SCORE_THRESH, the (num_proposals, num_classes, 4) boxes are never
+# built. The boxes_per_cls field of the detections holds their (num_detections, 4 * num_classes)
+# deltas, as large as the decoded boxes it replaces, and the predictors that compare every class
+# (Motifs / VCTree decoders, the sgdet object NMS) still decode all the classes of the detections
+_C.MODEL.ROI_HEADS.LAZY_BOX_DECODE = True
 # Maximum number of detections to return per image (100 is based on the limit
 # established for the COCO dataset)
 _C.MODEL.ROI_HEADS.DETECTIONS_PER_IMG = 256
@@ -300,6 +313,14 @@ _C.MODEL.ROI_RELATION_HEAD.CONTEXT_HIDDEN_DIM = 512
 _C.MODEL.ROI_RELATION_HEAD.CONTEXT_POOLING_DIM = 4096
 _C.MODEL.ROI_RELATION_HEAD.CONTEXT_OBJ_LAYER = 1  # assert >= 1
 _C.MODEL.ROI_RELATION_HEAD.CONTEXT_REL_LAYER = 1  # assert >= 1
+# the Motifs contexts pack the objects of the images into LSTM sequences, the images with more
+# objects first so that each sequence holds a single image, as the batched decoding needs in testing.
+# In training, the released models saw the images with fewer objects first, their sequences mixing
+# the objects of several images. Set True to train with the testing order
+_C.MODEL.ROI_RELATION_HEAD.CONTEXT_GROUP_IMAGES_IN_TRAINING = False
+# run the VCTree TreeLSTMs level by level over all trees of the batch,
+# False for the recursive node by node execution
+_C.MODEL.ROI_RELATION_HEAD.VCTREE_LEVEL_SYNC = True
 
 _C.MODEL.ROI_RELATION_HEAD.EVALUATE_REL_PROPOSAL = True
 
@@ -322,10 +343,18 @@ _C.MODEL.ROI_RELATION_HEAD.TRANSFORMER.NUM_HEAD = 8
 _C.MODEL.ROI_RELATION_HEAD.TRANSFORMER.INNER_DIM = 2048
 _C.MODEL.ROI_RELATION_HEAD.TRANSFORMER.KEY_DIM = 64
 _C.MODEL.ROI_RELATION_HEAD.TRANSFORMER.VAL_DIM = 64
+# "padded": attention on the batch padded to the largest image, "packed": block-diagonal
+# attention on the concatenated objects of the images, without padding
+_C.MODEL.ROI_RELATION_HEAD.TRANSFORMER.ATTENTION = "packed"
+# for packed attention, attend at most this many queries of an image at a time, 0 for all
+_C.MODEL.ROI_RELATION_HEAD.TRANSFORMER.ATTENTION_CHUNK_SIZE = 0
 
 _C.MODEL.ROI_RELATION_HEAD.LABEL_SMOOTHING_LOSS = False
 _C.MODEL.ROI_RELATION_HEAD.PREDICT_USE_VISION = True
 _C.MODEL.ROI_RELATION_HEAD.PREDICT_USE_BIAS = True
+# keep the frequency statistics and the frequency bias of the subject-object class pairs
+# seen in training only, for large vocabularies where the dense (num_obj^2, num_rel) table is too big
+_C.MODEL.ROI_RELATION_HEAD.SPARSE_FREQUENCY_BIAS = False
 _C.MODEL.ROI_RELATION_HEAD.REQUIRE_BOX_OVERLAP = True
 _C.MODEL.ROI_RELATION_HEAD.NUM_SAMPLE_PER_GT_REL = 4  # when sample fg relationship from gt, the max number of corresponding proposal pairs
 
@@ -429,6 +458,12 @@ _C.MODEL.ROI_RELATION_HEAD.GPSNET_MODULE.RELNESS_MP_WEIGHTING = False
 
 _C.MODEL.ROI_RELATION_HEAD.GPSNET_MODULE.GRAPH_HIDDEN_DIM = 512
 
+# "dense": attention normalized on the num_inst x num_inst matrix,
+# "edge": attention only computed on the relation pairs and normalized by a segment softmax,
+# without the epsilon of the dense softmax, the two only match when the attention logits of each node
+# are close to the global max (see MessageGenerator)
+_C.MODEL.ROI_RELATION_HEAD.GPSNET_MODULE.MSG_ATTENTION = "dense"
+
 ##### CVPR 2018 AGRCNN
 _C.MODEL.ROI_RELATION_HEAD.GRCNN_MODULE = CN()
 
@@ -495,6 +530,8 @@ _C.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.FOCAL_LOSS_GAMMA = 0.0
 ############## pairwise augment features #########################
 # switch of geometry information in union feature
 _C.MODEL.ROI_RELATION_HEAD.GEOMETRIC_FEATURES = True
+# rasterize the pair rectangle masks of the geometry branch in half precision, use together with DTYPE float16
+_C.MODEL.ROI_RELATION_HEAD.GEOMETRIC_FEATURES_HALF = False
 
 _C.MODEL.ROI_RELATION_HEAD.WORD_EMBEDDING_FEATURES = True
 
@@ -551,6 +588,13 @@ _C.MODEL.ROI_RELATION_HEAD.DATA_RESAMPLING_METHOD = "bilvl" # lvis
 # fix the feature extract modules only train the classifier
 _C.MODEL.ROI_RELATION_HEAD.FIX_FEATURE = False
 
+# with a frozen detector in predcls / sgcls, read the ROI and union features from the store
+# written by tools/relation_extract_features.py instead of running the backbone,
+# the store of MODEL.PRETRAINED_DETECTOR_CKPT is looked for in DIR
+_C.MODEL.ROI_RELATION_HEAD.FEATURE_STORE = CN()
+_C.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED = False
+_C.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.DIR = ""
+
 _C.MODEL.ROI_RELATION_HEAD.CLASSIFIER = "linear"  # weighted_norm
 
 _C.MODEL.ROI_RELATION_HEAD.CLASSIFIER_WEIGHT_SCALE = False  # weighted_norm
@@ -773,6 +817,10 @@ _C.TEST.EXPECTED_RESULTS_SIGMA_TOL = 4
 _C.TEST.IMS_PER_BATCH = 8
 # Number of detections per image
 _C.TEST.DETECTIONS_PER_IMG = 100
+# fold the frozen batch norms of the backbone into its convolutions once before testing, and
+# optionally run it in the channels last memory format, see backbone.prepare_for_inference
+_C.TEST.BACKBONE_PREPARE_FOR_INFERENCE = False
+_C.TEST.BACKBONE_CHANNELS_LAST = False
 
 # ---------------------------------------------------------------------------- #
 # Test-time augmentations for bounding box detection
@@ -795,6 +843,10 @@ _C.TEST.BBOX_AUG.MAX_SIZE = 4000
 # Horizontal flip at each scale
 _C.TEST.BBOX_AUG.SCALE_H_FLIP = False
 
+# Run the views padded to the same size, e.g. a scale and its horizontal flip,
+# in a single forward instead of one forward per view
+_C.TEST.BBOX_AUG.BATCHED = True
+
 _C.TEST.SAVE_PROPOSALS = False
 # Settings for relation testing
 _C.TEST.RELATION = CN()
@@ -806,6 +858,14 @@ _C.TEST.RELATION.LATER_NMS_PREDICTION_THRES = 0.3
 # synchronize_gather, used for sgdet, otherwise test on multi-gpu will cause out of memory
 # for detection mode, need to set as false, otherwise there may have some prediction been missed
 _C.TEST.RELATION.SYNC_GATHER = True
+# memory budget in MB for the activations of the relation pairs at test time, when > 0 the pairs of a batch are
+# streamed in chunks through the union feature extractor and the pair level layers of the predictor,
+# only work for the predictors that split the forward into object_context and pair_logits: MotifPredictor,
+# the other predictors ignore it with a warning and run all the pairs in one pass
+_C.TEST.RELATION.CHUNK_MEMORY_BUDGET = 0
+# fold the constant weights of the relation predictor (normalized classifiers, frequency bias scale,
+# batch norms) once before testing, see roi_relation_predictors.prepare_for_inference
+_C.TEST.RELATION.PREPARE_FOR_INFERENCE = False
 
 _C.TEST.ALLOW_LOAD_FROM_CACHE = False
 # ---------------------------------------------------------------------------- #
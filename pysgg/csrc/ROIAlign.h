@@ -41,6 +41,45 @@ at::Tensor ROIAlign_backward(const at::Tensor& grad,
     AT_ERROR("Not compiled with GPU support");
 #endif
   }
-  AT_ERROR("Not implemented on the CPU");
+  return ROIAlign_backward_cpu(grad, rois, spatial_scale, pooled_height, pooled_width, batch_size, channels, height, width, sampling_ratio);
 }
 
+at::Tensor ROIAlign_multilevel_forward(const std::vector<at::Tensor>& inputs,
+                                       const at::Tensor& rois,
+                                       const at::Tensor& levels,
+                                       const std::vector<double>& spatial_scales,
+                                       const int pooled_height,
+                                       const int pooled_width,
+                                       const int sampling_ratio,
+                                       const bool cat_all_levels) {
+  if (rois.type().is_cuda()) {
+#ifdef WITH_CUDA
+    return ROIAlign_multilevel_forward_cuda(inputs, rois, levels, spatial_scales, pooled_height, pooled_width, sampling_ratio, cat_all_levels);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return ROIAlign_multilevel_forward_cpu(inputs, rois, levels, spatial_scales, pooled_height, pooled_width, sampling_ratio, cat_all_levels);
+}
+
+std::vector<at::Tensor> ROIAlign_multilevel_backward(const at::Tensor& grad,
+                                                     const at::Tensor& rois,
+                                                     const at::Tensor& levels,
+                                                     const std::vector<double>& spatial_scales,
+                                                     const int pooled_height,
+                                                     const int pooled_width,
+                                                     const int batch_size,
+                                                     const int channels,
+                                                     const std::vector<int64_t>& heights,
+                                                     const std::vector<int64_t>& widths,
+                                                     const int sampling_ratio,
+                                                     const bool cat_all_levels) {
+  if (grad.type().is_cuda()) {
+#ifdef WITH_CUDA
+    return ROIAlign_multilevel_backward_cuda(grad, rois, levels, spatial_scales, pooled_height, pooled_width, batch_size, channels, heights, widths, sampling_ratio, cat_all_levels);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return ROIAlign_multilevel_backward_cpu(grad, rois, levels, spatial_scales, pooled_height, pooled_width, batch_size, channels, heights, widths, sampling_ratio, cat_all_levels);
+}
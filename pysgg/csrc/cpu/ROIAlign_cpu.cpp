@@ -1,5 +1,8 @@
 // Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 #include "cpu/vision.h"
+#include <ATen/Parallel.h>
+
+#include <vector>
 
 // implementation taken from Caffe2
 template <typename T>
@@ -110,11 +113,185 @@ void pre_calc_for_bilinear_interpolate(
   }
 }
 
+// the sampling grid of one roi, shared by all the channels, returns the
+// batch index of the roi and fills the bilinear weights of its samples
+template <typename T>
+int pre_calc_for_roi(
+    const T* roi,
+    const T spatial_scale,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    int& roi_bin_grid_h,
+    int& roi_bin_grid_w,
+    std::vector<PreCalc<T>>& pre_calc) {
+  int roi_batch_ind = roi[0];
+
+  // Do not using rounding; this implementation detail is critical
+  T roi_start_w = roi[1] * spatial_scale;
+  T roi_start_h = roi[2] * spatial_scale;
+  T roi_end_w = roi[3] * spatial_scale;
+  T roi_end_h = roi[4] * spatial_scale;
+
+  // Force malformed ROIs to be 1x1
+  T roi_width = std::max(roi_end_w - roi_start_w, (T)1.);
+  T roi_height = std::max(roi_end_h - roi_start_h, (T)1.);
+  T bin_size_h = static_cast<T>(roi_height) / static_cast<T>(pooled_height);
+  T bin_size_w = static_cast<T>(roi_width) / static_cast<T>(pooled_width);
+
+  // We use roi_bin_grid to sample the grid and mimic integral
+  roi_bin_grid_h = (sampling_ratio > 0)
+      ? sampling_ratio
+      : ceil(roi_height / pooled_height); // e.g., = 2
+  roi_bin_grid_w =
+      (sampling_ratio > 0) ? sampling_ratio : ceil(roi_width / pooled_width);
+
+  pre_calc.resize(roi_bin_grid_h * roi_bin_grid_w * pooled_width * pooled_height);
+  pre_calc_for_bilinear_interpolate(
+      height,
+      width,
+      pooled_height,
+      pooled_width,
+      roi_bin_grid_h,
+      roi_bin_grid_w,
+      roi_start_h,
+      roi_start_w,
+      bin_size_h,
+      bin_size_w,
+      roi_bin_grid_h,
+      roi_bin_grid_w,
+      pre_calc);
+  return roi_batch_ind;
+}
+
+// pools one roi of the feature map into the channels x pooled_height x
+// pooled_width block top_data
+template <typename T>
+void ROIAlignForward_cpu_roi(
+    const T* bottom_data,
+    const T* roi,
+    const T spatial_scale,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    std::vector<PreCalc<T>>& pre_calc,
+    T* top_data) {
+  // we want to precalculate indeces and weights shared by all chanels,
+  // this is the key point of optimiation
+  int roi_bin_grid_h, roi_bin_grid_w;
+  int roi_batch_ind = pre_calc_for_roi(
+      roi,
+      spatial_scale,
+      height,
+      width,
+      pooled_height,
+      pooled_width,
+      sampling_ratio,
+      roi_bin_grid_h,
+      roi_bin_grid_w,
+      pre_calc);
+
+  // We do average (integral) pooling inside a bin
+  const T count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
+
+  for (int c = 0; c < channels; c++) {
+    int index_c = c * pooled_width * pooled_height;
+    const T* offset_bottom_data =
+        bottom_data + (roi_batch_ind * channels + c) * height * width;
+    int pre_calc_index = 0;
+
+    for (int ph = 0; ph < pooled_height; ph++) {
+      for (int pw = 0; pw < pooled_width; pw++) {
+        int index = index_c + ph * pooled_width + pw;
+
+        T output_val = 0.;
+        for (int iy = 0; iy < roi_bin_grid_h; iy++) {
+          for (int ix = 0; ix < roi_bin_grid_w; ix++) {
+            const PreCalc<T>& pc = pre_calc[pre_calc_index];
+            output_val += pc.w1 * offset_bottom_data[pc.pos1] +
+                pc.w2 * offset_bottom_data[pc.pos2] +
+                pc.w3 * offset_bottom_data[pc.pos3] +
+                pc.w4 * offset_bottom_data[pc.pos4];
+
+            pre_calc_index += 1;
+          }
+        }
+        output_val /= count;
+
+        top_data[index] = output_val;
+      } // for pw
+    } // for ph
+  } // for c
+}
+
+// accumulates the gradient of the channels [c_begin, c_end) of one roi,
+// top_diff is the channels x pooled_height x pooled_width block of the roi
+template <typename T>
+void ROIAlignBackward_cpu_roi(
+    const T* top_diff,
+    const T* roi,
+    const T spatial_scale,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    const int64_t c_begin,
+    const int64_t c_end,
+    std::vector<PreCalc<T>>& pre_calc,
+    T* bottom_diff) {
+  int roi_bin_grid_h, roi_bin_grid_w;
+  int roi_batch_ind = pre_calc_for_roi(
+      roi,
+      spatial_scale,
+      height,
+      width,
+      pooled_height,
+      pooled_width,
+      sampling_ratio,
+      roi_bin_grid_h,
+      roi_bin_grid_w,
+      pre_calc);
+  const T count = roi_bin_grid_h * roi_bin_grid_w;
+
+  for (int64_t c = c_begin; c < c_end; c++) {
+    const T* offset_top_diff = top_diff + c * pooled_height * pooled_width;
+    T* offset_bottom_diff =
+        bottom_diff + (roi_batch_ind * channels + c) * height * width;
+    int pre_calc_index = 0;
+
+    for (int ph = 0; ph < pooled_height; ph++) {
+      for (int pw = 0; pw < pooled_width; pw++) {
+        const T top_diff_this_bin =
+            offset_top_diff[ph * pooled_width + pw] / count;
+        for (int iy = 0; iy < roi_bin_grid_h; iy++) {
+          for (int ix = 0; ix < roi_bin_grid_w; ix++) {
+            // the samples out of the feature map have zero weights
+            const PreCalc<T>& pc = pre_calc[pre_calc_index];
+            offset_bottom_diff[pc.pos1] += pc.w1 * top_diff_this_bin;
+            offset_bottom_diff[pc.pos2] += pc.w2 * top_diff_this_bin;
+            offset_bottom_diff[pc.pos3] += pc.w3 * top_diff_this_bin;
+            offset_bottom_diff[pc.pos4] += pc.w4 * top_diff_this_bin;
+
+            pre_calc_index += 1;
+          }
+        }
+      } // for pw
+    } // for ph
+  } // for c
+}
+
 template <typename T>
 void ROIAlignForward_cpu_kernel(
-    const int nthreads,
+    const int n_rois,
     const T* bottom_data,
-    const T& spatial_scale,
+    const T spatial_scale,
     const int channels,
     const int height,
     const int width,
@@ -122,100 +299,148 @@ void ROIAlignForward_cpu_kernel(
     const int pooled_width,
     const int sampling_ratio,
     const T* bottom_rois,
-    //int roi_cols,
     T* top_data) {
-  //AT_ASSERT(roi_cols == 4 || roi_cols == 5);
-  int roi_cols = 5;
-
-  int n_rois = nthreads / channels / pooled_width / pooled_height;
-  // (n, c, ph, pw) is an element in the pooled output
-  // can be parallelized using omp
-  // #pragma omp parallel for num_threads(32)
-  for (int n = 0; n < n_rois; n++) {
-    int index_n = n * channels * pooled_width * pooled_height;
-
-    // roi could have 4 or 5 columns
-    const T* offset_bottom_rois = bottom_rois + n * roi_cols;
-    int roi_batch_ind = 0;
-    if (roi_cols == 5) {
-      roi_batch_ind = offset_bottom_rois[0];
-      offset_bottom_rois++;
+  // every roi writes its own slice of the output
+  at::parallel_for(0, n_rois, 1, [&](int64_t begin, int64_t end) {
+    std::vector<PreCalc<T>> pre_calc;
+    for (int64_t n = begin; n < end; n++) {
+      ROIAlignForward_cpu_roi(
+          bottom_data,
+          bottom_rois + n * 5,
+          spatial_scale,
+          channels,
+          height,
+          width,
+          pooled_height,
+          pooled_width,
+          sampling_ratio,
+          pre_calc,
+          top_data + n * channels * pooled_height * pooled_width);
     }
+  });
+}
 
-    // Do not using rounding; this implementation detail is critical
-    T roi_start_w = offset_bottom_rois[0] * spatial_scale;
-    T roi_start_h = offset_bottom_rois[1] * spatial_scale;
-    T roi_end_w = offset_bottom_rois[2] * spatial_scale;
-    T roi_end_h = offset_bottom_rois[3] * spatial_scale;
-    // T roi_start_w = round(offset_bottom_rois[0] * spatial_scale);
-    // T roi_start_h = round(offset_bottom_rois[1] * spatial_scale);
-    // T roi_end_w = round(offset_bottom_rois[2] * spatial_scale);
-    // T roi_end_h = round(offset_bottom_rois[3] * spatial_scale);
-
-    // Force malformed ROIs to be 1x1
-    T roi_width = std::max(roi_end_w - roi_start_w, (T)1.);
-    T roi_height = std::max(roi_end_h - roi_start_h, (T)1.);
-    T bin_size_h = static_cast<T>(roi_height) / static_cast<T>(pooled_height);
-    T bin_size_w = static_cast<T>(roi_width) / static_cast<T>(pooled_width);
-
-    // We use roi_bin_grid to sample the grid and mimic integral
-    int roi_bin_grid_h = (sampling_ratio > 0)
-        ? sampling_ratio
-        : ceil(roi_height / pooled_height); // e.g., = 2
-    int roi_bin_grid_w =
-        (sampling_ratio > 0) ? sampling_ratio : ceil(roi_width / pooled_width);
-
-    // We do average (integral) pooling inside a bin
-    const T count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
-
-    // we want to precalculate indeces and weights shared by all chanels,
-    // this is the key point of optimiation
-    std::vector<PreCalc<T>> pre_calc(
-        roi_bin_grid_h * roi_bin_grid_w * pooled_width * pooled_height);
-    pre_calc_for_bilinear_interpolate(
-        height,
-        width,
-        pooled_height,
-        pooled_width,
-        roi_bin_grid_h,
-        roi_bin_grid_w,
-        roi_start_h,
-        roi_start_w,
-        bin_size_h,
-        bin_size_w,
-        roi_bin_grid_h,
-        roi_bin_grid_w,
-        pre_calc);
-
-      for (int c = 0; c < channels; c++) {
-      int index_n_c = index_n + c * pooled_width * pooled_height;
-      const T* offset_bottom_data =
-          bottom_data + (roi_batch_ind * channels + c) * height * width;
-      int pre_calc_index = 0;
-
-      for (int ph = 0; ph < pooled_height; ph++) {
-        for (int pw = 0; pw < pooled_width; pw++) {
-          int index = index_n_c + ph * pooled_width + pw;
-
-          T output_val = 0.;
-          for (int iy = 0; iy < roi_bin_grid_h; iy++) {
-            for (int ix = 0; ix < roi_bin_grid_w; ix++) {
-              PreCalc<T> pc = pre_calc[pre_calc_index];
-              output_val += pc.w1 * offset_bottom_data[pc.pos1] +
-                  pc.w2 * offset_bottom_data[pc.pos2] +
-                  pc.w3 * offset_bottom_data[pc.pos3] +
-                  pc.w4 * offset_bottom_data[pc.pos4];
-
-              pre_calc_index += 1;
-            }
-          }
-          output_val /= count;
+template <typename T>
+void ROIAlignBackward_cpu_kernel(
+    const int n_rois,
+    const T* top_diff,
+    const T spatial_scale,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    const T* bottom_rois,
+    T* bottom_diff) {
+  // the rois overlap, so the work is split over the channels instead: every
+  // thread owns its channels of the input gradient and needs no atomics,
+  // the sums are also accumulated in the same order whatever the threads
+  at::parallel_for(0, channels, 1, [&](int64_t c_begin, int64_t c_end) {
+    std::vector<PreCalc<T>> pre_calc;
+    for (int n = 0; n < n_rois; n++) {
+      ROIAlignBackward_cpu_roi(
+          top_diff + n * channels * pooled_height * pooled_width,
+          bottom_rois + n * 5,
+          spatial_scale,
+          channels,
+          height,
+          width,
+          pooled_height,
+          pooled_width,
+          sampling_ratio,
+          c_begin,
+          c_end,
+          pre_calc,
+          bottom_diff);
+    }
+  });
+}
 
-          top_data[index] = output_val;
-        } // for pw
-      } // for ph
-    } // for c
-  } // for n
+// the rois of all the feature map levels in one pass: the roi n is pooled
+// from the level levels[n], or from every level into consecutive blocks of
+// channels when levels is null (cat_all_levels)
+template <typename T>
+void ROIAlignMultilevelForward_cpu_kernel(
+    const int n_rois,
+    const std::vector<const T*>& bottom_data,
+    const std::vector<T>& spatial_scales,
+    const std::vector<int>& heights,
+    const std::vector<int>& widths,
+    const int64_t* levels,
+    const int channels,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    const T* bottom_rois,
+    T* top_data) {
+  const int num_levels = bottom_data.size();
+  const int block_size = channels * pooled_height * pooled_width;
+  const int roi_size = levels != nullptr ? block_size : block_size * num_levels;
+  at::parallel_for(0, n_rois, 1, [&](int64_t begin, int64_t end) {
+    std::vector<PreCalc<T>> pre_calc;
+    for (int64_t n = begin; n < end; n++) {
+      const int level_begin = levels != nullptr ? levels[n] : 0;
+      const int level_end = levels != nullptr ? levels[n] + 1 : num_levels;
+      for (int level = level_begin; level < level_end; level++) {
+        ROIAlignForward_cpu_roi(
+            bottom_data[level],
+            bottom_rois + n * 5,
+            spatial_scales[level],
+            channels,
+            heights[level],
+            widths[level],
+            pooled_height,
+            pooled_width,
+            sampling_ratio,
+            pre_calc,
+            top_data + n * roi_size + (levels != nullptr ? 0 : level * block_size));
+      }
+    }
+  });
+}
+
+template <typename T>
+void ROIAlignMultilevelBackward_cpu_kernel(
+    const int n_rois,
+    const T* top_diff,
+    const std::vector<T>& spatial_scales,
+    const std::vector<int>& heights,
+    const std::vector<int>& widths,
+    const int64_t* levels,
+    const int channels,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    const T* bottom_rois,
+    const std::vector<T*>& bottom_diff) {
+  const int num_levels = bottom_diff.size();
+  const int block_size = channels * pooled_height * pooled_width;
+  const int roi_size = levels != nullptr ? block_size : block_size * num_levels;
+  // split over the channels, as ROIAlignBackward_cpu_kernel
+  at::parallel_for(0, channels, 1, [&](int64_t c_begin, int64_t c_end) {
+    std::vector<PreCalc<T>> pre_calc;
+    for (int n = 0; n < n_rois; n++) {
+      const int level_begin = levels != nullptr ? levels[n] : 0;
+      const int level_end = levels != nullptr ? levels[n] + 1 : num_levels;
+      for (int level = level_begin; level < level_end; level++) {
+        ROIAlignBackward_cpu_roi(
+            top_diff + n * roi_size + (levels != nullptr ? 0 : level * block_size),
+            bottom_rois + n * 5,
+            spatial_scales[level],
+            channels,
+            heights[level],
+            widths[level],
+            pooled_height,
+            pooled_width,
+            sampling_ratio,
+            c_begin,
+            c_end,
+            pre_calc,
+            bottom_diff[level]);
+      }
+    }
+  });
 }
 
 at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
@@ -233,16 +458,17 @@ at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
   auto width = input.size(3);
 
   auto output = at::empty({num_rois, channels, pooled_height, pooled_width}, input.options());
-  auto output_size = num_rois * pooled_height * pooled_width * channels;
 
   if (output.numel() == 0) {
     return output;
   }
 
+  auto input_ = input.contiguous();
+  auto rois_ = rois.contiguous();
   AT_DISPATCH_FLOATING_TYPES(input.type(), "ROIAlign_forward", [&] {
     ROIAlignForward_cpu_kernel<scalar_t>(
-         output_size,
-         input.data<scalar_t>(),
+         num_rois,
+         input_.data<scalar_t>(),
          spatial_scale,
          channels,
          height,
@@ -250,8 +476,166 @@ at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
          pooled_height,
          pooled_width,
          sampling_ratio,
-         rois.data<scalar_t>(),
+         rois_.data<scalar_t>(),
          output.data<scalar_t>());
   });
   return output;
 }
+
+at::Tensor ROIAlign_backward_cpu(const at::Tensor& grad,
+                                 const at::Tensor& rois,
+                                 const float spatial_scale,
+                                 const int pooled_height,
+                                 const int pooled_width,
+                                 const int batch_size,
+                                 const int channels,
+                                 const int height,
+                                 const int width,
+                                 const int sampling_ratio) {
+  AT_ASSERTM(!grad.type().is_cuda(), "grad must be a CPU tensor");
+  AT_ASSERTM(!rois.type().is_cuda(), "rois must be a CPU tensor");
+
+  auto num_rois = rois.size(0);
+  auto grad_input = at::zeros({batch_size, channels, height, width}, grad.options());
+
+  // handle possibly empty gradients
+  if (grad.numel() == 0) {
+    return grad_input;
+  }
+
+  auto grad_ = grad.contiguous();
+  auto rois_ = rois.contiguous();
+  AT_DISPATCH_FLOATING_TYPES(grad.type(), "ROIAlign_backward", [&] {
+    ROIAlignBackward_cpu_kernel<scalar_t>(
+         num_rois,
+         grad_.data<scalar_t>(),
+         spatial_scale,
+         channels,
+         height,
+         width,
+         pooled_height,
+         pooled_width,
+         sampling_ratio,
+         rois_.data<scalar_t>(),
+         grad_input.data<scalar_t>());
+  });
+  return grad_input;
+}
+
+at::Tensor ROIAlign_multilevel_forward_cpu(const std::vector<at::Tensor>& inputs,
+                                           const at::Tensor& rois,
+                                           const at::Tensor& levels,
+                                           const std::vector<double>& spatial_scales,
+                                           const int pooled_height,
+                                           const int pooled_width,
+                                           const int sampling_ratio,
+                                           const bool cat_all_levels) {
+  AT_ASSERTM(inputs.size() > 0, "inputs should have at least one level");
+  AT_ASSERTM(inputs.size() == spatial_scales.size(), "inputs should have one spatial scale per level");
+  AT_ASSERTM(!rois.type().is_cuda(), "rois must be a CPU tensor");
+  AT_ASSERTM(cat_all_levels || levels.numel() == rois.size(0), "levels should have one level per roi");
+
+  const int num_levels = inputs.size();
+  auto num_rois = rois.size(0);
+  auto channels = inputs[0].size(1);
+  auto out_channels = cat_all_levels ? channels * num_levels : channels;
+
+  auto output = at::empty({num_rois, out_channels, pooled_height, pooled_width}, inputs[0].options());
+
+  if (output.numel() == 0) {
+    return output;
+  }
+
+  std::vector<at::Tensor> inputs_;
+  std::vector<int> heights, widths;
+  for (const auto& input : inputs) {
+    AT_ASSERTM(!input.type().is_cuda(), "input must be a CPU tensor");
+    AT_ASSERTM(input.size(1) == channels, "the levels should have the same number of channels");
+    inputs_.push_back(input.contiguous());
+    heights.push_back(input.size(2));
+    widths.push_back(input.size(3));
+  }
+  auto rois_ = rois.contiguous();
+  auto levels_ = levels.to(at::kLong).contiguous();
+  AT_DISPATCH_FLOATING_TYPES(inputs[0].type(), "ROIAlign_multilevel_forward", [&] {
+    std::vector<const scalar_t*> bottom_data;
+    std::vector<scalar_t> scales;
+    for (int level = 0; level < num_levels; level++) {
+      bottom_data.push_back(inputs_[level].data<scalar_t>());
+      // through float, as the spatial scale of ROIAlign_forward_cpu
+      scales.push_back(static_cast<float>(spatial_scales[level]));
+    }
+    ROIAlignMultilevelForward_cpu_kernel<scalar_t>(
+         num_rois,
+         bottom_data,
+         scales,
+         heights,
+         widths,
+         cat_all_levels ? nullptr : levels_.data<int64_t>(),
+         channels,
+         pooled_height,
+         pooled_width,
+         sampling_ratio,
+         rois_.data<scalar_t>(),
+         output.data<scalar_t>());
+  });
+  return output;
+}
+
+std::vector<at::Tensor> ROIAlign_multilevel_backward_cpu(const at::Tensor& grad,
+                                                         const at::Tensor& rois,
+                                                         const at::Tensor& levels,
+                                                         const std::vector<double>& spatial_scales,
+                                                         const int pooled_height,
+                                                         const int pooled_width,
+                                                         const int batch_size,
+                                                         const int channels,
+                                                         const std::vector<int64_t>& heights,
+                                                         const std::vector<int64_t>& widths,
+                                                         const int sampling_ratio,
+                                                         const bool cat_all_levels) {
+  AT_ASSERTM(!grad.type().is_cuda(), "grad must be a CPU tensor");
+  AT_ASSERTM(!rois.type().is_cuda(), "rois must be a CPU tensor");
+  AT_ASSERTM(heights.size() == spatial_scales.size() && widths.size() == spatial_scales.size(),
+             "heights and widths should have one size per level");
+
+  const int num_levels = spatial_scales.size();
+  auto num_rois = rois.size(0);
+  std::vector<at::Tensor> grad_inputs;
+  for (int level = 0; level < num_levels; level++) {
+    grad_inputs.push_back(at::zeros({batch_size, channels, heights[level], widths[level]}, grad.options()));
+  }
+
+  // handle possibly empty gradients
+  if (grad.numel() == 0) {
+    return grad_inputs;
+  }
+
+  auto grad_ = grad.contiguous();
+  auto rois_ = rois.contiguous();
+  auto levels_ = levels.to(at::kLong).contiguous();
+  std::vector<int> heights_(heights.begin(), heights.end());
+  std::vector<int> widths_(widths.begin(), widths.end());
+  AT_DISPATCH_FLOATING_TYPES(grad.type(), "ROIAlign_multilevel_backward", [&] {
+    std::vector<scalar_t*> bottom_diff;
+    std::vector<scalar_t> scales;
+    for (int level = 0; level < num_levels; level++) {
+      bottom_diff.push_back(grad_inputs[level].data<scalar_t>());
+      scales.push_back(static_cast<float>(spatial_scales[level]));
+    }
+    ROIAlignMultilevelBackward_cpu_kernel<scalar_t>(
+         num_rois,
+         grad_.data<scalar_t>(),
+         scales,
+         heights_,
+         widths_,
+         cat_all_levels ? nullptr : levels_.data<int64_t>(),
+         channels,
+         pooled_height,
+         pooled_width,
+         sampling_ratio,
+         rois_.data<scalar_t>(),
+         bottom_diff);
+  });
+  return grad_inputs;
+}
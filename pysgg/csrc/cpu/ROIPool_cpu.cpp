@@ -0,0 +1,200 @@
+// Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+#include "cpu/vision.h"
+#include <ATen/Parallel.h>
+
+#include <cfloat>
+#include <cmath>
+
+
+template <typename T>
+void ROIPoolForward_cpu_kernel(
+    const int n_rois,
+    const T* bottom_data,
+    const T spatial_scale,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const T* bottom_rois,
+    T* top_data,
+    int* argmax_data) {
+  // (n, c) planes of the output are independent
+  at::parallel_for(0, n_rois * channels, 1, [&](int64_t begin, int64_t end) {
+    for (int64_t index_n_c = begin; index_n_c < end; index_n_c++) {
+      int c = index_n_c % channels;
+      int n = index_n_c / channels;
+
+      const T* offset_bottom_rois = bottom_rois + n * 5;
+      int roi_batch_ind = offset_bottom_rois[0];
+      int roi_start_w = std::round(offset_bottom_rois[1] * spatial_scale);
+      int roi_start_h = std::round(offset_bottom_rois[2] * spatial_scale);
+      int roi_end_w = std::round(offset_bottom_rois[3] * spatial_scale);
+      int roi_end_h = std::round(offset_bottom_rois[4] * spatial_scale);
+
+      // Force malformed ROIs to be 1x1
+      int roi_width = std::max(roi_end_w - roi_start_w + 1, 1);
+      int roi_height = std::max(roi_end_h - roi_start_h + 1, 1);
+      T bin_size_h = static_cast<T>(roi_height)
+                         / static_cast<T>(pooled_height);
+      T bin_size_w = static_cast<T>(roi_width)
+                         / static_cast<T>(pooled_width);
+
+      const T* offset_bottom_data =
+          bottom_data + (roi_batch_ind * channels + c) * height * width;
+      int index_n_c_top = index_n_c * pooled_height * pooled_width;
+
+      for (int ph = 0; ph < pooled_height; ph++) {
+        for (int pw = 0; pw < pooled_width; pw++) {
+          int hstart = static_cast<int>(std::floor(static_cast<T>(ph)
+                                                   * bin_size_h));
+          int wstart = static_cast<int>(std::floor(static_cast<T>(pw)
+                                                   * bin_size_w));
+          int hend = static_cast<int>(std::ceil(static_cast<T>(ph + 1)
+                                                * bin_size_h));
+          int wend = static_cast<int>(std::ceil(static_cast<T>(pw + 1)
+                                                * bin_size_w));
+
+          // Add roi offsets and clip to input boundaries
+          hstart = std::min(std::max(hstart + roi_start_h, 0), height);
+          hend = std::min(std::max(hend + roi_start_h, 0), height);
+          wstart = std::min(std::max(wstart + roi_start_w, 0), width);
+          wend = std::min(std::max(wend + roi_start_w, 0), width);
+          bool is_empty = (hend <= hstart) || (wend <= wstart);
+
+          // Define an empty pooling region to be zero
+          T maxval = is_empty ? 0 : -FLT_MAX;
+          // If nothing is pooled, argmax = -1 causes nothing to be backprop'd
+          int maxidx = -1;
+          for (int h = hstart; h < hend; ++h) {
+            for (int w = wstart; w < wend; ++w) {
+              int bottom_index = h * width + w;
+              if (offset_bottom_data[bottom_index] > maxval) {
+                maxval = offset_bottom_data[bottom_index];
+                maxidx = bottom_index;
+              }
+            }
+          }
+          int index = index_n_c_top + ph * pooled_width + pw;
+          top_data[index] = maxval;
+          argmax_data[index] = maxidx;
+        } // for pw
+      } // for ph
+    } // for n, c
+  });
+}
+
+template <typename T>
+void ROIPoolBackward_cpu_kernel(
+    const int n_rois,
+    const T* top_diff,
+    const int* argmax_data,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const T* bottom_rois,
+    T* bottom_diff) {
+  // split over the channels, so that the overlapping rois never write the
+  // same input gradient from two threads
+  at::parallel_for(0, channels, 1, [&](int64_t c_begin, int64_t c_end) {
+    for (int n = 0; n < n_rois; n++) {
+      int roi_batch_ind = bottom_rois[n * 5];
+      for (int64_t c = c_begin; c < c_end; c++) {
+        int top_offset = (n * channels + c) * pooled_height * pooled_width;
+        const T* offset_top_diff = top_diff + top_offset;
+        const int* offset_argmax_data = argmax_data + top_offset;
+        T* offset_bottom_diff =
+            bottom_diff + (roi_batch_ind * channels + c) * height * width;
+
+        for (int index = 0; index < pooled_height * pooled_width; index++) {
+          int argmax = offset_argmax_data[index];
+          if (argmax != -1) {
+            offset_bottom_diff[argmax] += offset_top_diff[index];
+          }
+        }
+      } // for c
+    } // for n
+  });
+}
+
+std::tuple<at::Tensor, at::Tensor> ROIPool_forward_cpu(const at::Tensor& input,
+                                                       const at::Tensor& rois,
+                                                       const float spatial_scale,
+                                                       const int pooled_height,
+                                                       const int pooled_width) {
+  AT_ASSERTM(!input.type().is_cuda(), "input must be a CPU tensor");
+  AT_ASSERTM(!rois.type().is_cuda(), "rois must be a CPU tensor");
+
+  auto num_rois = rois.size(0);
+  auto channels = input.size(1);
+  auto height = input.size(2);
+  auto width = input.size(3);
+
+  auto output = at::empty({num_rois, channels, pooled_height, pooled_width}, input.options());
+  auto argmax = at::zeros({num_rois, channels, pooled_height, pooled_width}, input.options().dtype(at::kInt));
+
+  if (output.numel() == 0) {
+    return std::make_tuple(output, argmax);
+  }
+
+  auto input_ = input.contiguous();
+  auto rois_ = rois.contiguous();
+  AT_DISPATCH_FLOATING_TYPES(input.type(), "ROIPool_forward", [&] {
+    ROIPoolForward_cpu_kernel<scalar_t>(
+         num_rois,
+         input_.data<scalar_t>(),
+         spatial_scale,
+         channels,
+         height,
+         width,
+         pooled_height,
+         pooled_width,
+         rois_.data<scalar_t>(),
+         output.data<scalar_t>(),
+         argmax.data<int>());
+  });
+  return std::make_tuple(output, argmax);
+}
+
+at::Tensor ROIPool_backward_cpu(const at::Tensor& grad,
+                                const at::Tensor& input,
+                                const at::Tensor& rois,
+                                const at::Tensor& argmax,
+                                const float spatial_scale,
+                                const int pooled_height,
+                                const int pooled_width,
+                                const int batch_size,
+                                const int channels,
+                                const int height,
+                                const int width) {
+  AT_ASSERTM(!grad.type().is_cuda(), "grad must be a CPU tensor");
+  AT_ASSERTM(!rois.type().is_cuda(), "rois must be a CPU tensor");
+
+  auto num_rois = rois.size(0);
+  auto grad_input = at::zeros({batch_size, channels, height, width}, grad.options());
+
+  // handle possibly empty gradients
+  if (grad.numel() == 0) {
+    return grad_input;
+  }
+
+  auto grad_ = grad.contiguous();
+  auto rois_ = rois.contiguous();
+  auto argmax_ = argmax.contiguous();
+  AT_DISPATCH_FLOATING_TYPES(grad.type(), "ROIPool_backward", [&] {
+    ROIPoolBackward_cpu_kernel<scalar_t>(
+         num_rois,
+         grad_.data<scalar_t>(),
+         argmax_.data<int>(),
+         channels,
+         height,
+         width,
+         pooled_height,
+         pooled_width,
+         rois_.data<scalar_t>(),
+         grad_input.data<scalar_t>());
+  });
+  return grad_input;
+}
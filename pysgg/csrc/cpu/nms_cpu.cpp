@@ -1,11 +1,96 @@
 // Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 #include "cpu/vision.h"
+#include <ATen/Parallel.h>
 
+#include <algorithm>
+#include <vector>
 
+// the suppression bits are computed for this many boxes at a time, so that
+// the sweep can stop early without computing the bits of the remaining boxes
+const int64_t kRowsPerChunk = 256;
+const int64_t kBitsPerBlock = 64;
+
+
+// greedy NMS of the boxes [seg_start, seg_end) sorted by decreasing score, which only
+// suppress each other, the kept ones are flagged in kept
+template <typename scalar_t>
+void nms_cpu_segment(const scalar_t* boxes,
+                     const scalar_t* areas,
+                     const int64_t seg_start,
+                     const int64_t seg_end,
+                     const float threshold,
+                     const int64_t max_output,
+                     uint8_t* kept) {
+  const int64_t ndets = seg_end - seg_start;
+  const int64_t col_blocks = (ndets + kBitsPerBlock - 1) / kBitsPerBlock;
+  const int64_t max_keep = max_output > 0 ? std::min(max_output, ndets) : ndets;
+  boxes += seg_start * 4;
+  areas += seg_start;
+
+  std::vector<uint64_t> removed(col_blocks, 0);
+  std::vector<uint64_t> mask(std::min(kRowsPerChunk, ndets) * col_blocks);
+  int64_t num_to_keep = 0;
+
+  for (int64_t row_start = 0; row_start < ndets && num_to_keep < max_keep; row_start += kRowsPerChunk) {
+    const int64_t row_end = std::min(row_start + kRowsPerChunk, ndets);
+
+    // the boxes each row of the chunk suppresses, rows suppressed by the previous chunks are skipped
+    at::parallel_for(row_start, row_end, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t i = begin; i < end; i++) {
+        if (removed[i / kBitsPerBlock] & (1ULL << (i % kBitsPerBlock)))
+          continue;
+        uint64_t* mask_row = &mask[(i - row_start) * col_blocks];
+        auto ix1 = boxes[i * 4];
+        auto iy1 = boxes[i * 4 + 1];
+        auto ix2 = boxes[i * 4 + 2];
+        auto iy2 = boxes[i * 4 + 3];
+        auto iarea = areas[i];
+
+        for (int64_t block = i / kBitsPerBlock; block < col_blocks; block++) {
+          uint64_t bits = 0;
+          const int64_t col_end = std::min((block + 1) * kBitsPerBlock, ndets);
+          for (int64_t j = std::max(block * kBitsPerBlock, i + 1); j < col_end; j++) {
+            auto xx1 = std::max(ix1, boxes[j * 4]);
+            auto yy1 = std::max(iy1, boxes[j * 4 + 1]);
+            auto xx2 = std::min(ix2, boxes[j * 4 + 2]);
+            auto yy2 = std::min(iy2, boxes[j * 4 + 3]);
+
+            auto w = std::max(static_cast<scalar_t>(0), xx2 - xx1 + 1);
+            auto h = std::max(static_cast<scalar_t>(0), yy2 - yy1 + 1);
+            auto inter = w * h;
+            auto ovr = inter / (iarea + areas[j] - inter);
+            if (ovr >= threshold)
+              bits |= 1ULL << (j % kBitsPerBlock);
+          }
+          mask_row[block] = bits;
+        }
+      }
+    });
+
+    // sweep the chunk by decreasing score
+    for (int64_t i = row_start; i < row_end; i++) {
+      if (removed[i / kBitsPerBlock] & (1ULL << (i % kBitsPerBlock)))
+        continue;
+      kept[seg_start + i] = 1;
+      if (++num_to_keep == max_keep)
+        break;
+      const uint64_t* mask_row = &mask[(i - row_start) * col_blocks];
+      for (int64_t block = i / kBitsPerBlock; block < col_blocks; block++) {
+        removed[block] |= mask_row[block];
+      }
+    }
+  }
+}
+
+
+// with idxs, the boxes are sorted by group then by decreasing score, and the NMS of each
+// group only compares the boxes of its own segment, max_output is then per group
 template <typename scalar_t>
 at::Tensor nms_cpu_kernel(const at::Tensor& dets,
                           const at::Tensor& scores,
-                          const float threshold) {
+                          const at::Tensor& idxs,
+                          const float threshold,
+                          const int64_t max_output) {
   AT_ASSERTM(!dets.type().is_cuda(), "dets must be a CPU tensor");
   AT_ASSERTM(!scores.type().is_cuda(), "scores must be a CPU tensor");
   AT_ASSERTM(dets.type() == scores.type(), "dets should have the same type as scores");
@@ -14,62 +99,82 @@ at::Tensor nms_cpu_kernel(const at::Tensor& dets,
     return at::empty({0}, dets.options().dtype(at::kLong).device(at::kCPU));
   }
 
-  auto x1_t = dets.select(1, 0).contiguous();
-  auto y1_t = dets.select(1, 1).contiguous();
-  auto x2_t = dets.select(1, 2).contiguous();
-  auto y2_t = dets.select(1, 3).contiguous();
+  const int64_t ndets = dets.size(0);
+  // boxes sorted by decreasing score, row i can only suppress the rows after it
+  auto order_t = std::get<1>(scores.sort(0, /* descending=*/true));
+  const bool grouped = idxs.numel() > 0;
+  // the start of each segment of boxes suppressing each other, and the end of the last one
+  std::vector<int64_t> seg_bounds = {0};
+  if (grouped) {
+    AT_ASSERTM(idxs.numel() == ndets, "idxs should have one group per box");
+    auto groups_t = idxs.to(at::kLong).index_select(0, order_t.to(idxs.device()));
+    // by group, then by the score order, the keys are unique so the sort needs not be stable
+    auto keys_t = groups_t * ndets + at::arange(ndets, groups_t.options());
+    auto group_order_t = std::get<1>(keys_t.sort(0, /* descending=*/false));
+    order_t = order_t.index_select(0, group_order_t);
+    groups_t = groups_t.index_select(0, group_order_t).contiguous();
+    const int64_t* groups = groups_t.data<int64_t>();
+    for (int64_t i = 1; i < ndets; i++) {
+      if (groups[i] != groups[i - 1])
+        seg_bounds.push_back(i);
+    }
+  }
+  seg_bounds.push_back(ndets);
+  const int64_t num_segments = seg_bounds.size() - 1;
 
-  at::Tensor areas_t = (x2_t - x1_t + 1) * (y2_t - y1_t + 1);
+  auto dets_t = dets.index_select(0, order_t).contiguous();
+  auto boxes = dets_t.data<scalar_t>();
+  std::vector<scalar_t> areas(ndets);
+  for (int64_t i = 0; i < ndets; i++) {
+    areas[i] = (boxes[i * 4 + 2] - boxes[i * 4] + 1) * (boxes[i * 4 + 3] - boxes[i * 4 + 1] + 1);
+  }
 
-  auto order_t = std::get<1>(scores.sort(0, /* descending=*/true));
+  std::vector<uint8_t> kept(ndets, 0);
+  if (num_segments == 1) {
+    // the rows of each chunk are processed in parallel
+    nms_cpu_segment<scalar_t>(boxes, areas.data(), 0, ndets, threshold, max_output, kept.data());
+  } else {
+    // the groups are processed in parallel, the parallel_for over the rows runs inline
+    at::parallel_for(0, num_segments, 1, [&](int64_t begin, int64_t end) {
+      for (int64_t seg = begin; seg < end; seg++) {
+        nms_cpu_segment<scalar_t>(boxes, areas.data(), seg_bounds[seg], seg_bounds[seg + 1],
+                                  threshold, max_output, kept.data());
+      }
+    });
+  }
 
-  auto ndets = dets.size(0);
-  at::Tensor suppressed_t = at::zeros({ndets}, dets.options().dtype(at::kByte).device(at::kCPU));
-
-  auto suppressed = suppressed_t.data<uint8_t>();
-  auto order = order_t.data<int64_t>();
-  auto x1 = x1_t.data<scalar_t>();
-  auto y1 = y1_t.data<scalar_t>();
-  auto x2 = x2_t.data<scalar_t>();
-  auto y2 = y2_t.data<scalar_t>();
-  auto areas = areas_t.data<scalar_t>();
-
-  for (int64_t _i = 0; _i < ndets; _i++) {
-    auto i = order[_i];
-    if (suppressed[i] == 1)
-      continue;
-    auto ix1 = x1[i];
-    auto iy1 = y1[i];
-    auto ix2 = x2[i];
-    auto iy2 = y2[i];
-    auto iarea = areas[i];
-
-    for (int64_t _j = _i + 1; _j < ndets; _j++) {
-      auto j = order[_j];
-      if (suppressed[j] == 1)
-        continue;
-      auto xx1 = std::max(ix1, x1[j]);
-      auto yy1 = std::max(iy1, y1[j]);
-      auto xx2 = std::min(ix2, x2[j]);
-      auto yy2 = std::min(iy2, y2[j]);
-
-      auto w = std::max(static_cast<scalar_t>(0), xx2 - xx1 + 1);
-      auto h = std::max(static_cast<scalar_t>(0), yy2 - yy1 + 1);
-      auto inter = w * h;
-      auto ovr = inter / (iarea + areas[j] - inter);
-      if (ovr >= threshold)
-        suppressed[j] = 1;
-   }
+  const int64_t num_to_keep = std::count(kept.begin(), kept.end(), 1);
+  at::Tensor keep_t = at::empty({num_to_keep}, dets.options().dtype(at::kLong).device(at::kCPU));
+  auto keep = keep_t.data<int64_t>();
+  for (int64_t i = 0, k = 0; i < ndets; i++) {
+    if (kept[i])
+      keep[k++] = i;
   }
-  return at::nonzero(suppressed_t == 0).squeeze(1);
+
+  // back to the indices of the boxes, in increasing order
+  return std::get<0>(order_t.index_select(0, keep_t).sort(0, /* descending=*/false));
 }
 
 at::Tensor nms_cpu(const at::Tensor& dets,
                const at::Tensor& scores,
-               const float threshold) {
+               const float threshold,
+               const int64_t max_output) {
   at::Tensor result;
+  at::Tensor no_groups = at::empty({0}, dets.options().dtype(at::kLong));
   AT_DISPATCH_FLOATING_TYPES(dets.type(), "nms", [&] {
-    result = nms_cpu_kernel<scalar_t>(dets, scores, threshold);
+    result = nms_cpu_kernel<scalar_t>(dets, scores, no_groups, threshold, max_output);
+  });
+  return result;
+}
+
+at::Tensor batched_nms_cpu(const at::Tensor& dets,
+                           const at::Tensor& scores,
+                           const at::Tensor& idxs,
+                           const float threshold,
+                           const int64_t max_output) {
+  at::Tensor result;
+  AT_DISPATCH_FLOATING_TYPES(dets.type(), "batched_nms", [&] {
+    result = nms_cpu_kernel<scalar_t>(dets, scores, idxs, threshold, max_output);
   });
   return result;
 }
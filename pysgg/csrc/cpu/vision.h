@@ -10,7 +10,67 @@ at::Tensor ROIAlign_forward_cpu(const at::Tensor& input,
                                 const int pooled_width,
                                 const int sampling_ratio);
 
+at::Tensor ROIAlign_backward_cpu(const at::Tensor& grad,
+                                 const at::Tensor& rois,
+                                 const float spatial_scale,
+                                 const int pooled_height,
+                                 const int pooled_width,
+                                 const int batch_size,
+                                 const int channels,
+                                 const int height,
+                                 const int width,
+                                 const int sampling_ratio);
+
+at::Tensor ROIAlign_multilevel_forward_cpu(const std::vector<at::Tensor>& inputs,
+                                           const at::Tensor& rois,
+                                           const at::Tensor& levels,
+                                           const std::vector<double>& spatial_scales,
+                                           const int pooled_height,
+                                           const int pooled_width,
+                                           const int sampling_ratio,
+                                           const bool cat_all_levels);
+
+std::vector<at::Tensor> ROIAlign_multilevel_backward_cpu(const at::Tensor& grad,
+                                                         const at::Tensor& rois,
+                                                         const at::Tensor& levels,
+                                                         const std::vector<double>& spatial_scales,
+                                                         const int pooled_height,
+                                                         const int pooled_width,
+                                                         const int batch_size,
+                                                         const int channels,
+                                                         const std::vector<int64_t>& heights,
+                                                         const std::vector<int64_t>& widths,
+                                                         const int sampling_ratio,
+                                                         const bool cat_all_levels);
+
+
+std::tuple<at::Tensor, at::Tensor> ROIPool_forward_cpu(const at::Tensor& input,
+                                                       const at::Tensor& rois,
+                                                       const float spatial_scale,
+                                                       const int pooled_height,
+                                                       const int pooled_width);
+
+at::Tensor ROIPool_backward_cpu(const at::Tensor& grad,
+                                const at::Tensor& input,
+                                const at::Tensor& rois,
+                                const at::Tensor& argmax,
+                                const float spatial_scale,
+                                const int pooled_height,
+                                const int pooled_width,
+                                const int batch_size,
+                                const int channels,
+                                const int height,
+                                const int width);
+
 
 at::Tensor nms_cpu(const at::Tensor& dets,
                    const at::Tensor& scores,
-                   const float threshold);
+                   const float threshold,
+                   const int64_t max_output);
+
+
+at::Tensor batched_nms_cpu(const at::Tensor& dets,
+                           const at::Tensor& scores,
+                           const at::Tensor& idxs,
+                           const float threshold,
+                           const int64_t max_output);
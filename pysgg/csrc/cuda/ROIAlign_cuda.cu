@@ -251,6 +251,174 @@ __global__ void RoIAlignBackwardFeature(const int nthreads, const T* top_diff,
   } // CUDA_1D_KERNEL_LOOP
 } // RoIAlignBackward
 
+// the feature maps of the levels are passed by value to the fused kernels
+const int kMaxLevels = 8;
+
+template <typename T>
+struct MultiLevelFeatures {
+  const T* data[kMaxLevels];
+  T* diff[kMaxLevels];
+  int heights[kMaxLevels];
+  int widths[kMaxLevels];
+  T spatial_scales[kMaxLevels];
+};
+
+// the rois of all the levels in one launch: the roi n is pooled from the level
+// levels[n], or from every level into consecutive blocks of channels when
+// levels is null (cat_all_levels)
+template <typename T>
+__global__ void RoIAlignMultiLevelForward(const int nthreads,
+    const MultiLevelFeatures<T> features,
+    const int num_levels, const int64_t* levels, const int channels,
+    const int pooled_height, const int pooled_width,
+    const int sampling_ratio,
+    const T* bottom_rois, T* top_data) {
+  CUDA_1D_KERNEL_LOOP(index, nthreads) {
+    // (n, c, ph, pw) is an element in the pooled output
+    int pw = index % pooled_width;
+    int ph = (index / pooled_width) % pooled_height;
+    int n = index / pooled_width / pooled_height;
+    int c, level;
+    if (levels != nullptr) {
+      c = n % channels;
+      n = n / channels;
+      level = levels[n];
+    } else {
+      c = n % channels;
+      level = (n / channels) % num_levels;
+      n = n / channels / num_levels;
+    }
+
+    const T spatial_scale = features.spatial_scales[level];
+    const int height = features.heights[level];
+    const int width = features.widths[level];
+    const T* offset_bottom_rois = bottom_rois + n * 5;
+    int roi_batch_ind = offset_bottom_rois[0];
+
+    // Do not using rounding; this implementation detail is critical
+    T roi_start_w = offset_bottom_rois[1] * spatial_scale;
+    T roi_start_h = offset_bottom_rois[2] * spatial_scale;
+    T roi_end_w = offset_bottom_rois[3] * spatial_scale;
+    T roi_end_h = offset_bottom_rois[4] * spatial_scale;
+
+    // Force malformed ROIs to be 1x1
+    T roi_width = max(roi_end_w - roi_start_w, (T)1.);
+    T roi_height = max(roi_end_h - roi_start_h, (T)1.);
+    T bin_size_h = static_cast<T>(roi_height) / static_cast<T>(pooled_height);
+    T bin_size_w = static_cast<T>(roi_width) / static_cast<T>(pooled_width);
+
+    const T* offset_bottom_data = features.data[level] + (roi_batch_ind * channels + c) * height * width;
+
+    // We use roi_bin_grid to sample the grid and mimic integral
+    int roi_bin_grid_h = (sampling_ratio > 0) ? sampling_ratio : ceil(roi_height / pooled_height); // e.g., = 2
+    int roi_bin_grid_w = (sampling_ratio > 0) ? sampling_ratio : ceil(roi_width / pooled_width);
+
+    // We do average (integral) pooling inside a bin
+    const T count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
+
+    T output_val = 0.;
+    for (int iy = 0; iy < roi_bin_grid_h; iy ++) // e.g., iy = 0, 1
+    {
+      const T y = roi_start_h + ph * bin_size_h + static_cast<T>(iy + .5f) * bin_size_h / static_cast<T>(roi_bin_grid_h); // e.g., 0.5, 1.5
+      for (int ix = 0; ix < roi_bin_grid_w; ix ++)
+      {
+        const T x = roi_start_w + pw * bin_size_w + static_cast<T>(ix + .5f) * bin_size_w / static_cast<T>(roi_bin_grid_w);
+
+        T val = bilinear_interpolate(offset_bottom_data, height, width, y, x, index);
+        output_val += val;
+      }
+    }
+    output_val /= count;
+
+    top_data[index] = output_val;
+  }
+}
+
+
+template <typename T>
+__global__ void RoIAlignMultiLevelBackwardFeature(const int nthreads, const T* top_diff,
+    const MultiLevelFeatures<T> features,
+    const int num_levels, const int64_t* levels, const int channels,
+    const int pooled_height, const int pooled_width,
+    const int sampling_ratio,
+    const T* bottom_rois) {
+  CUDA_1D_KERNEL_LOOP(index, nthreads) {
+    // (n, c, ph, pw) is an element in the pooled output
+    int pw = index % pooled_width;
+    int ph = (index / pooled_width) % pooled_height;
+    int n = index / pooled_width / pooled_height;
+    int c, level;
+    if (levels != nullptr) {
+      c = n % channels;
+      n = n / channels;
+      level = levels[n];
+    } else {
+      c = n % channels;
+      level = (n / channels) % num_levels;
+      n = n / channels / num_levels;
+    }
+
+    const T spatial_scale = features.spatial_scales[level];
+    const int height = features.heights[level];
+    const int width = features.widths[level];
+    const T* offset_bottom_rois = bottom_rois + n * 5;
+    int roi_batch_ind = offset_bottom_rois[0];
+
+    // Do not using rounding; this implementation detail is critical
+    T roi_start_w = offset_bottom_rois[1] * spatial_scale;
+    T roi_start_h = offset_bottom_rois[2] * spatial_scale;
+    T roi_end_w = offset_bottom_rois[3] * spatial_scale;
+    T roi_end_h = offset_bottom_rois[4] * spatial_scale;
+
+    // Force malformed ROIs to be 1x1
+    T roi_width = max(roi_end_w - roi_start_w, (T)1.);
+    T roi_height = max(roi_end_h - roi_start_h, (T)1.);
+    T bin_size_h = static_cast<T>(roi_height) / static_cast<T>(pooled_height);
+    T bin_size_w = static_cast<T>(roi_width) / static_cast<T>(pooled_width);
+
+    T* offset_bottom_diff = features.diff[level] + (roi_batch_ind * channels + c) * height * width;
+
+    const T top_diff_this_bin = top_diff[index];
+
+    // We use roi_bin_grid to sample the grid and mimic integral
+    int roi_bin_grid_h = (sampling_ratio > 0) ? sampling_ratio : ceil(roi_height / pooled_height); // e.g., = 2
+    int roi_bin_grid_w = (sampling_ratio > 0) ? sampling_ratio : ceil(roi_width / pooled_width);
+
+    // We do average (integral) pooling inside a bin
+    const T count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
+
+    for (int iy = 0; iy < roi_bin_grid_h; iy ++) // e.g., iy = 0, 1
+    {
+      const T y = roi_start_h + ph * bin_size_h + static_cast<T>(iy + .5f) * bin_size_h / static_cast<T>(roi_bin_grid_h); // e.g., 0.5, 1.5
+      for (int ix = 0; ix < roi_bin_grid_w; ix ++)
+      {
+        const T x = roi_start_w + pw * bin_size_w + static_cast<T>(ix + .5f) * bin_size_w / static_cast<T>(roi_bin_grid_w);
+
+        T w1, w2, w3, w4;
+        int x_low, x_high, y_low, y_high;
+
+        bilinear_interpolate_gradient(height, width, y, x,
+            w1, w2, w3, w4,
+            x_low, x_high, y_low, y_high,
+            index);
+
+        T g1 = top_diff_this_bin * w1 / count;
+        T g2 = top_diff_this_bin * w2 / count;
+        T g3 = top_diff_this_bin * w3 / count;
+        T g4 = top_diff_this_bin * w4 / count;
+
+        if (x_low >= 0 && x_high >= 0 && y_low >= 0 && y_high >= 0)
+        {
+          atomicAdd(offset_bottom_diff + y_low * width + x_low, static_cast<T>(g1));
+          atomicAdd(offset_bottom_diff + y_low * width + x_high, static_cast<T>(g2));
+          atomicAdd(offset_bottom_diff + y_high * width + x_low, static_cast<T>(g3));
+          atomicAdd(offset_bottom_diff + y_high * width + x_high, static_cast<T>(g4));
+        } // if
+      } // ix
+    } // iy
+  } // CUDA_1D_KERNEL_LOOP
+} // RoIAlignMultiLevelBackward
+
 
 at::Tensor ROIAlign_forward_cuda(const at::Tensor& input,
                                  const at::Tensor& rois,
@@ -342,3 +510,131 @@ at::Tensor ROIAlign_backward_cuda(const at::Tensor& grad,
   C10_CUDA_CHECK(cudaGetLastError());
   return grad_input;
 }
+
+
+at::Tensor ROIAlign_multilevel_forward_cuda(const std::vector<at::Tensor>& inputs,
+                                            const at::Tensor& rois,
+                                            const at::Tensor& levels,
+                                            const std::vector<double>& spatial_scales,
+                                            const int pooled_height,
+                                            const int pooled_width,
+                                            const int sampling_ratio,
+                                            const bool cat_all_levels) {
+  AT_ASSERTM(inputs.size() > 0 && inputs.size() <= kMaxLevels, "inputs should have between 1 and 8 levels");
+  AT_ASSERTM(inputs.size() == spatial_scales.size(), "inputs should have one spatial scale per level");
+  AT_ASSERTM(rois.type().is_cuda(), "rois must be a CUDA tensor");
+  AT_ASSERTM(cat_all_levels || levels.numel() == rois.size(0), "levels should have one level per roi");
+
+  const int num_levels = inputs.size();
+  auto num_rois = rois.size(0);
+  auto channels = inputs[0].size(1);
+  auto out_channels = cat_all_levels ? channels * num_levels : channels;
+
+  auto output = at::empty({num_rois, out_channels, pooled_height, pooled_width}, inputs[0].options());
+  auto output_size = output.numel();
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+  dim3 grid(std::min(at::ceil_div((long)output_size, 512L), 4096L));
+  dim3 block(512);
+
+  if (output.numel() == 0) {
+    C10_CUDA_CHECK(cudaGetLastError());
+    return output;
+  }
+
+  std::vector<at::Tensor> inputs_;
+  for (const auto& input : inputs) {
+    AT_ASSERTM(input.type().is_cuda(), "input must be a CUDA tensor");
+    AT_ASSERTM(input.size(1) == channels, "the levels should have the same number of channels");
+    inputs_.push_back(input.contiguous());
+  }
+  auto rois_ = rois.contiguous();
+  auto levels_ = levels.to(at::kLong).contiguous();
+  AT_DISPATCH_FLOATING_TYPES(inputs[0].type(), "ROIAlign_multilevel_forward", [&] {
+    MultiLevelFeatures<scalar_t> features;
+    for (int level = 0; level < num_levels; level++) {
+      features.data[level] = inputs_[level].data<scalar_t>();
+      features.diff[level] = nullptr;
+      features.heights[level] = inputs_[level].size(2);
+      features.widths[level] = inputs_[level].size(3);
+      // through float, as the spatial scale of ROIAlign_forward_cuda
+      features.spatial_scales[level] = static_cast<float>(spatial_scales[level]);
+    }
+    RoIAlignMultiLevelForward<scalar_t><<<grid, block, 0, stream>>>(
+         output_size,
+         features,
+         num_levels,
+         cat_all_levels ? nullptr : levels_.data<int64_t>(),
+         channels,
+         pooled_height,
+         pooled_width,
+         sampling_ratio,
+         rois_.data<scalar_t>(),
+         output.data<scalar_t>());
+  });
+  C10_CUDA_CHECK(cudaGetLastError());
+  return output;
+}
+
+std::vector<at::Tensor> ROIAlign_multilevel_backward_cuda(const at::Tensor& grad,
+                                                          const at::Tensor& rois,
+                                                          const at::Tensor& levels,
+                                                          const std::vector<double>& spatial_scales,
+                                                          const int pooled_height,
+                                                          const int pooled_width,
+                                                          const int batch_size,
+                                                          const int channels,
+                                                          const std::vector<int64_t>& heights,
+                                                          const std::vector<int64_t>& widths,
+                                                          const int sampling_ratio,
+                                                          const bool cat_all_levels) {
+  AT_ASSERTM(grad.type().is_cuda(), "grad must be a CUDA tensor");
+  AT_ASSERTM(rois.type().is_cuda(), "rois must be a CUDA tensor");
+  AT_ASSERTM(spatial_scales.size() > 0 && spatial_scales.size() <= kMaxLevels, "between 1 and 8 levels are supported");
+  AT_ASSERTM(heights.size() == spatial_scales.size() && widths.size() == spatial_scales.size(),
+             "heights and widths should have one size per level");
+
+  const int num_levels = spatial_scales.size();
+  std::vector<at::Tensor> grad_inputs;
+  for (int level = 0; level < num_levels; level++) {
+    grad_inputs.push_back(at::zeros({batch_size, channels, heights[level], widths[level]}, grad.options()));
+  }
+
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+  dim3 grid(std::min(at::ceil_div((long)grad.numel(), 512L), 4096L));
+  dim3 block(512);
+
+  // handle possibly empty gradients
+  if (grad.numel() == 0) {
+    C10_CUDA_CHECK(cudaGetLastError());
+    return grad_inputs;
+  }
+
+  auto grad_ = grad.contiguous();
+  auto rois_ = rois.contiguous();
+  auto levels_ = levels.to(at::kLong).contiguous();
+  AT_DISPATCH_FLOATING_TYPES(grad.type(), "ROIAlign_multilevel_backward", [&] {
+    MultiLevelFeatures<scalar_t> features;
+    for (int level = 0; level < num_levels; level++) {
+      features.data[level] = nullptr;
+      features.diff[level] = grad_inputs[level].data<scalar_t>();
+      features.heights[level] = heights[level];
+      features.widths[level] = widths[level];
+      features.spatial_scales[level] = static_cast<float>(spatial_scales[level]);
+    }
+    RoIAlignMultiLevelBackwardFeature<scalar_t><<<grid, block, 0, stream>>>(
+         grad.numel(),
+         grad_.data<scalar_t>(),
+         features,
+         num_levels,
+         cat_all_levels ? nullptr : levels_.data<int64_t>(),
+         channels,
+         pooled_height,
+         pooled_width,
+         sampling_ratio,
+         rois_.data<scalar_t>());
+  });
+  C10_CUDA_CHECK(cudaGetLastError());
+  return grad_inputs;
+}
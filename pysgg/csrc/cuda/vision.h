@@ -36,6 +36,28 @@ at::Tensor ROIAlign_backward_cuda(const at::Tensor& grad,
                                   const int width,
                                   const int sampling_ratio);
 
+at::Tensor ROIAlign_multilevel_forward_cuda(const std::vector<at::Tensor>& inputs,
+                                            const at::Tensor& rois,
+                                            const at::Tensor& levels,
+                                            const std::vector<double>& spatial_scales,
+                                            const int pooled_height,
+                                            const int pooled_width,
+                                            const int sampling_ratio,
+                                            const bool cat_all_levels);
+
+std::vector<at::Tensor> ROIAlign_multilevel_backward_cuda(const at::Tensor& grad,
+                                                          const at::Tensor& rois,
+                                                          const at::Tensor& levels,
+                                                          const std::vector<double>& spatial_scales,
+                                                          const int pooled_height,
+                                                          const int pooled_width,
+                                                          const int batch_size,
+                                                          const int channels,
+                                                          const std::vector<int64_t>& heights,
+                                                          const std::vector<int64_t>& widths,
+                                                          const int sampling_ratio,
+                                                          const bool cat_all_levels);
+
 
 std::tuple<at::Tensor, at::Tensor> ROIPool_forward_cuda(const at::Tensor& input,
                                 const at::Tensor& rois,
@@ -55,7 +77,7 @@ at::Tensor ROIPool_backward_cuda(const at::Tensor& grad,
                                  const int height,
                                  const int width);
 
-at::Tensor nms_cuda(const at::Tensor boxes, float nms_overlap_thresh);
+at::Tensor nms_cuda(const at::Tensor boxes, float nms_overlap_thresh, const int64_t max_output);
 
 
 int deform_conv_forward_cuda(at::Tensor input, at::Tensor weight,
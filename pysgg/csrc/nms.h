@@ -7,9 +7,12 @@
 #endif
 
 
+// max_output > 0 keeps only the max_output kept boxes of highest score,
+// the kept indices are returned in increasing order
 at::Tensor nms(const at::Tensor& dets,
                const at::Tensor& scores,
-               const float threshold) {
+               const float threshold,
+               const int64_t max_output) {
 
   if (dets.type().is_cuda()) {
 #ifdef WITH_CUDA
@@ -17,12 +20,25 @@ at::Tensor nms(const at::Tensor& dets,
     if (dets.numel() == 0)
       return at::empty({0}, dets.options().dtype(at::kLong).device(at::kCPU));
     auto b = at::cat({dets, scores.unsqueeze(1)}, 1);
-    return nms_cuda(b, threshold);
+    return nms_cuda(b, threshold, max_output);
 #else
     AT_ERROR("Not compiled with GPU support");
 #endif
   }
 
-  at::Tensor result = nms_cpu(dets, scores, threshold);
+  at::Tensor result = nms_cpu(dets, scores, threshold, max_output);
   return result;
 }
+
+// boxes of different idxs never suppress each other, max_output > 0 keeps only
+// the max_output kept boxes of highest score of each group
+at::Tensor batched_nms(const at::Tensor& dets,
+                       const at::Tensor& scores,
+                       const at::Tensor& idxs,
+                       const float threshold,
+                       const int64_t max_output) {
+  if (dets.type().is_cuda()) {
+    AT_ERROR("batched_nms is only implemented on the CPU");
+  }
+  return batched_nms_cpu(dets, scores, idxs, threshold, max_output);
+}
@@ -7,9 +7,14 @@
 #include "deform_pool.h"
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
-  m.def("nms", &nms, "non-maximum suppression");
+  m.def("nms", &nms, "non-maximum suppression",
+        py::arg("dets"), py::arg("scores"), py::arg("threshold"), py::arg("max_output") = -1);
+  m.def("batched_nms", &batched_nms, "non-maximum suppression of each group of boxes",
+        py::arg("dets"), py::arg("scores"), py::arg("idxs"), py::arg("threshold"), py::arg("max_output") = -1);
   m.def("roi_align_forward", &ROIAlign_forward, "ROIAlign_forward");
   m.def("roi_align_backward", &ROIAlign_backward, "ROIAlign_backward");
+  m.def("roi_align_multilevel_forward", &ROIAlign_multilevel_forward, "ROIAlign_multilevel_forward");
+  m.def("roi_align_multilevel_backward", &ROIAlign_multilevel_backward, "ROIAlign_multilevel_backward");
   m.def("roi_pool_forward", &ROIPool_forward, "ROIPool_forward");
   m.def("roi_pool_backward", &ROIPool_backward, "ROIPool_backward");
   m.def("sigmoid_focalloss_forward", &SigmoidFocalLoss_forward, "SigmoidFocalLoss_forward");
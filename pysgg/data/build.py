@@ -38,7 +38,8 @@ def get_dataset_statistics(cfg):
     DatasetCatalog = paths_catalog.DatasetCatalog
     dataset_names = cfg.DATASETS.TRAIN
 
-    data_statistics_name = ''.join(dataset_names) + '_statistics'
+    sparse = cfg.MODEL.ROI_RELATION_HEAD.SPARSE_FREQUENCY_BIAS
+    data_statistics_name = ''.join(dataset_names) + ('_sparse_statistics' if sparse else '_statistics')
     save_file = os.path.join(cfg.OUTPUT_DIR, "{}.cache".format(data_statistics_name))
 
     if os.path.exists(save_file):
@@ -54,7 +55,7 @@ def get_dataset_statistics(cfg):
         dataset = factory(**args)
         if "VG_stanford" in dataset_name:
             get_dataset_distribution(dataset, dataset_name)
-        statistics.append(dataset.get_statistics())
+        statistics.append(dataset.get_statistics(sparse=sparse))
     logger.info('finish')
 
     assert len(statistics) == 1
@@ -65,6 +66,8 @@ def get_dataset_statistics(cfg):
         'rel_classes': statistics[0]['rel_classes'],
         'att_classes': statistics[0]['att_classes'],
     }
+    if sparse:
+        result['pred_dist_default'] = statistics[0]['pred_dist_default']
     logger.info('Save data statistics to: ' + str(save_file))
     logger.info('-' * 100)
     torch.save(result, save_file)
@@ -137,7 +140,7 @@ def get_dataset_distribution(train_data, dataset_name):
     synchronize()
 
 
-def build_dataset(cfg, dataset_list, transforms, dataset_catalog, is_train=True):
+def build_dataset(cfg, dataset_list, transforms, dataset_catalog, is_train=True, targets_only=False):
     """
     Arguments:
         dataset_list (list[str]): Contains the names of the datasets, i.e.,
@@ -146,6 +149,7 @@ def build_dataset(cfg, dataset_list, transforms, dataset_catalog, is_train=True)
         dataset_catalog (DatasetCatalog): contains the information on how to
             construct a dataset.
         is_train (bool): whether to setup the dataset for training or testing
+        targets_only (bool): the relation datasets do not load the images
     """
     if not isinstance(dataset_list, (list, tuple)):
         raise RuntimeError(
@@ -163,6 +167,8 @@ def build_dataset(cfg, dataset_list, transforms, dataset_catalog, is_train=True)
         if data["factory"] == "PascalVOCDataset":
             args["use_difficult"] = not is_train
         args["transforms"] = transforms
+        if targets_only:
+            args["targets_only"] = True
         # make dataset from factory
         # print("build dataset with args:")
         # pprint(args)
@@ -285,8 +291,13 @@ def make_data_loader(cfg, mode='train', is_distributed=False, start_iter=0):
         dataset_list = cfg.DATASETS.TEST
 
     # If bbox aug is enabled in testing, simply set transforms to None and we will apply transforms later
-    transforms = None if not is_train and cfg.TEST.BBOX_AUG.ENABLED else build_transforms(cfg, is_train)
-    datasets = build_dataset(cfg, dataset_list, transforms, DatasetCatalog, is_train)
+    # the features of the feature store are extracted with the test transforms, the boxes given
+    # with them should not be augmented either, and the images are not needed
+    targets_only = cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED
+    train_transforms = is_train and not targets_only
+    transforms = None if not is_train and cfg.TEST.BBOX_AUG.ENABLED else \
+        build_transforms(cfg, train_transforms, targets_only)
+    datasets = build_dataset(cfg, dataset_list, transforms, DatasetCatalog, is_train, targets_only)
 
     if is_train:
         # save category_id to label name mapping
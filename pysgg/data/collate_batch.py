@@ -14,7 +14,10 @@ class BatchCollator(object):
 
     def __call__(self, batch):
         transposed_batch = list(zip(*batch))
-        images = to_image_list(transposed_batch[0], self.size_divisible)
+        images = None
+        # the datasets in targets only mode give no image
+        if transposed_batch[0][0] is not None:
+            images = to_image_list(transposed_batch[0], self.size_divisible)
         targets = transposed_batch[1]
         img_ids = transposed_batch[2]
         return images, targets, img_ids
@@ -13,7 +13,7 @@ import matplotlib.pyplot as plt
 
 from pysgg.config import cfg
 from pysgg.data.datasets.visual_genome import resampling_dict_generation, get_VG_statistics, \
-    apply_resampling
+    pred_dist_statistics, apply_resampling
 from pysgg.structures.bounding_box import BoxList
 from pysgg.structures.boxlist_ops import split_boxlist, cat_boxlist
 from pysgg.utils.comm import get_rank, synchronize
@@ -119,7 +119,8 @@ def load_annotations(annotation_file, img_dir, num_img, split,
 class OIDataset(torch.utils.data.Dataset):
 
     def __init__(self, split, img_dir, ann_file, cate_info_file, transforms=None,
-                 num_im=-1, check_img_file=False, filter_duplicate_rels=True,  flip_aug=False):
+                 num_im=-1, check_img_file=False, filter_duplicate_rels=True,  flip_aug=False,
+                 targets_only=False):
         """
         Torch dataset for VisualGenome
         Parameters:
@@ -134,6 +135,9 @@ class OIDataset(torch.utils.data.Dataset):
             num_im: Number of images in the entire dataset. -1 for all images.
             num_val_im: Number of images in the validation set (must be less than num_im
                unless num_im is -1.)
+            targets_only: the images are not loaded, None is given in place of them and the
+               transforms only change the targets, e.g. when the relation head reads the
+               image features from the feature store
         """
         # for debug
         if cfg.DEBUG:
@@ -150,6 +154,7 @@ class OIDataset(torch.utils.data.Dataset):
         self.annotation_file = ann_file
         self.filter_duplicate_rels = filter_duplicate_rels and self.split == 'train'
         self.transforms = transforms
+        self.targets_only = targets_only
         self.repeat_dict = None
         self.check_img_file = check_img_file
         self.remove_tail_classes = False
@@ -216,10 +221,13 @@ class OIDataset(torch.utils.data.Dataset):
         if self.repeat_dict is not None:
             index = self.idx_list[index]
 
-        img = Image.open(self.filenames[index]).convert("RGB")
-        if img.size[0] != self.img_info[index]['width'] or img.size[1] != self.img_info[index]['height']:
-            print('=' * 20, ' ERROR index ', str(index), ' ', str(img.size), ' ', str(self.img_info[index]['width']),
-                  ' ', str(self.img_info[index]['height']), ' ', '=' * 20)
+        img_size = (self.img_info[index]['width'], self.img_info[index]['height'])
+        img = None
+        if not self.targets_only:
+            img = Image.open(self.filenames[index]).convert("RGB")
+            if img.size != img_size:
+                print('=' * 20, ' ERROR index ', str(index), ' ', str(img.size), ' ', str(img_size[0]),
+                      ' ', str(img_size[1]), ' ', '=' * 20)
 
         flip_img = False
 
@@ -231,7 +239,7 @@ class OIDataset(torch.utils.data.Dataset):
             pre_comp_result = self.pre_compute_bbox[int(
                 self.img_info[index]['image_id'])]
             boxes_arr = torch.as_tensor(pre_comp_result['bbox']).reshape(-1, 4)
-            pre_compute_boxlist = BoxList(boxes_arr, img.size, mode='xyxy')
+            pre_compute_boxlist = BoxList(boxes_arr, img_size, mode='xyxy')
             pre_compute_boxlist.add_field(
                 "pred_scores", torch.as_tensor(pre_comp_result['scores']))
             pre_compute_boxlist.add_field(
@@ -256,21 +264,16 @@ class OIDataset(torch.utils.data.Dataset):
 
         return img, target, index
 
-    def get_statistics(self):
+    def get_statistics(self, sparse=False):
         fg_matrix, bg_matrix, rel_counter_init = get_VG_statistics(self,
-                                                 must_overlap=True)
-        eps = 1e-3
-        bg_matrix += 1
-        fg_matrix[:, :, 0] = bg_matrix
-        pred_dist = fg_matrix / fg_matrix.sum(2)[:, :, None] + eps
-
-        result = {
-            'fg_matrix': torch.from_numpy(fg_matrix),
-            'pred_dist': torch.from_numpy(pred_dist).float(),
+                                                 must_overlap=True, sparse=sparse)
+        result = pred_dist_statistics(fg_matrix, bg_matrix, len(self.ind_to_classes),
+                                      len(self.ind_to_predicates))
+        result.update({
             'obj_classes': self.ind_to_classes,
             'rel_classes': self.ind_to_predicates,
             'att_classes': [],
-        }
+        })
 
         rel_counter = Counter()
 
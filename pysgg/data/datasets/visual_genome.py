@@ -45,7 +45,7 @@ class VGDataset(torch.utils.data.Dataset):
 
     def __init__(self, split, img_dir, roidb_file, dict_file, image_file, transforms=None,
                  filter_empty_rels=True, num_im=-1, num_val_im=5000, check_img_file=False,
-                 filter_duplicate_rels=True, filter_non_overlap=True, flip_aug=False):
+                 filter_duplicate_rels=True, filter_non_overlap=True, flip_aug=False, targets_only=False):
         """
         Torch dataset for VisualGenome
         Parameters:
@@ -60,6 +60,9 @@ class VGDataset(torch.utils.data.Dataset):
             num_im: Number of images in the entire dataset. -1 for all images.
             num_val_im: Number of images in the validation set (must be less than num_im
                unless num_im is -1.)
+            targets_only: the images are not loaded, None is given in place of them and the
+               transforms only change the targets, e.g. when the relation head reads the
+               image features from the feature store
         """
         # for debug
         if cfg.DEBUG:
@@ -79,6 +82,7 @@ class VGDataset(torch.utils.data.Dataset):
         self.filter_non_overlap = filter_non_overlap and self.split == 'train'
         self.filter_duplicate_rels = filter_duplicate_rels and self.split == 'train'
         self.transforms = transforms
+        self.targets_only = targets_only
         self.repeat_dict = None
         self.check_img_file = check_img_file
         # self.remove_tail_classes = False
@@ -153,10 +157,13 @@ class VGDataset(torch.utils.data.Dataset):
         if self.repeat_dict is not None:
             index = self.idx_list[index]
 
-        img = Image.open(self.filenames[index]).convert("RGB")
-        if img.size[0] != self.img_info[index]['width'] or img.size[1] != self.img_info[index]['height']:
-            print('=' * 20, ' ERROR index ', str(index), ' ', str(img.size), ' ', str(self.img_info[index]['width']),
-                  ' ', str(self.img_info[index]['height']), ' ', '=' * 20)
+        img_size = (self.img_info[index]['width'], self.img_info[index]['height'])
+        img = None
+        if not self.targets_only:
+            img = Image.open(self.filenames[index]).convert("RGB")
+            if img.size != img_size:
+                print('=' * 20, ' ERROR index ', str(index), ' ', str(img.size), ' ', str(img_size[0]),
+                      ' ', str(img_size[1]), ' ', '=' * 20)
 
         target = self.get_groundtruth(index, flip_img=False)
         # todo add pre-compute boxes
@@ -166,7 +173,7 @@ class VGDataset(torch.utils.data.Dataset):
             pre_comp_result = self.pre_compute_bbox[int(
                 self.img_info[index]['image_id'])]
             boxes_arr = torch.as_tensor(pre_comp_result['bbox']).reshape(-1, 4)
-            pre_compute_boxlist = BoxList(boxes_arr, img.size, mode='xyxy')
+            pre_compute_boxlist = BoxList(boxes_arr, img_size, mode='xyxy')
             pre_compute_boxlist.add_field(
                 "pred_scores", torch.as_tensor(pre_comp_result['scores']))
             pre_compute_boxlist.add_field(
@@ -190,21 +197,16 @@ class VGDataset(torch.utils.data.Dataset):
 
         return img, target, index
 
-    def get_statistics(self):
+    def get_statistics(self, sparse=False):
         fg_matrix, bg_matrix, rel_counter_init = get_VG_statistics(self,
-                                                 must_overlap=True)
-        eps = 1e-3
-        bg_matrix += 1
-        fg_matrix[:, :, 0] = bg_matrix
-        pred_dist = fg_matrix / fg_matrix.sum(2)[:, :, None] + eps
-
-        result = {
-            'fg_matrix': torch.from_numpy(fg_matrix),
-            'pred_dist': torch.from_numpy(pred_dist).float(),
+                                                 must_overlap=True, sparse=sparse)
+        result = pred_dist_statistics(fg_matrix, bg_matrix, len(self.ind_to_classes),
+                                      len(self.ind_to_predicates))
+        result.update({
             'obj_classes': self.ind_to_classes,
             'rel_classes': self.ind_to_predicates,
             'att_classes': self.ind_to_attributes,
-        }
+        })
 
         rel_counter = Counter()
 
@@ -355,12 +357,14 @@ class VGDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.idx_list)
 
-def get_VG_statistics(train_data, must_overlap=True):
+def get_VG_statistics(train_data, must_overlap=True, sparse=False):
     """save the initial data distribution for the frequency bias model
 
     Args:
         train_data ([type]): the self
         must_overlap (bool, optional): [description]. Defaults to True.
+        sparse (bool, optional): count the foreground of the observed triplets only,
+            instead of the dense (num_obj, num_obj, num_rel) matrix. Defaults to False.
 
     Returns:
         [type]: [description]
@@ -368,8 +372,11 @@ def get_VG_statistics(train_data, must_overlap=True):
 
     num_obj_classes = len(train_data.ind_to_classes)
     num_rel_classes = len(train_data.ind_to_predicates)
-    fg_matrix = np.zeros((num_obj_classes, num_obj_classes,
-                          num_rel_classes), dtype=np.int64)
+    if sparse:
+        fg_keys = []
+    else:
+        fg_matrix = np.zeros((num_obj_classes, num_obj_classes,
+                              num_rel_classes), dtype=np.int64)
     bg_matrix = np.zeros((num_obj_classes, num_obj_classes), dtype=np.int64)
     rel_counter = Counter()
     for ex_ind in tqdm(range(len(train_data.img_info))):
@@ -379,17 +386,72 @@ def get_VG_statistics(train_data, must_overlap=True):
 
         # For the foreground, we'll just look at everything
         o1o2 = gt_classes[gt_relations[:, :2]]
-        for (o1, o2), gtr in zip(o1o2, gt_relations[:, 2]):
-            fg_matrix[o1, o2, gtr] += 1
-            rel_counter[gtr] += 1
+        if sparse:
+            o1o2 = o1o2.astype(np.int64)
+            fg_keys.append((o1o2[:, 0] * num_obj_classes + o1o2[:, 1]) * num_rel_classes + gt_relations[:, 2])
+            rel_counter.update(gt_relations[:, 2])
+        else:
+            for (o1, o2), gtr in zip(o1o2, gt_relations[:, 2]):
+                fg_matrix[o1, o2, gtr] += 1
+                rel_counter[gtr] += 1
         # For the background, get all of the things that overlap.
         o1o2_total = gt_classes[np.array(
             box_filter(gt_boxes, must_overlap=must_overlap), dtype=int)]
         for (o1, o2) in o1o2_total:
             bg_matrix[o1, o2] += 1
 
+    if sparse:
+        # (subject * num_obj + object) * num_rel + predicate of each observed triplet, and its count
+        fg_keys = np.concatenate(fg_keys) if len(fg_keys) > 0 else np.zeros(0, dtype=np.int64)
+        fg_matrix = np.unique(fg_keys, return_counts=True)
+
     return fg_matrix, bg_matrix, rel_counter
 
+
+def pred_dist_statistics(fg_matrix, bg_matrix, num_obj_classes, num_rel_classes, eps=1e-3):
+    """the predicate distribution of each subject-object class pair for the frequency bias,
+    with the background counted as the predicate 0
+
+    Args:
+        fg_matrix: the foreground counts of get_VG_statistics, dense or sparse
+        bg_matrix (np.ndarray): the (num_obj, num_obj) background counts
+
+    Returns:
+        dict: 'fg_matrix' and 'pred_dist' of shape (num_obj, num_obj, num_rel). For the sparse counts,
+            both are sparse tensors holding the pairs with foreground relations only, the other pairs
+            all have the distribution 'pred_dist_default'
+    """
+    bg_matrix = bg_matrix + 1
+    if not isinstance(fg_matrix, tuple):
+        fg_matrix[:, :, 0] = bg_matrix
+        pred_dist = fg_matrix / fg_matrix.sum(2)[:, :, None] + eps
+        return {
+            'fg_matrix': torch.from_numpy(fg_matrix),
+            'pred_dist': torch.from_numpy(pred_dist).float(),
+        }
+
+    fg_keys, fg_counts = fg_matrix
+    pair_keys, pair_row = np.unique(fg_keys // num_rel_classes, return_inverse=True)
+    sub_cls, obj_cls = pair_keys // num_obj_classes, pair_keys % num_obj_classes
+    fg_rows = np.zeros((len(pair_keys), num_rel_classes), dtype=np.int64)
+    fg_rows[pair_row, fg_keys % num_rel_classes] = fg_counts
+    fg_rows[:, 0] = bg_matrix[sub_cls, obj_cls]
+    pred_rows = fg_rows / fg_rows.sum(1)[:, None] + eps
+    # a pair without foreground relations only has its background
+    pred_dist_default = np.full(num_rel_classes, eps)
+    pred_dist_default[0] += 1
+
+    # every predicate of an observed pair is kept, so its row is contiguous in the coalesced values
+    indices = torch.from_numpy(np.stack((sub_cls.repeat(num_rel_classes), obj_cls.repeat(num_rel_classes),
+                                         np.tile(np.arange(num_rel_classes), len(pair_keys)))))
+    size = (num_obj_classes, num_obj_classes, num_rel_classes)
+    return {
+        'fg_matrix': torch.sparse_coo_tensor(indices, torch.from_numpy(fg_rows.reshape(-1)), size).coalesce(),
+        'pred_dist': torch.sparse_coo_tensor(indices, torch.from_numpy(pred_rows.reshape(-1)).float(),
+                                             size).coalesce(),
+        'pred_dist_default': torch.from_numpy(pred_dist_default).float(),
+    }
+
 def box_filter(boxes, must_overlap=False):
     """ Only include boxes that overlap as possible relations.
     If no overlapping boxes, use all of them."""
@@ -2,7 +2,7 @@
 from . import transforms as T
 
 
-def build_transforms(cfg, is_train=True):
+def build_transforms(cfg, is_train=True, targets_only=False):
     if is_train:
         min_size = cfg.INPUT.MIN_SIZE_TRAIN
         max_size = cfg.INPUT.MAX_SIZE_TRAIN
@@ -22,6 +22,11 @@ def build_transforms(cfg, is_train=True):
         saturation = 0.0
         hue = 0.0
 
+    if targets_only:
+        # no image is loaded, the targets get the resize of the test images
+        assert not is_train, "the training augmentations need the images"
+        return T.Compose([T.ResizeTarget(min_size, max_size)])
+
     to_bgr255 = cfg.INPUT.TO_BGR255
     normalize_transform = T.Normalize(
         mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD, to_bgr255=to_bgr255
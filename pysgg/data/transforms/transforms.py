@@ -63,6 +63,13 @@ class Resize(object):
         return image, target
 
 
+class ResizeTarget(Resize):
+    # the resize of the boxes alone, for the datasets that give no image
+    def __call__(self, image, target):
+        oh, ow = self.get_size(target.size)
+        return image, target.resize((ow, oh))
+
+
 class RandomHorizontalFlip(object):
     def __init__(self, prob=0.5):
         self.prob = prob
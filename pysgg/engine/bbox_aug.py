@@ -1,3 +1,6 @@
+import math
+from collections import OrderedDict
+
 import torch
 import torchvision.transforms as TT
 
@@ -9,110 +12,104 @@ from pysgg.modeling.roi_heads.box_head.inference import make_roi_box_post_proces
 
 
 def im_detect_bbox_aug(model, images, device):
-    # Collect detections computed under different transformations
-    boxlists_ts = []
-    for _ in range(len(images)):
-        boxlists_ts.append([])
-
-    def add_preds_t(boxlists_t):
-        for i, boxlist_t in enumerate(boxlists_t):
-            if len(boxlists_ts[i]) == 0:
-                # The first one is identity transform, no need to resize the boxlist
-                boxlists_ts[i].append(boxlist_t)
-            else:
-                # Resize the boxlist as the first one
-                boxlists_ts[i].append(boxlist_t.resize(boxlists_ts[i][0].size))
-
-    # Compute detections for the original image (identity transform)
-    boxlists_i = im_detect_bbox(
-        model, images, cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST, device
-    )
-    add_preds_t(boxlists_i)
-
-    # Perform detection on the horizontally flipped image
+    assert not cfg.MODEL.RELATION_ON, "test-time augmentation is only supported for the detector"
+    # The transformations, the first one is the identity transform
+    views = [(cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST, False)]
     if cfg.TEST.BBOX_AUG.H_FLIP:
-        boxlists_hf = im_detect_bbox_hflip(
-            model, images, cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST, device
-        )
-        add_preds_t(boxlists_hf)
-
-    # Compute detections at different scales
+        views.append((cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST, True))
     for scale in cfg.TEST.BBOX_AUG.SCALES:
-        max_size = cfg.TEST.BBOX_AUG.MAX_SIZE
-        boxlists_scl = im_detect_bbox_scale(
-            model, images, scale, max_size, device
-        )
-        add_preds_t(boxlists_scl)
-
+        views.append((scale, cfg.TEST.BBOX_AUG.MAX_SIZE, False))
         if cfg.TEST.BBOX_AUG.SCALE_H_FLIP:
-            boxlists_scl_hf = im_detect_bbox_scale(
-                model, images, scale, max_size, device, hflip=True
-            )
-            add_preds_t(boxlists_scl_hf)
+            views.append((scale, cfg.TEST.BBOX_AUG.MAX_SIZE, True))
 
-    # Merge boxlists detected by different bbox aug params
-    boxlists = []
-    for i, boxlist_ts in enumerate(boxlists_ts):
-        bbox = torch.cat([boxlist_t.bbox for boxlist_t in boxlist_ts])
-        scores = torch.cat([boxlist_t.get_field('scores') for boxlist_t in boxlist_ts])
-        boxlist = BoxList(bbox, boxlist_ts[0].size, boxlist_ts[0].mode)
-        boxlist.add_field('scores', scores)
-        boxlists.append(boxlist)
+    # Collect detections computed under different transformations
+    view_images = [[make_transform(*view)(image) for image in images] for view in views]
+    boxlists_ts = [[None] * len(views) for _ in range(len(images))]
+    if cfg.TEST.BBOX_AUG.BATCHED:
+        groups = group_views_by_padded_size(view_images, cfg.DATALOADER.SIZE_DIVISIBILITY)
+    else:
+        groups = [[v] for v in range(len(views))]
+    for group in groups:
+        # the views of a group are padded to the same size, they share a single forward
+        image_list = to_image_list([image for v in group for image in view_images[v]],
+                                   cfg.DATALOADER.SIZE_DIVISIBILITY)
+        boxlists = model(image_list.to(device))
+        for j, v in enumerate(group):
+            for i, boxlist_t in enumerate(boxlists[j * len(images):(j + 1) * len(images)]):
+                if views[v][2]:
+                    # Invert the detections computed on the flipped image
+                    boxlist_t = boxlist_t.transpose(0)
+                boxlists_ts[i][v] = boxlist_t
+    # Resize the boxlists as the identity transform
+    boxlists_ts = [[boxlist_ts[0]] + [boxlist_t.resize(boxlist_ts[0].size) for boxlist_t in boxlist_ts[1:]]
+                   for boxlist_ts in boxlists_ts]
 
-    # Apply NMS and limit the final detections
-    results = []
     post_processor = make_roi_box_post_processor(cfg)
-    for boxlist in boxlists:
-        results.append(post_processor.filter_results(boxlist, cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES))
-
-    return results
+    return merge_detections(boxlists_ts, post_processor, cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES)
 
 
-def im_detect_bbox(model, images, target_scale, target_max_size, device):
-    """
-    Performs bbox detection on the original image.
-    """
-    transform = TT.Compose([
-        T.Resize(target_scale, target_max_size),
+def make_transform(target_scale, target_max_size, hflip=False):
+    transforms = [T.Resize(target_scale, target_max_size)]
+    if hflip:
+        transforms.append(TT.RandomHorizontalFlip(1.0))
+    transforms += [
         TT.ToTensor(),
         T.Normalize(
             mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD, to_bgr255=cfg.INPUT.TO_BGR255
         )
-    ])
-    images = [transform(image) for image in images]
-    images = to_image_list(images, cfg.DATALOADER.SIZE_DIVISIBILITY)
-    return model(images.to(device))
+    ]
+    return TT.Compose(transforms)
 
 
-def im_detect_bbox_hflip(model, images, target_scale, target_max_size, device):
-    """
-    Performs bbox detection on the horizontally flipped image.
-    Function signature is the same as for im_detect_bbox.
+def group_views_by_padded_size(view_images, size_divisible=0):
     """
-    transform = TT.Compose([
-        T.Resize(target_scale, target_max_size),
-        TT.RandomHorizontalFlip(1.0),
-        TT.ToTensor(),
-        T.Normalize(
-            mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD, to_bgr255=cfg.INPUT.TO_BGR255
-        )
-    ])
-    images = [transform(image) for image in images]
-    images = to_image_list(images, cfg.DATALOADER.SIZE_DIVISIBILITY)
-    boxlists = model(images.to(device))
+    Groups the views whose images are padded to the same batch size by to_image_list,
+    e.g. a scale and its horizontal flip, in the order of their first view.
 
-    # Invert the detections computed on the flipped image
-    boxlists_inv = [boxlist.transpose(0) for boxlist in boxlists]
-    return boxlists_inv
+    Arguments:
+        view_images (list[list[Tensor]]): the images of each view
+        size_divisible (int)
 
-
-def im_detect_bbox_scale(model, images, target_scale, target_max_size, device, hflip=False):
+    Returns:
+        groups (list[list[int]]): the indices of the views of each group
     """
-    Computes bbox detections at the given scale.
-    Returns predictions in the scaled image space.
+    groups = OrderedDict()
+    for v, images in enumerate(view_images):
+        height = max(image.shape[-2] for image in images)
+        width = max(image.shape[-1] for image in images)
+        if size_divisible > 0:
+            height = int(math.ceil(height / size_divisible) * size_divisible)
+            width = int(math.ceil(width / size_divisible) * size_divisible)
+        groups.setdefault((height, width), []).append(v)
+    return list(groups.values())
+
+
+def merge_detections(boxlists_ts, post_processor, num_classes):
     """
-    if hflip:
-        boxlists_scl = im_detect_bbox_hflip(model, images, target_scale, target_max_size, device)
+    Merges the detections of the views of each image, the boxes of every class with their
+    'pred_scores' as given by the box post processor in bbox aug mode, and applies NMS and
+    limits the final detections, in a single NMS call for all the images if batched.
+
+    Arguments:
+        boxlists_ts (list[list[BoxList]]): the detections of the views of each image, in the
+            frame of the first one
+        post_processor (PostProcessor)
+        num_classes (int)
+    """
+    boxlists = []
+    for boxlist_ts in boxlists_ts:
+        bbox = torch.cat([boxlist_t.bbox for boxlist_t in boxlist_ts])
+        scores = torch.cat([boxlist_t.get_field('pred_scores') for boxlist_t in boxlist_ts])
+        boxlist = BoxList(bbox, boxlist_ts[0].size, boxlist_ts[0].mode)
+        boxlist.add_field('pred_scores', scores)
+        boxlists.append(boxlist)
+
+    if post_processor.batched_nms:
+        filtered = post_processor.filter_results_batch(boxlists, num_classes)
     else:
-        boxlists_scl = im_detect_bbox(model, images, target_scale, target_max_size, device)
-    return boxlists_scl
+        filtered = [post_processor.filter_results(boxlist, num_classes) for boxlist in boxlists]
+    results = []
+    for result, _, boxes_per_cls in filtered:
+        result.add_field('boxes_per_cls', boxes_per_cls)
+        results.append(result)
+    return results
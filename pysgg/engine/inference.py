@@ -11,6 +11,7 @@ from .bbox_aug import im_detect_bbox_aug
 from ..utils.comm import all_gather
 from ..utils.comm import is_main_process, get_world_size
 from ..utils.comm import synchronize
+from ..utils.feature_store import image_keys
 from ..utils.timer import Timer, get_time_str
 
 
@@ -38,7 +39,13 @@ def compute_on_dataset(model, data_loader, device, synchronize_gather=True, time
                 output = im_detect_bbox_aug(model, images, device)
             else:
                 # relation detection needs the targets
-                output = model(images.to(device), targets, logger=logger)
+                store_keys = None
+                if cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED:
+                    # the loader gives no image, the features are read from the feature store
+                    store_keys = image_keys(data_loader.dataset, image_ids)
+                else:
+                    images = images.to(device)
+                output = model(images, targets, logger=logger, store_keys=store_keys)
             if timer:
                 if not cfg.MODEL.DEVICE == 'cpu':
                     torch.cuda.synchronize()
@@ -2,14 +2,19 @@
 import torch
 
 from .batch_norm import FrozenBatchNorm2d
+from .batch_norm import fold_batch_norms
+from .batch_norm import fold_batch_norm_into
 from .misc import Conv2d
 from .misc import DFConv2d
 from .misc import ConvTranspose2d
 from .misc import BatchNorm2d
 from .misc import interpolate
 from .nms import nms
+from .nms import batched_nms
 from .roi_align import ROIAlign
 from .roi_align import roi_align
+from .roi_align import MultiLevelROIAlign
+from .roi_align import multilevel_roi_align
 from .roi_pool import ROIPool
 from .roi_pool import roi_pool
 from .entropy_loss import entropy_loss
@@ -25,8 +30,11 @@ from .dcn.deform_pool_module import DeformRoIPooling, DeformRoIPoolingPack, Modu
 
 __all__ = [
     "nms",
+    "batched_nms",
     "roi_align",
     "ROIAlign",
+    "multilevel_roi_align",
+    "MultiLevelROIAlign",
     "roi_pool",
     "ROIPool",
     "smooth_l1_loss",
@@ -38,6 +46,8 @@ __all__ = [
     "interpolate",
     "BatchNorm2d",
     "FrozenBatchNorm2d",
+    "fold_batch_norms",
+    "fold_batch_norm_into",
     "SigmoidFocalLoss",
     "Label_Smoothing_Regression",
     'deform_conv',
@@ -29,3 +29,71 @@ class FrozenBatchNorm2d(nn.Module):
         scale = scale.reshape(1, -1, 1, 1)
         bias = bias.reshape(1, -1, 1, 1)
         return x * scale + bias
+
+
+_FOLDABLE_LAYERS = (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d)
+_FOLDABLE_NORMS = (FrozenBatchNorm2d, nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)
+
+
+def batch_norm_scale_bias(bn):
+    """
+    the per channel scale and bias an eval mode batch norm applies
+    """
+    if isinstance(bn, FrozenBatchNorm2d):
+        scale = bn.weight * bn.running_var.rsqrt()
+    else:
+        scale = (bn.running_var + bn.eps).rsqrt()
+        if bn.weight is not None:
+            scale = scale * bn.weight
+    bias = -bn.running_mean * scale
+    if bn.bias is not None:
+        bias = bias + bn.bias
+    return scale, bias
+
+
+def fold_batch_norm(layer, bn):
+    """
+    fold the eval mode batch norm that follows a linear or convolution layer
+    into the weight and the bias of that layer
+    """
+    with torch.no_grad():
+        scale, bias = batch_norm_scale_bias(bn)
+        if layer.bias is None:
+            layer.bias = nn.Parameter(torch.zeros_like(bias), requires_grad=layer.weight.requires_grad)
+        layer.bias.copy_(layer.bias * scale + bias)
+        layer.weight.mul_(scale.view((-1,) + (1,) * (layer.weight.dim() - 1)))
+
+
+def fold_batch_norm_into(module, layer_name, bn_name):
+    """
+    fold the batch norm module.<bn_name> applied right after the layer module.<layer_name>
+    into that layer, and replace it by an identity
+
+    :return: whether the batch norm could be folded
+    """
+    layer, bn = getattr(module, layer_name), getattr(module, bn_name)
+    if not isinstance(layer, _FOLDABLE_LAYERS) or not isinstance(bn, _FOLDABLE_NORMS):
+        return False
+    # batch norms still using the batch statistics can't be folded
+    if not isinstance(bn, FrozenBatchNorm2d) and (bn.training or bn.running_mean is None):
+        return False
+    fold_batch_norm(layer, bn)
+    setattr(module, bn_name, nn.Identity())
+    return True
+
+
+def fold_batch_norms(module):
+    """
+    fold every batch norm directly following a linear or convolution layer
+    in an nn.Sequential of the module into that layer, and replace it by an identity
+
+    :return: the number of folded batch norms
+    """
+    num_folded = 0
+    for seq in list(module.modules()):
+        if not isinstance(seq, nn.Sequential):
+            continue
+        names = list(seq._modules.keys())
+        for layer_name, bn_name in zip(names[:-1], names[1:]):
+            num_folded += fold_batch_norm_into(seq, layer_name, bn_name)
+    return num_folded
@@ -6,6 +6,8 @@ from apex import amp
 
 # Only valid with fp32 inputs - give AMP the hint
 nms = amp.float_function(_C.nms)
+# CPU only: boxes with different idxs never suppress each other
+batched_nms = amp.float_function(_C.batched_nms)
 
 # nms = _C.nms
 
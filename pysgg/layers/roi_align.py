@@ -67,3 +67,92 @@ class ROIAlign(nn.Module):
         tmpstr += ", sampling_ratio=" + str(self.sampling_ratio)
         tmpstr += ")"
         return tmpstr
+
+
+class _MultiLevelROIAlign(Function):
+    @staticmethod
+    def forward(ctx, rois, levels, output_size, spatial_scales, sampling_ratio, cat_all_levels, *inputs):
+        output_size = _pair(output_size)
+        ctx.save_for_backward(rois, levels)
+        ctx.output_size = output_size
+        ctx.spatial_scales = spatial_scales
+        ctx.sampling_ratio = sampling_ratio
+        ctx.cat_all_levels = cat_all_levels
+        ctx.input_shapes = [input.size() for input in inputs]
+        output = _C.roi_align_multilevel_forward(
+            list(inputs), rois, levels, spatial_scales, output_size[0], output_size[1],
+            sampling_ratio, cat_all_levels
+        )
+        return output
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        rois, levels = ctx.saved_tensors
+        output_size = ctx.output_size
+        bs, ch = ctx.input_shapes[0][:2]
+        grad_inputs = _C.roi_align_multilevel_backward(
+            grad_output,
+            rois,
+            levels,
+            ctx.spatial_scales,
+            output_size[0],
+            output_size[1],
+            bs,
+            ch,
+            [shape[2] for shape in ctx.input_shapes],
+            [shape[3] for shape in ctx.input_shapes],
+            ctx.sampling_ratio,
+            ctx.cat_all_levels,
+        )
+        return (None, None, None, None, None, None) + tuple(grad_inputs)
+
+
+def multilevel_roi_align(inputs, rois, levels, output_size, spatial_scales, sampling_ratio, cat_all_levels=False):
+    """
+    ROIAlign of the rois of all the feature map levels in one call.
+
+    Arguments:
+        inputs (list[Tensor]): the feature maps of the levels, with the same number of channels
+        rois (Tensor): (N, 5) rois, batch index and xyxy box
+        levels (Tensor): (N,) level of each roi, ignored when cat_all_levels
+        output_size (tuple[int] or int)
+        spatial_scales (list[float]): the scale of each level
+        sampling_ratio (int)
+        cat_all_levels (bool): pool every roi from all the levels and concatenate
+            the levels along the channels instead
+
+    Returns:
+        (N, C, h, w) tensor, or (N, C * len(inputs), h, w) when cat_all_levels
+    """
+    if cat_all_levels:
+        levels = rois.new_zeros((0,), dtype=torch.int64)
+    return _MultiLevelROIAlign.apply(
+        rois, levels, output_size, [float(scale) for scale in spatial_scales], sampling_ratio,
+        cat_all_levels, *inputs
+    )
+
+
+class MultiLevelROIAlign(nn.Module):
+    def __init__(self, output_size, spatial_scales, sampling_ratio, cat_all_levels=False):
+        super(MultiLevelROIAlign, self).__init__()
+        self.output_size = output_size
+        self.spatial_scales = spatial_scales
+        self.sampling_ratio = sampling_ratio
+        self.cat_all_levels = cat_all_levels
+
+    @amp.float_function
+    def forward(self, inputs, rois, levels):
+        return multilevel_roi_align(
+            inputs, rois, levels, self.output_size, self.spatial_scales, self.sampling_ratio,
+            self.cat_all_levels
+        )
+
+    def __repr__(self):
+        tmpstr = self.__class__.__name__ + "("
+        tmpstr += "output_size=" + str(self.output_size)
+        tmpstr += ", spatial_scales=" + str(self.spatial_scales)
+        tmpstr += ", sampling_ratio=" + str(self.sampling_ratio)
+        tmpstr += ", cat_all_levels=" + str(self.cat_all_levels)
+        tmpstr += ")"
+        return tmpstr
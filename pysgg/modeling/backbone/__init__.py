@@ -1,3 +1,4 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 from .backbone import build_backbone
+from .backbone import prepare_for_inference
 from . import fbnet
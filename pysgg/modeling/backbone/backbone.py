@@ -1,8 +1,10 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 from collections import OrderedDict
 
+import torch
 from torch import nn
 
+from pysgg.layers import fold_batch_norms
 from pysgg.modeling import registry
 from pysgg.modeling.make_layers import conv_with_kaiming_uniform
 from . import fpn as fpn_module
@@ -87,3 +89,37 @@ def build_backbone(cfg):
             cfg.MODEL.BACKBONE.CONV_BODY
         )
     return registry.BACKBONES[cfg.MODEL.BACKBONE.CONV_BODY](cfg)
+
+
+def _to_channels_last(module, inputs):
+    return tuple(x.contiguous(memory_format=torch.channels_last) for x in inputs)
+
+
+def _to_contiguous(module, inputs, outputs):
+    return type(outputs)(x.contiguous() for x in outputs)
+
+
+def prepare_for_inference(backbone, channels_last=False):
+    """
+    Fold the frozen batch norms of the backbone into the convolutions before them, and optionally
+    run the backbone in the channels last memory format. The feature maps are given back in the
+    default contiguous format the heads expect.
+    The backbone is put in eval mode and frozen, it is meant for inference only afterwards,
+    as the folded batch norms are removed from the model.
+
+    :return: the number of folded batch norms
+    """
+    backbone.eval()
+    num_folded = fold_batch_norms(backbone)
+    for module in backbone.modules():
+        if isinstance(module, (resnet.Bottleneck, resnet.BaseStem)):
+            num_folded += module.fold_batch_norms()
+    for param in backbone.parameters():
+        param.requires_grad_(False)
+    if channels_last:
+        if not hasattr(torch, "channels_last"):
+            raise RuntimeError("The channels last memory format needs PyTorch 1.5 or newer")
+        backbone.to(memory_format=torch.channels_last)
+        backbone.register_forward_pre_hook(_to_channels_last)
+        backbone.register_forward_hook(_to_contiguous)
+    return num_folded
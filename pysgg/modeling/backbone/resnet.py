@@ -24,6 +24,7 @@ from torch import nn
 
 from pysgg.layers import FrozenBatchNorm2d
 from pysgg.layers import Conv2d
+from pysgg.layers import fold_batch_norm_into
 from pysgg.layers import DFConv2d
 from pysgg.modeling.make_layers import group_norm
 from pysgg.utils.registry import Registry
@@ -343,6 +344,15 @@ class Bottleneck(nn.Module):
 
         return out
 
+    def fold_batch_norms(self):
+        """
+        fold the batch norms into the convolutions before them, for inference
+
+        :return: the number of folded batch norms
+        """
+        return sum(fold_batch_norm_into(self, conv, bn)
+                   for conv, bn in (("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")))
+
 
 class BaseStem(nn.Module):
     def __init__(self, cfg, norm_func):
@@ -365,6 +375,9 @@ class BaseStem(nn.Module):
         x = F.max_pool2d(x, kernel_size=3, stride=2, padding=1)
         return x
 
+    def fold_batch_norms(self):
+        return int(fold_batch_norm_into(self, "conv1", "bn1"))
+
 
 class BottleneckWithFixedBatchNorm(Bottleneck):
     def __init__(
@@ -30,11 +30,13 @@ class GeneralizedRCNN(nn.Module):
         self.rpn = build_rpn(cfg, self.backbone.out_channels)
         self.roi_heads = build_roi_heads(cfg, self.backbone.out_channels)
 
-    def forward(self, images, targets=None, logger=None):
+    def forward(self, images, targets=None, logger=None, store_keys=None):
         """
         Arguments:
             images (list[Tensor] or ImageList): images to be processed
             targets (list[BoxList]): ground-truth boxes present in the image (optional)
+            store_keys (list[int]): keys of the images in the feature store, when the relation
+                head reads the features of the frozen detector from it (optional)
 
         Returns:
             result (list[BoxList] or dict[Tensor]): the output from the model.
@@ -45,6 +47,13 @@ class GeneralizedRCNN(nn.Module):
         """
         if self.training and targets is None:
             raise ValueError("In training mode, targets should be passed")
+        if store_keys is not None:
+            # neither the backbone nor the rpn run, the relation head needs the targets only
+            x, result, detector_losses = self.roi_heads(None, None, targets, logger, store_keys=store_keys)
+            if self.training:
+                return detector_losses
+            return result
+
         images = to_image_list(images)
         features = self.backbone(images.tensors)
         proposals, proposal_losses = self.rpn(images, features, targets)
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from torch import nn
 
 from pysgg.layers import ROIAlign
+from pysgg.layers import MultiLevelROIAlign
 from pysgg.modeling.make_layers import make_conv3x3
 
 from .utils import cat
@@ -55,12 +56,14 @@ class Pooler(nn.Module):
     # NOTE: cat_all_levels is added for relationship detection. We want to concatenate 
     # all levels, since detector is fixed in relation detection. Without concatenation
     # if there is any difference among levels, it can not be finetuned anymore. 
-    def __init__(self, output_size, scales, sampling_ratio, in_channels=512, cat_all_levels=False):
+    def __init__(self, output_size, scales, sampling_ratio, in_channels=512, cat_all_levels=False, fused=True):
         """
         Arguments:
             output_size (list[tuple[int]] or list[int]): output size for the pooled region
             scales (list[float]): scales for each Pooler
             sampling_ratio (int): sampling ratio for ROIAlign
+            fused (bool): pool the rois of all the levels with a single MultiLevelROIAlign
+                call instead of one ROIAlign call per level
         """
         super(Pooler, self).__init__()
         poolers = []
@@ -71,6 +74,10 @@ class Pooler(nn.Module):
                 )
             )
         self.poolers = nn.ModuleList(poolers)
+        self.fused = fused
+        self.multilevel_pooler = MultiLevelROIAlign(
+            output_size, spatial_scales=scales, sampling_ratio=sampling_ratio, cat_all_levels=cat_all_levels
+        )
         self.output_size = output_size
         self.cat_all_levels = cat_all_levels
         # get the levels in the feature map by leveraging the fact that the network always
@@ -110,13 +117,19 @@ class Pooler(nn.Module):
         if num_levels == 1:
             return self.poolers[0](x[0], rois)
 
-        levels = self.map_levels(boxes)
+        levels = None if self.cat_all_levels else self.map_levels(boxes)
+        dtype = x[0].dtype
+        if self.fused:
+            result = self.multilevel_pooler(x[:num_levels], rois, levels).to(dtype)
+            if self.cat_all_levels:
+                result = self.reduce_channel(result)
+            return result
 
         num_rois = len(rois)
         num_channels = x[0].shape[1]
         output_size = self.output_size[0]
 
-        dtype, device = x[0].dtype, x[0].device
+        device = x[0].device
         final_channels = num_channels * num_levels if self.cat_all_levels else num_channels
         result = torch.zeros(
             (num_rois, final_channels, output_size, output_size),
@@ -5,8 +5,9 @@ from torch import nn
 
 from pysgg.modeling.box_coder import BoxCoder
 from pysgg.structures.bounding_box import BoxList
+from pysgg.structures.boxes_per_cls import LazyBoxesPerCls
+from pysgg.structures.boxlist_ops import batched_nms
 from pysgg.structures.boxlist_ops import boxlist_nms
-from pysgg.structures.boxlist_ops import cat_boxlist
 
 
 class PostProcessor(nn.Module):
@@ -26,7 +27,9 @@ class PostProcessor(nn.Module):
             box_coder=None,
             cls_agnostic_bbox_reg=False,
             bbox_aug_enabled=False,
-            save_proposals=False
+            save_proposals=False,
+            batched_nms=True,
+            lazy_decode=True
     ):
         """
         Arguments:
@@ -34,6 +37,11 @@ class PostProcessor(nn.Module):
             nms (float)
             detections_per_img (int)
             box_coder (BoxCoder)
+            batched_nms (bool): run the NMS of all the classes and images
+                in a single call, instead of class by class
+            lazy_decode (bool): keep the regression deltas and only decode the
+                boxes of the classes that are read, the 'boxes_per_cls' field of
+                the results is then a LazyBoxesPerCls
         """
         super(PostProcessor, self).__init__()
         self.score_thresh = score_thresh
@@ -47,6 +55,8 @@ class PostProcessor(nn.Module):
         self.cls_agnostic_bbox_reg = cls_agnostic_bbox_reg
         self.bbox_aug_enabled = bbox_aug_enabled
         self.save_proposals = save_proposals
+        self.batched_nms = batched_nms
+        self.lazy_decode = lazy_decode
 
     def forward(self, x, boxes, relation_mode=False):
         """
@@ -70,30 +80,47 @@ class PostProcessor(nn.Module):
 
         if self.cls_agnostic_bbox_reg:
             box_regression = box_regression[:, -4:]
-        # add rpn regression offset to the original proposals
-        proposals = self.box_coder.decode(
-            box_regression.view(sum(boxes_per_image), -1), concat_boxes
-        )  # tensor of size (num_box, 4*num_cls)
-        if self.cls_agnostic_bbox_reg:
-            proposals = proposals.repeat(1, class_prob.shape[1])
-
         num_classes = class_prob.shape[1]
 
         features = features.split(boxes_per_image, dim=0)
-        proposals = proposals.split(boxes_per_image, dim=0)
         class_prob = class_prob.split(boxes_per_image, dim=0)
 
+        boxlists = []
+        if self.lazy_decode:
+            box_regression = box_regression.view(sum(boxes_per_image), -1).split(boxes_per_image, dim=0)
+            for prob, regression, boxes_per_img, image_shape in zip(
+                    class_prob, box_regression, concat_boxes.split(boxes_per_image, dim=0), image_shapes):
+                boxlists.append(self.prepare_lazy_boxlist(boxes_per_img, regression, prob, image_shape))
+        else:
+            # add rpn regression offset to the original proposals
+            proposals = self.box_coder.decode(
+                box_regression.view(sum(boxes_per_image), -1), concat_boxes
+            )  # tensor of size (num_box, 4*num_cls)
+            if self.cls_agnostic_bbox_reg:
+                proposals = proposals.repeat(1, num_classes)
+            proposals = proposals.split(boxes_per_image, dim=0)
+
+            for prob, boxes_per_img, image_shape in zip(class_prob, proposals, image_shapes):
+                boxlist = self.prepare_boxlist(boxes_per_img, prob, image_shape)
+                boxlists.append(boxlist.clip_to_image(remove_empty=False))
+
+        if self.bbox_aug_enabled:
+            # the boxes of every class, filtered once the views are merged by im_detect_bbox_aug
+            if self.lazy_decode:
+                boxlists = [self.prepare_boxlist(boxlist.get_field("boxes_per_cls").tensor(),
+                                                 boxlist.get_field("pred_scores"), boxlist.size)
+                            for boxlist in boxlists]
+            return torch.cat(features, dim=0), boxlists
+
+        if self.batched_nms:
+            filtered = self.filter_results_batch(boxlists, num_classes)
+        else:
+            filtered = [self.filter_results(boxlist, num_classes, boxes[i].get_field('predict_logits'))
+                        for i, boxlist in enumerate(boxlists)]
+
         results = []
         nms_features = []
-        for i, (prob, boxes_per_img, image_shape) in enumerate(zip(
-                class_prob, proposals, image_shapes
-        )):
-            boxlist = self.prepare_boxlist(boxes_per_img, prob, image_shape)
-            boxlist = boxlist.clip_to_image(remove_empty=False)
-            assert self.bbox_aug_enabled == False
-            if not self.bbox_aug_enabled:  # If bbox aug is enabled, we will do it later
-                boxlist, orig_inds, boxes_per_cls = self.filter_results(boxlist, num_classes,
-                                                                        boxes[i].get_field('predict_logits'))
+        for i, (boxlist, orig_inds, boxes_per_cls) in enumerate(filtered):
             # add
             boxlist = self.add_important_fields(i, boxes, orig_inds, boxlist, boxes_per_cls, relation_mode)
 
@@ -154,49 +181,101 @@ class PostProcessor(nn.Module):
         boxlist.add_field("pred_scores", scores)
         return boxlist
 
+    def prepare_lazy_boxlist(self, proposals, box_regression, scores, image_shape):
+        """
+        The counterpart of `prepare_boxlist` which does not decode the boxes: the
+        BoxList holds the #detections proposals, with the (#detections, #classes)
+        `scores` in the "pred_scores" field and the boxes of every class in a
+        LazyBoxesPerCls "boxes_per_cls" field, decoded and clipped when read.
+        """
+        num_classes = scores.shape[1]
+        boxlist = BoxList(proposals, image_shape, mode="xyxy")
+        boxlist.add_field("pred_scores", scores)
+        boxlist.add_field("boxes_per_cls",
+                          LazyBoxesPerCls(proposals, box_regression, self.box_coder, num_classes, image_shape))
+        return boxlist
+
+    @staticmethod
+    def get_boxes_per_cls(boxlist, num_classes):
+        # the lazy boxes of prepare_lazy_boxlist, or the decoded ones of prepare_boxlist
+        if boxlist.has_field("boxes_per_cls"):
+            return boxlist.get_field("boxes_per_cls")
+        return boxlist.bbox.reshape(-1, num_classes, 4)
+
     def filter_results(self, boxlist, num_classes, obj_logit=None):
         """Returns bounding-box detection results by thresholding on scores and
         applying non-maximum suppression (NMS).
         """
         # unwrap the boxlist to avoid additional overhead.
         # if we had multi-class NMS, we could perform this directly on the boxlist
-        boxes = boxlist.bbox.reshape(-1, num_classes * 4)
-        boxes_per_cls = boxlist.bbox.reshape(-1, num_classes, 4)
+        boxes_per_cls = self.get_boxes_per_cls(boxlist, num_classes)
         scores = boxlist.get_field("pred_scores").reshape(-1, num_classes)
 
         device = scores.device
-        result = []
         orig_inds = []
+        labels = []
         # Apply threshold on detection probabilities and apply NMS
         # Skip j = 0, because it's the background class
         inds_all = scores > self.score_thresh
         for j in range(1, num_classes):
             inds = inds_all[:, j].nonzero().squeeze(1)
             scores_j = scores[inds, j]
-            boxes_j = boxes[inds, j * 4: (j + 1) * 4]
+            boxes_j = boxes_per_cls[inds, j]
             boxlist_for_class = BoxList(boxes_j, boxlist.size, mode="xyxy")
             boxlist_for_class.add_field("pred_scores", scores_j)
             boxlist_for_class, keep = boxlist_nms(
                 boxlist_for_class, self.nms, max_proposals=self.post_nms_per_cls_topn, score_field='pred_scores'
             )
-            inds = inds[keep]
-            num_labels = len(boxlist_for_class)
-            boxlist_for_class.add_field(
-                "pred_labels", torch.full((num_labels,), j, dtype=torch.int64, device=device)
-            )
-            result.append(boxlist_for_class)
-            orig_inds.append(inds)
+            orig_inds.append(inds[keep])
+            labels.append(torch.full((len(keep),), j, dtype=torch.int64, device=device))
 
+        return self.select_detections(boxlist, scores, boxes_per_cls,
+                                      torch.cat(orig_inds, dim=0), torch.cat(labels, dim=0))
+
+    def filter_results_batch(self, boxlists, num_classes):
+        """filter_results of all the images, with a single NMS call over
+        the classes of every image.
+        """
+        boxes_per_cls = [self.get_boxes_per_cls(boxlist, num_classes) for boxlist in boxlists]
+        scores = [boxlist.get_field("pred_scores").reshape(-1, num_classes) for boxlist in boxlists]
+        num_boxes = [len(scores_per_img) for scores_per_img in scores]
+        device = scores[0].device
+
+        all_scores = torch.cat(scores, dim=0)
+        img_ids = torch.repeat_interleave(torch.arange(len(boxlists), device=device),
+                                          torch.tensor(num_boxes, device=device))
+        # Apply threshold on detection probabilities, skip the background class
+        inds_all = all_scores > self.score_thresh
+        inds_all[:, 0] = 0
+        inds, labels = inds_all.nonzero().unbind(1)
+        groups = img_ids[inds] * num_classes + labels
+        # only the boxes above the threshold are decoded, image by image
+        img_starts = [sum(num_boxes[:i]) for i in range(len(boxlists))]
+        num_candidates = torch.bincount(img_ids[inds], minlength=len(boxlists)).tolist()
+        candidate_boxes = torch.cat([boxes[inds_i - start, labels_i] for boxes, inds_i, labels_i, start in zip(
+            boxes_per_cls, inds.split(num_candidates), labels.split(num_candidates), img_starts)], dim=0)
+        keep = batched_nms(candidate_boxes, all_scores[inds, labels], groups,
+                           self.nms, max_proposals=self.post_nms_per_cls_topn)
+
+        # image by image and class by class, each class in the order of the boxes as filter_results
+        keep = keep[torch.argsort(groups[keep] * len(keep) + torch.arange(len(keep), device=device))]
+        keep_per_img = torch.bincount(img_ids[inds[keep]], minlength=len(boxlists)).tolist()
+        results = []
+        for i, (keep_i, boxlist) in enumerate(zip(keep.split(keep_per_img), boxlists)):
+            results.append(self.select_detections(boxlist, scores[i], boxes_per_cls[i],
+                                                  inds[keep_i] - img_starts[i], labels[keep_i]))
+        return results
+
+    def select_detections(self, boxlist, scores, boxes_per_cls, orig_inds, labels):
+        """Builds the detections of an image from the boxes and labels kept by NMS,
+        removes the duplicated boxes and limits the number of detections.
+        """
         # NOTE: kaihua, according to Neural-MOTIFS (and my experiments, we need remove duplicate bbox)
         if self.nms_filter_duplicates or self.save_proposals:
-            assert len(orig_inds) == (num_classes - 1)
-            # set all bg to zero
-            inds_all[:, 0] = 0
-            for j in range(1, num_classes):
-                inds_all[:, j] = 0
-                orig_idx = orig_inds[j - 1]
-                inds_all[orig_idx, j] = 1
-            dist_scores = scores * inds_all.float()
+            # set all bg and the boxes suppressed by NMS to zero
+            inds_all = torch.zeros_like(scores)
+            inds_all[orig_inds, labels] = 1
+            dist_scores = scores * inds_all
             scores_pre, labels_pre = dist_scores.max(1)
             final_inds = scores_pre.nonzero()
             assert final_inds.dim() != 0
@@ -210,8 +289,9 @@ class PostProcessor(nn.Module):
             result.add_field("pred_labels", labels_pre)
             orig_inds = final_inds
         else:
-            result = cat_boxlist(result)
-            orig_inds = torch.cat(orig_inds, dim=0)
+            result = BoxList(boxes_per_cls[orig_inds, labels], boxlist.size, mode="xyxy")
+            result.add_field("pred_scores", scores[orig_inds, labels])
+            result.add_field("pred_labels", labels)
 
         number_of_detections = len(result)
         # Limit to max_per_image detections **over all classes**
@@ -252,6 +332,8 @@ def make_roi_box_post_processor(cfg):
     post_nms_per_cls_topn = cfg.MODEL.ROI_HEADS.POST_NMS_PER_CLS_TOPN
     nms_filter_duplicates = cfg.MODEL.ROI_HEADS.NMS_FILTER_DUPLICATES
     save_proposals = cfg.TEST.SAVE_PROPOSALS
+    batched_nms = cfg.MODEL.ROI_HEADS.BATCHED_NMS
+    lazy_decode = cfg.MODEL.ROI_HEADS.LAZY_BOX_DECODE
 
     postprocessor = PostProcessor(
         score_thresh,
@@ -262,6 +344,8 @@ def make_roi_box_post_processor(cfg):
         box_coder,
         cls_agnostic_bbox_reg,
         bbox_aug_enabled,
-        save_proposals
+        save_proposals,
+        batched_nms,
+        lazy_decode
     )
     return postprocessor
@@ -7,7 +7,40 @@ from torch.nn import functional as F, init
 from pysgg.config import cfg
 
 
-class WeightNormClassifier(nn.Module):
+class FoldedWeightMixin(object):
+    """
+    Computes the eval mode weight and bias of a classifier once, after prepare_for_inference,
+    instead of on every call. The folded weights are recomputed after a device or dtype change,
+    and dropped when the module goes back to training.
+    The classes define fold_weight, which returns the (weight, bias) the forward computes
+    from the parameters.
+    """
+    frozen = False
+    _folded = None
+
+    def prepare_for_inference(self):
+        self.frozen = True
+        self._folded = None
+        return self
+
+    def folded_weight(self):
+        if self._folded is None:
+            with torch.no_grad():
+                self._folded = self.fold_weight()
+        return self._folded
+
+    def train(self, mode=True):
+        if mode:
+            self.frozen = False
+            self._folded = None
+        return super(FoldedWeightMixin, self).train(mode)
+
+    def _apply(self, fn):
+        self._folded = None
+        return super(FoldedWeightMixin, self)._apply(fn)
+
+
+class WeightNormClassifier(FoldedWeightMixin, nn.Module):
     """
     Hierarchical Category Context Modeling
     The FC classifier with the weight normalizations
@@ -27,7 +60,12 @@ class WeightNormClassifier(nn.Module):
         stdv = 1. / math.sqrt(self.weight.size(1))
         self.weight.data.uniform_(-stdv, stdv)
 
+    def fold_weight(self):
+        return self.gamma * F.normalize(self.weight, dim=1), None
+
     def forward(self, cls_feat):
+        if self.frozen:
+            return torch.matmul(cls_feat, self.folded_weight()[0].t())
         # Global Representation Normalization
         #  along the feature dimenstion
         # N, 1024
@@ -100,7 +138,7 @@ class WeightNormClassifier(nn.Module):
 #         return scores
 
 
-class DotProductClassifier(nn.Module):
+class DotProductClassifier(FoldedWeightMixin, nn.Module):
     def __init__(self, in_dims, num_class, bias=True, learnable_scale=False):
         super(DotProductClassifier, self).__init__()
         self.in_dims = in_dims
@@ -128,7 +166,15 @@ class DotProductClassifier(nn.Module):
         if self.bias is not None:
             self.bias.requires_grad = requires_grad
 
+    def fold_weight(self):
+        if self.scales is None:
+            return self.weight, self.bias
+        bias = self.bias * self.scales if self.bias is not None else None
+        return self.weight * self.scales.view(-1, 1), bias
+
     def forward(self, input):
+        if self.frozen:
+            return F.linear(input, *self.folded_weight())
         output = F.linear(input, self.weight, self.bias)
         if self.scales is not None:
             output *= self.scales
@@ -136,7 +182,7 @@ class DotProductClassifier(nn.Module):
         return output
 
 
-class CosineSimilarityClassifier(nn.Module):
+class CosineSimilarityClassifier(FoldedWeightMixin, nn.Module):
     """
     large-scale longtail classifier
     not only normalize the classifier weight, but also normalize the initial input features.
@@ -165,10 +211,17 @@ class CosineSimilarityClassifier(nn.Module):
         self.scale = nn.Parameter(torch.ones(1) * self.init_scale)
         self.weight.data.uniform_(-stdv, stdv)
 
+    def fold_weight(self):
+        # the scale multiplies the input features, the same as scaling the weight columns
+        w_normalized = self.weight / torch.norm(self.weight, 2, 1, keepdim=True)
+        return w_normalized * self.scale, None
+
     def forward(self, input, *args):
         norm_x = torch.norm(input, 2, 1, keepdim=True)
         # x_normalized = input.div(norm_x + 1e-5)
         x_normalized = (norm_x / (1 + norm_x)) * (input / norm_x)
+        if self.frozen:
+            return torch.mm(x_normalized, self.folded_weight()[0].t())
         w_normalized = self.weight / torch.norm(self.weight, 2, 1, keepdim=True)
         return torch.mm(self.scale * x_normalized, w_normalized.t())
 
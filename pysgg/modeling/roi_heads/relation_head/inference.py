@@ -6,6 +6,7 @@ from torch import nn
 
 from pysgg.config import cfg
 from pysgg.structures.bounding_box import BoxList
+from pysgg.structures.boxes_per_cls import cat_boxes_per_cls
 from .utils_relation import obj_prediction_nms
 
 import ipdb
@@ -42,7 +43,7 @@ class PostProcessor(nn.Module):
             self.use_relness_ranking = cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.USE_RELATEDNESS_FOR_PREDICTION_RANKING
 
 
-    def forward(self, x, rel_pair_idxs, boxes):
+    def forward(self, x, rel_pair_idxs, boxes, relness_scores=None):
         """
         re-NMS on refined object classifcations logits
         and ranking the relationship prediction according to the object and relationship
@@ -55,6 +56,8 @@ class PostProcessor(nn.Module):
                 the size of tensor is (num_rel, 2)
             boxes (list[BoxList]): bounding boxes that are used as
                 reference, one for ech image
+            relness_scores (list[tensor], optional): relatedness of each relation in rel_pair_idxs
+                from the relation proposal network, the relness_mat field of boxes takes priority
 
         Returns:
             results (list[BoxList]): one BoxList for each image, containing
@@ -100,7 +103,7 @@ class PostProcessor(nn.Module):
                 obj_pred = obj_pred + 1
             else:
                 # NOTE: by kaihua, apply late nms for object prediction
-                obj_pred = obj_prediction_nms(box.get_field('boxes_per_cls'), obj_logit, self.later_nms_pred_thres)
+                obj_pred = obj_prediction_nms(cat_boxes_per_cls([box]), obj_logit, self.later_nms_pred_thres)
                 # obj_pred = box.get_field('pred_labels')
                 obj_score_ind = torch.arange(num_obj_bbox, device=obj_logit.device) * num_obj_class + obj_pred
                 obj_scores = obj_class_prob.view(-1)[obj_score_ind]
@@ -135,6 +138,8 @@ class PostProcessor(nn.Module):
             if rel_binarys_matrix is not None:
                 rel_bin_mat = rel_binarys_matrix[i]
                 relness = rel_bin_mat[rel_pair_idx[:, 0], rel_pair_idx[:, 1]]
+            elif relness_scores is not None:
+                relness = relness_scores[i].unsqueeze(-1)
 
             # TODO Kaihua: how about using weighted some here?  e.g. rel*1 + obj *0.8 + obj*0.8
             if self.use_relness_ranking:
@@ -147,7 +152,7 @@ class PostProcessor(nn.Module):
             rel_class_prob = rel_class_prob[sorting_idx]
             rel_labels = rel_class[sorting_idx]
 
-            if rel_binarys_matrix is not None:
+            if rel_binarys_matrix is not None or relness_scores is not None:
                 boxlist.add_field('relness', relness[sorting_idx])
                 
             boxlist.add_field('rel_pair_idxs', rel_pair_idx)  # (#rel, 2)
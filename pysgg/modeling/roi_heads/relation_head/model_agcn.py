@@ -1,6 +1,5 @@
 # Graph R-CNN for scene graph generation from jwyang' codebase
 # Re-implemented by us
-import copy
 import math
 
 import ipdb
@@ -10,6 +9,7 @@ import torch.nn.functional as F
 
 from pysgg.modeling.make_layers import make_fc
 from pysgg.modeling.roi_heads.relation_head.model_msg_passing import PairwiseFeatureExtractor
+from pysgg.modeling.roi_heads.relation_head.utils_graph import RelationGraphBatch, segment_to_padded
 from pysgg.structures.boxlist_ops import squeeze_tensor
 
 
@@ -74,60 +74,26 @@ class GRCNN(nn.Module):
         :param num_proposals:
         :param rel_pair_idxs:
         :return:
-            rel_inds,
-                extent the instances pairing matrix to the batch wised (num_inst, 2)
-            subj_pred_map,
-                how the instances related to the relation predicates as the subject (num_inst, rel_pair_num)
-            obj_pred_map
-                how the instances related to the relation predicates as the object (num_inst, rel_pair_num)
+            graph,
+                RelationGraphBatch of all the relation pairs, the batch wised pair index is graph.rel_inds
+            mp_graph,
+                the graph that only pass message on the valid pairs, same as graph if not filtered
+            selected_relness
         """
-        rel_inds = []
-        offset = 0
         rel_prop_pairs_relness_batch = []
 
-
-
-        for idx, (prop_num, rel_ind_i) in enumerate(zip(num_proposals, rel_pair_idxs, )):
-            if self.filter_the_mp_instance:
-                assert relatedness is not None
-                related_matrix = relatedness[idx]
-                rel_prop_pairs_relness = related_matrix[rel_ind_i[:, 0],
-                                                        rel_ind_i[:, 1]]
+        if self.filter_the_mp_instance:
+            assert relatedness is not None
+            for related_matrix, rel_ind_i in zip(relatedness, rel_pair_idxs):
                 # get the valid relation pair for the message passing
-                rel_prop_pairs_relness_batch.append(rel_prop_pairs_relness)
-            rel_ind_i = copy.deepcopy(rel_ind_i)
-
-            rel_ind_i += offset
-            offset += prop_num
-            rel_inds.append(rel_ind_i)
-
-        rel_inds = torch.cat(rel_inds, 0)
-
-        subj_pred_map = rel_inds.new(
-            sum(num_proposals), rel_inds.shape[0]).fill_(0).float().detach()
-        obj_pred_map = rel_inds.new(
-            sum(num_proposals), rel_inds.shape[0]).fill_(0).float().detach()
+                rel_prop_pairs_relness_batch.append(related_matrix[rel_ind_i[:, 0], rel_ind_i[:, 1]])
 
-        subj_pred_map.scatter_(0, (rel_inds[:, 0].contiguous().view(1, -1)), 1)
-        obj_pred_map.scatter_(0, (rel_inds[:, 1].contiguous().view(1, -1)), 1)
-
-        obj_obj_map = torch.zeros(sum(num_proposals), sum(num_proposals),
-                                  device=rel_pair_idxs[0].device).float()
-
-        obj_obj_map[rel_inds[:, 0], rel_inds[:, 1]] = 1
-        obj_obj_map[rel_inds[:, 1], rel_inds[:, 0]] = 1
+        graph = RelationGraphBatch.from_rel_pairs(num_proposals, rel_pair_idxs)
 
         # only message passing on valid pairs
         selected_relness = None
-        subj_pred_map_filtered = None
-        obj_pred_map_filtered = None
+        mp_graph = graph
         if len(rel_prop_pairs_relness_batch) != 0:
-
-            subj_pred_map_filtered = rel_inds.new(
-                sum(num_proposals), rel_inds.shape[0]).fill_(0).float().detach()
-            obj_pred_map_filtered = rel_inds.new(
-                sum(num_proposals), rel_inds.shape[0]).fill_(0).float().detach()
-
             rel_prop_pairs_relness_batch_cat = torch.cat(
                 rel_prop_pairs_relness_batch, 0)
 
@@ -144,23 +110,10 @@ class GRCNN(nn.Module):
             else:
                 raise ValueError()
 
-            subj_pred_map_filtered[rel_inds[selected_rel_prop_pairs_idx,
-                                            0], selected_rel_prop_pairs_idx] = 1
-            obj_pred_map_filtered[rel_inds[selected_rel_prop_pairs_idx,
-                                           1], selected_rel_prop_pairs_idx] = 1
+            mp_graph = graph.select(selected_rel_prop_pairs_idx)
             selected_relness = rel_prop_pairs_relness_batch_cat[selected_rel_prop_pairs_idx]
 
-            obj_obj_map = torch.zeros(sum(num_proposals), sum(num_proposals),
-                                      device=rel_pair_idxs[0].device).float()
-
-            obj_obj_map[rel_inds[selected_rel_prop_pairs_idx, 0],
-                        rel_inds[selected_rel_prop_pairs_idx, 1]] = 1
-            obj_obj_map[rel_inds[selected_rel_prop_pairs_idx, 1],
-                        rel_inds[selected_rel_prop_pairs_idx, 0]] = 1
-
-        return rel_inds, subj_pred_map, obj_pred_map, \
-               subj_pred_map_filtered, obj_pred_map_filtered, \
-               obj_obj_map, selected_relness
+        return graph, mp_graph, selected_relness
 
     def forward(self, inst_features, rel_union_features, proposals, rel_pair_inds, relatedness=None):
 
@@ -170,9 +123,13 @@ class GRCNN(nn.Module):
         num_inst_proposals = [len(b) for b in proposals]
 
         # all batch wise thing has been concate into one dim matrix
-        batchwise_rel_pair_inds, subj_pred_map, obj_pred_map, \
-        subj_pred_map_filtered, obj_pred_map_filtered, \
-        obj_obj_map, selected_relness = self._get_map_idxs(num_inst_proposals, rel_pair_inds, relatedness)
+        graph, mp_graph, selected_relness = self._get_map_idxs(num_inst_proposals, rel_pair_inds, relatedness)
+        # edges as (target, source) index, the relation to instance edges only on the valid pairs
+        inst2inst_edges = mp_graph.inst2inst_edges()
+        rel2sub_edges = mp_graph.rel2inst_edges(0)
+        rel2obj_edges = mp_graph.rel2inst_edges(1)
+        sub2rel_edges = graph.inst2rel_edges(0)
+        obj2rel_edges = graph.inst2rel_edges(1)
 
         x_obj = self.obj_embedding(augment_obj_feat)
         x_pred = self.rel_embedding(rel_feats)
@@ -183,25 +140,14 @@ class GRCNN(nn.Module):
 
         for t in range(self.feat_update_step):
             # message from other objects
-            update_feat_obj, vaild_mp_idx_obj = self.gcn_collect_feat(obj_feats[t], obj_feats[t], obj_obj_map,
+            update_feat_obj, vaild_mp_idx_obj = self.gcn_collect_feat(obj_feats[t], obj_feats[t], inst2inst_edges,
                                                                  GraphConvolutionCollectLayer.INST2INST)
 
             # message from predicates to instances
-            if subj_pred_map_filtered is not None:
-                update_feat_rel_sub, vaild_mp_idx_rel_sub = self.gcn_collect_feat(obj_feats[t], pred_feats[t],
-                                                                             subj_pred_map_filtered,
-                                                                             GraphConvolutionCollectLayer.REL2SUB)
-            else:
-                update_feat_rel_sub, vaild_mp_idx_rel_sub = self.gcn_collect_feat(obj_feats[t], pred_feats[t], subj_pred_map,
-                                                                             GraphConvolutionCollectLayer.REL2SUB)
-
-            if obj_pred_map_filtered is not None:
-                update_feat_rel_obj, vaild_mp_idx_rel_obj = self.gcn_collect_feat(obj_feats[t], pred_feats[t],
-                                                                             obj_pred_map_filtered,
-                                                                             GraphConvolutionCollectLayer.REL2OBJ)
-            else:
-                update_feat_rel_obj, vaild_mp_idx_rel_obj = self.gcn_collect_feat(obj_feats[t], pred_feats[t], obj_pred_map,
-                                                                             GraphConvolutionCollectLayer.REL2OBJ)
+            update_feat_rel_sub, vaild_mp_idx_rel_sub = self.gcn_collect_feat(obj_feats[t], pred_feats[t], rel2sub_edges,
+                                                                         GraphConvolutionCollectLayer.REL2SUB)
+            update_feat_rel_obj, vaild_mp_idx_rel_obj = self.gcn_collect_feat(obj_feats[t], pred_feats[t], rel2obj_edges,
+                                                                         GraphConvolutionCollectLayer.REL2OBJ)
 
             update_feat2ent_all = (update_feat_obj + update_feat_rel_sub + update_feat_rel_obj) / 3
 
@@ -217,9 +163,9 @@ class GRCNN(nn.Module):
             # print(torch.nonzero(torch.isnan(padded_next_stp_obj_feats)))
 
             '''update predicate features'''
-            source_obj_sub, vaild_mp_idx_obj_rel = self.gcn_collect_feat(pred_feats[t], obj_feats[t], subj_pred_map.t(),
+            source_obj_sub, vaild_mp_idx_obj_rel = self.gcn_collect_feat(pred_feats[t], obj_feats[t], sub2rel_edges,
                                                                          GraphConvolutionCollectLayer.SUB2REL)
-            source_obj_obj, vaild_mp_idx_sub_rel = self.gcn_collect_feat(pred_feats[t], obj_feats[t], obj_pred_map.t(),
+            source_obj_obj, vaild_mp_idx_sub_rel = self.gcn_collect_feat(pred_feats[t], obj_feats[t], obj2rel_edges,
                                                                          GraphConvolutionCollectLayer.OBJ2REL)
             source2rel_all = (source_obj_sub + source_obj_obj) / 2
 
@@ -247,27 +193,16 @@ class GRCNN(nn.Module):
 
         for t in range(self.score_update_step):
             '''entities to entities'''
-            update_feat_obj, vaild_mp_idx_obj = self.gcn_collect_score(obj_scores[t], obj_scores[t], obj_obj_map,
+            update_feat_obj, vaild_mp_idx_obj = self.gcn_collect_score(obj_scores[t], obj_scores[t], inst2inst_edges,
                                                                   GraphConvolutionCollectLayer.INST2INST)
 
             '''entities to predicates'''
-            if subj_pred_map_filtered is not None:
-                update_feat_rel_sub, vaild_mp_idx_rel_sub = self.gcn_collect_score(obj_scores[t], pred_scores[t],
-                                                                              subj_pred_map_filtered,
-                                                                              GraphConvolutionCollectLayer.REL2SUB)
-            else:
-                update_feat_rel_sub, vaild_mp_idx_rel_sub = self.gcn_collect_score(obj_scores[t], pred_scores[t],
-                                                                              subj_pred_map,
-                                                                              GraphConvolutionCollectLayer.REL2SUB)
-
-            if obj_pred_map_filtered is not None:
-                update_feat_rel_obj, vaild_mp_idx_rel_obj = self.gcn_collect_score(obj_scores[t], pred_scores[t],
-                                                                              obj_pred_map_filtered,
-                                                                              GraphConvolutionCollectLayer.REL2OBJ)
-            else:
-                update_feat_rel_obj, vaild_mp_idx_rel_obj = self.gcn_collect_score(obj_scores[t], pred_scores[t],
-                                                                              obj_pred_map,
-                                                                              GraphConvolutionCollectLayer.REL2OBJ)
+            update_feat_rel_sub, vaild_mp_idx_rel_sub = self.gcn_collect_score(obj_scores[t], pred_scores[t],
+                                                                          rel2sub_edges,
+                                                                          GraphConvolutionCollectLayer.REL2SUB)
+            update_feat_rel_obj, vaild_mp_idx_rel_obj = self.gcn_collect_score(obj_scores[t], pred_scores[t],
+                                                                          rel2obj_edges,
+                                                                          GraphConvolutionCollectLayer.REL2OBJ)
 
             padded_next_stp_obj_feats = obj_scores[t].clone()
             update_feat2ent_all = (update_feat_obj + update_feat_rel_sub + update_feat_rel_obj) / 3
@@ -283,10 +218,10 @@ class GRCNN(nn.Module):
 
             '''update predicate logits'''
             source_obj_sub, vaild_mp_idx_obj_rel = self.gcn_collect_score(pred_scores[t], obj_scores[t],
-                                                                          subj_pred_map.t(),
+                                                                          sub2rel_edges,
                                                                           GraphConvolutionCollectLayer.SUB2REL)
             source_obj_obj, vaild_mp_idx_sub_rel = self.gcn_collect_score(pred_scores[t], obj_scores[t],
-                                                                          obj_pred_map.t(),
+                                                                          obj2rel_edges,
                                                                           GraphConvolutionCollectLayer.OBJ2REL)
             source2rel_all = (source_obj_sub + source_obj_obj) / 2
 
@@ -331,49 +266,26 @@ class UpdateUnit(nn.Module):
         return update
 
 
-def prepare_message(target, source, adj_matrix, trans_fc, att_module):
+def prepare_message(target, source, edge_index, trans_fc, att_module):
+    """
+    :param target: (num_target, dim)
+    :param source: (num_source, dim)
+    :param edge_index: (target_idx, source_idx) of the edges, sorted by the target then the source
+    :return: the attention aggregated messages (num_target, dim) and the targets that receive messages
+    """
     # assert attention_base.size(0) == source.size(0), "source number must be equal to attention number"
     source = F.relu(trans_fc(source))
+    target_idx, source_idx = edge_index
 
-    max_income_edge_num = int(torch.max(adj_matrix.sum(1)).item())
-    att_mask = torch.ones(
-        (target.shape[0], max_income_edge_num), device=source.device, dtype=torch.bool)
-    vaild_mp_idx = []
-
-    active_nodes_num = 0
-    active_nodes_id = []
-    active_nodes_indices = []
-    for f_id in range(target.shape[0]):
-        tmp_idx = squeeze_tensor(torch.nonzero(adj_matrix[f_id]))
-        if len(tmp_idx) > 0:
-            active_nodes_indices.append(tmp_idx)
-            active_nodes_num += 1
-            active_nodes_id.append(f_id)
-
-    active_nodes_iter = 0
-    selected_idx = []
-    # generate idx in loops, do indexing at once
-    for i, f_id in enumerate(active_nodes_id):
-        # do 1 to N attention:
-        #    multiple source nodes to single target node
-        indices = active_nodes_indices[i]
-        att_mask[f_id, torch.arange(len(indices))] = False
-        padding = torch.zeros((max_income_edge_num - len(indices)), dtype=torch.long, device=indices.device)
-        indices = torch.cat((indices, padding), dim=0)
-
-        selected_idx.append(indices)
-        active_nodes_iter += 1
-
-    # reshape the indexs ad indexing
-    selected_idx = torch.cat(selected_idx, dim=0)
-    att_sources = source[selected_idx].reshape(active_nodes_iter, max_income_edge_num, -1)
-
-    vaild_mp_idx = torch.Tensor(active_nodes_id).long().to(target.device)
+    # do 1 to N attention:
+    #    multiple source nodes to single target node, the sources of each target are
+    #    gathered into one padded row at once
+    vaild_mp_idx, padded_edge_idx, att_mask = segment_to_padded(target_idx, target.shape[0])
+    att_sources = source[source_idx[padded_edge_idx]]  # aggrate_num, source_num, dim
 
     att_targets = target[vaild_mp_idx].unsqueeze(0).contiguous()  # 1, aggrate_num, dim
     att_sources = att_sources.transpose(0, 1).contiguous()  # source_num, aggrate_num, dim
 
-    att_mask = att_mask[vaild_mp_idx]
     att_res, att_weight = att_module(query=att_targets, key=att_sources, value=att_sources,
                                      key_padding_mask=att_mask) # 1 to source
     att_res = squeeze_tensor(att_res)
@@ -414,8 +326,8 @@ class GraphConvolutionCollectLayer(nn.Module):
             nn.MultiheadAttention(num_heads=att_head_num, embed_dim=dim_obj),
         ])
 
-    def forward(self, target, source, adjc_matrix, unit_id):
-        collection, vaild_mp_idx = prepare_message(target, source, adjc_matrix,
+    def forward(self, target, source, edge_index, unit_id):
+        collection, vaild_mp_idx = prepare_message(target, source, edge_index,
                                                    self.collect_units_fc[unit_id],
                                                    self.collect_units_att_module[unit_id])
 
@@ -14,6 +14,7 @@ from pysgg.modeling.roi_heads.relation_head.model_msg_passing import (
 from pysgg.modeling.roi_heads.relation_head.rel_proposal_network.models import (
     make_relation_confidence_aware_module,
 )
+from pysgg.modeling.roi_heads.relation_head.utils_graph import RelationGraphBatch, segment_mean
 from pysgg.structures.boxlist_ops import squeeze_tensor
 
 
@@ -526,10 +527,9 @@ class BGNNContext(nn.Module):
 
             rel_inds,
                 extent the instances pairing matrix to the batch wised (num_rel, 2)
-            subj_pred_map,
-                how the instances related to the relation predicates as the subject (num_inst, rel_pair_num)
-            obj_pred_map
-                how the instances related to the relation predicates as the object (num_inst, rel_pair_num)
+            mp_graph,
+                RelationGraphBatch, how the instances related to the relation predicates
+                as the subject and object, only the selected relationship pass messages
             selected_relness,
                 the relatness score for selected relationship proposal that send message to adjency nodes (val_rel_pair_num, 1)
             selected_rel_prop_pairs_idx
@@ -561,18 +561,6 @@ class BGNNContext(nn.Module):
             rel_inds_batch_cat.append(rel_ind_i)
         rel_inds_batch_cat = torch.cat(rel_inds_batch_cat, 0)
 
-        subj_pred_map = (
-            rel_inds_batch_cat.new(sum(num_proposals), rel_inds_batch_cat.shape[0])
-            .fill_(0)
-            .float()
-            .detach()
-        )
-        obj_pred_map = (
-            rel_inds_batch_cat.new(sum(num_proposals), rel_inds_batch_cat.shape[0])
-            .fill_(0)
-            .float()
-            .detach()
-        )
         # only message passing on valid pairs
 
         if len(rel_prop_pairs_relness_batch) != 0:
@@ -634,14 +622,6 @@ class BGNNContext(nn.Module):
                     rel_prop_pairs_relness_batch_update, 0
                 )
 
-            subj_pred_map[
-                rel_inds_batch_cat[selected_rel_prop_pairs_idx, 0],
-                selected_rel_prop_pairs_idx,
-            ] = 1
-            obj_pred_map[
-                rel_inds_batch_cat[selected_rel_prop_pairs_idx, 1],
-                selected_rel_prop_pairs_idx,
-            ] = 1
             selected_relness = rel_prop_pairs_relness_batch_cat
         else:
             # or all relationship pairs
@@ -649,12 +629,12 @@ class BGNNContext(nn.Module):
                 len(rel_inds_batch_cat[:, 0]), device=rel_inds_batch_cat.device
             )
             selected_relness = None
-            subj_pred_map.scatter_(0, (rel_inds_batch_cat[:, 0].contiguous().view(1, -1)), 1)
-            obj_pred_map.scatter_(0, (rel_inds_batch_cat[:, 1].contiguous().view(1, -1)), 1)
+        mp_graph = RelationGraphBatch(
+            rel_inds_batch_cat, sum(num_proposals), selected_rel_prop_pairs_idx
+        )
         return (
             rel_inds_batch_cat,
-            subj_pred_map,
-            obj_pred_map,
+            mp_graph,
             selected_relness,
             selected_rel_prop_pairs_idx,
         )
@@ -665,7 +645,7 @@ class BGNNContext(nn.Module):
         self,
         target_features,
         source_features,
-        select_mat,
+        edge_index,
         gate_module,
         relness_scores=None,
         relness_logits=None,
@@ -676,79 +656,47 @@ class BGNNContext(nn.Module):
         Then the message passing process can be
         :param target_features: (num_inst, dim)
         :param source_features: (num_rel, dim)
-        :param select_mat:  (num_inst, rel_pair_num)
+        :param edge_index:  (target_indices, source_indices) of the message passing edges
         :param gate_module:
         :param relness_scores: (num_rel, )
         :param relness_logit (num_rel, num_rel_category)
 
         :return: messages representation: (num_inst, dim)
         """
-        feature_data = []
+        target_indices, source_indices = edge_index
 
-        if select_mat.sum() == 0:
-            temp = torch.zeros(
-                (target_features.size()[1:]),
-                requires_grad=True,
-                dtype=target_features.dtype,
-                device=target_features.dtype,
-            )
-            feature_data = torch.stack(temp, 0)
-        else:
-            transfer_list = (select_mat > 0).nonzero()
-            source_indices = transfer_list[:, 1]
-            target_indices = transfer_list[:, 0]
-            source_f = torch.index_select(source_features, 0, source_indices)
-            target_f = torch.index_select(target_features, 0, target_indices)
+        if len(source_indices) == 0:
+            return target_features.new_zeros(target_features.shape)
 
-            select_relness = relness_scores[source_indices]
+        source_f = torch.index_select(source_features, 0, source_indices)
+        target_f = torch.index_select(target_features, 0, target_indices)
 
-            if self.gating_with_relness_logits:
-                assert relness_logits is not None
+        select_relness = relness_scores[source_indices]
 
-                # relness_dist =  relness_logits
-                select_relness_dist = torch.sigmoid(relness_logits[source_indices])
+        if self.gating_with_relness_logits:
+            assert relness_logits is not None
 
-                if self.relness_weighting_mp:
-                    transferred_features, weighting_gate = gate_module(
-                        target_f, source_f, select_relness_dist, select_relness
-                    )
-                else:
-                    transferred_features, weighting_gate = gate_module(
-                        target_f, source_f, select_relness_dist
-                    )
-            else:
-                if self.relness_weighting_mp:
-                    select_relness = relness_scores[transfer_list[:, 1]]
-                    transferred_features, weighting_gate = gate_module(
-                        target_f, source_f, select_relness
-                    )
-                else:
-                    transferred_features, weighting_gate = gate_module(target_f, source_f)
-            aggregator_matrix = torch.zeros(
-                (target_features.shape[0], transferred_features.shape[0]),
-                dtype=weighting_gate.dtype,
-                device=weighting_gate.device,
-            )
+            # relness_dist =  relness_logits
+            select_relness_dist = torch.sigmoid(relness_logits[source_indices])
 
-            for f_id in range(target_features.shape[0]):
-                if select_mat[f_id, :].data.sum() > 0:
-                    # average from the multiple sources
-                    feature_indices = squeeze_tensor(
-                        (transfer_list[:, 0] == f_id).nonzero()
-                    )  # obtain source_relevant_idx
-                    # (target, source_relevant_idx)
-                    aggregator_matrix[f_id, feature_indices] = 1
-            # (target, source_relevant_idx) @ (source_relevant_idx, feat-dim) => (target, feat-dim)
-            aggregate_feat = torch.matmul(aggregator_matrix, transferred_features)
-            avg_factor = aggregator_matrix.sum(dim=1)
-            vaild_aggregate_idx = avg_factor != 0
-            avg_factor = avg_factor.unsqueeze(1).expand(
-                avg_factor.shape[0], aggregate_feat.shape[1]
-            )
-            aggregate_feat[vaild_aggregate_idx] /= avg_factor[vaild_aggregate_idx]
+            if self.relness_weighting_mp:
+                transferred_features, weighting_gate = gate_module(
+                    target_f, source_f, select_relness_dist, select_relness
+                )
+            else:
+                transferred_features, weighting_gate = gate_module(
+                    target_f, source_f, select_relness_dist
+                )
+        else:
+            if self.relness_weighting_mp:
+                transferred_features, weighting_gate = gate_module(
+                    target_f, source_f, select_relness
+                )
+            else:
+                transferred_features, weighting_gate = gate_module(target_f, source_f)
 
-            feature_data = aggregate_feat
-        return feature_data
+        # average from the multiple sources of each target
+        return segment_mean(transferred_features, target_indices, target_features.shape[0])
 
     # def pairwise_rel_features(self, augment_obj_feat, rel_pair_idxs):
     #     pairwise_obj_feats_fused = self.pairwise_obj_feat_updim_fc(augment_obj_feat)
@@ -867,8 +815,7 @@ class BGNNContext(nn.Module):
 
                 (
                     batchwise_rel_pair_inds,
-                    subj_pred_map,
-                    obj_pred_map,
+                    mp_graph,
                     relness_scores,
                     selected_rel_prop_pairs_idx,
                 ) = self._prepare_adjacency_matrix(
@@ -878,15 +825,12 @@ class BGNNContext(nn.Module):
                 if (
                     len(squeeze_tensor(valid_inst_idx.nonzero())) < 1
                     or len(squeeze_tensor(batchwise_rel_pair_inds.nonzero())) < 1
-                    or len(squeeze_tensor(subj_pred_map.nonzero())) < 1
-                    or len(squeeze_tensor(obj_pred_map.nonzero())) < 1
+                    or mp_graph.num_edges() < 1
                     or self.pretrain_pre_clser_mode
                 ):  # directly return, no mp process
 
                     # print("valid_inst_idx", valid_inst_idx.nonzero())
                     # print("batchwise_rel_pair_inds", batchwise_rel_pair_inds.nonzero())
-                    # print("subj_pred_map", subj_pred_map.nonzero())
-                    # print("obj_pred_map", obj_pred_map.nonzero())
                     # print("WARNING: all graph nodes has been filtered out. ")
 
                     refined_inst_features = inst_feature4iter[-1]
@@ -906,7 +850,7 @@ class BGNNContext(nn.Module):
                 object_sub = self.prepare_message(
                     inst_feature4iter[t],
                     rel_feature4iter[t],
-                    subj_pred_map,
+                    (mp_graph.edge_sub_idx, mp_graph.edge_rel_idx),
                     self.gate_pred2sub[param_idx],
                     relness_scores=relness_scores,
                     relness_logits=pre_cls_logits,
@@ -914,7 +858,7 @@ class BGNNContext(nn.Module):
                 object_obj = self.prepare_message(
                     inst_feature4iter[t],
                     rel_feature4iter[t],
-                    obj_pred_map,
+                    (mp_graph.edge_obj_idx, mp_graph.edge_rel_idx),
                     self.gate_pred2obj[param_idx],
                     relness_scores=relness_scores,
                     relness_logits=pre_cls_logits,
@@ -9,6 +9,7 @@ from pysgg.modeling.make_layers import make_fc
 from pysgg.modeling.roi_heads.relation_head.model_motifs import FrequencyBias
 from pysgg.modeling.roi_heads.relation_head.model_msg_passing import PairwiseFeatureExtractor
 from pysgg.modeling.roi_heads.relation_head.rel_proposal_network.models import make_relation_confidence_aware_module
+from pysgg.modeling.roi_heads.relation_head.utils_graph import segment_softmax, segment_sum
 from pysgg.structures.boxlist_ops import squeeze_tensor
 
 
@@ -70,10 +71,24 @@ def multichnl_matmul(tensor3d, mat):
 
 
 class MessageGenerator(nn.Module):
-    def __init__(self, input_dims, hidden_dim):
+    def __init__(self, input_dims, hidden_dim, attention_mode="dense"):
+        """
+
+        Args:
+            input_dims:
+            hidden_dim:
+            attention_mode: "dense" normalizes the attention on the n_nodes x n_nodes matrix,
+                "edge" only computes it on the relation pairs with a segment softmax per node.
+                the dense softmax shifts by the global max and adds 1e-6 to each row sum, so a row
+                is scaled by row_sum / (row_sum + 1e-6) against the edge one: negligible when the
+                logits of the row are close to the global max, but the dense attention of a node
+                whose logits are all far below it (by ~14 or more) shrinks towards zero
+        """
         super(MessageGenerator, self).__init__()
         self.input_dims = input_dims
         self.hidden_dim = hidden_dim
+        assert attention_mode in ("dense", "edge")
+        self.attention_mode = attention_mode
 
         self.output_fc = nn.Sequential(nn.Linear(self.input_dims, self.input_dims // 4),
                                        nn.LayerNorm(self.input_dims // 4),
@@ -85,6 +100,9 @@ class MessageGenerator(nn.Module):
             nn.Linear(self.input_dims, self.input_dims // 2))  # down dim for the bidirectional message
 
     def forward(self, source_features, weighting_gate, rel_pair_idx, relness_score=None):
+        if self.attention_mode == "edge":
+            return self.edge_forward(source_features, weighting_gate, rel_pair_idx, relness_score)
+
         n_nodes = source_features.shape[0]
 
         # apply a masked softmax on the attention logits
@@ -131,6 +149,36 @@ class MessageGenerator(nn.Module):
 
         return padded_msg_feat
 
+    def edge_forward(self, source_features, weighting_gate, rel_pair_idx, relness_score=None):
+        """
+        same messages as the dense path, but the attention only lives on the relation pairs:
+        each subject normalizes the attention over its pairs, then the message of the
+        object is sent to the subject and the message of the subject is sent back to the object
+        """
+        n_nodes = source_features.shape[0]
+        sub_idx = rel_pair_idx[:, 0]
+        obj_idx = rel_pair_idx[:, 1]
+
+        atten = segment_softmax(weighting_gate.view(-1), sub_idx, n_nodes)
+
+        # apply the relness scores
+        if relness_score is not None:
+            atten = atten * relness_score
+
+        # bidirectional msp attention
+        source_msg = self.message_fc(source_features)
+        atten = atten.unsqueeze(1)
+        message_feats = torch.cat((segment_sum(atten * source_msg[obj_idx], sub_idx, n_nodes),
+                                   segment_sum(atten * source_msg[sub_idx], obj_idx, n_nodes)), -1)
+
+        vaild_msg_idx = squeeze_tensor(segment_sum(atten, sub_idx, n_nodes).view(-1).nonzero())
+
+        padded_msg_feat = torch.zeros((n_nodes, self.hidden_dim),
+                                      dtype=source_features.dtype, device=source_features.device)
+        padded_msg_feat[vaild_msg_idx] += self.output_fc(torch.index_select(message_feats, 0, vaild_msg_idx))
+
+        return padded_msg_feat
+
 
 class MessagePassingUnit(nn.Module):
     def __init__(self, hidden_dim, filter_dim=128):
@@ -232,7 +280,8 @@ class GPSNetContext(nn.Module):
         )
 
         self.obj2obj_gating_model = GatingModel(self.pooling_dim, self.pooling_dim, self.hidden_dim)
-        self.obj2obj_msg_gen = MessageGenerator(self.pooling_dim, self.hidden_dim)
+        self.obj2obj_msg_gen = MessageGenerator(self.pooling_dim, self.hidden_dim,
+                                                cfg.MODEL.ROI_RELATION_HEAD.GPSNET_MODULE.MSG_ATTENTION)
 
         self.sub2pred_msp = MessagePassingUnit(self.hidden_dim, 64)
         self.obj2pred_msp = MessagePassingUnit(self.hidden_dim, 64)
@@ -1,5 +1,6 @@
 # Well, this file contains modules of GGNN_obj and GGNN_rel
 import numpy as np
+import torch
 import torch.nn as nn
 from torch.autograd import Variable
 
@@ -50,23 +51,40 @@ class GGNNObj(nn.Module):
         self.ReLU = nn.ReLU(True)
         self.fc_obj_cls = nn.Linear(self.num_obj_cls * output_dim, self.num_obj_cls)
 
-    def forward(self, instance_feats):
+    def aggregate(self, hidden, img_ids, num_img):
+        """
+        eq(2) for all the nodes at once, each instance gathers the other instances of its image
+
+        :param hidden: (num_instances, num_obj_cls, hidden_dim)
+        :param img_ids: (num_instances, ) image index of each instance
+        :param num_img:
+        :return: (num_instances * num_obj_cls, 2 * hidden_dim)
+        """
+        hidden_sum = hidden.new_zeros((num_img,) + hidden.shape[1:]).index_add_(0, img_ids, hidden)
+        hidden_others = hidden_sum[img_ids] - hidden
+        av = torch.cat((torch.matmul(self.matrix.transpose(0, 1), hidden_others),
+                        torch.matmul(self.matrix, hidden_others)), 2)
+        return av.view(-1, av.shape[-1])
+
+    def forward(self, instance_feats, num_objs=None):
         """
 
         :param instance_feats: batch concatenated instance features (num_instances, hidden_dim)
+        :param num_objs: instance number of each image, the instances propagate within their image,
+                         all of them are one image by default
         :return:
         """
         # propogation process
         num_object = instance_feats.size()[0]
+        if num_objs is None:
+            num_objs = [num_object]
+        img_ids = torch.arange(len(num_objs), device=instance_feats.device).repeat_interleave(
+            torch.as_tensor(num_objs, device=instance_feats.device))
         # (num_instances, num_obj_cls, hidden_dim)
         hidden = instance_feats.repeat(1, self.num_obj_cls).view(num_object, self.num_obj_cls, -1)
         for t in range(self.time_step_num):
             # eq(2)
-            # here we use some matrix operation skills
-            hidden_sum = torch.sum(hidden, 0)
-            av = torch.cat(
-                [torch.cat([self.matrix.transpose(0, 1) @ (hidden_sum - hidden_i) for hidden_i in hidden], 0),
-                 torch.cat([self.matrix @ (hidden_sum - hidden_i) for hidden_i in hidden], 0)], 1)
+            av = self.aggregate(hidden, img_ids, len(num_objs))
 
             # eq(3)
             hidden = hidden.view(num_object * self.num_obj_cls, -1)
@@ -95,7 +113,9 @@ class GGNNRel(nn.Module):
         super(GGNNRel, self).__init__()
         self.num_rel_cls = num_rel_cls
         self.time_step_num = time_step_num
-        self.matrix = np.load(prior_matrix).astype(np.float32)
+        # a buffer follows the module to its device, the checkpoints saved before it was registered
+        # still load since the missing keys keep the prior loaded here
+        self.register_buffer("matrix", torch.from_numpy(np.load(prior_matrix).astype(np.float32)))
         self.use_knowledge = use_knowledge
         self.avg_graph_sum = cfg.MODEL.ROI_RELATION_HEAD.KERN_MODULE.AVERAGE_GRAPH_SUMMARY
 
@@ -111,23 +131,26 @@ class GGNNRel(nn.Module):
         if not self.avg_graph_sum:
             self.fc_output_2 = nn.Linear((self.num_rel_cls + 2) * output_dim, output_dim)
 
+    def prior_adjacency(self, sub_obj_preds, input_ggnn):
+        """
+        the adjacency between the subject, object nodes and the predicate nodes of each relation
+
+        :param sub_obj_preds: (num_rel, 2) predicted labels of the subject and object
+        :param input_ggnn: (num_rel, num_rel_cls + 2, hidden_dim)
+        :return: (num_rel, 2, num_rel_cls)
+        """
+        if self.use_knowledge:  # construct adjacency matrix depending on the predicted labels of subject and object.
+            sub_obj_preds = sub_obj_preds.long()
+            prior = self.matrix[sub_obj_preds[:, 0], sub_obj_preds[:, 1]]
+        else:
+            prior = input_ggnn.new_full((input_ggnn.shape[0], self.num_rel_cls), 1.0 / float(self.num_rel_cls))
+        return prior.unsqueeze(1).repeat(1, 2, 1)
+
     def forward(self, rel_inds, sub_obj_preds, input_ggnn):
 
         (input_rel_num, node_num, _) = input_ggnn.size()
         assert input_rel_num == len(rel_inds)
-        batch_in_matrix_sub = np.zeros((input_rel_num, 2, self.num_rel_cls), dtype=np.float32)
-
-        if self.use_knowledge:  # construct adjacency matrix depending on the predicted labels of subject and object.
-            for index, rel in enumerate(rel_inds):
-                batch_in_matrix_sub[index][0] = \
-                    self.matrix[sub_obj_preds[index, 0].cpu().data, sub_obj_preds[index, 1].cpu().data]
-                batch_in_matrix_sub[index][1] = batch_in_matrix_sub[index][0]
-        else:
-            for index, rel in enumerate(rel_inds):
-                batch_in_matrix_sub[index][0] = 1.0 / float(self.num_rel_cls)
-                batch_in_matrix_sub[index][1] = batch_in_matrix_sub[index][0]
-        batch_in_matrix_sub_gpu = Variable(torch.from_numpy(batch_in_matrix_sub), requires_grad=False).cuda()
-        del batch_in_matrix_sub
+        batch_in_matrix_sub_gpu = self.prior_adjacency(sub_obj_preds, input_ggnn)
 
         hidden = input_ggnn
         hidden_save = []
@@ -181,7 +204,8 @@ class GGNNObjReason(nn.Module):
         self.num_obj_cls = num_obj_cls
         self.obj_proj = nn.Linear(obj_dim, hidden_dim)
         self.ggnn_obj = GGNNObj(num_obj_cls=num_obj_cls, time_step_num=time_step_num, hidden_dim=hidden_dim,
-                                output_dim=output_dim, use_knowledge=use_knowledge, prior_matrix=knowledge_matrix)
+                                output_dim=output_dim, use_prior_prob_knowledge=use_knowledge,
+                                prior_matrix=knowledge_matrix)
 
     def forward(self, im_inds, obj_fmaps, obj_labels):
         """
@@ -195,12 +219,9 @@ class GGNNObjReason(nn.Module):
         else:
             input_ggnn = self.obj_proj(obj_fmaps)
 
-            lengths = []
-            for i, s, e in enumerate_by_image(im_inds.data):
-                lengths.append(e - s)
-            obj_cum_add = np.cumsum([0] + lengths)
-            obj_dists = torch.cat(
-                [self.ggnn_obj(input_ggnn[obj_cum_add[i]: obj_cum_add[i + 1]]) for i in range(len(lengths))], 0)
+            # im_inds are sorted by image
+            lengths = torch.bincount(im_inds.long()).tolist()
+            obj_dists = self.ggnn_obj(input_ggnn, lengths)
             return obj_dists
 
 
@@ -233,31 +254,31 @@ class GGNNRelReason(nn.Module):
         self.ggnn_rel = GGNNRel(num_rel_cls=num_rel_cls, time_step_num=time_step_num, hidden_dim=hidden_dim,
                                 output_dim=output_dim, use_knowledge=use_knowledge, prior_matrix=knowledge_matrix)
 
-    def forward(self, inst_feats, union_feats, sub_obj_preds, rel_pair_idxs):
+    def forward(self, inst_feats, union_feats, sub_obj_preds, rel_pair_idxs, num_objs):
         """
         Reason relationship classes using knowledge of object and relationship coccurrence.
         all features vectors are batch concatenated
         :param inst_feats: (num_instances, hidden_dim)
-        :param rel_pair_idxs: num_rel, 2
+        :param rel_pair_idxs: list of (num_rel, 2) pair index of each image
         :param union_feats: num_rel, pooling_dim
-        :param inst_pred_labels: instance prediction labels, pass GT while training
+        :param sub_obj_preds: (num_rel, 2) instance prediction labels of the pairs, pass GT while training
+        :param num_objs: instance number of each image
         :return:
         """
 
         batched_rel_pair_idx = []
         start = 0
-        for idx in range(len(rel_pair_idxs)):
-            batched_rel_pair_idx.append(rel_pair_idxs[idx] + start)
-            start += torch.max(rel_pair_idxs[idx])
+        for pair_idx, num_obj in zip(rel_pair_idxs, num_objs):
+            batched_rel_pair_idx.append(pair_idx.long() + start)
+            start += num_obj
         batched_rel_pair_idx = torch.cat(batched_rel_pair_idx)
 
         inst_feats = self.instance_fc(inst_feats)
         union_feats = self.rel_union_feat_fc(union_feats)
         # (num_rel, num_rel_cls + 2, hidden_dim )
-        gnn_input = torch.stack([torch.cat([inst_feats[rel_ind[0]].unsqueeze(0),  # 1, hidden_dim
-                                            inst_feats[rel_ind[1]].unsqueeze(0),  # 1, hidden_dim
-                                            union_feats[index].repeat(self.num_rel_cls, 1)], 0)  # 51, hidden_dim
-                                 for index, rel_ind in enumerate(batched_rel_pair_idx)])
+        gnn_input = torch.cat((inst_feats[batched_rel_pair_idx[:, 0]].unsqueeze(1),  # 1, hidden_dim
+                               inst_feats[batched_rel_pair_idx[:, 1]].unsqueeze(1),  # 1, hidden_dim
+                               union_feats.unsqueeze(1).expand(-1, self.num_rel_cls, -1)), 1)  # 51, hidden_dim
         rel_dists = self.ggnn_rel(batched_rel_pair_idx, sub_obj_preds, gnn_input)
 
         return rel_dists
@@ -7,11 +7,13 @@ from torch.nn import functional as F
 from torch.nn.utils.rnn import PackedSequence
 
 from pysgg.modeling.utils import cat
+from pysgg.structures.boxes_per_cls import cat_boxes_per_cls
+from .classifier import FoldedWeightMixin
 from .utils_motifs import obj_edge_vectors, center_x, sort_by_score, to_onehot, get_dropout_mask, encode_box_info
-from .utils_relation import nms_overlaps
+from .utils_relation import packed_label_nms
 
 
-class FrequencyBias(nn.Module):
+class FrequencyBias(FoldedWeightMixin, nn.Module):
     """
     The goal of this is to provide a simplified way of computing
     P(predicate | obj1, obj2, img).
@@ -19,23 +21,73 @@ class FrequencyBias(nn.Module):
 
     def __init__(self, cfg, statistics, eps=1e-3):
         super(FrequencyBias, self).__init__()
+        if statistics['pred_dist'].is_sparse:
+            self._init_sparse(statistics)
+            return
         pred_dist = np.log(statistics['pred_dist'].float())
         assert pred_dist.size(0) == pred_dist.size(1)
 
         self.num_objs = pred_dist.size(0)
         self.num_rels = pred_dist.size(2)
         pred_dist = pred_dist.view(-1, self.num_rels)
+        self.pair_index = None
 
         self.obj_baseline = nn.Embedding(self.num_objs * self.num_objs, self.num_rels)
         with torch.no_grad():
             self.obj_baseline.weight.copy_(pred_dist, non_blocking=True)
 
-    def index_with_labels(self, labels):
+    def _init_sparse(self, statistics):
+        """
+        one row for each subject-object pair seen in training, the pairs never seen share the last row
+        """
+        pred_dist = statistics['pred_dist'].coalesce()
+        assert pred_dist.size(0) == pred_dist.size(1)
+
+        self.num_objs = pred_dist.size(0)
+        self.num_rels = pred_dist.size(2)
+        pair_cls = pred_dist.indices()[:2, ::self.num_rels]
+        num_pairs = pair_cls.size(1)
+        pred_dist = torch.cat((pred_dist.values().float().view(num_pairs, self.num_rels),
+                               statistics['pred_dist_default'].float().view(1, self.num_rels)), 0)
+
+        pair_index = torch.full((self.num_objs * self.num_objs,), num_pairs, dtype=torch.int32)
+        pair_index[pair_cls[0] * self.num_objs + pair_cls[1]] = torch.arange(num_pairs, dtype=torch.int32)
+        self.register_buffer("pair_index", pair_index)
+        self.register_buffer("pair_sub_cls", pair_cls[0].clone())
+        self.register_buffer("pair_obj_cls", pair_cls[1].clone())
+
+        self.obj_baseline = nn.Embedding(num_pairs + 1, self.num_rels)
+        with torch.no_grad():
+            self.obj_baseline.weight.copy_(torch.log(pred_dist), non_blocking=True)
+
+    def prepare_for_inference(self, scale=None):
+        """
+        :param scale: the weight of the bias in the logits, folded into the table
+        """
+        # a plain number, the scale parameter of the predictor is not registered again here
+        self.fold_scale = None if scale is None else float(scale)
+        return super(FrequencyBias, self).prepare_for_inference()
+
+    def fold_weight(self):
+        if self.fold_scale is None:
+            return self.obj_baseline.weight, None
+        return self.fold_scale * self.obj_baseline.weight, None
+
+    def index_with_labels(self, labels, scale=None):
         """
         :param labels: [batch_size, 2] 
+        :param scale: the weight of the bias, already in the table after prepare_for_inference
         :return: 
         """
-        return self.obj_baseline(labels[:, 0] * self.num_objs + labels[:, 1])
+        pair_idx = labels[:, 0] * self.num_objs + labels[:, 1]
+        if self.pair_index is not None:
+            pair_idx = self.pair_index[pair_idx].long()
+        if self.frozen:
+            assert scale is None or float(scale) == self.fold_scale, \
+                "the frequency bias was folded with the scale {}, not {}".format(self.fold_scale, float(scale))
+            return F.embedding(pair_idx, self.folded_weight()[0])
+        freq_bias = self.obj_baseline(pair_idx)
+        return freq_bias if scale is None else scale * freq_bias
 
     def index_with_probability(self, pair_prob):
         """
@@ -44,6 +96,13 @@ class FrequencyBias(nn.Module):
         """
         batch_size, num_obj, _ = pair_prob.shape
 
+        if self.pair_index is not None:
+            # every pair takes the shared row, the seen pairs add the difference to their own row
+            default_baseline = self.obj_baseline.weight[-1:]
+            total_prob = pair_prob[:, :, 0].sum(1, keepdim=True) * pair_prob[:, :, 1].sum(1, keepdim=True)
+            seen_prob = pair_prob[:, self.pair_sub_cls, 0] * pair_prob[:, self.pair_obj_cls, 1]
+            return total_prob * default_baseline + seen_prob @ (self.obj_baseline.weight[:-1] - default_baseline)
+
         joint_prob = pair_prob[:, :, 0].contiguous().view(batch_size, num_obj, 1) * pair_prob[:, :,
                                                                                     1].contiguous().view(batch_size, 1,
                                                                                                          num_obj)
@@ -191,7 +250,6 @@ class DecoderRNN(nn.Module):
                 refined_obj_labels.append(labels_to_embed)
                 previous_obj_embed = self.obj_embed(labels_to_embed + 1)
             else:
-                assert l_batch == 1
                 out_dist_sample = F.softmax(pred_dist, dim=1)
                 best_ind = out_dist_sample[:, 1:].max(1)[1] + 1
                 refined_obj_labels.append(best_ind)
@@ -199,22 +257,9 @@ class DecoderRNN(nn.Module):
 
         # Do NMS here as a post-processing step
         if boxes_for_nms is not None and not self.training:
-            is_overlap = nms_overlaps(boxes_for_nms).view(
-                boxes_for_nms.size(0), boxes_for_nms.size(0), boxes_for_nms.size(1)
-            ).cpu().numpy() >= self.nms_thresh
-
-            out_dists_sampled = F.softmax(torch.cat(out_dists, 0), 1).cpu().numpy()
-            out_dists_sampled[:, 0] = 0
-
-            refined_obj_labels = refined_obj_labels[0].new(len(refined_obj_labels)).fill_(0)
-
-            for i in range(refined_obj_labels.size(0)):
-                box_ind, cls_ind = np.unravel_index(out_dists_sampled.argmax(), out_dists_sampled.shape)
-                refined_obj_labels[int(box_ind)] = int(cls_ind)
-                out_dists_sampled[is_overlap[box_ind, :, cls_ind], cls_ind] = 0.0
-                out_dists_sampled[box_ind] = -1.0  # This way we won't re-sample
-
-            refined_obj_labels = refined_obj_labels
+            # greedy label nms on all the sequences of the batch together
+            refined_obj_labels = packed_label_nms(torch.cat(out_dists, 0), boxes_for_nms,
+                                                  batch_lengths, self.nms_thresh)
         else:
             refined_obj_labels = torch.cat(refined_obj_labels, 0)
 
@@ -301,7 +346,9 @@ class LSTMContext(nn.Module):
         c_x = center_x(proposals)
         # leftright order
         scores = c_x / (c_x.max() + 1)
-        return sort_by_score(proposals, scores)
+        # the batched decoding of the test images needs one image per sequence
+        group_images = (not self.training) or self.cfg.MODEL.ROI_RELATION_HEAD.CONTEXT_GROUP_IMAGES_IN_TRAINING
+        return sort_by_score(proposals, scores, group_images)
 
     def obj_ctx(self, obj_feats, proposals, obj_labels=None, boxes_per_cls=None, ctx_average=False):
         """
@@ -394,8 +441,7 @@ class LSTMContext(nn.Module):
 
         boxes_per_cls = None
         if self.mode == 'sgdet' and not self.training:
-            boxes_per_cls = cat([proposal.get_field('boxes_per_cls') for proposal in proposals],
-                                dim=0)  # comes from post process of box_head
+            boxes_per_cls = cat_boxes_per_cls(proposals)  # comes from post process of box_head
 
         # object level contextual feature
         obj_dists, obj_preds, obj_ctx, perm, inv_perm, ls_transposed = self.obj_ctx(obj_pre_rep, proposals, obj_labels,
@@ -6,8 +6,9 @@ from torch import nn
 from torch.nn.utils.rnn import PackedSequence
 from torch.nn import functional as F
 from pysgg.modeling.utils import cat
+from pysgg.structures.boxes_per_cls import cat_boxes_per_cls
 from .utils_motifs import obj_edge_vectors, center_x, sort_by_score, to_onehot, get_dropout_mask, encode_box_info, generate_attributes_target, normalize_sigmoid_logits
-from .utils_relation import nms_overlaps
+from .utils_relation import packed_label_nms
 
 class AttributeDecoderRNN(nn.Module):
     def __init__(self, config, obj_classes, att_classes, embed_dim, inputs_dim, hidden_dim, rnn_drop):
@@ -145,7 +146,6 @@ class AttributeDecoderRNN(nn.Module):
                 out_commitments.append(labels_to_embed)
                 previous_obj_embed = self.obj_embed(labels_to_embed+1)
             else:
-                assert l_batch == 1
                 out_dist_sample = F.softmax(pred_dist, dim=1)
                 best_ind = out_dist_sample[:, 1:].max(1)[1] + 1
                 out_commitments.append(best_ind)
@@ -155,22 +155,9 @@ class AttributeDecoderRNN(nn.Module):
 
         # Do NMS here as a post-processing step
         if boxes_for_nms is not None and not self.training:
-            is_overlap = nms_overlaps(boxes_for_nms).view(
-                boxes_for_nms.size(0), boxes_for_nms.size(0), boxes_for_nms.size(1)
-            ).cpu().numpy() >= self.nms_thresh
-
-            out_dists_sampled = F.softmax(torch.cat(out_dists,0), 1).cpu().numpy()
-            out_dists_sampled[:,0] = 0
-
-            out_commitments = out_commitments[0].new(len(out_commitments)).fill_(0)
-
-            for i in range(out_commitments.size(0)):
-                box_ind, cls_ind = np.unravel_index(out_dists_sampled.argmax(), out_dists_sampled.shape)
-                out_commitments[int(box_ind)] = int(cls_ind)
-                out_dists_sampled[is_overlap[box_ind,:,cls_ind], cls_ind] = 0.0
-                out_dists_sampled[box_ind] = -1.0 # This way we won't re-sample
-
-            out_commitments = out_commitments
+            # greedy label nms on all the sequences of the batch together
+            out_commitments = packed_label_nms(torch.cat(out_dists, 0), boxes_for_nms,
+                                               batch_lengths, self.nms_thresh)
         else:
             out_commitments = torch.cat(out_commitments, 0)
 
@@ -255,7 +242,9 @@ class AttributeLSTMContext(nn.Module):
         c_x = center_x(proposals)
         # leftright order
         scores = c_x / (c_x.max() + 1)
-        return sort_by_score(proposals, scores)
+        # the batched decoding of the test images needs one image per sequence
+        group_images = (not self.training) or self.cfg.MODEL.ROI_RELATION_HEAD.CONTEXT_GROUP_IMAGES_IN_TRAINING
+        return sort_by_score(proposals, scores, group_images)
 
     def obj_ctx(self, obj_feats, proposals, obj_labels=None, att_labels=None, boxes_per_cls=None):
         """
@@ -339,7 +328,7 @@ class AttributeLSTMContext(nn.Module):
 
         boxes_per_cls = None
         if self.mode == 'sgdet' and not self.training:
-            boxes_per_cls = cat([proposal.get_field('boxes_per_cls') for proposal in proposals], dim=0) # comes from post process of box_head
+            boxes_per_cls = cat_boxes_per_cls(proposals) # comes from post process of box_head
 
         # object level contextual feature
         obj_dists, obj_preds, att_dists, obj_ctx, perm, inv_perm, ls_transposed = self.obj_ctx(obj_pre_rep, proposals, obj_labels, att_labels, boxes_per_cls)
@@ -2,8 +2,6 @@
 from torch import (
     cat as torch_cat,
     zeros as torch_zeros,
-    arange as torch_arange,
-    int64 as torch_int64,
     no_grad as torch_no_grad,
     equal as torch_equal,
 )
@@ -14,6 +12,7 @@ from pysgg.data import get_dataset_statistics
 from pysgg.modeling.make_layers import make_fc
 from pysgg.modeling.roi_heads.relation_head.utils_relation import get_box_pair_info, get_box_info_norm, \
     layer_init
+from pysgg.modeling.roi_heads.relation_head.utils_graph import RelationGraphBatch, segment_sum
 # from pysgg.modeling.utils import torch_cat
 from .utils_motifs import obj_edge_vectors, encode_box_info
 
@@ -67,29 +66,9 @@ class IMPContext(Module):
         rel_count = rel_rep.shape[0]
 
         # generate sub-rel-obj mapping
-        sub2rel = torch_zeros(obj_count, rel_count).to(obj_rep.device).float()
-        obj2rel = torch_zeros(obj_count, rel_count).to(obj_rep.device).float()
-        obj_offset = 0
-        rel_offset = 0
-        sub_global_inds = []
-        obj_global_inds = []
-        for pair_idx, num_obj in zip(rel_pair_idxs, num_objs):
-            num_rel = pair_idx.shape[0]
-            sub_idx = pair_idx[:, 0].contiguous().long().view(-1) + obj_offset
-            obj_idx = pair_idx[:, 1].contiguous().long().view(-1) + obj_offset
-            rel_idx = torch_arange(num_rel, device=obj_rep.device, dtype=torch_int64).view(-1) + rel_offset
-
-            sub_global_inds.append(sub_idx)
-            obj_global_inds.append(obj_idx)
-
-            sub2rel[sub_idx, rel_idx] = 1.0
-            obj2rel[obj_idx, rel_idx] = 1.0
-
-            obj_offset += num_obj
-            rel_offset += num_rel
-
-        sub_global_inds = torch_cat(sub_global_inds, dim=0)
-        obj_global_inds = torch_cat(obj_global_inds, dim=0)
+        graph = RelationGraphBatch.from_rel_pairs(num_objs, rel_pair_idxs)
+        sub_global_inds = graph.edge_sub_idx
+        obj_global_inds = graph.edge_obj_idx
 
         # iterative message passing
         hx_obj = torch_zeros(obj_count, self.hidden_dim, requires_grad=False, device=obj_rep.device).float()
@@ -112,7 +91,7 @@ class IMPContext(Module):
             # Compute vertex context
             pre_out = self.out_edge_w_fc(torch_cat((sub_vert, edge_factor[i]), 1)) * edge_factor[i]
             pre_in = self.in_edge_w_fc(torch_cat((obj_vert, edge_factor[i]), 1)) * edge_factor[i]
-            vert_ctx = sub2rel @ pre_out + obj2rel @ pre_in
+            vert_ctx = segment_sum(pre_out, sub_global_inds, obj_count) + segment_sum(pre_in, obj_global_inds, obj_count)
             vert_factor.append(self.node_gru(vert_ctx, vert_factor[i]))
 
         return vert_factor[-1], edge_factor[-1]
@@ -8,6 +8,7 @@ from pysgg.modeling.roi_heads.relation_head.utils_relation import (
     obj_prediction_nms,
 )
 from pysgg.modeling.utils import cat
+from pysgg.structures.boxes_per_cls import cat_boxes_per_cls
 from .utils_motifs import obj_edge_vectors, encode_box_info, to_onehot
 
 
@@ -232,9 +233,7 @@ class PairwiseFeatureExtractor(nn.Module):
 
         boxes_per_cls = None
         if self.mode in ["sgdet", "sgcls"]:
-            boxes_per_cls = cat(
-                [proposal.get_field("boxes_per_cls") for proposal in inst_proposals], dim=0
-            )  # comes from post process of box_head
+            boxes_per_cls = cat_boxes_per_cls(inst_proposals)  # comes from post process of box_head
         # object level contextual feature
         (
             augment_obj_feat,
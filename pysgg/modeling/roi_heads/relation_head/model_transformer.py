@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from pysgg.modeling.utils import cat
+from pysgg.structures.boxes_per_cls import cat_boxes_per_cls
 from .utils_motifs import obj_edge_vectors, to_onehot, encode_box_info
 from .utils_relation import nms_overlaps
 
@@ -104,6 +105,41 @@ class MultiHeadAttention(nn.Module):
 
         return output, attn
 
+    def forward_packed(self, q, k, v, num_objs, chunk_size=0):
+        """
+        Attention within each image over the concatenated sequences of a batch, i.e. the
+        block-diagonal part of the full attention, without padding or masks.
+        Args:
+            q (#total_box, dim_q)
+            k (#total_box, dim_k)
+            v (#total_box, dim_v)
+            num_objs [list of int] (bsz, ) : sequence length of each image
+            chunk_size (int) : if > 0, at most chunk_size queries of an image attend at a time
+        Returns:
+            output (#total_box, d_model)
+        """
+        d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
+
+        residual = q
+
+        q = self.w_qs(q).view(-1, n_head, d_k).transpose(0, 1) # n x total x dk
+        k = self.w_ks(k).view(-1, n_head, d_k).transpose(0, 1) # n x total x dk
+        v = self.w_vs(v).view(-1, n_head, d_v).transpose(0, 1) # n x total x dv
+
+        output = []
+        for q_img, k_img, v_img in zip(q.split(num_objs, 1), k.split(num_objs, 1), v.split(num_objs, 1)):
+            q_chunks = q_img.split(chunk_size, 1) if chunk_size > 0 else (q_img,)
+            for q_chunk in q_chunks:
+                output.append(self.attention(q_chunk, k_img, v_img)[0])
+        output = torch.cat(output, 1)
+
+        output = output.transpose(0, 1).contiguous().view(-1, n_head * d_v) # total x (n*dv)
+
+        output = self.dropout(self.fc(output))
+        output = self.layer_norm(output + residual)
+
+        return output
+
 
 class PositionwiseFeedForward(nn.Module):
     ''' A two-feed-forward-layer module '''
@@ -149,13 +185,27 @@ class EncoderLayer(nn.Module):
 
         return enc_output, enc_slf_attn
 
+    def forward_packed(self, enc_input, num_objs, chunk_size=0):
+        enc_output = self.slf_attn.forward_packed(
+            enc_input, enc_input, enc_input, num_objs, chunk_size=chunk_size)
+
+        enc_output = self.pos_ffn(enc_output.unsqueeze(0)).squeeze(0)
+
+        return enc_output
+
 
 class TransformerEncoder(nn.Module):
     """
     A encoder model with self attention mechanism.
+    attention = padded | packed, packed attends within each image on the concatenated sequences,
+    optionally chunk_size queries at a time
     """
-    def __init__(self, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout=0.1):
+    def __init__(self, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout=0.1, attention='padded',
+                 chunk_size=0):
         super().__init__()
+        assert attention in ('padded', 'packed')
+        self.attention = attention
+        self.chunk_size = chunk_size
         self.layer_stack = nn.ModuleList([
             EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
@@ -168,6 +218,12 @@ class TransformerEncoder(nn.Module):
         Returns:
             enc_output [Tensor] (#total_box, d_model)
         """
+        if self.attention == 'packed':
+            enc_output = input_feats
+            for enc_layer in self.layer_stack:
+                enc_output = enc_layer.forward_packed(enc_output, num_objs, chunk_size=self.chunk_size)
+            return enc_output
+
         original_input_feats = input_feats
         input_feats = input_feats.split(num_objs, dim=0)
         input_feats = nn.utils.rnn.pad_sequence(input_feats, batch_first=True)
@@ -218,6 +274,8 @@ class TransformerContext(nn.Module):
         self.inner_dim = self.cfg.MODEL.ROI_RELATION_HEAD.TRANSFORMER.INNER_DIM     
         self.k_dim = self.cfg.MODEL.ROI_RELATION_HEAD.TRANSFORMER.KEY_DIM         
         self.v_dim = self.cfg.MODEL.ROI_RELATION_HEAD.TRANSFORMER.VAL_DIM    
+        self.attention = self.cfg.MODEL.ROI_RELATION_HEAD.TRANSFORMER.ATTENTION
+        self.chunk_size = self.cfg.MODEL.ROI_RELATION_HEAD.TRANSFORMER.ATTENTION_CHUNK_SIZE
 
 
         # the following word embedding layer should be initalize by glove.6B before using
@@ -237,9 +295,11 @@ class TransformerContext(nn.Module):
         self.lin_edge = nn.Linear(self.embed_dim + self.hidden_dim + self.in_channels, self.hidden_dim)
         self.out_obj = nn.Linear(self.hidden_dim, self.num_obj_cls)
         self.context_obj = TransformerEncoder(self.obj_layer, self.num_head, self.k_dim, 
-                                                self.v_dim, self.hidden_dim, self.inner_dim, self.dropout_rate)
+                                                self.v_dim, self.hidden_dim, self.inner_dim, self.dropout_rate,
+                                                self.attention, self.chunk_size)
         self.context_edge = TransformerEncoder(self.edge_layer, self.num_head, self.k_dim, 
-                                                self.v_dim, self.hidden_dim, self.inner_dim, self.dropout_rate)
+                                                self.v_dim, self.hidden_dim, self.inner_dim, self.dropout_rate,
+                                                self.attention, self.chunk_size)
 
     
     def forward(self, roi_features, proposals, logger=None):
@@ -273,7 +333,7 @@ class TransformerContext(nn.Module):
             obj_dists = self.out_obj(obj_feats)
             use_decoder_nms = self.mode == 'sgdet' and not self.training
             if use_decoder_nms:
-                boxes_per_cls = [proposal.get_field('boxes_per_cls') for proposal in proposals]
+                boxes_per_cls = [cat_boxes_per_cls([proposal]) for proposal in proposals]
                 obj_preds = self.nms_per_cls(obj_dists, boxes_per_cls, num_objs)
             else:
                 obj_preds = obj_dists[:, 1:].max(1)[1] + 1
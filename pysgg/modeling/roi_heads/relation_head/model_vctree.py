@@ -6,8 +6,9 @@ from torch.nn import functional as F
 from pysgg.modeling.utils import cat
 from .utils_motifs import obj_edge_vectors, to_onehot, get_dropout_mask, encode_box_info
 from .utils_relation import layer_init
-from .utils_treelstm import TreeLSTM_IO, MultiLayer_BTreeLSTM, BiTreeLSTM_Backward, BiTreeLSTM_Foreward
-from .utils_vctree import generate_forest, arbForest_to_biForest, get_overlap_info
+from .utils_treelstm import TreeLSTM_IO, MultiLayer_BTreeLSTM, BiTreeLSTM_Backward, BiTreeLSTM_Foreward, \
+    image_dropout_mask
+from .utils_vctree import generate_forest, generate_array_forest, arbForest_to_biForest, get_overlap_info
 
 
 class DecoderTreeLSTM(torch.nn.Module):
@@ -68,6 +69,16 @@ class DecoderTreeLSTM(torch.nn.Module):
 
         return out_dists, out_commitments
 
+    def forward_levels(self, forest, features):
+        if self.dropout > 0.0:
+            dropout_mask = image_dropout_mask(self.dropout, forest, self.hidden_size, features.device)
+        else:
+            dropout_mask = None
+
+        _, out_dists, out_commitments = self.decoderLSTM.forward_levels(forest, features, dropout_mask)
+
+        return out_dists, out_commitments
+
 
 class VCTreeLSTMContext(nn.Module):
     """
@@ -122,9 +133,17 @@ class VCTreeLSTMContext(nn.Module):
         self.nl_obj = self.cfg.MODEL.ROI_RELATION_HEAD.CONTEXT_OBJ_LAYER
         self.nl_edge = self.cfg.MODEL.ROI_RELATION_HEAD.CONTEXT_REL_LAYER
         assert self.nl_obj > 0 and self.nl_edge > 0
+        self.level_sync = self.cfg.MODEL.ROI_RELATION_HEAD.VCTREE_LEVEL_SYNC
 
         # VCTree
-        co_occour = statistics['pred_dist'].float().sum(-1)
+        pred_dist = statistics['pred_dist']
+        if pred_dist.is_sparse:
+            # the pairs without foreground relations all have the default distribution
+            pair_sum = torch.sparse.sum(pred_dist.float(), 2).coalesce()
+            co_occour = statistics['pred_dist_default'].float().sum().repeat(pred_dist.size(0), pred_dist.size(1))
+            co_occour[pair_sum.indices()[0], pair_sum.indices()[1]] = pair_sum.values()
+        else:
+            co_occour = pred_dist.float().sum(-1)
         assert co_occour.shape[0] == co_occour.shape[-1]
         assert len(co_occour.shape) == 2
         self.bi_freq_prior = nn.Linear(self.num_obj_classes * self.num_obj_classes, 1, bias=False)
@@ -181,6 +200,9 @@ class VCTreeLSTMContext(nn.Module):
                  obj_preds: argmax of that distribution.
                  obj_final_ctx: [num_obj, #feats] For later!
         """
+        if self.level_sync:
+            return self.obj_ctx_levels(num_objs, obj_feats, obj_labels, vc_forest, ctx_average)
+
         obj_feats = obj_feats.split(num_objs, dim=0)
         obj_labels = obj_labels.split(num_objs, dim=0) if obj_labels is not None else None
 
@@ -211,12 +233,36 @@ class VCTreeLSTMContext(nn.Module):
         obj_dists = cat(obj_dists, dim=0)
         return obj_ctxs, obj_preds, obj_dists
 
+    def obj_ctx_levels(self, num_objs, obj_feats, obj_labels=None, vc_forest=None, ctx_average=False):
+        """
+        obj_ctx with the TreeLSTMs run level by level over the ArrayForest of the whole batch
+        """
+        obj_ctxs = self.obj_ctx_rnn.forward_levels(vc_forest, obj_feats)
+        # Decode in order
+        if self.mode != 'predcls':
+            if (not self.training) and self.effect_analysis and ctx_average:
+                decoder_inp = self.untreated_dcd_feat.view(1, -1).expand(obj_ctxs.shape[0], -1)
+            else:
+                decoder_inp = torch.cat((obj_feats, obj_ctxs), 1)
+            if self.training and self.effect_analysis:
+                for img_inp in decoder_inp.split(num_objs, dim=0):
+                    self.untreated_dcd_feat = self.moving_average(self.untreated_dcd_feat, img_inp)
+            obj_dists, obj_preds = self.decoder_rnn.forward_levels(vc_forest, decoder_inp)
+        else:
+            assert obj_labels is not None
+            obj_preds = obj_labels
+            obj_dists = to_onehot(obj_preds, self.num_obj_classes)
+        return obj_ctxs, obj_preds, obj_dists
+
     def edge_ctx(self, num_objs, obj_feats, forest):
         """
         Object context and object classification.
         :param obj_feats: [num_obj, img_dim + object embedding0 dim]
         :return: edge_ctx: [num_obj, #feats] For later!
         """
+        if self.level_sync:
+            return self.edge_ctx_rnn.forward_levels(forest, obj_feats)
+
         inp_feats = obj_feats.split(num_objs, dim=0)
 
         edge_ctxs = []
@@ -256,8 +302,11 @@ class VCTreeLSTMContext(nn.Module):
         pair_inp = self.overlap_embed(get_overlap_info(proposals))
         bi_inp = cat((self.obj_reduce(x.detach()), self.emb_reduce(obj_embed.detach()), box_inp, pair_inp), -1)
         bi_preds, vc_scores = self.vctree_score_net(num_objs, bi_inp, obj_logits, proposals)
-        forest = generate_forest(vc_scores, proposals, self.mode)
-        vc_forest = arbForest_to_biForest(forest)
+        if self.level_sync:
+            vc_forest = generate_array_forest(vc_scores)
+        else:
+            forest = generate_forest(vc_scores, proposals, self.mode)
+            vc_forest = arbForest_to_biForest(forest)
 
         # object level contextual feature
         obj_ctxs, obj_preds, obj_dists = self.obj_ctx(num_objs, obj_pre_rep, proposals, obj_labels, vc_forest,
@@ -11,44 +11,42 @@ from pysgg.data import get_dataset_statistics
 from pysgg.modeling import registry
 from pysgg.modeling.roi_heads.relation_head.classifier import build_classifier
 from pysgg.modeling.roi_heads.relation_head.model_motifs import FrequencyBias
+from pysgg.modeling.roi_heads.relation_head.sampling import proposal_target_matching
 from pysgg.modeling.roi_heads.relation_head.utils_motifs import (
     obj_edge_vectors,
     encode_box_info,
 )
-from pysgg.structures.boxlist_ops import boxlist_iou, squeeze_tensor
+from pysgg.structures.boxlist_ops import squeeze_tensor
 from pysgg.utils.global_buffer import store_data
 
 
-def gt_rel_proposal_matching(proposals, targets, fg_thres, require_overlap):
+def gt_rel_proposal_matching(proposals, targets, fg_thres, require_overlap, matchings=None):
     """
 
     :param proposals:
     :param targets:
     :param fg_thres:
     :param require_overlap:
+    :param matchings: the proposal_target_matching results shared with the relation sampling,
+        computed here if not given
     :return:
         fg_pair_matrixs the box pairs that both box are matching with gt ground-truth
         prop_relatedness_matrixs: the box pairs that both boxes are matching with ground-truth relationship
     """
     assert targets is not None
+    if matchings is None:
+        matchings = proposal_target_matching(proposals, targets, fg_thres)
     prop_relatedness_matrixs = []
     fg_pair_matrixs = []
-    for img_id, (proposal, target) in enumerate(zip(proposals, targets)):
+    for img_id, (proposal, target, matching) in enumerate(zip(proposals, targets, matchings)):
         device = proposal.bbox.device
-        tgt_rel_matrix = target.get_field("relation")  # [tgt, tgt]
 
         # IoU matching for object detection results
-        ious = boxlist_iou(target, proposal)  # [tgt, prp]
-        is_match = ious > fg_thres  # [tgt, prp]
-        # one box may match multiple gt boxes here we just mark them as a valid matching if they
-        # match any boxes
-        locating_match = (ious > fg_thres).nonzero()  # [tgt, prp]
-        locating_match_stat = torch.zeros((len(proposal)), device=device)
-        locating_match_stat[locating_match[:, 1]] = 1
+        locating_match_stat = matching["locating_match"]
         proposal.add_field("locating_match", locating_match_stat)
 
         # Proposal self IoU to filter non-overlap
-        prp_self_iou = boxlist_iou(proposal, proposal)  # [prp, prp]
+        prp_self_iou = matching["prp_self_iou"]  # [prp, prp]
         # store the box pairs whose head and tails bbox are all overlapping with the GT boxes
         # does not requires classification results
         if require_overlap:
@@ -68,47 +66,8 @@ def gt_rel_proposal_matching(proposals, targets, fg_thres, require_overlap):
 
         fg_pair_matrixs.append(fg_boxpair_mat)
 
-        tgt_pair_idxs = torch.nonzero(tgt_rel_matrix != 0)
-
-        assert tgt_pair_idxs.shape[1] == 2
-        tgt_head_idxs = tgt_pair_idxs[:, 0].contiguous().view(-1)
-        tgt_tail_idxs = tgt_pair_idxs[:, 1].contiguous().view(-1)
-        tgt_rel_labs = tgt_rel_matrix[tgt_head_idxs, tgt_tail_idxs].contiguous().view(-1)
-
-        num_tgt_rels = tgt_rel_labs.shape[0]
-        # generate binary prp mask
-        num_prp = len(proposal)
-        # num_tgt_rel, num_prp (matched prp head)
-        binary_prp_head = is_match[tgt_head_idxs]
-        # num_tgt_rel, num_prp (matched prp tail)
-        binary_prp_tail = is_match[tgt_tail_idxs]
         # mark the box pair who overlaps with the gt relation box pairs
-        binary_rel_mat = torch.zeros((num_prp, num_prp), device=device).long()
-
-        fg_rel_triplets = []
-        for i in range(num_tgt_rels):
-            # generate binary prp mask
-            bi_match_head = torch.nonzero(binary_prp_head[i] > 0)
-            bi_match_tail = torch.nonzero(binary_prp_tail[i] > 0)
-
-            num_bi_head = bi_match_head.shape[0]
-            num_bi_tail = bi_match_tail.shape[0]
-            if num_bi_head > 0 and num_bi_tail > 0:
-                bi_match_head = (
-                    bi_match_head.view(1, num_bi_head)
-                    .expand(num_bi_tail, num_bi_head)
-                    .contiguous()
-                )
-                bi_match_tail = (
-                    bi_match_tail.view(num_bi_tail, 1)
-                    .expand(num_bi_tail, num_bi_head)
-                    .contiguous()
-                )
-                # binary rel only consider related or not, so its symmetric
-                binary_rel_mat[bi_match_head.view(-1), bi_match_tail.view(-1)] = 1
-                binary_rel_mat[bi_match_tail.view(-1), bi_match_head.view(-1)] = 1
-
-        prop_relatedness_matrixs.append(binary_rel_mat)
+        prop_relatedness_matrixs.append(matching["locating_binary_rel"])
 
     return fg_pair_matrixs, prop_relatedness_matrixs
 
@@ -251,117 +210,126 @@ class RelationProposalModel(nn.Module):
         rel_labels=None,
         fg_boxpair_matrixs=None,
         gt_rel_boxpair_matrixs=None,
+        return_dense=False,
     ):
-        prop_relatedness_matrixs = []
-        losses = []
-        inst_roi_feat = torch.split(inst_roi_feat, [len(p) for p in inst_proposals], dim=0)
-
-        for img_id, (proposal, roi_feats, pair_idx) in enumerate(
-            zip(inst_proposals, inst_roi_feat, rel_pair_idxs)
-        ):
-            pred_logits = proposal.get_field("predict_logits").detach()
-            device = proposal.bbox.device
-            pred_rel_matrix = torch.zeros(
-                (len(proposal), len(proposal)), device=device, dtype=pred_logits.dtype
-            )
+        """
+        The relatedness is only scored on the given (or, in training, sampled) pairs of all
+        images at once, the pairs are indexed into the batch concatenated instances by
+        the segment offsets of each image.
+
+        Returns:
+            relness_scores (list[Tensor]): relatedness of each pair in rel_pair_idxs, [num_rel]
+            relness_matrixs (list[Tensor] or None): dense relatedness matrix [num_inst, num_inst] of
+                each image, only materialized in training or when return_dense is True
+            losses (Tensor or None)
+        """
+        num_insts = [len(p) for p in inst_proposals]
+        device = inst_proposals[0].bbox.device
 
-            if self.training:
-                assert fg_boxpair_matrixs is not None
-                assert rel_labels is not None
-                fg_boxpair_mat = fg_boxpair_matrixs[img_id]
-                pair_idx, relness_labels = self._train_sampling(
-                    proposal, pair_idx, fg_boxpair_mat, rel_labels[img_id]
+        if self.training:
+            assert fg_boxpair_matrixs is not None
+            assert rel_labels is not None
+            scored_pair_idxs = []
+            relness_labels = []
+            for img_id, (proposal, pair_idx) in enumerate(zip(inst_proposals, rel_pair_idxs)):
+                pair_idx, relness_label = self._train_sampling(
+                    proposal, pair_idx, fg_boxpair_matrixs[img_id], rel_labels[img_id]
                 )
-            # else:
-            #     num_prp = len(proposal)
-            #     selected_pair_idx = pair_idx
-            #     all_pair_idx_mat = torch.ones((num_prp, num_prp), device=device).long() - torch.eye(num_prp, device=device).long()
-            #     all_pair_idx = torch.nonzero(all_pair_idx_mat)
-            #     pair_idx = all_pair_idx
+                scored_pair_idxs.append(pair_idx)
+                relness_labels.append(relness_label)
+        else:
+            scored_pair_idxs = rel_pair_idxs
 
-            pos_embed = self.obj_pos_embed(
-                encode_box_info(
-                    [
-                        proposal,
-                    ]
-                )
-            )
-            obj_sem_embed = F.softmax(pred_logits, dim=1) @ self.obj_sem_embed.weight
-            # inst_logtis_embed = self.inst_logtis_embed(pred_logits)
-            rel_prop_repre = torch.cat(
-                (
-                    pos_embed[pair_idx[:, 0]],
-                    obj_sem_embed[pair_idx[:, 0]],
-                    pos_embed[pair_idx[:, 1]],
-                    obj_sem_embed[pair_idx[:, 1]],
-                ),
-                dim=1,
-            )
-            relness = squeeze_tensor(self.proposal_relness_cls_fc(rel_prop_repre))
+        # pair index in the batch concatenated instances
+        inst_offsets = torch.cumsum(torch.tensor([0] + num_insts[:-1], device=device), dim=0)
+        batch_pair_idx = torch.cat(
+            [pair_idx + offset for pair_idx, offset in zip(scored_pair_idxs, inst_offsets)], dim=0
+        )
 
-            if self.visual_features_on:
-                sub_roi_feat = self.sub_vis_embed(roi_feats)
-                sub_roi_feat = self.subj_self_att(
-                    sub_roi_feat, sub_roi_feat, sub_roi_feat
-                ).squeeze(1)
-                obj_roi_feat = self.obj_vis_embed(roi_feats)
-                obj_roi_feat = self.obj_self_att(
-                    obj_roi_feat, obj_roi_feat, obj_roi_feat
-                ).squeeze(1)
-                visual_relness_scores = torch.mm(sub_roi_feat, obj_roi_feat.t())  # k x k
-                visual_relness_scores = visual_relness_scores[pair_idx[:, 0], pair_idx[:, 1]]
-                relness += visual_relness_scores
+        pred_logits = torch.cat([p.get_field("predict_logits").detach() for p in inst_proposals], dim=0)
+        pos_embed = self.obj_pos_embed(encode_box_info(inst_proposals))
+        obj_sem_embed = F.softmax(pred_logits, dim=1) @ self.obj_sem_embed.weight
+        rel_prop_repre = torch.cat(
+            (
+                pos_embed[batch_pair_idx[:, 0]],
+                obj_sem_embed[batch_pair_idx[:, 0]],
+                pos_embed[batch_pair_idx[:, 1]],
+                obj_sem_embed[batch_pair_idx[:, 1]],
+            ),
+            dim=1,
+        )
+        relness = self.proposal_relness_cls_fc(rel_prop_repre).view(-1)
 
-            # calculate loss by gt_matching
-            if self.training:
-                # accumulate the loss with the foreground background sampling
-                if len(relness.view(-1, 1)) != 0:
-                    loss = self.loss_eval(
-                        relness.view(-1, 1), relness_labels.view(-1, 1).float()
-                    )
-                    losses.append(loss)
-
-                relness = torch.sigmoid(relness)
-                pred_rel_matrix[pair_idx[:, 0], pair_idx[:, 1]] = relness
-
-                # add the gt pair on prediction in training phrase for more stable training
-                prop_relatedness_matrixs.append(
+        if self.visual_features_on:
+            sub_roi_feat = self.sub_vis_embed(inst_roi_feat)
+            sub_roi_feat = self.subj_self_att(
+                sub_roi_feat, sub_roi_feat, sub_roi_feat
+            ).squeeze(1)
+            obj_roi_feat = self.obj_vis_embed(inst_roi_feat)
+            obj_roi_feat = self.obj_self_att(
+                obj_roi_feat, obj_roi_feat, obj_roi_feat
+            ).squeeze(1)
+            # only the inner products of the scored pairs instead of the whole k x k matrix
+            relness = relness + (
+                sub_roi_feat[batch_pair_idx[:, 0]] * obj_roi_feat[batch_pair_idx[:, 1]]
+            ).sum(-1)
+
+        relness_logits = relness.split([len(p) for p in scored_pair_idxs], dim=0)
+        relness = torch.sigmoid(relness).split([len(p) for p in scored_pair_idxs], dim=0)
+
+        losses = None
+        relness_matrixs = None
+        if self.training:
+            # accumulate the loss with the foreground background sampling
+            losses = []
+            for logits, labels in zip(relness_logits, relness_labels):
+                if len(logits) != 0:
+                    losses.append(self.loss_eval(logits.view(-1, 1), labels.view(-1, 1).float()))
+            assert len(losses) > 0
+            losses = torch.mean(torch.stack(losses))
+
+            # the sampled pairs are not the input pairs in training, scatter them into the
+            # dense matrix and add the gt pair on prediction for more stable training
+            relness_matrixs = []
+            for img_id, (pair_idx, img_relness) in enumerate(zip(scored_pair_idxs, relness)):
+                pred_rel_matrix = img_relness.new_zeros((num_insts[img_id], num_insts[img_id]))
+                pred_rel_matrix[pair_idx[:, 0], pair_idx[:, 1]] = img_relness
+                relness_matrixs.append(
                     pred_rel_matrix * 0.8 + gt_rel_boxpair_matrixs[img_id] * 0.2
                 )
-            else:
-
-                relness = torch.sigmoid(relness)
-                pred_rel_matrix[pair_idx[:, 0], pair_idx[:, 1]] = relness
+            relness_scores = [
+                rel_mat[pair_idx[:, 0], pair_idx[:, 1]]
+                for rel_mat, pair_idx in zip(relness_matrixs, rel_pair_idxs)
+            ]
+        else:
+            relness_scores = list(relness)
+            if return_dense or cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.EVAL_MODEL_AUC:
+                relness_matrixs = []
+                for num_inst, pair_idx, img_relness in zip(num_insts, rel_pair_idxs, relness_scores):
+                    pred_rel_matrix = img_relness.new_zeros((num_inst, num_inst))
+                    pred_rel_matrix[pair_idx[:, 0], pair_idx[:, 1]] = img_relness
+                    relness_matrixs.append(pred_rel_matrix)
+
+        # evaluate the AUC and save the eval results to buffer, once for the whole batch
+        # todo
+        #   : maybe directly add to the relation predication structure
+        if cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.EVAL_MODEL_AUC:
+            if self.training:
+                y = torch.cat(relness_labels).detach().long().cpu().numpy()
+                pred = torch.cat(relness).detach().cpu().numpy()
 
-                prop_relatedness_matrixs.append(pred_rel_matrix)
+                store_data("rel_pn-train_y", y)
+                store_data("rel_pn-train_pred", pred)
 
-            # evaluate the AUC and save the eval results to buffer
-            # todo
-            #   : maybe directly add to the relation predication structure
-            if cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.EVAL_MODEL_AUC:
-                if self.training:
-                    y = relness_labels.detach().long().cpu().numpy()
-                    pred = relness.detach().cpu().numpy()
+            else:
+                # todo: the test threshold should be removed
+                y = torch.cat([each.view(-1) for each in gt_rel_boxpair_matrixs]).detach().long().cpu().numpy()
+                pred = torch.cat([each.view(-1) for each in relness_matrixs]).detach().cpu().numpy()
 
-                    store_data("rel_pn-train_y", y)
-                    store_data("rel_pn-train_pred", pred)
+                store_data("rel_pn-test_y", y)
+                store_data("rel_pn-test_pred", pred)
 
-                else:
-                    # todo: the test threshold should be removed
-                    fg_boxpair_mat = gt_rel_boxpair_matrixs[img_id]
-                    y = fg_boxpair_mat.view(-1).detach().long().cpu().numpy()
-                    pred = pred_rel_matrix.view(-1).detach().cpu().numpy()
-
-                    store_data("rel_pn-test_y", y)
-                    store_data("rel_pn-test_pred", pred)
-
-        if self.training:
-            assert len(losses) > 0
-            losses = torch.mean(torch.stack(losses))
-        else:
-            losses = None
-
-        return prop_relatedness_matrixs, losses
+        return relness_scores, relness_matrixs, losses
 
 
 def reverse_sigmoid(x):
@@ -754,24 +722,37 @@ def make_relation_confidence_aware_module(in_channels):
     return func(in_channels)
 
 
-def filter_rel_pairs(relness_matrix, rel_pair_idxs, rel_labels=None):
+def filter_rel_pairs(relness_scores, rel_pair_idxs, rel_labels=None):
+    """
+    keep the pairs of highest relatedness for each image
+
+    :param relness_scores: list[Tensor], relatedness score of each pair in rel_pair_idxs
+    :param rel_pair_idxs:
+    :param rel_labels:
+    :return: the filtered rel_pair_idxs, rel_labels and relness_scores
+    """
     filtered_rel_pairs = []
     filtered_rel_labels = []
+    filtered_relness_scores = []
     valid_pair_num = (
         cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.PAIR_NUMS_AFTER_FILTERING
     )
     if valid_pair_num < 0:
-        return rel_pair_idxs, rel_labels
+        return rel_pair_idxs, rel_labels, relness_scores
 
-    for idx, (rel_mat, rel_pair) in enumerate(zip(relness_matrix, rel_pair_idxs)):
-        relness_scores = rel_mat[rel_pair[:, 0], rel_pair[:, 1]]
-        _, selected_rel_prop_pairs_idx = torch.sort(relness_scores, descending=True)
+    for idx, (relness, rel_pair) in enumerate(zip(relness_scores, rel_pair_idxs)):
+        _, selected_rel_prop_pairs_idx = torch.sort(relness, descending=True)
         selected_rel_prop_pairs_idx = selected_rel_prop_pairs_idx[:valid_pair_num]
         filtered_rel_pairs.append(rel_pair[selected_rel_prop_pairs_idx])
+        filtered_relness_scores.append(relness[selected_rel_prop_pairs_idx])
         if rel_labels is not None:
             filtered_rel_labels.append(rel_labels[idx][selected_rel_prop_pairs_idx])
 
-    return filtered_rel_pairs, filtered_rel_labels if len(filtered_rel_labels) > 0 else None
+    return (
+        filtered_rel_pairs,
+        filtered_rel_labels if len(filtered_rel_labels) > 0 else None,
+        filtered_relness_scores,
+    )
 
 
 class MultiHeadAttention(nn.Module):
@@ -1,4 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+import logging
+
 import torch
 
 from pysgg.modeling.roi_heads.relation_head.rel_proposal_network.models import (
@@ -6,15 +8,18 @@ from pysgg.modeling.roi_heads.relation_head.rel_proposal_network.models import (
     RelationProposalModel,
     filter_rel_pairs,
 )
+from pysgg.utils.feature_store import FeatureStore, modules_fingerprint, store_dir
 from pysgg.utils.visualize_graph import *
 from .inference import make_roi_relation_post_processor
 from .loss import make_roi_relation_loss_evaluator
 from .roi_relation_feature_extractors import make_roi_relation_feature_extractor
 from .roi_relation_predictors import make_roi_relation_predictor
-from .sampling import make_roi_relation_samp_processor
+from .sampling import make_roi_relation_samp_processor, proposal_target_matching
+from .utils_relation import split_pair_chunks
 from ..attribute_head.roi_attribute_feature_extractors import (
     make_roi_attribute_feature_extractor,
 )
+from ..box_head.box_head import add_predict_info
 from ..box_head.roi_box_feature_extractors import (
     make_roi_box_feature_extractor,
     ResNet50Conv5ROIFeatureExtractor,
@@ -23,6 +28,9 @@ from pysgg.modeling.roi_heads.relation_head.model_kern import (
     to_onehot,
 )
 
+logger = logging.getLogger(__name__)
+
+
 class ROIRelationHead(torch.nn.Module):
     """
     Generic Relation Head class.
@@ -80,6 +88,23 @@ class ROIRelationHead(torch.nn.Module):
 
         # parameters
         self.use_union_box = self.cfg.MODEL.ROI_RELATION_HEAD.PREDICT_USE_VISION
+        self.chunk_memory_budget = self.cfg.TEST.RELATION.CHUNK_MEMORY_BUDGET
+        self.support_chunked_inference = all(
+            hasattr(self.predictor, name) for name in ("object_context", "pair_logits", "pair_memory_bytes")
+        )
+        if self.chunk_memory_budget > 0 and not self.support_chunked_inference:
+            logger.warning(
+                "TEST.RELATION.CHUNK_MEMORY_BUDGET is ignored: the {} does not support the chunked inference, "
+                "all the relation pairs of a batch run in one pass (supported predictors: MotifPredictor)".format(
+                    cfg.MODEL.ROI_RELATION_HEAD.PREDICTOR))
+
+        # the features of the frozen detector are read from the feature store, opened on first use
+        # once the weights are loaded, see tools/relation_extract_features.py
+        self.use_feature_store = cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED
+        self.feature_store = None
+        if self.use_feature_store:
+            assert self.mode != "sgdet", "the feature store only holds the features of the ground truth boxes"
+            assert not cfg.MODEL.ATTRIBUTE_ON, "the feature store has no attribute features"
 
         self.rel_pn_thres = torch.nn.Parameter(torch.Tensor([0.5]), requires_grad=False)
         self.rel_pn_thres_for_test = torch.nn.Parameter(
@@ -102,12 +127,68 @@ class ROIRelationHead(torch.nn.Module):
             if self.rel_prop_type == "pre_clser":
                 self.use_same_label_with_clser == cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.USE_SAME_LABEL_WITH_CLSER
 
-    def forward(self, features, proposals, targets=None, logger=None):
+    def frozen_feature_modules(self):
+        """the modules whose outputs are read from the feature store"""
+        modules = [self.box_feature_extractor]
+        if self.use_union_box:
+            modules.append(self.union_feature_extractor)
+        return modules
+
+    def extract_store_features(self, features, proposal, pairs_per_chunk):
+        """
+        The ROI features of the boxes of an image and the union features of all its ordered
+        pairs, the pair (i, j) at row i * num_boxes + j, as the feature store holds them.
+        """
+        roi_features = self.box_feature_extractor(features, [proposal])
+        if isinstance(self.box_feature_extractor, ResNet50Conv5ROIFeatureExtractor):
+            roi_features = self.box_feature_extractor.flatten_roi_features(roi_features)
+
+        union_features = None
+        if self.use_union_box:
+            num_boxes = len(proposal)
+            idxs = torch.arange(num_boxes, device=proposal.bbox.device)
+            pairs = torch.stack((idxs.view(-1, 1).expand(num_boxes, num_boxes),
+                                 idxs.view(1, -1).expand(num_boxes, num_boxes)), dim=2).view(-1, 2)
+            union_features = [self.union_feature_extractor(features, [proposal], [chunk])
+                              for chunk in pairs.split(pairs_per_chunk)]
+            if any(isinstance(each, tuple) for each in union_features):
+                raise ValueError("the feature store holds a single union feature per pair")
+            union_features = torch.cat(union_features, dim=0) if union_features else roi_features.new_zeros(
+                (0, self.union_feature_extractor.out_channels))
+        return roi_features, union_features
+
+    def get_feature_store(self):
+        if self.feature_store is None:
+            store = FeatureStore(store_dir(self.cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.DIR,
+                                           self.cfg.MODEL.PRETRAINED_DETECTOR_CKPT))
+            store.check_fingerprint(modules_fingerprint(self.frozen_feature_modules()))
+            self.feature_store = store
+        return self.feature_store
+
+    def stored_detections(self, targets, store_keys):
+        """
+        The ground truth proposals the box head gives in predcls / sgcls, with the box head
+        logits of the feature store in sgcls.
+        """
+        proposals = [target.copy_with_fields(["labels", "attributes"]) for target in targets]
+        if self.mode == "sgcls":
+            class_logits = self.get_feature_store().obj_logits(store_keys, targets[0].bbox.device)
+            proposals = add_predict_info(proposals, class_logits)
+        return proposals
+
+    def extract_union_features(self, features, proposals, rel_pair_idxs, store_keys=None):
+        if store_keys is not None:
+            return self.get_feature_store().union_features(store_keys, rel_pair_idxs, proposals[0].bbox.device)
+        return self.union_feature_extractor(features, proposals, rel_pair_idxs)
+
+    def forward(self, features, proposals, targets=None, logger=None, store_keys=None):
         """
         Arguments:
-            features (list[Tensor]): feature-maps from possibly several levels
+            features (list[Tensor]): feature-maps from possibly several levels, None when
+                the features are read from the feature store
             proposals (list[BoxList]): proposal boxes. Note: it has been post-processed (regression, nms) in sgdet mode
             targets (list[BoxList], optional): the ground-truth targets.
+            store_keys (list[int], optional): the keys of the images in the feature store
 
         Returns:
             x (Tensor): the result of the feature extractor
@@ -117,6 +198,15 @@ class ROIRelationHead(torch.nn.Module):
                 head. During testing, returns an empty dict.
         """
 
+        # the proposal to ground truth matching is computed once and shared by the relation
+        # sampling and the targets of relation proposal model
+        matchings = None
+        if targets is not None and (self.rel_prop_on or (self.training and self.mode == "sgdet")):
+            with torch.no_grad():
+                matchings = proposal_target_matching(
+                    proposals, targets, self.cfg.MODEL.ROI_HEADS.FG_IOU_THRESHOLD
+                )
+
         if self.training:
             # relation subsamples and assign ground truth label during training
             with torch.no_grad():
@@ -136,16 +226,16 @@ class ROIRelationHead(torch.nn.Module):
                         rel_labels_all,
                         rel_pair_idxs,
                         gt_rel_binarys_matrix,
-                    ) = self.samp_processor.detect_relsample(proposals, targets)
+                    ) = self.samp_processor.detect_relsample(proposals, targets, matchings)
         else:
             rel_labels, rel_labels_all, gt_rel_binarys_matrix = None, None, None
             rel_pair_idxs = self.samp_processor.prepare_test_pairs(
-                features[0].device, proposals
+                proposals[0].bbox.device, proposals
             )
 
         if self.mode == "predcls":
             # overload the pred logits by the gt label
-            device = features[0].device
+            device = proposals[0].bbox.device
             for proposal in proposals:
                 obj_labels = proposal.get_field("labels")
                 proposal.add_field("predict_logits", to_onehot(obj_labels, self.num_obj_cls))
@@ -153,12 +243,15 @@ class ROIRelationHead(torch.nn.Module):
                 proposal.add_field("pred_labels", obj_labels.to(device))
 
         # use box_head to extract features that will be fed to the later predictor processing
-        roi_features = self.box_feature_extractor(features, proposals)
-        if isinstance(self.box_feature_extractor, ResNet50Conv5ROIFeatureExtractor):
-            roi_features = self.box_feature_extractor.flatten_roi_features(roi_features)
+        if store_keys is not None:
+            roi_features = self.get_feature_store().roi_features(store_keys, proposals[0].bbox.device)
+        else:
+            roi_features = self.box_feature_extractor(features, proposals)
+            if isinstance(self.box_feature_extractor, ResNet50Conv5ROIFeatureExtractor):
+                roi_features = self.box_feature_extractor.flatten_roi_features(roi_features)
 
         rel_pn_loss = None
-        relness_matrix = None
+        relness_scores = None
         if self.rel_prop_on:
             fg_pair_matrixs = None
             gt_rel_binarys_matrix = None
@@ -169,12 +262,12 @@ class ROIRelationHead(torch.nn.Module):
                     targets,
                     self.cfg.MODEL.ROI_HEADS.FG_IOU_THRESHOLD,
                     self.cfg.TEST.RELATION.REQUIRE_OVERLAP,
+                    matchings,
                 )
-                gt_rel_binarys_matrix = [each.float().cuda() for each in gt_rel_binarys_matrix]
-
+                gt_rel_binarys_matrix = [each.float() for each in gt_rel_binarys_matrix]
 
             if self.rel_prop_type == "rel_pn":
-                relness_matrix, rel_pn_loss = self.rel_pn(
+                relness_scores, _, rel_pn_loss = self.rel_pn(
                     proposals,
                     roi_features,
                     rel_pair_idxs,
@@ -183,37 +276,40 @@ class ROIRelationHead(torch.nn.Module):
                     gt_rel_binarys_matrix,
                 )
 
-                rel_pair_idxs, rel_labels = filter_rel_pairs(
-                    relness_matrix, rel_pair_idxs, rel_labels
+                rel_pair_idxs, rel_labels, relness_scores = filter_rel_pairs(
+                    relness_scores, rel_pair_idxs, rel_labels
                 )
-                for enti_prop, rel_mat in zip(proposals, relness_matrix):
-                    enti_prop.add_field('relness_mat', rel_mat.unsqueeze(-1)) 
 
         if self.cfg.MODEL.ATTRIBUTE_ON:
             att_features = self.att_feature_extractor(features, proposals)
             roi_features = torch.cat((roi_features, att_features), dim=-1)
 
-        if self.use_union_box:
-            union_features = self.union_feature_extractor(features, proposals, rel_pair_idxs)
+        if (not self.training) and self.chunk_memory_budget > 0 and self.support_chunked_inference:
+            obj_refine_logits, relation_logits = self.chunked_inference(
+                features, proposals, rel_pair_idxs, roi_features, logger, store_keys
+            )
+            add_losses = {}
         else:
-            union_features = None
-
-        # final classifier that converts the features into predictions
-        # should corresponding to all the functions and layers after the self.context class
-        rel_pn_labels = rel_labels
-        if not self.use_same_label_with_clser:
-            rel_pn_labels = rel_labels_all
-
-
-        obj_refine_logits, relation_logits, add_losses = self.predictor(
-            proposals,
-            rel_pair_idxs,
-            rel_pn_labels,
-            gt_rel_binarys_matrix,
-            roi_features,
-            union_features,
-            logger,
-        )
+            if self.use_union_box:
+                union_features = self.extract_union_features(features, proposals, rel_pair_idxs, store_keys)
+            else:
+                union_features = None
+
+            # final classifier that converts the features into predictions
+            # should corresponding to all the functions and layers after the self.context class
+            rel_pn_labels = rel_labels
+            if not self.use_same_label_with_clser:
+                rel_pn_labels = rel_labels_all
+
+            obj_refine_logits, relation_logits, add_losses = self.predictor(
+                proposals,
+                rel_pair_idxs,
+                rel_pn_labels,
+                gt_rel_binarys_matrix,
+                roi_features,
+                union_features,
+                logger,
+            )
 
         # proposals, rel_pair_idxs, rel_pn_labels,relness_net_input,roi_features,union_features, None
         # for test
@@ -224,7 +320,7 @@ class ROIRelationHead(torch.nn.Module):
                 obj_refine_logits = [prop.get_field("predict_logits") for prop in proposals]
 
             result = self.post_processor(
-                (relation_logits, obj_refine_logits), rel_pair_idxs, proposals
+                (relation_logits, obj_refine_logits), rel_pair_idxs, proposals, relness_scores
             )
 
             return roi_features, result, {}
@@ -260,6 +356,51 @@ class ROIRelationHead(torch.nn.Module):
         return roi_features, proposals, output_losses
 
 
+    def chunked_inference(self, features, proposals, rel_pair_idxs, roi_features, logger=None, store_keys=None):
+        """
+        Inference with bounded peak memory: the object context is computed once for the whole batch,
+        then the relation pairs are streamed in chunks through the union feature extractor and
+        the pair level layers of the predictor. The logits are the same as the one pass forward.
+
+        Returns:
+            obj_refine_logits (list[Tensor] or tuple): same as the output of predictor
+            relation_logits (list[Tensor]): (num_rel, num_rel_cls) for each image
+        """
+        obj_context = self.predictor.object_context(proposals, roi_features, logger)
+
+        # the activations of a pair in the pair level layers of the predictor, and in the union
+        # feature extractor when the pairs use the union features
+        pair_bytes = self.predictor.pair_memory_bytes()
+        if self.use_union_box:
+            pair_bytes += self.union_feature_extractor.pair_memory_bytes()
+        pairs_per_chunk = max(int(self.chunk_memory_budget * 1024 ** 2) // pair_bytes, 1)
+
+        relation_logits = [[] for _ in rel_pair_idxs]
+        for img_ids, chunk_pair_idxs in split_pair_chunks(rel_pair_idxs, pairs_per_chunk):
+            chunk_context = {key: [val[i] for i in img_ids] for key, val in obj_context.items()}
+            if self.use_union_box:
+                union_features = self.extract_union_features(
+                    None if features is None else [each[img_ids] for each in features],
+                    [proposals[i] for i in img_ids],
+                    chunk_pair_idxs,
+                    None if store_keys is None else [store_keys[i] for i in img_ids],
+                )
+            else:
+                union_features = None
+            chunk_logits = self.predictor.pair_logits(chunk_context, chunk_pair_idxs, union_features)
+            chunk_logits = chunk_logits.split([len(each) for each in chunk_pair_idxs], dim=0)
+            for img_id, logits in zip(img_ids, chunk_logits):
+                relation_logits[img_id].append(logits)
+        # the images without pairs have no chunk
+        relation_logits = [torch.cat(each, dim=0) if len(each) > 0 else roi_features.new_zeros((0, self.num_rel_cls))
+                           for each in relation_logits]
+
+        obj_refine_logits = obj_context["obj_dists"]
+        if "att_dists" in obj_context:
+            obj_refine_logits = (obj_refine_logits, obj_context["att_dists"])
+        return obj_refine_logits, relation_logits
+
+
 def build_roi_relation_head(cfg, in_channels):
     """
     Constructs a new relation head.
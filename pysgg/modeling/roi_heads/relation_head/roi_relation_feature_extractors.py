@@ -20,6 +20,7 @@ class RelationFeatureExtractor(nn.Module):
     def __init__(self, cfg, in_channels):
         super(RelationFeatureExtractor, self).__init__()
         self.cfg = cfg.clone()
+        self.in_channels = in_channels
         # should corresponding to obj_feature_map function in neural-motifs
         resolution = cfg.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION
         pool_all_levels = cfg.MODEL.ROI_RELATION_HEAD.POOLING_ALL_LEVELS
@@ -38,6 +39,7 @@ class RelationFeatureExtractor(nn.Module):
         self.geometry_feature = cfg.MODEL.ROI_RELATION_HEAD.GEOMETRIC_FEATURES
         # union rectangle size
         self.rect_size = resolution * 4 - 1
+        self.rect_mask_dtype = torch.half if cfg.MODEL.ROI_RELATION_HEAD.GEOMETRIC_FEATURES_HALF else torch.float
 
         if self.geometry_feature:
             self.rect_conv = nn.Sequential(*[
@@ -62,69 +64,132 @@ class RelationFeatureExtractor(nn.Module):
                                                       out_dim // 2, out_dim), nn.ReLU(inplace=True),
                                                   ])
 
+    def pair_memory_bytes(self):
+        """
+        rough size in bytes of the activations taken by a single relation pair in forward,
+        used to split the pairs into chunks under a memory budget
+        """
+        pooler = self.feature_extractor.pooler
+        resolution = pooler.output_size[0]
+        num_levels = len(pooler.poolers) if pooler.cat_all_levels else 1
+        # pooled union features, and the reduced features when all levels are concatenated
+        num_elements = self.in_channels * resolution ** 2 * (num_levels + 1)
+        if self.geometry_feature:
+            half_size = (self.rect_size + 1) // 2
+            quarter_size = (half_size + 1) // 2
+            num_elements += 2 * self.rect_size ** 2
+            # rect_conv activations before and after the batch norms
+            num_elements += 2 * (self.in_channels // 2) * half_size ** 2
+            num_elements += 2 * self.in_channels * quarter_size ** 2
+        if self.cfg.MODEL.ATTRIBUTE_ON:
+            num_elements *= 2
+        return num_elements * 4
+
     def forward(self, x, proposals, rel_pair_idxs=None):
-        device = x[0].device
         union_proposals = []
-        rect_inputs = []
+        # (i, j) and (j, i) share the same union box, so the union region is pooled only once
+        # per unordered pair and scattered back to both directions by pair_inverse_idxs
+        pair_inverse_idxs = []
+        num_unique_pairs = 0
+        head_boxes = []
+        tail_boxes = []
         for proposal, rel_pair_idx in zip(proposals, rel_pair_idxs):
-            head_proposal = proposal[rel_pair_idx[:, 0]]
-            tail_proposal = proposal[rel_pair_idx[:, 1]]
-            union_proposal = boxlist_union(head_proposal, tail_proposal)
+            unique_pair_idx, inverse_idx = unordered_pair_index(rel_pair_idx)
+            pair_inverse_idxs.append(inverse_idx + num_unique_pairs)
+            num_unique_pairs += len(unique_pair_idx)
+
+            union_proposal = boxlist_union(proposal[unique_pair_idx[:, 0]],
+                                           proposal[unique_pair_idx[:, 1]])
             union_proposals.append(union_proposal)
 
-            # use range to construct rectangle, sized (rect_size, rect_size)
-            num_rel = len(rel_pair_idx)
-            dummy_x_range = torch.arange(self.rect_size, device=device).view(1, 1, -1).expand(num_rel, self.rect_size,
-                                                                                              self.rect_size)
-            dummy_y_range = torch.arange(self.rect_size, device=device).view(1, -1, 1).expand(num_rel, self.rect_size,
-                                                                                              self.rect_size)
-            # resize bbox to the scale rect_size
+            # the rectangle masks depend on the direction of pair, collect the boxes of each ordered pair
+            # resized to the scale rect_size, the masks of all images are rasterized together afterwards
             if self.geometry_feature:
-                head_proposal = head_proposal.resize(
-                    (self.rect_size, self.rect_size))
-                tail_proposal = tail_proposal.resize(
-                    (self.rect_size, self.rect_size))
-                head_rect = ((dummy_x_range >= head_proposal.bbox[:, 0].floor().view(-1, 1, 1).long())
-                             & (dummy_x_range <= head_proposal.bbox[:, 2].ceil().view(-1, 1, 1).long())
-                             & (dummy_y_range >= head_proposal.bbox[:, 1].floor().view(-1, 1, 1).long())
-                             & (dummy_y_range <= head_proposal.bbox[:, 3].ceil().view(-1, 1, 1).long())).float()
-                tail_rect = ((dummy_x_range >= tail_proposal.bbox[:, 0].floor().view(-1, 1, 1).long())
-                             & (dummy_x_range <= tail_proposal.bbox[:, 2].ceil().view(-1, 1, 1).long())
-                             & (dummy_y_range >= tail_proposal.bbox[:, 1].floor().view(-1, 1, 1).long())
-                             & (dummy_y_range <= tail_proposal.bbox[:, 3].ceil().view(-1, 1, 1).long())).float()
-
-                # (num_rel, 4, rect_size, rect_size)
-                rect_input = torch.stack((head_rect, tail_rect), dim=1)
-                rect_inputs.append(rect_input)
-
-        # union visual feature. size (total_num_rel, in_channels, POOLER_RESOLUTION, POOLER_RESOLUTION)
+                img_w, img_h = proposal.size
+                rect_scale = proposal.bbox.new_tensor([self.rect_size / img_w, self.rect_size / img_h,
+                                                       self.rect_size / img_w, self.rect_size / img_h])
+                scaled_boxes = proposal.convert("xyxy").bbox * rect_scale
+                head_boxes.append(scaled_boxes[rel_pair_idx[:, 0]])
+                tail_boxes.append(scaled_boxes[rel_pair_idx[:, 1]])
+
+        pair_inverse_idxs = torch.cat(pair_inverse_idxs, dim=0)
+
+        # union visual feature. size (total_num_unique_pair, in_channels, POOLER_RESOLUTION, POOLER_RESOLUTION)
         union_vis_features = self.feature_extractor.pooler(x, union_proposals)
         # merge two parts
         if self.geometry_feature:
+            # (total_num_rel, 2, rect_size, rect_size)
+            rect_inputs = pair_rect_masks(torch.cat(head_boxes, dim=0), torch.cat(tail_boxes, dim=0),
+                                          self.rect_size, dtype=self.rect_mask_dtype)
             # rectangle feature. size (total_num_rel, in_channels, POOLER_RESOLUTION, POOLER_RESOLUTION)
-            rect_inputs = torch.cat(rect_inputs, dim=0)
             rect_features = self.rect_conv(rect_inputs)
 
             if self.separate_spatial:
+                # the region branch is direction independent, run it on the unique pairs only
                 region_features = self.feature_extractor.forward_without_pool(union_vis_features)
+                region_features = region_features[pair_inverse_idxs]
                 spatial_features = self.spatial_fc(rect_features.view(rect_features.size(0), -1))
                 union_features = (region_features, spatial_features)
             else:
-                union_features = union_vis_features + rect_features
+                union_features = union_vis_features[pair_inverse_idxs] + rect_features
                 union_features = self.feature_extractor.forward_without_pool(union_features)
                 # (total_num_rel, out_channels)
         else:
             union_features = self.feature_extractor.forward_without_pool(union_vis_features)
+            union_features = union_features[pair_inverse_idxs]
 
         if self.cfg.MODEL.ATTRIBUTE_ON:
             union_att_features = self.att_feature_extractor.pooler(x, union_proposals)
-            union_features_att = union_att_features + rect_features
+            union_features_att = union_att_features[pair_inverse_idxs] + rect_features
             union_features_att = self.att_feature_extractor.forward_without_pool(union_features_att)
             union_features = torch.cat((union_features, union_features_att), dim=-1)
 
         return union_features
 
 
+def unordered_pair_index(rel_pair_idx):
+    """
+    Collapse the ordered pairs (i, j) and (j, i) into one unordered pair.
+
+    Arguments:
+        rel_pair_idx (Tensor): ordered pair indexes, sized [num_rel, 2]
+
+    Returns:
+        unique_pair_idx (Tensor): unordered pairs sorted as (min, max), sized [num_unique, 2]
+        inverse_idx (Tensor): position of each ordered pair in unique_pair_idx, sized [num_rel]
+    """
+    sorted_pair_idx = torch.sort(rel_pair_idx, dim=1)[0]
+    unique_pair_idx, inverse_idx = torch.unique(sorted_pair_idx, dim=0, return_inverse=True)
+    return unique_pair_idx, inverse_idx
+
+
+def pair_rect_masks(head_boxes, tail_boxes, rect_size, dtype=torch.float):
+    """
+    Rasterize the head and tail boxes of each pair into binary masks sized (rect_size, rect_size).
+    Each box mask is the outer product of its 1-D row and column interval masks, so only
+    O(num_rel * rect_size) comparisons are needed.
+
+    Arguments:
+        head_boxes (Tensor): xyxy boxes already scaled to rect_size, sized [num_rel, 4]
+        tail_boxes (Tensor): xyxy boxes already scaled to rect_size, sized [num_rel, 4]
+        rect_size (int)
+        dtype (torch.dtype): dtype of the returned masks
+
+    Returns:
+        rect_masks (Tensor): sized [num_rel, 2, rect_size, rect_size]
+    """
+    # (num_rel, 2, 4)
+    boxes = torch.stack((head_boxes, tail_boxes), dim=1)
+    lower = boxes[:, :, :2].floor().long()
+    upper = boxes[:, :, 2:].ceil().long()
+    dummy_range = torch.arange(rect_size, device=boxes.device).view(1, 1, 1, -1)
+    # (num_rel, 2, 2, rect_size), interval masks along x and y
+    interval_masks = ((dummy_range >= lower.unsqueeze(-1)) & (dummy_range <= upper.unsqueeze(-1))).to(dtype)
+    x_masks = interval_masks[:, :, 0]
+    y_masks = interval_masks[:, :, 1]
+    return y_masks.unsqueeze(-1) * x_masks.unsqueeze(-2)
+
+
 def make_roi_relation_feature_extractor(cfg, in_channels):
     func = registry.ROI_RELATION_FEATURE_EXTRACTORS[
         cfg.MODEL.ROI_RELATION_HEAD.FEATURE_EXTRACTOR
@@ -9,9 +9,10 @@ from torch.nn import functional as F
 
 from pysgg.config import cfg
 from pysgg.data import get_dataset_statistics
+from pysgg.layers import fold_batch_norms
 from pysgg.modeling import registry
 from pysgg.modeling.make_layers import make_fc
-from pysgg.modeling.roi_heads.relation_head.classifier import build_classifier
+from pysgg.modeling.roi_heads.relation_head.classifier import build_classifier, FoldedWeightMixin
 from pysgg.modeling.roi_heads.relation_head.model_kern import (
     GGNNRelReason,
     InstanceFeaturesAugments,
@@ -22,6 +23,7 @@ from pysgg.modeling.roi_heads.relation_head.model_naive import (
     PairwiseFeatureExtractor,
 )
 from pysgg.modeling.utils import cat
+from pysgg.structures.boxes_per_cls import cat_boxes_per_cls
 from pysgg.structures.boxlist_ops import squeeze_tensor
 from .model_motifs import LSTMContext, FrequencyBias
 from .model_motifs_with_attribute import AttributeLSTMContext
@@ -435,9 +437,7 @@ class MSDNPredictor(nn.Module):
 
         # using the object results, update the pred label and logits
         if self.use_obj_recls_logits:
-            boxes_per_cls = cat(
-                [proposal.get_field("boxes_per_cls") for proposal in inst_proposals], dim=0
-            )  # comes from post process of box_head
+            boxes_per_cls = cat_boxes_per_cls(inst_proposals)  # comes from post process of box_head
             # here we use the logits refinements by adding
             if self.obj_recls_logits_update_manner == "add":
                 obj_pred_logits = refined_obj_logits + obj_pred_logits
@@ -462,7 +462,7 @@ class MSDNPredictor(nn.Module):
             pair_pred = cat(pair_preds, dim=0)
             rel_cls_logits = (
                 rel_cls_logits
-                + self.freq_lambda * self.freq_bias.index_with_labels(pair_pred.long())
+                + self.freq_bias.index_with_labels(pair_pred.long(), scale=self.freq_lambda)
             )
 
         obj_pred_logits = obj_pred_logits.split(num_objs, dim=0)
@@ -628,9 +628,7 @@ class BGNNPredictor(nn.Module):
         # using the object results, update the pred label and logits
         if self.use_obj_recls_logits:
             if self.mode == "sgdet":
-                boxes_per_cls = cat(
-                    [proposal.get_field("boxes_per_cls") for proposal in inst_proposals], dim=0
-                )  # comes from post process of box_head
+                boxes_per_cls = cat_boxes_per_cls(inst_proposals)  # comes from post process of box_head
                 # here we use the logits refinements by adding
                 if self.obj_recls_logits_update_manner == "add":
                     obj_pred_logits = refined_obj_logits + obj_pred_logits
@@ -657,7 +655,7 @@ class BGNNPredictor(nn.Module):
             pair_pred = cat(pair_preds, dim=0)
             rel_cls_logits = (
                 rel_cls_logits
-                + self.freq_lambda * self.freq_bias.index_with_labels(pair_pred.long())
+                + self.freq_bias.index_with_labels(pair_pred.long(), scale=self.freq_lambda)
             )
 
         obj_pred_logits = obj_pred_logits.split(num_objs, dim=0)
@@ -788,9 +786,7 @@ class GPSNetPredictor(nn.Module):
 
         # using the object results, update the pred label and logits
         if self.use_obj_recls_logits:
-            boxes_per_cls = cat(
-                [proposal.get_field("boxes_per_cls") for proposal in inst_proposals], dim=0
-            )  # comes from post process of box_head
+            boxes_per_cls = cat_boxes_per_cls(inst_proposals)  # comes from post process of box_head
             # here we use the logits refinements by adding
             if self.obj_recls_logits_update_manner == "add":
                 obj_pred_logits = refined_obj_logits + obj_pred_logits
@@ -926,9 +922,7 @@ class AGRCNNPredictor(nn.Module):
 
         # using the object results, update the pred label and logits
         if self.use_obj_recls_logits:
-            boxes_per_cls = cat(
-                [proposal.get_field("boxes_per_cls") for proposal in inst_proposals], dim=0
-            )  # comes from post process of box_head
+            boxes_per_cls = cat_boxes_per_cls(inst_proposals)  # comes from post process of box_head
             # here we use the logits refinements by adding
             if self.obj_recls_logits_update_manner == "add":
                 obj_pred_logits = refined_obj_logits + obj_pred_logits
@@ -1055,6 +1049,33 @@ class MotifPredictor(nn.Module):
             rel_pair_idxs (list[Tensor]): (num_rel, 2) index of subject and object
             union_features (Tensor): (batch_num_rel, context_pooling_dim): visual union feature of each pair
         """
+        obj_context = self.object_context(proposals, roi_features, logger)
+        rel_dists = self.pair_logits(obj_context, rel_pair_idxs, union_features)
+
+        num_rels = [r.shape[0] for r in rel_pair_idxs]
+        assert len(num_rels) == len(proposals)
+        rel_dists = rel_dists.split(num_rels, dim=0)
+        obj_dists = obj_context["obj_dists"]
+
+        # we use obj_preds instead of pred from obj_dists
+        # because in decoder_rnn, preds has been through a nms stage
+        add_losses = {}
+
+        if self.attribute_on:
+            return (obj_dists, obj_context["att_dists"]), rel_dists, add_losses
+        else:
+            return obj_dists, rel_dists, add_losses
+
+    def object_context(self, proposals, roi_features, logger=None):
+        """
+        the object level part of the forward, which is independent of the relation pairs
+        :param proposals:
+        :param roi_features: object features
+        :param logger:
+        Returns:
+            obj_context (dict[list[Tensor]]): per image object logits, predictions and
+                head/tail representations consumed by pair_logits
+        """
         # encode context infomation
         if self.attribute_on:
             obj_dists, obj_preds, att_dists, edge_ctx = self.context_layer(
@@ -1071,9 +1092,7 @@ class MotifPredictor(nn.Module):
         head_rep = edge_rep[:, 0].contiguous().view(-1, self.hidden_dim)
         tail_rep = edge_rep[:, 1].contiguous().view(-1, self.hidden_dim)
 
-        num_rels = [r.shape[0] for r in rel_pair_idxs]
         num_objs = [len(b) for b in proposals]
-        assert len(num_rels) == len(num_objs)
 
         head_reps = head_rep.split(num_objs, dim=0)
         tail_reps = tail_rep.split(num_objs, dim=0)
@@ -1081,10 +1100,48 @@ class MotifPredictor(nn.Module):
         if not self.use_obj_recls_labels:
             obj_preds = [each.get_field("pred_labels") for each in proposals]
 
+        obj_dists = obj_dists.split(num_objs, dim=0)
+        if not self.use_obj_recls_logits:
+            obj_dists = [each.get_field("predict_logits") for each in proposals]
+
+        obj_context = dict(
+            obj_dists=obj_dists,
+            obj_preds=obj_preds,
+            head_reps=head_reps,
+            tail_reps=tail_reps,
+        )
+        if self.attribute_on:
+            obj_context["att_dists"] = att_dists.split(num_objs, dim=0)
+        return obj_context
+
+    def pair_memory_bytes(self):
+        """
+        rough size in bytes of the activations taken by a single relation pair in pair_logits,
+        used to split the pairs into chunks under a memory budget
+        """
+        # the head and tail representations, the post_cat output and the logits
+        num_elements = self.hidden_dim * 2 + self.pooling_dim + self.num_rel_cls
+        if self.use_vision:
+            # the product with the union features, and their up projection
+            num_elements += self.pooling_dim * (2 if self.union_single_not_match else 1)
+        if self.use_bias:
+            num_elements += self.num_rel_cls * 2
+        return num_elements * 4
+
+    def pair_logits(self, obj_context, rel_pair_idxs, union_features):
+        """
+        the pair level part of the forward, each relation pair is classified independently
+        so the pairs can be fed in any chunk
+        :param obj_context: the output of object_context, one entry per image of rel_pair_idxs
+        :param rel_pair_idxs:
+        :param union_features: union box ROI features of object in relation
+        Returns:
+            rel_dists (Tensor): (batch_num_rel, num_rel_cls)
+        """
         prod_reps = []
         pair_preds = []
         for pair_idx, head_rep, tail_rep, obj_pred in zip(
-            rel_pair_idxs, head_reps, tail_reps, obj_preds
+            rel_pair_idxs, obj_context["head_reps"], obj_context["tail_reps"], obj_context["obj_preds"]
         ):
             prod_reps.append(
                 torch.cat((head_rep[pair_idx[:, 0]], tail_rep[pair_idx[:, 1]]), dim=-1)
@@ -1110,21 +1167,7 @@ class MotifPredictor(nn.Module):
         if self.use_bias:
             rel_dists = rel_dists + self.freq_bias.index_with_labels(pair_pred.long())
 
-        obj_dists = obj_dists.split(num_objs, dim=0)
-        rel_dists = rel_dists.split(num_rels, dim=0)
-
-        if not self.use_obj_recls_logits:
-            obj_dists = [each.get_field("predict_logits") for each in proposals]
-
-        # we use obj_preds instead of pred from obj_dists
-        # because in decoder_rnn, preds has been through a nms stage
-        add_losses = {}
-
-        if self.attribute_on:
-            att_dists = att_dists.split(num_objs, dim=0)
-            return (obj_dists, att_dists), rel_dists, add_losses
-        else:
-            return obj_dists, rel_dists, add_losses
+        return rel_dists
 
 
 @registry.ROI_RELATION_PREDICTOR.register("VCTreePredictor")
@@ -2314,7 +2357,7 @@ class KERNPredictor(nn.Module):
         if self.union_single_not_match:
             rel_reasoning_features = self.rel_feat_downdim_fc(rel_reasoning_features)
         rel_reasonion_out_feats = self.KERN_rel_reasoning(
-            augment_obj_feat, rel_reasoning_features, pair_preds_labels, rel_pair_idxs
+            augment_obj_feat, rel_reasoning_features, pair_preds_labels, rel_pair_idxs, num_objs
         )
 
         rel_dists = self.calculate_logits(
@@ -2543,6 +2586,7 @@ class CausalAnalysisPredictor(nn.Module):
         obj_boxs,
         logger,
         ctx_average=False,
+        with_counterfactual=False,
     ):
         """
 
@@ -2553,7 +2597,10 @@ class CausalAnalysisPredictor(nn.Module):
         :param obj_boxs: relation pair boxes geometry information list(Tensor(n_pairs, 12))
         :param logger:
         :param ctx_average:
+        :param with_counterfactual: also encode the average context counterfactual, stacked with
+            the factual pass through the pair feature layers
         :return:
+            ..., and the counterfactual post_ctx_rep and pair_obj_probs if with_counterfactual
         """
         # encode context infomation
         obj_dists, obj_preds, edge_ctx, binary_preds = self.context_layer(
@@ -2561,6 +2608,26 @@ class CausalAnalysisPredictor(nn.Module):
         )
         obj_dist_prob = F.softmax(obj_dists, dim=-1)
 
+        # batch-wise pair index
+        pair_idxs = []
+        offset = 0
+        for pair_idx, num_obj in zip(rel_pair_idxs, num_objs):
+            pair_idxs.append(pair_idx.long() + offset)
+            offset += num_obj
+        pair_idx = cat(pair_idxs, dim=0)
+        num_obj_all = offset
+
+        if with_counterfactual:
+            with torch.no_grad():
+                avg_obj_dists, _, avg_edge_ctx, _ = self.context_layer(
+                    roi_features, proposals, rel_pair_idxs, logger, ctx_average=True
+                )
+            # the factual and counterfactual objects go through the pair layers together
+            edge_ctx = cat((edge_ctx, avg_edge_ctx), dim=0)
+            pair_idx_stacked = cat((pair_idx, pair_idx + num_obj_all), dim=0)
+        else:
+            pair_idx_stacked = pair_idx
+
         # post decode
         edge_rep = self.post_emb(
             edge_ctx
@@ -2568,45 +2635,24 @@ class CausalAnalysisPredictor(nn.Module):
         edge_rep = edge_rep.view(edge_rep.size(0), 2, self.edge_dim)
         head_rep = edge_rep[:, 0].contiguous().view(-1, self.edge_dim)
         tail_rep = edge_rep[:, 1].contiguous().view(-1, self.edge_dim)
-        # split
-        head_reps = head_rep.split(num_objs, dim=0)
-        tail_reps = tail_rep.split(num_objs, dim=0)
-        obj_preds = obj_preds.split(num_objs, dim=0)
-        obj_prob_list = obj_dist_prob.split(num_objs, dim=0)
-        obj_dist_list = obj_dists.split(num_objs, dim=0)
-        ctx_reps = []
-        pair_preds = []
-        pair_obj_probs = []
-        pair_bboxs_info = []
-        for pair_idx, head_rep, tail_rep, obj_pred, obj_box, obj_prob in zip(
-            rel_pair_idxs, head_reps, tail_reps, obj_preds, obj_boxs, obj_prob_list
-        ):
-            if self.use_vtranse:
-                ctx_reps.append(head_rep[pair_idx[:, 0]] - tail_rep[pair_idx[:, 1]])
-            else:
-                ctx_reps.append(
-                    torch.cat((head_rep[pair_idx[:, 0]], tail_rep[pair_idx[:, 1]]), dim=-1)
-                )
-            pair_preds.append(
-                torch.stack((obj_pred[pair_idx[:, 0]], obj_pred[pair_idx[:, 1]]), dim=1)
-            )
-            pair_obj_probs.append(
-                torch.stack((obj_prob[pair_idx[:, 0]], obj_prob[pair_idx[:, 1]]), dim=2)
-            )
-            pair_bboxs_info.append(
-                get_box_pair_info(obj_box[pair_idx[:, 0]], obj_box[pair_idx[:, 1]])
-            )
-        pair_obj_probs = cat(pair_obj_probs, dim=0)
-        pair_bbox_geo_feat = cat(pair_bboxs_info, dim=0)
-        pair_pred = cat(pair_preds, dim=0)
-        ctx_rep = cat(ctx_reps, dim=0)
+        if self.use_vtranse:
+            ctx_rep = head_rep[pair_idx_stacked[:, 0]] - tail_rep[pair_idx_stacked[:, 1]]
+        else:
+            ctx_rep = torch.cat((head_rep[pair_idx_stacked[:, 0]], tail_rep[pair_idx_stacked[:, 1]]), dim=-1)
         if self.use_vtranse:
             post_ctx_rep = ctx_rep
         else:
             post_ctx_rep = self.post_cat(ctx_rep)
 
-        return (
-            post_ctx_rep,
+        obj_box = cat(obj_boxs, dim=0)
+        pair_pred = torch.stack((obj_preds[pair_idx[:, 0]], obj_preds[pair_idx[:, 1]]), dim=1)
+        pair_obj_probs = torch.stack((obj_dist_prob[pair_idx[:, 0]], obj_dist_prob[pair_idx[:, 1]]), dim=2)
+        pair_bbox_geo_feat = get_box_pair_info(obj_box[pair_idx[:, 0]], obj_box[pair_idx[:, 1]])
+        obj_dist_list = obj_dists.split(num_objs, dim=0)
+        edge_rep = edge_rep[:num_obj_all]
+
+        outputs = (
+            post_ctx_rep[: len(pair_idx)],
             pair_pred,
             pair_bbox_geo_feat,
             pair_obj_probs,
@@ -2615,6 +2661,13 @@ class CausalAnalysisPredictor(nn.Module):
             edge_rep,
             obj_dist_list,
         )
+        if with_counterfactual:
+            avg_obj_dist_prob = F.softmax(avg_obj_dists, dim=-1)
+            avg_pair_obj_probs = torch.stack(
+                (avg_obj_dist_prob[pair_idx[:, 0]], avg_obj_dist_prob[pair_idx[:, 1]]), dim=2
+            )
+            outputs = outputs + (post_ctx_rep[len(pair_idx):].detach(), avg_pair_obj_probs)
+        return outputs
 
     def forward(
         self,
@@ -2648,6 +2701,17 @@ class CausalAnalysisPredictor(nn.Module):
 
         assert len(num_rels) == len(num_objs)
 
+        # generate the avg blank features for causalities comparison
+        with_counterfactual = (not self.training) and self.effect_analysis and self.effect_type != "none"
+        pair_features = self.pair_feature_generate(
+            roi_features,
+            proposals,
+            rel_pair_idxs,
+            num_objs,
+            obj_boxs,
+            logger,
+            with_counterfactual=with_counterfactual,
+        )
         (
             post_ctx_rep,
             pair_pred,
@@ -2657,31 +2721,9 @@ class CausalAnalysisPredictor(nn.Module):
             obj_dist_prob,
             edge_rep,
             obj_dist_list,
-        ) = self.pair_feature_generate(
-            roi_features, proposals, rel_pair_idxs, num_objs, obj_boxs, logger
-        )
-
-        # generate the avg blank features for causalities comparison
-        if (not self.training) and self.effect_analysis:
-            with torch.no_grad():
-                (
-                    avg_post_ctx_rep,
-                    _,
-                    _,
-                    avg_pair_obj_prob,
-                    _,
-                    _,
-                    _,
-                    _,
-                ) = self.pair_feature_generate(
-                    roi_features,
-                    proposals,
-                    rel_pair_idxs,
-                    num_objs,
-                    obj_boxs,
-                    logger,
-                    ctx_average=True,
-                )
+        ) = pair_features[:8]
+        if with_counterfactual:
+            avg_post_ctx_rep, avg_pair_obj_prob = pair_features[8:]
 
         if self.separate_spatial:
             union_features, spatial_conv_feats = union_features
@@ -2690,10 +2732,12 @@ class CausalAnalysisPredictor(nn.Module):
         if self.spatial_for_vision:
             post_ctx_rep = post_ctx_rep * self.spt_emb(pair_bbox)
 
-        rel_dists = self.calculate_logits(
-            union_features, post_ctx_rep, pair_pred, use_label_dist=False
-        )
-        rel_dist_list = rel_dists.split(num_rels, dim=0)
+        # the effect types below replace the label based logits
+        if not with_counterfactual:
+            rel_dists = self.calculate_logits(
+                union_features, post_ctx_rep, pair_pred, use_label_dist=False
+            )
+            rel_dist_list = rel_dists.split(num_rels, dim=0)
 
         add_losses = {}
         # additional loss
@@ -2738,7 +2782,7 @@ class CausalAnalysisPredictor(nn.Module):
             self.avg_post_ctx = self.moving_average(self.avg_post_ctx, post_ctx_rep)
             self.untreated_feat = self.moving_average(self.untreated_feat, union_features)
 
-        elif self.effect_analysis:
+        elif with_counterfactual:
             with torch.no_grad():
                 # untreated spatial
                 if self.spatial_for_vision:
@@ -2759,21 +2803,20 @@ class CausalAnalysisPredictor(nn.Module):
                 # untreated category dist
                 avg_frq_rep = avg_pair_obj_prob
 
+            # (ctx_rep, index of the frq_rep) of the factual and the counterfactual branch
+            frq_reps = [pair_obj_probs, avg_frq_rep]
             if self.effect_type == "TDE":  # TDE of CTX
-                rel_dists = self.calculate_logits(
-                    union_features, post_ctx_rep, pair_obj_probs
-                ) - self.calculate_logits(union_features, avg_ctx_rep, pair_obj_probs)
+                frq_reps = frq_reps[:1]
+                variants = [(post_ctx_rep, 0), (avg_ctx_rep, 0)]
             elif self.effect_type == "NIE":  # NIE of FRQ
-                rel_dists = self.calculate_logits(
-                    union_features, avg_ctx_rep, pair_obj_probs
-                ) - self.calculate_logits(union_features, avg_ctx_rep, avg_frq_rep)
-            elif self.effect_type == "TE":  # Total Effect
-                rel_dists = self.calculate_logits(
-                    union_features, post_ctx_rep, pair_obj_probs
-                ) - self.calculate_logits(union_features, avg_ctx_rep, avg_frq_rep)
+                variants = [(avg_ctx_rep, 0), (avg_ctx_rep, 1)]
             else:
-                assert self.effect_type == "none"
-                pass
+                assert self.effect_type == "TE"  # Total Effect
+                variants = [(post_ctx_rep, 0), (avg_ctx_rep, 1)]
+            factual_dists, counterfactual_dists = self.calculate_effect_logits(
+                union_features, frq_reps, variants
+            )
+            rel_dists = factual_dists - counterfactual_dists
             rel_dist_list = rel_dists.split(num_rels, dim=0)
 
         return obj_dist_list, rel_dist_list, add_losses
@@ -2795,36 +2838,64 @@ class CausalAnalysisPredictor(nn.Module):
         if mean_ctx:
             ctx_rep = ctx_rep.mean(-1).unsqueeze(-1)
 
-        if self.fusion_type != "features":
+        return self.fuse_logits(vis_rep, ctx_rep, frq_dists)
+
+    def fuse_logits(self, vis_rep, ctx_rep, frq_dists, vis_dists=None):
+        """
+        fuse the visual, context and frequency terms into the relation logits
+        :param vis_dists: vis_compress(vis_rep) when it is already computed, vis_rep is then unused
+            by the "sum" and "gate" fusions
+        """
+        if self.fusion_type == "features":
+            return self.vis_compress(vis_rep + ctx_rep)
+
+        if vis_dists is None:
             vis_dists = self.vis_compress(vis_rep)
-            ctx_dists = self.ctx_compress(ctx_rep)
-
-            if self.fusion_type == "gate":
-                ctx_gate_dists = self.ctx_gate_fc(ctx_rep)
-                union_dists = ctx_dists * torch.sigmoid(vis_dists + frq_dists + ctx_gate_dists)
-                # union_dists = (ctx_dists.exp() * torch.sigmoid(vis_dists + frq_dists + ctx_constraint) + 1e-9).log()    # improve on zero-shot, but low mean recall and TDE recall
-                # union_dists = ctx_dists * torch.sigmoid(vis_dists * frq_dists)                                          # best conventional Recall results
-                # union_dists = (ctx_dists.exp() + vis_dists.exp() + frq_dists.exp() + 1e-9).log()                        # good zero-shot Recall
-                # union_dists = ctx_dists * torch.max(torch.sigmoid(vis_dists), torch.sigmoid(frq_dists))                 # good zero-shot Recall
-                # union_dists = ctx_dists * torch.sigmoid(vis_dists) * torch.sigmoid(frq_dists)                           # balanced recall and mean recall
-                # union_dists = ctx_dists * (torch.sigmoid(vis_dists) + torch.sigmoid(frq_dists)) / 2.0                   # good zero-shot Recall
-                # union_dists = ctx_dists * torch.sigmoid((vis_dists.exp() + frq_dists.exp() + 1e-9).log())               # good zero-shot Recall, bad for all of the rest
-
-            elif self.fusion_type == "sum":
-                if cfg.MODEL.ROI_RELATION_HEAD.CAUSAL.OBJ_PAIR_LABEL_FREQUENCY_BIAS_BRANCH:
-                    union_dists = vis_dists + ctx_dists + frq_dists
-                else:
-                    union_dists = vis_dists + ctx_dists
-            else:
-                raise ValueError("invalid fusion type")
+        ctx_dists = self.ctx_compress(ctx_rep)
 
-        elif self.fusion_type == "features":
-            union_dists = self.vis_compress(vis_rep + ctx_rep)
+        if self.fusion_type == "gate":
+            ctx_gate_dists = self.ctx_gate_fc(ctx_rep)
+            union_dists = ctx_dists * torch.sigmoid(vis_dists + frq_dists + ctx_gate_dists)
+            # union_dists = (ctx_dists.exp() * torch.sigmoid(vis_dists + frq_dists + ctx_constraint) + 1e-9).log()    # improve on zero-shot, but low mean recall and TDE recall
+            # union_dists = ctx_dists * torch.sigmoid(vis_dists * frq_dists)                                          # best conventional Recall results
+            # union_dists = (ctx_dists.exp() + vis_dists.exp() + frq_dists.exp() + 1e-9).log()                        # good zero-shot Recall
+            # union_dists = ctx_dists * torch.max(torch.sigmoid(vis_dists), torch.sigmoid(frq_dists))                 # good zero-shot Recall
+            # union_dists = ctx_dists * torch.sigmoid(vis_dists) * torch.sigmoid(frq_dists)                           # balanced recall and mean recall
+            # union_dists = ctx_dists * (torch.sigmoid(vis_dists) + torch.sigmoid(frq_dists)) / 2.0                   # good zero-shot Recall
+            # union_dists = ctx_dists * torch.sigmoid((vis_dists.exp() + frq_dists.exp() + 1e-9).log())               # good zero-shot Recall, bad for all of the rest
+
+        elif self.fusion_type == "sum":
+            if cfg.MODEL.ROI_RELATION_HEAD.CAUSAL.OBJ_PAIR_LABEL_FREQUENCY_BIAS_BRANCH:
+                union_dists = vis_dists + ctx_dists + frq_dists
+            else:
+                union_dists = vis_dists + ctx_dists
         else:
             raise ValueError("invalid fusion type")
 
         return union_dists
 
+    def calculate_effect_logits(self, vis_rep, frq_reps, variants):
+        """
+        calculate_logits of several factual / counterfactual variants in one batched pass.
+        The visual logits are shared by all variants, the frequency bias is looked up once for
+        each distribution of frq_reps, and the context terms run on the stacked context features.
+        :param vis_rep: (num_rel, pooling_dim) visual features shared by the variants
+        :param frq_reps: list of the distinct pair object distributions of the variants
+        :param variants: list of (ctx_rep, index of its pair object distribution in frq_reps)
+        :return: list of the logits of each variant
+        """
+        num_rel = vis_rep.shape[0]
+        ctx_rep = cat([ctx_rep.expand(num_rel, -1) for ctx_rep, _ in variants], dim=0)
+        frq_dists = [self.freq_bias.index_with_probability(frq_rep) for frq_rep in frq_reps]
+        frq_dists = cat([frq_dists[frq_id] for _, frq_id in variants], dim=0)
+
+        if self.fusion_type == "features":
+            vis_rep, vis_dists = vis_rep.repeat(len(variants), 1), None
+        else:
+            vis_dists = self.vis_compress(vis_rep).repeat(len(variants), 1)
+        union_dists = self.fuse_logits(vis_rep, ctx_rep, frq_dists, vis_dists)
+        return union_dists.split(num_rel, dim=0)
+
     def binary_ce_loss(self, logits, gt):
         batch_size, num_cat = logits.shape
         answer = torch.zeros((batch_size, num_cat), device=gt.device).float()
@@ -2838,3 +2909,23 @@ class CausalAnalysisPredictor(nn.Module):
 def make_roi_relation_predictor(cfg, in_channels):
     func = registry.ROI_RELATION_PREDICTOR[cfg.MODEL.ROI_RELATION_HEAD.PREDICTOR]
     return func(cfg, in_channels)
+
+
+def prepare_for_inference(predictor):
+    """
+    Fold the weights that stay constant at inference once, instead of on every batch:
+    the normalized classifier weights, the weighted frequency bias table and the
+    batch norms following a linear or convolution layer.
+    The predictor is put in eval mode and frozen, it is meant for inference only afterwards,
+    as the folded batch norms are removed from the model.
+    """
+    predictor.eval()
+    fold_batch_norms(predictor)
+    for module in predictor.modules():
+        if isinstance(module, FoldedWeightMixin):
+            module.prepare_for_inference()
+    if getattr(predictor, "freq_bias", None) is not None and hasattr(predictor, "freq_lambda"):
+        predictor.freq_bias.prepare_for_inference(scale=predictor.freq_lambda)
+    for param in predictor.parameters():
+        param.requires_grad_(False)
+    return predictor
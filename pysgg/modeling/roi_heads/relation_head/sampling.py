@@ -7,6 +7,70 @@ from pysgg.modeling.utils import cat
 from pysgg.structures.boxlist_ops import boxlist_iou
 
 
+def proposal_target_matching(proposals, targets, fg_thres):
+    """
+    IoU matching between the proposals and the ground truth of each image. It is computed once
+    in the relation head and shared by the relation sampling and the relation proposal network targets.
+
+    Arguments:
+        proposals (list[BoxList])
+        targets (list[BoxList])
+        fg_thres (float)
+
+    Returns:
+        matchings (list[dict]): for each image
+            ious: [num_tgt, num_prp] IoU between targets and proposals
+            prp_self_iou: [num_prp, num_prp] IoU between proposals
+            is_located: [num_tgt, num_prp] the IoU is over fg_thres
+            locating_match: [num_prp] 1 for the proposals that overlap any target over fg_thres
+            tgt_pair_idxs: [num_tgt_rel, 2] head and tail target index of the gt relations
+            tgt_rel_labs: [num_tgt_rel] label of the gt relations
+            locating_binary_rel: [num_prp, num_prp] binary_relatedness_matrix of is_located, the
+                relation proposal network targets. The relation sampling also requires the labels
+                to match, on the proposal labels of the box head sampling, so it builds its own.
+    """
+    matchings = []
+    for proposal, target in zip(proposals, targets):
+        ious = boxlist_iou(target, proposal)  # [tgt, prp]
+        is_located = ious > fg_thres
+        tgt_rel_matrix = target.get_field("relation")  # [tgt, tgt]
+        tgt_pair_idxs = torch.nonzero(tgt_rel_matrix != 0).view(-1, 2)
+        tgt_head_idxs = tgt_pair_idxs[:, 0].contiguous()
+        tgt_tail_idxs = tgt_pair_idxs[:, 1].contiguous()
+        matchings.append(dict(
+            ious=ious,
+            prp_self_iou=boxlist_iou(proposal, proposal),  # [prp, prp]
+            is_located=is_located,
+            # one box may match multiple gt boxes here we just mark them as a valid matching if they
+            # match any boxes
+            locating_match=is_located.any(dim=0).float(),
+            tgt_pair_idxs=tgt_pair_idxs,
+            tgt_rel_labs=tgt_rel_matrix[tgt_head_idxs, tgt_tail_idxs],
+            locating_binary_rel=binary_relatedness_matrix(is_located, tgt_head_idxs, tgt_tail_idxs),
+        ))
+    return matchings
+
+
+def binary_relatedness_matrix(is_match, tgt_head_idxs, tgt_tail_idxs):
+    """
+    mark the proposal pairs that match any ground truth relation, the pair (i, j) is marked
+    when one gt relation matches i on its head and j on its tail. The binary relatedness only
+    consider related or not, so it's symmetric.
+
+    Arguments:
+        is_match (Tensor): [num_tgt, num_prp] matching between targets and proposals
+        tgt_head_idxs (Tensor): [num_tgt_rel] head target index of gt relations
+        tgt_tail_idxs (Tensor): [num_tgt_rel] tail target index of gt relations
+
+    Returns:
+        binary_rel_mat (Tensor): [num_prp, num_prp] long tensor
+    """
+    binary_prp_head = is_match[tgt_head_idxs].float()  # num_tgt_rel, num_prp (matched prp head)
+    binary_prp_tail = is_match[tgt_tail_idxs].float()  # num_tgt_rel, num_prp (matched prp tail)
+    binary_rel_mat = (binary_prp_head.t() @ binary_prp_tail) > 0
+    return (binary_rel_mat | binary_rel_mat.t()).long()
+
+
 class RelationSampling(object):
     def __init__(
             self,
@@ -106,7 +170,7 @@ class RelationSampling(object):
 
         return proposals, rel_labels, rel_idx_pairs, rel_sym_binarys
 
-    def detect_relsample(self, proposals, targets):
+    def detect_relsample(self, proposals, targets, matchings=None):
         # corresponding to rel_assignments function in neural-motifs
         """
         The input proposals are already processed by subsample function of box_head,
@@ -116,32 +180,28 @@ class RelationSampling(object):
         Arguments:
             proposals (list[BoxList])  contain fields: labels, predict_logits
             targets (list[BoxList]) contain fields: labels
+            matchings (list[dict], optional): output of proposal_target_matching, computed here if not given
         """
+        if matchings is None:
+            matchings = proposal_target_matching(proposals, targets, self.fg_thres)
         self.num_pos_per_img = int(self.batch_size_per_image * self.positive_fraction)
         rel_idx_pairs = []
         rel_labels = []
         rel_labels_all = []
         rel_sym_binarys = []
-        for img_id, (proposal, target) in enumerate(zip(proposals, targets)):
+        for img_id, (proposal, target, matching) in enumerate(zip(proposals, targets, matchings)):
             device = proposal.bbox.device
             prp_box = proposal.bbox
             prp_lab = proposal.get_field("labels").long()
-            tgt_box = target.bbox
             tgt_lab = target.get_field("labels").long()
-            tgt_rel_matrix = target.get_field("relation")  # [tgt, tgt]
 
             # IoU matching for object detection results
-            ious = boxlist_iou(target, proposal)  # [tgt, prp]
-            is_match = (tgt_lab[:, None] == prp_lab[None]) & (ious > self.fg_thres)  # [tgt, prp]
-            # one box may match multiple gt boxes here we just mark them as a valid matching if they
-            # match any boxes
-            locating_match = (ious > self.fg_thres).nonzero()  # [tgt, prp]
-            locating_match_stat = torch.zeros((len(proposal)), device=device)
-            locating_match_stat[locating_match[:, 1]] = 1
-            proposal.add_field("locating_match", locating_match_stat)
+            ious = matching["ious"]  # [tgt, prp]
+            is_match = (tgt_lab[:, None] == prp_lab[None]) & matching["is_located"]  # [tgt, prp]
+            proposal.add_field("locating_match", matching["locating_match"])
 
             # Proposal self IoU to filter non-overlap
-            prp_self_iou = boxlist_iou(proposal, proposal)  # [prp, prp]
+            prp_self_iou = matching["prp_self_iou"]  # [prp, prp]
             if self.require_overlap and (not self.use_gt_box):
                 rel_possibility = (prp_self_iou > 0) & (prp_self_iou < 1)  # not self & intersect
             else:
@@ -153,9 +213,9 @@ class RelationSampling(object):
             rel_possibility[prp_lab == 0] = 0
             rel_possibility[:, prp_lab == 0] = 0
 
-            img_rel_triplets, corrsp_gt_rel_idx, binary_rel = self.motif_rel_fg_bg_sampling(device, tgt_rel_matrix,
-                                                                         ious, is_match, rel_possibility,
-                                                                         proposal.get_field('pred_scores'))
+            img_rel_triplets, corrsp_gt_rel_idx, binary_rel = self.motif_rel_fg_bg_sampling(
+                device, matching["tgt_pair_idxs"], matching["tgt_rel_labs"], ious, is_match, rel_possibility,
+                proposal.get_field('pred_scores'))
             
             if target.has_field("relation_non_masked"):
                 rel_map = target.get_field("relation_non_masked")
@@ -176,13 +236,15 @@ class RelationSampling(object):
         
         return proposals, rel_labels, rel_labels_all, rel_idx_pairs, rel_sym_binarys
 
-    def motif_rel_fg_bg_sampling(self, device, tgt_rel_matrix, ious, is_match, rel_possibility, proposals_quality):
+    def motif_rel_fg_bg_sampling(self, device, tgt_pair_idxs, tgt_rel_labs, ious, is_match, rel_possibility,
+                                 proposals_quality):
         """
         prepare to sample fg relation triplet and bg relation triplet
         the motifs sampling method only sampled the relation pairs whose boxes are overlapping with the
         ground truth
 
-        tgt_rel_matrix: # [number_target, number_target]
+        tgt_pair_idxs:  # [number_target_relation, 2]
+        tgt_rel_labs:   # [number_target_relation]
         ious:           # [number_target, num_proposal]
         is_match:       # [number_target, num_proposal]
         rel_possibility:# [num_proposal, num_proposal]
@@ -194,38 +256,18 @@ class RelationSampling(object):
 
         """
 
-        tgt_pair_idxs = torch.nonzero(tgt_rel_matrix != 0)
-
-        assert tgt_pair_idxs.shape[1] == 2
         tgt_head_idxs = tgt_pair_idxs[:, 0].contiguous().view(-1)
         tgt_tail_idxs = tgt_pair_idxs[:, 1].contiguous().view(-1)
-        tgt_rel_labs = tgt_rel_matrix[tgt_head_idxs, tgt_tail_idxs].contiguous().view(-1)
 
         num_tgt_rels = tgt_rel_labs.shape[0]
         # generate binary prp mask
-        num_prp = is_match.shape[-1]
-        binary_prp_head = is_match[tgt_head_idxs]  # num_tgt_rel, num_prp (matched prp head)
-        binary_prp_tail = is_match[tgt_tail_idxs]  # num_tgt_rel, num_prp (matched prp tail)
-        binary_rel_matrixs = torch.zeros((num_prp, num_prp), device=device).long()
+        binary_rel_matrixs = binary_relatedness_matrix(is_match, tgt_head_idxs, tgt_tail_idxs)
 
         fg_rel_triplets = []
         
         corrsp_gt_rel_idx = []
 
         for i in range(num_tgt_rels):
-            # generate binary prp mask
-            bi_match_head = torch.nonzero(binary_prp_head[i] > 0)
-            bi_match_tail = torch.nonzero(binary_prp_tail[i] > 0)
-
-            num_bi_head = bi_match_head.shape[0]
-            num_bi_tail = bi_match_tail.shape[0]
-            if num_bi_head > 0 and num_bi_tail > 0:
-                bi_match_head = bi_match_head.view(1, num_bi_head).expand(num_bi_tail, num_bi_head).contiguous()
-                bi_match_tail = bi_match_tail.view(num_bi_tail, 1).expand(num_bi_tail, num_bi_head).contiguous()
-                # binary rel only consider related or not, so its symmetric
-                binary_rel_matrixs[bi_match_head.view(-1), bi_match_tail.view(-1)] = 1
-                binary_rel_matrixs[bi_match_tail.view(-1), bi_match_head.view(-1)] = 1
-
             tgt_head_idx = int(tgt_head_idxs[i])
             tgt_tail_idx = int(tgt_tail_idxs[i])
             tgt_rel_lab = int(tgt_rel_labs[i])
@@ -0,0 +1,170 @@
+import torch
+
+
+class RelationGraphBatch(object):
+    """
+    sparse instance-predicate graph of a batch.
+    the relation pairs of all images are concatenated with the instance offsets, and the
+    edges are kept as index lists instead of the dense (num_inst, num_rel) maps.
+
+        rel_inds: (num_rel, 2) batch-wise instance index of the subject and object
+        edge_rel_idx: (num_edge, ) the relations that pass messages, all of them by default
+        edge_sub_idx, edge_obj_idx: (num_edge, ) subject and object instance of each edge
+    """
+
+    def __init__(self, rel_inds, num_inst, edge_rel_idx=None):
+        self.rel_inds = rel_inds
+        self.num_inst = num_inst
+        self.num_rel = rel_inds.shape[0]
+        if edge_rel_idx is None:
+            edge_rel_idx = torch.arange(self.num_rel, device=rel_inds.device)
+        self.edge_rel_idx = edge_rel_idx
+        self.edge_sub_idx = rel_inds[edge_rel_idx, 0]
+        self.edge_obj_idx = rel_inds[edge_rel_idx, 1]
+
+    @classmethod
+    def from_rel_pairs(cls, num_proposals, rel_pair_idxs, edge_rel_idx=None):
+        """
+        :param num_proposals: list of instance numbers of each image
+        :param rel_pair_idxs: list of (num_rel, 2) image-wise pair index
+        """
+        rel_inds = []
+        offset = 0
+        for num_prop, pair_idx in zip(num_proposals, rel_pair_idxs):
+            rel_inds.append(pair_idx.long() + offset)
+            offset += num_prop
+        return cls(torch.cat(rel_inds, 0), offset, edge_rel_idx)
+
+    def select(self, edge_rel_idx):
+        """ the same graph with messages passing only along the given relations """
+        return RelationGraphBatch(self.rel_inds, self.num_inst, edge_rel_idx)
+
+    def num_edges(self):
+        return len(self.edge_rel_idx)
+
+    def rel2inst_edges(self, role):
+        """
+        edges from the relations to their subject (role 0) or object (role 1) instances
+        :return: (target_inst_idx, source_rel_idx), sorted by the target then the source
+        """
+        inst_idx = self.edge_sub_idx if role == 0 else self.edge_obj_idx
+        return sort_edges(inst_idx, self.edge_rel_idx, self.num_rel)
+
+    def inst2rel_edges(self, role):
+        """
+        edges from the subject (role 0) or object (role 1) instances to their relations
+        :return: (target_rel_idx, source_inst_idx), sorted by the target
+        """
+        inst_idx = self.edge_sub_idx if role == 0 else self.edge_obj_idx
+        return sort_edges(self.edge_rel_idx, inst_idx, self.num_inst)
+
+    def inst2inst_edges(self):
+        """
+        undirected edges between the subject and object of each relation, without duplicates
+        :return: (target_inst_idx, source_inst_idx), sorted by the target then the source
+        """
+        pairs = torch.cat(
+            (
+                torch.stack((self.edge_sub_idx, self.edge_obj_idx), 1),
+                torch.stack((self.edge_obj_idx, self.edge_sub_idx), 1),
+            ),
+            0,
+        )
+        if len(pairs) == 0:
+            return pairs[:, 0], pairs[:, 1]
+        pairs = torch.unique(pairs, dim=0)
+        return pairs[:, 0], pairs[:, 1]
+
+    def dense_maps(self):
+        """
+        the dense form of the graph, (num_inst, num_rel) subject and object maps and the
+        (num_inst, num_inst) instance map
+        """
+        device = self.rel_inds.device
+        subj_pred_map = torch.zeros((self.num_inst, self.num_rel), device=device)
+        obj_pred_map = torch.zeros((self.num_inst, self.num_rel), device=device)
+        obj_obj_map = torch.zeros((self.num_inst, self.num_inst), device=device)
+        subj_pred_map[self.edge_sub_idx, self.edge_rel_idx] = 1
+        obj_pred_map[self.edge_obj_idx, self.edge_rel_idx] = 1
+        obj_obj_map[self.edge_sub_idx, self.edge_obj_idx] = 1
+        obj_obj_map[self.edge_obj_idx, self.edge_sub_idx] = 1
+        return subj_pred_map, obj_pred_map, obj_obj_map
+
+
+def sort_edges(target_idx, source_idx, num_source):
+    """ order the edges by the target index then the source index """
+    order = torch.sort(target_idx * num_source + source_idx)[1]
+    return target_idx[order], source_idx[order]
+
+
+def segment_sum(src, segment_ids, num_segments):
+    """
+    sum the rows of src that share the same segment id
+    :param src: (num_elem, ...)
+    :param segment_ids: (num_elem, ) long
+    :return: (num_segments, ...), zeros for the empty segments
+    """
+    out = src.new_zeros((num_segments,) + src.shape[1:])
+    return out.index_add_(0, segment_ids, src)
+
+
+def segment_mean(src, segment_ids, num_segments):
+    """ average the rows of src that share the same segment id, zeros for the empty segments """
+    count = torch.bincount(segment_ids, minlength=num_segments).clamp(min=1)
+    count = count.to(src.dtype).view((-1,) + (1,) * (src.dim() - 1))
+    return segment_sum(src, segment_ids, num_segments) / count
+
+
+def segment_max(src, segment_ids, num_segments):
+    """
+    the max of the rows of src that share the same segment id
+    :param src: (num_elem, ...)
+    :param segment_ids: (num_elem, ) long, in any order
+    :return: (num_segments, ...), -inf for the empty segments
+    """
+    order = torch.sort(segment_ids)[1]
+    active_segments, padded_idx, pad_mask = segment_to_padded(segment_ids[order], num_segments)
+    padded_src = src[order][padded_idx]
+    pad_mask = pad_mask.view(pad_mask.shape + (1,) * (src.dim() - 1))
+    out = src.new_full((num_segments,) + src.shape[1:], float("-inf"))
+    if len(active_segments) > 0:
+        out[active_segments] = padded_src.masked_fill(pad_mask, float("-inf")).max(1)[0]
+    return out
+
+
+def segment_softmax(logits, segment_ids, num_segments):
+    """
+    softmax over the rows of logits that share the same segment id
+    :param logits: (num_elem, ...)
+    :param segment_ids: (num_elem, ) long
+    :return: (num_elem, ...) normalized within each segment
+    """
+    shift = segment_max(logits.detach(), segment_ids, num_segments)
+    exp_logits = torch.exp(logits - shift[segment_ids])
+    return exp_logits / segment_sum(exp_logits, segment_ids, num_segments)[segment_ids]
+
+
+def segment_to_padded(segment_ids, num_segments):
+    """
+    group the elements of each non-empty segment into the rows of a padded index
+    :param segment_ids: (num_elem, ) long, sorted
+    :return:
+        active_segments: (num_active, ) the non-empty segment ids
+        padded_idx: (num_active, max_len) element index of each row, 0 for the padding
+        pad_mask: (num_active, max_len) bool, True for the padding
+    """
+    count = torch.bincount(segment_ids, minlength=num_segments)
+    active_segments = torch.nonzero(count > 0).view(-1)
+    max_len = int(count.max().item()) if len(segment_ids) > 0 else 0
+
+    # rank of each element inside its segment, and row of each segment in the padded index
+    starts = torch.cumsum(count, 0) - count
+    elem_idx = torch.arange(len(segment_ids), device=segment_ids.device)
+    pos = elem_idx - starts[segment_ids]
+    rows = (torch.cumsum((count > 0).long(), 0) - 1)[segment_ids]
+
+    padded_idx = segment_ids.new_zeros((len(active_segments), max_len))
+    pad_mask = torch.ones((len(active_segments), max_len), dtype=torch.bool, device=segment_ids.device)
+    padded_idx[rows, pos] = elem_idx
+    pad_mask[rows, pos] = False
+    return active_segments, padded_idx, pad_mask
@@ -57,12 +57,15 @@ def transpose_packed_sequence_inds(lengths):
     return new_inds, new_lens
 
 
-def sort_by_score(proposals, scores):
+def sort_by_score(proposals, scores, group_images=True):
     """
     We'll sort everything scorewise from Hi->low, BUT we need to keep images together
     and sort LSTM from l
     :param im_inds: Which im we're on
     :param scores: Goodness ranging between [0, 1]. Higher numbers come FIRST
+    :param group_images: images with more rois first, matching the descending lengths of the
+        packed sequence so that each sequence holds one image. Otherwise the images with fewer
+        rois come first, the order of the original implementation
     :return: Permutation to put everything in the right order for the LSTM
              Inverse permutation
              Lengths for the TxB packed sequence.
@@ -72,8 +75,9 @@ def sort_by_score(proposals, scores):
 
     scores = scores.split(num_rois, dim=0)
     ordered_scores = []
+    sign = 1.0 if group_images else -1.0
     for i, (score, num_roi) in enumerate(zip(scores, num_rois)):
-        ordered_scores.append( score - 2.0 * float(num_roi * 2 * num_im + i) )
+        ordered_scores.append( score + sign * 2.0 * float(num_roi * 2 * num_im + i) )
     ordered_scores = cat(ordered_scores, dim=0)
     _, perm = torch.sort(ordered_scores, 0, descending=True)
 
@@ -11,8 +11,12 @@ from torch import (
     cat as torch_cat,
     clamp as torch_clamp,
     zeros as torch_zeros,
+    bool as torch_bool,
     tensor as torch_tensor,
     int64 as torch_int64,
+    arange as torch_arange,
+    full as torch_full,
+    bincount as torch_bincount,
 )
 from torch.nn.init import normal_, constant_, xavier_normal_, orthogonal_
 from torch.nn.functional import softmax as F_softmax
@@ -152,6 +156,88 @@ def obj_prediction_nms(boxes_per_cls, pred_logits, nms_thresh=0.3):
 
 
 
+def packed_label_nms(pred_logits, boxes_per_cls, batch_lengths, nms_thresh=0.3):
+    """
+    the greedy label nms of the motifs decoder, done for all the sequences of a packed
+    batch together: in each step every sequence takes its global maximum (box, category),
+    then suppresses the boxes overlapping with it in that category
+
+    pred_logits:                 [num_obj, num_category] in packed order
+    boxes_per_cls:               [num_obj, num_cls, 4] in packed order
+    batch_lengths:               the number of sequences of each timestep
+    return: [num_obj] the labels in packed order
+    """
+    device = pred_logits.device
+    num_cls = pred_logits.shape[1]
+    batch_size, max_len = int(batch_lengths[0]), len(batch_lengths)
+    # the sequence and the timestep of each packed element
+    seq_ids = torch_cat([torch_arange(int(l), device=device) for l in batch_lengths], 0)
+    step_ids = torch_cat([torch_full((int(l),), t, dtype=torch_int64, device=device)
+                          for t, l in enumerate(batch_lengths)], 0)
+    seq_lens = torch_bincount(seq_ids, minlength=batch_size)
+
+    prob = F_softmax(pred_logits, 1).detach()
+    prob[:, 0] = 0  # set bg to 0
+    # padded as [batch_size, max_len, num_cls], the padding is never taken
+    prob_sampled = prob.new_full((batch_size, max_len, num_cls), -1.0)
+    prob_sampled[seq_ids, step_ids] = prob
+
+    is_overlap = torch_zeros((batch_size, max_len, max_len, num_cls), dtype=torch_bool, device=device)
+    for seq_id in range(batch_size):
+        seq_boxes = boxes_per_cls[seq_ids == seq_id]
+        seq_len = seq_boxes.shape[0]
+        is_overlap[seq_id, :seq_len, :seq_len] = nms_overlaps(seq_boxes) >= nms_thresh
+
+    pred_label = torch_zeros((batch_size, max_len), dtype=torch_int64, device=device)
+    seq_range = torch_arange(batch_size, device=device)
+    for step in range(max_len):
+        best_ind = prob_sampled.view(batch_size, -1).argmax(1)
+        active = step < seq_lens
+        seq_ind = seq_range[active]
+        box_ind = (best_ind // num_cls)[active]
+        cls_ind = (best_ind % num_cls)[active]
+
+        pred_label[seq_ind, box_ind] = cls_ind
+        # suppress all boxes overlapping and have same category with this maximum box
+        suppress = is_overlap[seq_ind, box_ind, :, cls_ind]
+        prob_sampled[seq_ind, :, cls_ind] = prob_sampled[seq_ind, :, cls_ind].masked_fill(suppress, 0.0)
+        # Mark this box has already sampled so we won't re-sample
+        prob_sampled[seq_ind, box_ind] = -1.0
+    return pred_label[seq_ids, step_ids]
+
+
+def split_pair_chunks(rel_pair_idxs, chunk_size):
+    """
+    split the relation pairs of a batch into chunks of at most chunk_size pairs,
+    the images are kept in order and one image may be split across the chunks,
+    the images without pairs are in no chunk
+    input:
+        rel_pair_idxs: list of [num_rel, 2] tensor, one for each image
+        chunk_size: int
+    output:
+        generator of (img_ids, chunk_pair_idxs), the chunk_pair_idxs is a list of
+        pair tensors for the images img_ids of the batch
+    """
+    img_ids = []
+    chunk_pair_idxs = []
+    chunk_len = 0
+    for img_id, pair_idx in enumerate(rel_pair_idxs):
+        start = 0
+        while start < len(pair_idx):
+            take = min(chunk_size - chunk_len, len(pair_idx) - start)
+            img_ids.append(img_id)
+            chunk_pair_idxs.append(pair_idx[start: start + take])
+            chunk_len += take
+            start += take
+            if chunk_len == chunk_size:
+                yield img_ids, chunk_pair_idxs
+                img_ids = []
+                chunk_pair_idxs = []
+                chunk_len = 0
+    if len(chunk_pair_idxs) > 0:
+        yield img_ids, chunk_pair_idxs
+
+
 def block_orthogonal(tensor, split_sizes, gain=1.0):
     sizes = list(tensor.size())
     if any([a % b != 0 for a, b in zip(sizes, split_sizes)]):
@@ -26,6 +26,15 @@ class MultiLayer_BTreeLSTM(nn.Module):
             features = self.multi_layer_lstm[i](tree, features, num_obj)
         return features
 
+    def forward_levels(self, forest, features):
+        """
+        forest: ArrayForest of the batch
+        features: [num_obj, featuresize] of all images
+        """
+        for i in range(self.num_layer):
+            features = self.multi_layer_lstm[i].forward_levels(forest, features)
+        return features
+
 
 class BidirectionalTreeLSTM(nn.Module):
     """
@@ -48,6 +57,12 @@ class BidirectionalTreeLSTM(nn.Module):
 
         return final_output
 
+    def forward_levels(self, forest, features):
+        foreward_output = self.treeLSTM_foreward.forward_levels(forest, features)
+        backward_output = self.treeLSTM_backward.forward_levels(forest, features)
+
+        return torch.cat((foreward_output, backward_output), 1)
+
 
 class OneDirectionalTreeLSTM(nn.Module):
     """
@@ -81,6 +96,16 @@ class OneDirectionalTreeLSTM(nn.Module):
         output = lstm_io.hidden[lstm_io.order.long()]
         return output
 
+    def forward_levels(self, forest, features):
+        # one dropout mask for each image, as the image by image forward
+        if self.dropout > 0.0:
+            dropout_mask = image_dropout_mask(self.dropout, forest, self.out_dim, features.device)
+        else:
+            dropout_mask = None
+
+        output, _, _ = self.treeLSTM.forward_levels(forest, features, dropout_mask)
+        return output
+
 
 class BiTreeLSTM_Foreward(nn.Module):
     """
@@ -192,6 +217,46 @@ class BiTreeLSTM_Foreward(nn.Module):
         treelstm_io.order_count += 1
         return
 
+    def forward_levels(self, forest, features, dropout_mask=None):
+        """
+        level-synchronous forward over all trees of the batch, the nodes of the same depth are
+        updated together from the deepest leaves to the roots
+        forest: ArrayForest of the batch
+        features: [num_obj, featuresize]
+        dropout_mask: [num_obj, h_dim] or None
+        output: hidden [num_obj, h_dim], and dists, commitments of the decoder (None otherwise),
+                in the same order as the input
+        """
+        num_obj = features.shape[0]
+        level_nodes, left_idx, right_idx, _ = forest_level_index(forest, features.device)
+        # the extra last row is the state of the missing children
+        state_c = features.new_zeros((num_obj + 1, self.h_dim))
+        state_h = features.new_zeros((num_obj + 1, self.h_dim))
+        if self.is_pass_embed:
+            state_embed = self.embed_layer.weight[0].view(1, -1).repeat(num_obj + 1, 1)
+
+        level_nodes = level_nodes[::-1]
+        hidden, dists, commitments = [], [], []
+        for nodes in level_nodes:
+            left, right = left_idx[nodes], right_idx[nodes]
+            next_feature = features[nodes]
+            if self.is_pass_embed:
+                next_feature = torch.cat((next_feature, state_embed[left], state_embed[right]), 1)
+
+            c, h = self.node_forward(next_feature, state_c[left], state_c[right], state_h[left], state_h[right],
+                                     dropout_mask[nodes] if dropout_mask is not None else None)
+            state_c = state_c.index_copy(0, nodes, c)
+            state_h = state_h.index_copy(0, nodes, h)
+            hidden.append(h)
+            if self.is_pass_embed:
+                pred_dist, label_to_embed, embeded_label = pass_embed_level_postprocess(
+                    h, self.embed_out_layer, self.embed_layer, self.training)
+                state_embed = state_embed.index_copy(0, nodes, embeded_label)
+                dists.append(pred_dist)
+                commitments.append(label_to_embed)
+
+        return resume_level_order(level_nodes, hidden, dists, commitments)
+
 
 class BiTreeLSTM_Backward(nn.Module):
     """
@@ -286,6 +351,45 @@ class BiTreeLSTM_Backward(nn.Module):
 
         return
 
+    def forward_levels(self, forest, features, dropout_mask=None):
+        """
+        level-synchronous forward over all trees of the batch, the nodes of the same depth are
+        updated together from the roots to the deepest leaves
+        forest: ArrayForest of the batch
+        features: [num_obj, featuresize]
+        dropout_mask: [num_obj, h_dim] or None
+        output: hidden [num_obj, h_dim], and dists, commitments of the decoder (None otherwise),
+                in the same order as the input
+        """
+        num_obj = features.shape[0]
+        level_nodes, _, _, parent_idx = forest_level_index(forest, features.device)
+        # the extra last row is the state above the roots
+        state_c = features.new_zeros((num_obj + 1, self.h_dim))
+        state_h = features.new_zeros((num_obj + 1, self.h_dim))
+        if self.is_pass_embed:
+            state_embed = self.embed_layer.weight[0].view(1, -1).repeat(num_obj + 1, 1)
+
+        hidden, dists, commitments = [], [], []
+        for nodes in level_nodes:
+            parent = parent_idx[nodes]
+            next_features = features[nodes]
+            if self.is_pass_embed:
+                next_features = torch.cat((next_features, state_embed[parent]), 1)
+
+            c, h = self.node_backward(next_features, state_c[parent], state_h[parent],
+                                      dropout_mask[nodes] if dropout_mask is not None else None)
+            state_c = state_c.index_copy(0, nodes, c)
+            state_h = state_h.index_copy(0, nodes, h)
+            hidden.append(h)
+            if self.is_pass_embed:
+                pred_dist, label_to_embed, embeded_label = pass_embed_level_postprocess(
+                    h, self.embed_out_layer, self.embed_layer, self.training)
+                state_embed = state_embed.index_copy(0, nodes, embeded_label)
+                dists.append(pred_dist)
+                commitments.append(label_to_embed)
+
+        return resume_level_order(level_nodes, hidden, dists, commitments)
+
 
 def pass_embed_postprocess(h, embed_out_layer, embed_layer, tree, treelstm_io, is_training):
     """
@@ -311,6 +415,52 @@ def pass_embed_postprocess(h, embed_out_layer, embed_layer, tree, treelstm_io, i
         treelstm_io.commitments = torch.cat((treelstm_io.commitments, label_to_embed.view(-1)), 0)
 
 
+def pass_embed_level_postprocess(h, embed_out_layer, embed_layer, is_training):
+    """
+    pass_embed_postprocess of a whole level
+    output: the dists, the predicted labels and the embedding passed to the next level
+    """
+    pred_dist = embed_out_layer(h)
+    label_to_embed = F.softmax(pred_dist, 1)[:, 1:].max(1)[1] + 1
+    if is_training:
+        sampled_label = F.softmax(pred_dist, 1)[:, 1:].multinomial(1).view(-1).detach() + 1
+        embeded_label = embed_layer(sampled_label+1)
+    else:
+        embeded_label = embed_layer(label_to_embed+1)
+    return pred_dist, label_to_embed, embeded_label
+
+
+def forest_level_index(forest, device):
+    """
+    index tensors of the level-synchronous execution, the missing children and the parent
+    of the roots point to the extra state row num_obj
+    output: nodes of each level from the roots, left child, right child, parent [num_obj]
+    """
+    num_obj = len(forest.parent)
+    levels = forest.levels()
+    level_nodes = torch.from_numpy(np.concatenate(levels)).to(device).split([len(l) for l in levels])
+
+    def state_index(idx):
+        return torch.from_numpy(np.where(idx >= 0, idx, num_obj)).to(device)
+
+    return level_nodes, state_index(forest.left_child), state_index(forest.right_child), state_index(forest.parent)
+
+
+def resume_level_order(level_nodes, hidden, dists, commitments):
+    """ gather the outputs of the levels back to the input order """
+    order = torch.argsort(torch.cat(level_nodes))
+    hidden = torch.cat(hidden, 0)[order]
+    if len(dists) == 0:
+        return hidden, None, None
+    return hidden, torch.cat(dists, 0)[order], torch.cat(commitments, 0)[order]
+
+
+def image_dropout_mask(dropout_probability, forest, out_dim, device):
+    """ a dropout mask for each image of the forest, expanded to [num_obj, out_dim] """
+    dropout_mask = get_dropout_mask(dropout_probability, (len(forest.num_objs), out_dim), device)
+    return dropout_mask[torch.from_numpy(forest.img_ids).to(device)]
+
+
 class TreeLSTM_IO(object):
     def __init__(self, hidden_tensor, order_tensor, order_count, dists_tensor, commitments_tensor, dropout_mask):
         self.hidden = hidden_tensor # Float tensor [num_obj, self.out_dim]
@@ -23,71 +23,155 @@ def generate_forest(pair_scores, proposals, mode):
     """
     output_forest = []  # the list of trees, each one is a chunk of overlapping objects
 
-    for pair_score, proposal in zip(pair_scores, proposals):
-        num_obj = pair_score.shape[0]
+    tree_parents = greedy_tree_parents(pair_scores)
+    for pair_score, proposal, (parent, insert_order) in zip(pair_scores, proposals, tree_parents):
         obj_label = proposal.get_field("labels") if mode == "predcls" else proposal.get_field("predict_logits").max(-1)[1]
 
         assert pair_score.shape[0] == len(proposal)
         assert pair_score.shape[0] == pair_score.shape[1]
-        node_scores = pair_score.mean(1).view(-1)
-        root_idx = int(node_scores.max(-1)[1])
-
-        root = ArbitraryTree(root_idx, float(node_scores[root_idx]), int(obj_label[root_idx]), proposal.bbox[root_idx], is_root=True)
-
-        node_container = []
-        remain_index = []
-        # put all nodes into node container
-        for idx in list(range(num_obj)):
-            if idx == root_idx:
-                continue
-            new_node = ArbitraryTree(idx, float(node_scores[idx]), int(obj_label[idx]),  proposal.bbox[idx])
-            node_container.append(new_node)
-            remain_index.append(idx)
-        
-        # iteratively generate tree
-        gen_tree(node_container, pair_score, node_scores, root, remain_index, mode)
+        node_scores = pair_score.mean(1).view(-1).tolist()
+        obj_label = obj_label.tolist()
+
+        # build the nodes in the order they join the tree, so the children keep their order
+        parent = parent.tolist()
+        nodes = [None] * len(parent)
+        for idx in np.argsort(insert_order).tolist():
+            nodes[idx] = ArbitraryTree(idx, node_scores[idx], obj_label[idx], proposal.bbox[idx],
+                                       is_root=parent[idx] < 0)
+            if parent[idx] >= 0:
+                nodes[parent[idx]].add_child(nodes[idx])
+            else:
+                root = nodes[idx]
         output_forest.append(root)
 
     return output_forest
 
-def gen_tree(node_container, pair_score, node_scores, root, remain_index, mode):
-    """
-    Step 1: Devide all nodes into left child container and right child container
-    Step 2: From left child container and right child container, select their respective sub roots
 
-    pair_scores: [obj_num, obj_num]
-    node_scores: [obj_num]
+def greedy_tree_parents(pair_scores):
+    """
+    grow the tree of every image from its root, the node with the highest mean pair score.
+    Each step attaches the remaining node with the highest score to any node already in
+    the tree (a maximum spanning arborescence grown as Prim's algorithm), all images of
+    the batch step together on the padded score matrix.
+
+    pair_scores: list of [obj_num, obj_num], pair_score[i, j] scores i as the parent of j
+    output: list of (parent, insert_order) numpy arrays of each image,
+            parent is -1 for the root, insert_order is the step the node joins the tree
+    """
+    num_objs = [pair_score.shape[0] for pair_score in pair_scores]
+    num_img, max_obj = len(num_objs), max(num_objs)
+    num_objs = np.array(num_objs)
+    rows = np.arange(num_img)
+    cols = np.arange(max_obj)
+
+    scores = np.full((num_img, max_obj, max_obj), -np.inf, dtype=np.float32)
+    for i, pair_score in enumerate(pair_scores):
+        scores[i, :num_objs[i], :num_objs[i]] = pair_score.detach().cpu().numpy()
+    valid = cols[None] < num_objs[:, None]
+
+    root_idx = np.array([int(pair_score.mean(1).view(-1).max(-1)[1]) for pair_score in pair_scores], dtype=np.int64)
+
+    parent = np.full((num_img, max_obj), -1, dtype=np.int64)
+    insert_order = np.zeros((num_img, max_obj), dtype=np.int64)
+    # the padding is treated as already in the tree, so it is never attached
+    in_tree = ~valid
+    in_tree[rows, root_idx] = True
+    # the best score of attaching each remaining node, and the tree node it depends on
+    best_score = np.where(in_tree, -np.inf, scores[rows, root_idx])
+    best_parent = np.repeat(root_idx[:, None], max_obj, axis=1)
+
+    for step in range(1, max_obj):
+        # the first maximum in the order of (depend node joined, node index)
+        max_score = best_score.max(1, keepdims=True)
+        tie_key = np.where(best_score == max_score, insert_order[rows[:, None], best_parent] * max_obj + cols,
+                           np.iinfo(np.int64).max)
+        insert_id = tie_key.argmin(1)
+
+        active = step < num_objs
+        img_ids, insert_id = rows[active], insert_id[active]
+        parent[img_ids, insert_id] = best_parent[img_ids, insert_id]
+        insert_order[img_ids, insert_id] = step
+        in_tree[img_ids, insert_id] = True
+        best_score[img_ids, insert_id] = -np.inf
+
+        # the new tree node may be a better depend node for the remaining ones
+        insert_scores = scores[img_ids, insert_id]
+        update = (insert_scores > best_score[img_ids]) & ~in_tree[img_ids]
+        best_score[img_ids] = np.where(update, insert_scores, best_score[img_ids])
+        best_parent[img_ids] = np.where(update, insert_id[:, None], best_parent[img_ids])
+
+    return [(parent[i, :n], insert_order[i, :n]) for i, n in enumerate(num_objs)]
+
+
+class ArrayForest(object):
+    """
+    array encoding of the binary VCTree forest of a batch, the objects of all images are
+    indexed after concatenation. As arTree_to_biTree, the first child of a node is its left
+    child and each following child is the right child of the previous one.
+
+        left_child, right_child: [num_obj], -1 if there is no such child
+        parent: [num_obj] the parent in the binary tree, -1 for the roots
+        depth: [num_obj] the depth in the binary tree, 0 for the roots
+        roots: [num_img]
+        img_ids: [num_obj] the image of each object
     """
-    num_nodes = len(node_container)
-    device = pair_score.device
-    # Step 0
-    if  num_nodes == 0:
-        return
-    # Step 1
-    select_node = []
-    select_index = []
-    select_node.append(root)
-    select_index.append(root.index)
-
-    while len(node_container) > 0:
-        wid = len(remain_index)
-        select_indexs = torch.tensor(select_index, device=device, dtype=torch.int64)
-        remain_indexs = torch.tensor(remain_index, device=device, dtype=torch.int64)
-        select_score_map = pair_score[select_indexs][:, remain_indexs].view(-1)
-        best_id = select_score_map.max(0)[1]
-
-        depend_id = int(best_id) // wid
-        insert_id = int(best_id) % wid
-        best_depend_node = select_node[depend_id]
-        best_insert_node = node_container[insert_id]
-        best_depend_node.add_child(best_insert_node)
-
-        select_node.append(best_insert_node)
-        select_index.append(best_insert_node.index)
-        node_container.remove(best_insert_node)
-        remain_index.remove(best_insert_node.index)
-
 
+    def __init__(self, tree_parents):
+        """
+        tree_parents: list of (parent, insert_order) of each image, as greedy_tree_parents
+        """
+        num_objs = [len(parent) for parent, _ in tree_parents]
+        offsets = np.cumsum([0] + num_objs[:-1])
+        ar_parent = np.concatenate([np.where(p >= 0, p + offset, -1) for (p, _), offset in zip(tree_parents, offsets)])
+        insert_order = np.concatenate([order for _, order in tree_parents])
+        num_obj = len(ar_parent)
+
+        self.num_objs = num_objs
+        self.img_ids = np.repeat(np.arange(len(num_objs)), num_objs)
+        self.roots = np.flatnonzero(ar_parent < 0)
+        self.left_child = np.full(num_obj, -1, dtype=np.int64)
+        self.right_child = np.full(num_obj, -1, dtype=np.int64)
+        self.parent = np.full(num_obj, -1, dtype=np.int64)
+
+        # group the children of each node in the order they joined the tree
+        children = np.flatnonzero(ar_parent >= 0)
+        children = children[np.lexsort((insert_order[children], ar_parent[children]))]
+        if len(children) > 0:
+            child_parent = ar_parent[children]
+            is_first = np.ones(len(children), dtype=bool)
+            is_first[1:] = child_parent[1:] != child_parent[:-1]
+            first, follow = children[is_first], np.flatnonzero(~is_first)
+            self.left_child[child_parent[is_first]] = first
+            self.parent[first] = child_parent[is_first]
+            self.right_child[children[follow - 1]] = children[follow]
+            self.parent[children[follow]] = children[follow - 1]
+
+        # depth by pointer jumping, log(max depth) rounds
+        depth = (self.parent >= 0).astype(np.int64)
+        ancestor = self.parent.copy()
+        while (ancestor >= 0).any():
+            has_ancestor = ancestor >= 0
+            jump = ancestor[has_ancestor]
+            depth[has_ancestor] += depth[jump]
+            next_ancestor = ancestor.copy()
+            next_ancestor[has_ancestor] = ancestor[jump]
+            ancestor = next_ancestor
+        self.depth = depth
+
+    def levels(self):
+        """ the node indices of each depth, from the roots to the deepest leaves """
+        order = np.argsort(self.depth, kind="stable")
+        counts = np.bincount(self.depth)
+        return np.split(order, np.cumsum(counts)[:-1])
+
+
+def generate_array_forest(pair_scores):
+    """
+    generate the array encoded binary forest of a batch, same trees as
+    arbForest_to_biForest(generate_forest(...)) without building any node objects
+    pair_scores: list of [obj_num, obj_num]
+    """
+    return ArrayForest(greedy_tree_parents(pair_scores))
 
 
 def arbForest_to_biForest(forest):
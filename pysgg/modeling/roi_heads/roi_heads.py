@@ -22,7 +22,12 @@ class CombinedROIHeads(torch.nn.ModuleDict):
         if cfg.MODEL.KEYPOINT_ON and cfg.MODEL.ROI_KEYPOINT_HEAD.SHARE_BOX_FEATURE_EXTRACTOR:
             self.keypoint.feature_extractor = self.box.feature_extractor
 
-    def forward(self, features, proposals, targets=None, logger=None):
+    def forward(self, features, proposals, targets=None, logger=None, store_keys=None):
+        if store_keys is not None:
+            # the features of the frozen detector are read from the feature store by the relation head
+            detections = self.relation.stored_detections(targets, store_keys)
+            return self.relation(None, detections, targets, logger, store_keys=store_keys)
+
         losses = {}
         x, detections, loss_box = self.box(features, proposals, targets)
         if not self.cfg.MODEL.RELATION_ON:
@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import math
+from collections import OrderedDict
 
 import numpy as np
 import torch
@@ -35,6 +36,9 @@ class AnchorGenerator(nn.Module):
     """
     For a set of image sizes and feature maps, computes a set
     of anchors
+
+    The anchor grids of the last `cache_size` feature map sizes are cached,
+    as the resized images keep producing the same few feature map sizes.
     """
 
     def __init__(
@@ -43,6 +47,7 @@ class AnchorGenerator(nn.Module):
         aspect_ratios=(0.5, 1.0, 2.0),
         anchor_strides=(8, 16, 32),
         straddle_thresh=0,
+        cache_size=16,
     ):
         super(AnchorGenerator, self).__init__()
 
@@ -66,6 +71,9 @@ class AnchorGenerator(nn.Module):
         self.strides = anchor_strides
         self.cell_anchors = BufferList(cell_anchors)
         self.straddle_thresh = straddle_thresh
+        self.cache_size = cache_size
+        # least recently used first
+        self._cache = OrderedDict()
 
     def num_anchors_per_location(self):
         return [len(cell_anchors) for cell_anchors in self.cell_anchors]
@@ -94,6 +102,39 @@ class AnchorGenerator(nn.Module):
 
         return anchors
 
+    def cached_grid_anchors(self, grid_sizes):
+        """
+        The grid_anchors of each feature map, with the part of their visibility
+        which does not depend on the image size, from the cache when possible.
+        """
+        base_anchors = next(iter(self.cell_anchors))
+        device = base_anchors.device
+        key = (tuple(tuple(size) for size in grid_sizes), tuple(self.strides), device, base_anchors.dtype)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        grids = []
+        for anchors in self.grid_anchors(grid_sizes):
+            if self.straddle_thresh >= 0:
+                # the top left corner is checked once for all the images
+                inside = (anchors[:, 0] >= -self.straddle_thresh) & (anchors[:, 1] >= -self.straddle_thresh)
+                grids.append((anchors, anchors[:, 2].contiguous(), anchors[:, 3].contiguous(), inside))
+            else:
+                inside = torch.ones(anchors.shape[0], dtype=torch.uint8, device=device)
+                grids.append((anchors, None, None, inside))
+
+        if self.cache_size > 0:
+            self._cache[key] = grids
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return grids
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # the loaded cell anchors may differ from the ones the grids were built from
+        self._cache.clear()
+        super(AnchorGenerator, self)._load_from_state_dict(*args, **kwargs)
+
     def add_visibility_to(self, boxlist):
         image_width, image_height = boxlist.size
         anchors = boxlist.bbox
@@ -111,15 +152,19 @@ class AnchorGenerator(nn.Module):
 
     def forward(self, image_list, feature_maps):
         grid_sizes = [feature_map.shape[-2:] for feature_map in feature_maps]
-        anchors_over_all_feature_maps = self.grid_anchors(grid_sizes)
+        grids = self.cached_grid_anchors(grid_sizes)
         anchors = []
         for i, (image_height, image_width) in enumerate(image_list.image_sizes):
             anchors_in_image = []
-            for anchors_per_feature_map in anchors_over_all_feature_maps:
+            for anchors_per_feature_map, x2, y2, inside in grids:
                 boxlist = BoxList(
                     anchors_per_feature_map, (image_width, image_height), mode="xyxy"
                 )
-                self.add_visibility_to(boxlist)
+                # same as add_visibility_to, only the bottom right corner depends on the image
+                if x2 is not None:
+                    inside = inside & (x2 < image_width + self.straddle_thresh) \
+                             & (y2 < image_height + self.straddle_thresh)
+                boxlist.add_field("visibility", inside)
                 anchors_in_image.append(boxlist)
             anchors.append(anchors_in_image)
         return anchors
@@ -130,6 +175,7 @@ def make_anchor_generator(config):
     aspect_ratios = config.MODEL.RPN.ASPECT_RATIOS
     anchor_stride = config.MODEL.RPN.ANCHOR_STRIDE
     straddle_thresh = config.MODEL.RPN.STRADDLE_THRESH
+    cache_size = config.MODEL.RPN.ANCHOR_CACHE_SIZE
 
     if config.MODEL.RPN.USE_FPN:
         assert len(anchor_stride) == len(
@@ -138,7 +184,7 @@ def make_anchor_generator(config):
     else:
         assert len(anchor_stride) == 1, "Non-FPN should have a single ANCHOR_STRIDE"
     anchor_generator = AnchorGenerator(
-        anchor_sizes, aspect_ratios, anchor_stride, straddle_thresh
+        anchor_sizes, aspect_ratios, anchor_stride, straddle_thresh, cache_size
     )
     return anchor_generator
 
@@ -148,6 +194,7 @@ def make_anchor_generator_retinanet(config):
     aspect_ratios = config.MODEL.RETINANET.ASPECT_RATIOS
     anchor_strides = config.MODEL.RETINANET.ANCHOR_STRIDES
     straddle_thresh = config.MODEL.RETINANET.STRADDLE_THRESH
+    cache_size = config.MODEL.RPN.ANCHOR_CACHE_SIZE
     octave = config.MODEL.RETINANET.OCTAVE
     scales_per_octave = config.MODEL.RETINANET.SCALES_PER_OCTAVE
 
@@ -161,7 +208,7 @@ def make_anchor_generator_retinanet(config):
         new_anchor_sizes.append(tuple(per_layer_anchor_sizes))
 
     anchor_generator = AnchorGenerator(
-        tuple(new_anchor_sizes), aspect_ratios, anchor_strides, straddle_thresh
+        tuple(new_anchor_sizes), aspect_ratios, anchor_strides, straddle_thresh, cache_size
     )
     return anchor_generator
 
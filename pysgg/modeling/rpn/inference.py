@@ -3,8 +3,10 @@ import torch
 
 from pysgg.modeling.box_coder import BoxCoder
 from pysgg.structures.bounding_box import BoxList
+from pysgg.structures.boxlist_ops import batched_nms
 from pysgg.structures.boxlist_ops import cat_boxlist
 from pysgg.structures.boxlist_ops import boxlist_nms
+from pysgg.structures.boxlist_ops import rank_in_group
 from pysgg.structures.boxlist_ops import remove_small_boxes
 
 from ..utils import cat
@@ -26,6 +28,7 @@ class RPNPostProcessor(torch.nn.Module):
         fpn_post_nms_top_n=None,
         fpn_post_nms_per_batch=True,
         add_gt=True,
+        batched=False,
     ):
         """
         Arguments:
@@ -35,6 +38,8 @@ class RPNPostProcessor(torch.nn.Module):
             min_size (int)
             box_coder (BoxCoder)
             fpn_post_nms_top_n (int)
+            batched (bool): decode and NMS the proposals of all the levels
+                and images at once, see forward_batched
         """
         super(RPNPostProcessor, self).__init__()
         self.pre_nms_top_n = pre_nms_top_n
@@ -51,6 +56,7 @@ class RPNPostProcessor(torch.nn.Module):
             fpn_post_nms_top_n = post_nms_top_n
         self.fpn_post_nms_top_n = fpn_post_nms_top_n
         self.fpn_post_nms_per_batch = fpn_post_nms_per_batch
+        self.batched = batched
 
     def add_gt_proposals(self, proposals, targets):
         """
@@ -120,6 +126,7 @@ class RPNPostProcessor(torch.nn.Module):
                 self.nms_thresh,
                 max_proposals=self.post_nms_top_n,
                 score_field="objectness",
+                scores_sorted=True,
             )
             result.append(boxlist)
         return result
@@ -135,17 +142,20 @@ class RPNPostProcessor(torch.nn.Module):
             boxlists (list[BoxList]): the post-processed anchors, after
                 applying box decoding and NMS
         """
-        sampled_boxes = []
-        num_levels = len(objectness)
-        anchors = list(zip(*anchors))
-        for a, o, b in zip(anchors, objectness, box_regression):
-            sampled_boxes.append(self.forward_for_single_feature_map(a, o, b))
+        if self.batched:
+            boxlists = self.forward_batched(anchors, objectness, box_regression)
+        else:
+            sampled_boxes = []
+            num_levels = len(objectness)
+            anchors = list(zip(*anchors))
+            for a, o, b in zip(anchors, objectness, box_regression):
+                sampled_boxes.append(self.forward_for_single_feature_map(a, o, b))
 
-        boxlists = list(zip(*sampled_boxes))
-        boxlists = [cat_boxlist(boxlist) for boxlist in boxlists]
+            boxlists = list(zip(*sampled_boxes))
+            boxlists = [cat_boxlist(boxlist) for boxlist in boxlists]
 
-        if num_levels > 1:
-            boxlists = self.select_over_all_levels(boxlists)
+            if num_levels > 1:
+                boxlists = self.select_over_all_levels(boxlists)
 
         # append ground-truth bboxes to proposals
         if self.training and (targets is not None) and self.add_gt:
@@ -153,6 +163,79 @@ class RPNPostProcessor(torch.nn.Module):
 
         return boxlists
 
+    def forward_batched(self, anchors, objectness, box_regression):
+        """
+        The same proposals as forward_for_single_feature_map on every level followed by
+        select_over_all_levels, with one box decoding and one NMS for all the levels and images.
+
+        Arguments:
+            anchors: list[list[BoxList]]
+            objectness: list[tensor]
+            box_regression: list[tensor]
+        """
+        device = objectness[0].device
+        N = objectness[0].shape[0]
+        num_levels = len(objectness)
+        image_shapes = [anchors_per_img[0].size for anchors_per_img in anchors]
+        batch_idx = torch.arange(N, device=device)[:, None]
+
+        # the pre NMS top n anchors of each level
+        scores, regressions, level_anchors, levels = [], [], [], []
+        for level, (objectness_lvl, box_regression_lvl) in enumerate(zip(objectness, box_regression)):
+            _, A, H, W = objectness_lvl.shape
+            objectness_lvl = permute_and_flatten(objectness_lvl, N, A, 1, H, W).view(N, -1).sigmoid()
+            box_regression_lvl = permute_and_flatten(box_regression_lvl, N, A, 4, H, W)
+
+            pre_nms_top_n = min(self.pre_nms_top_n, A * H * W)
+            objectness_lvl, topk_idx = objectness_lvl.topk(pre_nms_top_n, dim=1, sorted=True)
+            anchors_lvl = torch.stack([anchors_per_img[level].bbox for anchors_per_img in anchors], dim=0)
+
+            scores.append(objectness_lvl)
+            regressions.append(box_regression_lvl[batch_idx, topk_idx])
+            level_anchors.append(anchors_lvl[batch_idx, topk_idx])
+            levels.append(torch.full((pre_nms_top_n,), level, dtype=torch.int64, device=device))
+        scores = cat(scores, dim=1).view(-1)
+        levels = cat(levels, dim=0).repeat(N)
+        img_ids = batch_idx.expand(N, len(levels) // N).reshape(-1)
+
+        proposals = self.box_coder.decode(
+            cat(regressions, dim=1).view(-1, 4), cat(level_anchors, dim=1).view(-1, 4)
+        )
+
+        # clip_to_image and remove_small_boxes of every image at once
+        TO_REMOVE = 1
+        image_max = torch.tensor(image_shapes, dtype=proposals.dtype, device=device) - TO_REMOVE
+        image_max = image_max[img_ids].repeat(1, 2)
+        proposals = torch.min(proposals.clamp(min=0), image_max)
+        widths = proposals[:, 2] - proposals[:, 0] + TO_REMOVE
+        heights = proposals[:, 3] - proposals[:, 1] + TO_REMOVE
+        keep = torch.nonzero((widths >= self.min_size) & (heights >= self.min_size)).squeeze(1)
+
+        # NMS of each level of each image, the boxes of a level are sorted by decreasing score,
+        # so the first post_nms_top_n kept are the top ones. keep stays image by image, level by level
+        keep = keep[batched_nms(proposals[keep], scores[keep], img_ids[keep] * num_levels + levels[keep],
+                                self.nms_thresh, max_proposals=self.post_nms_top_n)]
+
+        if num_levels > 1:
+            if self.training and self.fpn_post_nms_per_batch:
+                post_nms_top_n = min(self.fpn_post_nms_top_n, len(keep))
+                _, inds_sorted = torch.topk(scores[keep], post_nms_top_n, dim=0, sorted=True)
+                keep = keep[torch.sort(inds_sorted)[0]]
+            else:
+                # the top n of each image, image by image by decreasing score
+                keep = keep[torch.argsort(scores[keep], descending=True)]
+                keep = keep[rank_in_group(img_ids[keep]) < self.fpn_post_nms_top_n]
+                keep = keep[torch.argsort(img_ids[keep] * len(keep) + torch.arange(len(keep), device=device))]
+
+        boxes_per_img = torch.bincount(img_ids[keep], minlength=N).tolist()
+        boxlists = []
+        for proposal, score, im_shape in zip(proposals[keep].split(boxes_per_img),
+                                             scores[keep].split(boxes_per_img), image_shapes):
+            boxlist = BoxList(proposal, im_shape, mode="xyxy")
+            boxlist.add_field("objectness", score)
+            boxlists.append(boxlist)
+        return boxlists
+
     def select_over_all_levels(self, boxlists):
         num_images = len(boxlists)
         # different behavior during training and during testing:
@@ -197,6 +280,7 @@ def make_rpn_postprocessor(config, rpn_box_coder, is_train):
     nms_thresh = config.MODEL.RPN.NMS_THRESH
     min_size = config.MODEL.RPN.MIN_SIZE
     add_gt = config.MODEL.ROI_RELATION_HEAD.ADD_GTBOX_TO_PROPOSAL_IN_TRAIN
+    batched = config.MODEL.RPN.BATCHED_POSTPROCESS
     box_selector = RPNPostProcessor(
         pre_nms_top_n=pre_nms_top_n,
         post_nms_top_n=post_nms_top_n,
@@ -206,5 +290,6 @@ def make_rpn_postprocessor(config, rpn_box_coder, is_train):
         fpn_post_nms_top_n=fpn_post_nms_top_n,
         fpn_post_nms_per_batch=fpn_post_nms_per_batch,
         add_gt=add_gt,
+        batched=batched,
     )
     return box_selector
@@ -0,0 +1,113 @@
+import torch
+
+from pysgg.structures.bounding_box import BoxList
+
+
+class LazyBoxesPerCls(object):
+    """
+    The boxes regressed for every class of a set of proposals, (N, num_classes, 4)
+    in xyxy mode and clipped to the image, as the box head used to decode them.
+
+    Only the proposals and their regression deltas are kept, the boxes are decoded
+    when they are indexed. The deltas take as much memory as the boxes, the saving is
+    in the boxes that are never decoded:
+        boxes_per_cls[rows]          -> LazyBoxesPerCls of the selected proposals
+        boxes_per_cls[rows, labels]  -> (len(rows), 4) tensor, the boxes of these classes
+        boxes_per_cls.tensor()       -> (N, num_classes, 4) tensor of all the classes
+    """
+
+    def __init__(self, proposals, box_regression, box_coder, num_classes, image_size):
+        """
+        Arguments:
+            proposals (Tensor): (N, 4) reference boxes, xyxy
+            box_regression (Tensor): (N, 4 * num_classes) deltas, or (N, 4) for
+                a class agnostic regression
+            box_coder (BoxCoder)
+            num_classes (int)
+            image_size (tuple): (width, height) the boxes are clipped to
+        """
+        assert box_regression.size(1) in (4, 4 * num_classes)
+        self.proposals = proposals
+        self.box_regression = box_regression
+        self.box_coder = box_coder
+        self.num_classes = num_classes
+        self.size = image_size
+
+    @property
+    def cls_agnostic(self):
+        return self.box_regression.size(1) == 4
+
+    @property
+    def shape(self):
+        return torch.Size((len(self), self.num_classes, 4))
+
+    @property
+    def device(self):
+        return self.box_regression.device
+
+    def _clip(self, boxes):
+        return BoxList(boxes, self.size, mode="xyxy").clip_to_image(remove_empty=False).bbox
+
+    def decode(self, rows, labels):
+        """
+        Boxes of the proposals `rows` regressed for the classes `labels`, one class
+        per row or a single class for all of them.
+        """
+        if self.cls_agnostic:
+            rel_codes = self.box_regression[rows]
+        else:
+            rel_codes = self.box_regression.view(len(self), self.num_classes, 4)[rows, labels]
+        rel_codes = rel_codes.reshape(-1, 4)
+        proposals = self.proposals[rows].reshape(-1, 4)
+        return self._clip(self.box_coder.decode(rel_codes, proposals))
+
+    def tensor(self):
+        boxes = self._clip(self.box_coder.decode(self.box_regression, self.proposals).view(-1, 4))
+        if self.cls_agnostic:
+            return boxes.repeat(1, self.num_classes).view(self.shape)
+        return boxes.view(self.shape)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows, labels = item
+            return self.decode(rows, labels)
+        return type(self)(self.proposals[item], self.box_regression[item],
+                          self.box_coder, self.num_classes, self.size)
+
+    def __len__(self):
+        return self.proposals.shape[0]
+
+    def to(self, *args, **kwargs):
+        return type(self)(self.proposals.to(*args, **kwargs), self.box_regression.to(*args, **kwargs),
+                          self.box_coder, self.num_classes, self.size)
+
+    # like the dense tensor it stands for, the class boxes stay in the frame
+    # of the image the box head saw when the boxlist holding them is changed
+    def resize(self, size, *args, **kwargs):
+        return self
+
+    def transpose(self, method):
+        return self
+
+    def crop(self, box):
+        return self
+
+    def __repr__(self):
+        s = self.__class__.__name__ + "("
+        s += "num_boxes={}, ".format(len(self))
+        s += "num_classes={}, ".format(self.num_classes)
+        s += "cls_agnostic={})".format(self.cls_agnostic)
+        return s
+
+
+def cat_boxes_per_cls(boxlists):
+    """
+    The (sum(N), num_classes, 4) tensor of the 'boxes_per_cls' fields of the boxlists,
+    which are either tensors or LazyBoxesPerCls.
+    """
+    boxes_per_cls = [boxlist.get_field("boxes_per_cls") for boxlist in boxlists]
+    boxes_per_cls = [boxes.tensor() if isinstance(boxes, LazyBoxesPerCls) else boxes
+                     for boxes in boxes_per_cls]
+    if len(boxes_per_cls) == 1:
+        return boxes_per_cls[0]
+    return torch.cat(boxes_per_cls, dim=0)
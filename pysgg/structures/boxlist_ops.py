@@ -5,9 +5,10 @@ import scipy.linalg
 from .bounding_box import BoxList
 
 from pysgg.layers import nms as _box_nms
+from pysgg.layers import batched_nms as _box_batched_nms
 
 
-def boxlist_nms(boxlist, nms_thresh, max_proposals=-1, score_field="scores"):
+def boxlist_nms(boxlist, nms_thresh, max_proposals=-1, score_field="scores", scores_sorted=False):
     """
     Performs non-maximum suppression on a boxlist, with scores specified
     in a boxlist field via score_field.
@@ -18,6 +19,8 @@ def boxlist_nms(boxlist, nms_thresh, max_proposals=-1, score_field="scores"):
         max_proposals (int): if > 0, then only the top max_proposals are kept
             after non-maximum suppression
         score_field (str)
+        scores_sorted (bool): the boxes are sorted by decreasing score, so the
+            NMS can stop once max_proposals boxes are kept
     """
     if nms_thresh <= 0:
         return boxlist
@@ -25,13 +28,64 @@ def boxlist_nms(boxlist, nms_thresh, max_proposals=-1, score_field="scores"):
     boxlist = boxlist.convert("xyxy")
     boxes = boxlist.bbox
     score = boxlist.get_field(score_field)
-    keep = _box_nms(boxes, score, nms_thresh)
+    keep = _box_nms(boxes, score, nms_thresh, max_proposals if scores_sorted else -1)
     if max_proposals > 0:
         keep = keep[: max_proposals]
     boxlist = boxlist[keep]
     return boxlist.convert(mode), keep
 
 
+def batched_nms(boxes, scores, idxs, nms_thresh, max_proposals=-1):
+    """
+    Performs non-maximum suppression independently on each group of boxes
+    (e.g. the classes of several images) with a single NMS call. On the GPU,
+    every group is moved to its own region of the coordinates.
+
+    Arguments:
+        boxes (Tensor[N, 4]): boxes in xyxy mode
+        scores (Tensor[N])
+        idxs (Tensor[N]): the group of each box
+        nms_thresh (float)
+        max_proposals (int): if > 0, then only the first max_proposals kept of
+            each group are kept, in the order of the boxes as boxlist_nms
+
+    Returns:
+        keep (Tensor): indices of the kept boxes, in increasing order as nms
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    # number the groups present densely, to keep the moved coordinates small
+    _, groups = torch.unique(idxs, return_inverse=True)
+    if boxes.is_cuda:
+        # leave more than the +1 of the box width convention between two groups
+        offsets = groups.to(boxes) * (boxes.max() - boxes.min() + 2)
+        keep = _box_nms(boxes + offsets[:, None], scores, nms_thresh)
+    else:
+        keep = _box_batched_nms(boxes, scores, groups, nms_thresh)
+    if max_proposals > 0:
+        keep = keep[rank_in_group(groups[keep]) < max_proposals]
+    return keep
+
+
+def rank_in_group(idxs):
+    """
+    The position of each element among the elements of its group, in the given order
+
+    Arguments:
+        idxs (Tensor[N]): the non-negative group of each element
+    """
+    num = len(idxs)
+    position = torch.arange(num, device=idxs.device)
+    # stable sort by group
+    order = torch.argsort(idxs * num + position)
+    sorted_idxs = idxs[order]
+    counts = torch.bincount(sorted_idxs)
+    starts = torch.cumsum(counts, 0) - counts
+    rank = torch.empty_like(position)
+    rank[order] = position - starts[sorted_idxs]
+    return rank
+
+
 def remove_small_boxes(boxlist, min_size):
     """
     Only keep boxes with both sides >= min_size
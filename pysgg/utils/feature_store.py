@@ -0,0 +1,163 @@
+"""
+On-disk store of the features a frozen detector gives to the relation head, so that the
+relation head can be trained and evaluated in predcls / sgcls without running the backbone.
+
+A store is written once by tools/relation_extract_features.py into <root>/<hash>/, where
+<hash> is the sha1 of the detector checkpoint (MODEL.PRETRAINED_DETECTOR_CKPT):
+    meta.pth            the feature sizes, the fingerprint of the relation feature extractors
+                        and the offsets of each image
+    roi_features.bin    (num_boxes, roi_dim) float16, ROI features of the ground truth boxes
+    union_features.bin  (sum(num_boxes ** 2), union_dim) float16, union features of all the
+                        ordered pairs of each image, the pair (i, j) at row i * num_boxes + j
+    obj_logits.bin      (num_boxes, num_classes) float32, box head logits, for sgcls
+The .bin files are read through memory maps.
+"""
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from .miscellaneous import mkdir
+
+_FEATURE_FILES = {
+    "roi_features": np.float16,
+    "union_features": np.float16,
+    "obj_logits": np.float32,
+}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def modules_fingerprint(modules):
+    """
+    sha1 of the parameters and buffers of the modules, the stored features are only
+    valid for the feature extractors that computed them.
+    """
+    sha1 = hashlib.sha1()
+    for module in modules:
+        for name, value in module.state_dict().items():
+            sha1.update(name.encode())
+            sha1.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def store_dir(root, checkpoint):
+    return os.path.join(root, file_hash(checkpoint))
+
+
+def image_keys(dataset, indices):
+    """
+    Keys of the images `indices` of a relation dataset in a feature store, their image ids,
+    which do not depend on the split nor on the resampling of the dataset.
+    """
+    return [int(dataset.get_img_info(index)["image_id"]) for index in indices]
+
+
+class FeatureStoreWriter(object):
+    def __init__(self, path, fingerprint):
+        mkdir(path)
+        self.path = path
+        self.meta = {"fingerprint": fingerprint, "dims": {}, "images": {}}
+        self.files = {name: open(os.path.join(path, name + ".bin"), "wb") for name in _FEATURE_FILES}
+        self.num_rows = {name: 0 for name in _FEATURE_FILES}
+
+    def __contains__(self, key):
+        return key in self.meta["images"]
+
+    def _write(self, name, features):
+        features = features.detach().cpu().numpy().astype(_FEATURE_FILES[name])
+        dim = self.meta["dims"].setdefault(name, features.shape[1])
+        assert features.shape[1] == dim, "{} should have {} channels".format(name, dim)
+        self.files[name].write(features.tobytes())
+        start = self.num_rows[name]
+        self.num_rows[name] += features.shape[0]
+        return start
+
+    def add(self, key, roi_features, union_features=None, obj_logits=None):
+        """
+        Arguments:
+            key (int): image key, see image_keys
+            roi_features (Tensor): (n, roi_dim)
+            union_features (Tensor): (n * n, union_dim), the pair (i, j) at row i * n + j
+            obj_logits (Tensor): (n, num_classes)
+        """
+        num_boxes = roi_features.shape[0]
+        entry = {"num_boxes": num_boxes, "roi_features": self._write("roi_features", roi_features)}
+        if union_features is not None:
+            assert union_features.shape[0] == num_boxes ** 2
+            entry["union_features"] = self._write("union_features", union_features)
+        if obj_logits is not None:
+            entry["obj_logits"] = self._write("obj_logits", obj_logits)
+        self.meta["images"][key] = entry
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        # written last, a store without meta.pth is incomplete
+        torch.save(self.meta, os.path.join(self.path, "meta.pth"))
+
+
+class FeatureStore(object):
+    def __init__(self, path):
+        meta_file = os.path.join(path, "meta.pth")
+        if not os.path.exists(meta_file):
+            raise FileNotFoundError(
+                "No feature store in {}, write it with tools/relation_extract_features.py".format(path))
+        self.path = path
+        self.meta = torch.load(meta_file)
+        self._memmaps = {}
+
+    def check_fingerprint(self, fingerprint):
+        if fingerprint != self.meta["fingerprint"]:
+            raise RuntimeError(
+                "The feature store {} was written by other relation feature extractors, "
+                "extract the features again".format(self.path))
+
+    def _features(self, name):
+        if name not in self._memmaps:
+            if name not in self.meta["dims"]:
+                raise KeyError("The feature store {} has no {}".format(self.path, name))
+            self._memmaps[name] = np.memmap(
+                os.path.join(self.path, name + ".bin"), dtype=_FEATURE_FILES[name], mode="r"
+            ).reshape(-1, self.meta["dims"][name])
+        return self._memmaps[name]
+
+    def _entry(self, key):
+        try:
+            return self.meta["images"][key]
+        except KeyError:
+            raise KeyError("The image {} is not in the feature store {}".format(key, self.path))
+
+    def _rows(self, name, keys):
+        features = self._features(name)
+        rows = []
+        for key in keys:
+            entry = self._entry(key)
+            rows.append(features[entry[name]:entry[name] + entry["num_boxes"]])
+        return rows
+
+    def roi_features(self, keys, device):
+        """(sum(num_boxes), roi_dim) float tensor of the boxes of the images `keys`"""
+        return torch.from_numpy(np.concatenate(self._rows("roi_features", keys))).float().to(device)
+
+    def obj_logits(self, keys, device):
+        return torch.from_numpy(np.concatenate(self._rows("obj_logits", keys))).float().to(device)
+
+    def union_features(self, keys, rel_pair_idxs, device):
+        """
+        (sum(num_rel), union_dim) float tensor of the pairs rel_pair_idxs of the images `keys`
+        """
+        features = self._features("union_features")
+        rows = []
+        for key, rel_pair_idx in zip(keys, rel_pair_idxs):
+            entry = self._entry(key)
+            rel_pair_idx = rel_pair_idx.cpu().numpy()
+            rows.append(entry["union_features"] + rel_pair_idx[:, 0] * entry["num_boxes"] + rel_pair_idx[:, 1])
+        return torch.from_numpy(features[np.concatenate(rows)]).float().to(device)
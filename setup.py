@@ -3,6 +3,7 @@
 
 import glob
 import os
+import sys
 
 import torch
 from setuptools import find_packages
@@ -26,8 +27,14 @@ def get_extensions():
     extension = CppExtension
 
     extra_compile_args = {"cxx": []}
+    extra_link_args = []
     define_macros = []
 
+    # the CPU kernels split their work with at::parallel_for
+    if sys.platform.startswith("linux"):
+        extra_compile_args["cxx"].append("-fopenmp")
+        extra_link_args.append("-fopenmp")
+
     if (torch.cuda.is_available() and CUDA_HOME is not None) or os.getenv("FORCE_CUDA", "0") == "1":
         extension = CUDAExtension
         sources += source_cuda
@@ -50,6 +57,7 @@ def get_extensions():
             include_dirs=include_dirs,
             define_macros=define_macros,
             extra_compile_args=extra_compile_args,
+            extra_link_args=extra_link_args,
         )
     ]
 
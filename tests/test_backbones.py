@@ -5,6 +5,8 @@ import copy
 import torch
 # import modules to to register backbones
 from pysgg.modeling.backbone import build_backbone # NoQA
+from pysgg.modeling.backbone import prepare_for_inference
+from pysgg.layers import FrozenBatchNorm2d
 from pysgg.modeling import registry
 from pysgg.config import cfg as g_cfg
 from utils import load_config
@@ -50,6 +52,37 @@ class TestBackbones(unittest.TestCase):
                     torch.Size([N, backbone.out_channels])
                 )
 
+    def test_prepare_for_inference(self):
+        torch.manual_seed(0)
+        cfg = copy.deepcopy(g_cfg)
+        cfg.MODEL.BACKBONE.CONV_BODY = "R-50-FPN"
+        backbone = registry.BACKBONES["R-50-FPN"](cfg)
+        # non trivial frozen statistics
+        num_bns = 0
+        for module in backbone.modules():
+            if isinstance(module, FrozenBatchNorm2d):
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.normal_(0, 0.1)
+                module.running_mean.normal_(0, 0.1)
+                module.running_var.uniform_(0.5, 1.5)
+                num_bns += 1
+        input = torch.rand([2, 3, 96, 128], dtype=torch.float32)
+        with torch.no_grad():
+            expected = backbone(input)
+
+        modes = [False] + ([True] if hasattr(torch, "channels_last") else [])
+        for channels_last in modes:
+            prepared = copy.deepcopy(backbone)
+            self.assertEqual(prepare_for_inference(prepared, channels_last=channels_last), num_bns)
+            self.assertFalse(any(isinstance(m, FrozenBatchNorm2d) for m in prepared.modules()))
+            with torch.no_grad():
+                out = prepared(input)
+            self.assertEqual(len(out), len(expected))
+            for cur_out, cur_expected in zip(out, expected):
+                self.assertTrue(cur_out.is_contiguous())
+                self.assertLess((cur_out - cur_expected).abs().max().item(),
+                                1e-4 * cur_expected.abs().max().item())
+
 
 if __name__ == "__main__":
     unittest.main()
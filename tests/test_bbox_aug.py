@@ -0,0 +1,51 @@
+import unittest
+
+import torch
+
+from pysgg.engine.bbox_aug import group_views_by_padded_size, merge_detections
+from pysgg.modeling.roi_heads.box_head.inference import PostProcessor
+from pysgg.structures.bounding_box import BoxList
+
+
+def _random_boxes(num_boxes, size=100):
+    boxes = torch.rand(num_boxes, 4) * size
+    boxes[:, 2:] = torch.max(boxes[:, :2], boxes[:, 2:])
+    return boxes
+
+
+class TestBBoxAug(unittest.TestCase):
+    def test_group_views_by_padded_size(self):
+        view_images = [
+            [torch.rand(3, 60, 80), torch.rand(3, 64, 70)],
+            [torch.rand(3, 60, 80), torch.rand(3, 64, 70)],
+            [torch.rand(3, 90, 120), torch.rand(3, 96, 100)],
+            [torch.rand(3, 62, 78), torch.rand(3, 50, 80)],
+        ]
+        self.assertEqual(group_views_by_padded_size(view_images), [[0, 1], [2], [3]])
+        self.assertEqual(group_views_by_padded_size(view_images, 32), [[0, 1, 3], [2]])
+
+    def test_merge_detections(self):
+        torch.manual_seed(0)
+        num_classes = 5
+        boxlists_ts = []
+        for num_boxes in ((20, 12, 7), (0, 3, 0)):
+            boxlist_ts = []
+            for num in num_boxes:
+                boxlist = BoxList(_random_boxes(num * num_classes), (100, 100), mode="xyxy")
+                boxlist.add_field("pred_scores", torch.softmax(torch.randn(num, num_classes) * 3, 1).view(-1))
+                boxlist_ts.append(boxlist)
+            boxlists_ts.append(boxlist_ts)
+
+        results = merge_detections(boxlists_ts, PostProcessor(detections_per_img=10), num_classes)
+        expected = merge_detections(boxlists_ts, PostProcessor(detections_per_img=10, batched_nms=False),
+                                    num_classes)
+        for result, expected_result, boxlist_ts in zip(results, expected, boxlists_ts):
+            self.assertLessEqual(len(result), 10)
+            self.assertEqual(result.size, boxlist_ts[0].size)
+            self.assertTrue(torch.equal(result.bbox, expected_result.bbox))
+            for field in ("pred_scores", "pred_labels", "boxes_per_cls"):
+                self.assertTrue(torch.equal(result.get_field(field), expected_result.get_field(field)))
+
+
+if __name__ == "__main__":
+    unittest.main()
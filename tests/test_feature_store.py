@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from PIL import Image
+from torch import nn
+
+from pysgg.data.transforms import build_transforms
+from pysgg.modeling.roi_heads.relation_head.relation_head import ROIRelationHead
+from pysgg.structures.bounding_box import BoxList
+from pysgg.utils.feature_store import FeatureStore, FeatureStoreWriter, modules_fingerprint, store_dir
+from utils import load_relation_config
+
+
+def _gt_boxes(num_objs, num_obj_cls, image_size=(128, 96)):
+    targets = []
+    for num_obj in num_objs:
+        boxes = torch.rand(num_obj, 4) * 40
+        boxes[:, 2:] += boxes[:, :2] + 8
+        target = BoxList(boxes, image_size, mode="xyxy")
+        target.add_field("labels", torch.randint(1, num_obj_cls, (num_obj,)))
+        targets.append(target)
+    return targets
+
+
+class TestFeatureStore(unittest.TestCase):
+    def test_write_read(self):
+        torch.manual_seed(0)
+        fingerprint = modules_fingerprint([nn.Linear(4, 2)])
+        images = {}
+        with tempfile.TemporaryDirectory() as path:
+            writer = FeatureStoreWriter(path, fingerprint)
+            for key, num_boxes in ((11, 3), (7, 5), (2, 1)):
+                images[key] = (torch.rand(num_boxes, 8), torch.rand(num_boxes ** 2, 6), torch.randn(num_boxes, 4))
+                writer.add(key, *images[key])
+            self.assertIn(7, writer)
+            writer.close()
+
+            store = FeatureStore(path)
+            store.check_fingerprint(fingerprint)
+            with self.assertRaises(RuntimeError):
+                store.check_fingerprint(modules_fingerprint([nn.Linear(4, 2)]))
+            with self.assertRaises(KeyError):
+                store.roi_features([3], "cpu")
+
+            keys = [7, 11, 2]
+            roi_features = store.roi_features(keys, "cpu")
+            expected = torch.cat([images[key][0] for key in keys])
+            self.assertEqual(roi_features.dtype, torch.float32)
+            self.assertTrue(torch.equal(roi_features, expected.half().float()))
+            self.assertTrue(torch.equal(store.obj_logits(keys, "cpu"), torch.cat([images[key][2] for key in keys])))
+
+            rel_pair_idxs = [torch.tensor([[0, 1], [4, 2], [3, 3]]), torch.tensor([[2, 0]]), torch.tensor([[0, 0]])]
+            expected = []
+            for key, rel_pair_idx in zip(keys, rel_pair_idxs):
+                num_boxes = len(images[key][0])
+                expected.append(images[key][1][rel_pair_idx[:, 0] * num_boxes + rel_pair_idx[:, 1]])
+            union_features = store.union_features(keys, rel_pair_idxs, "cpu")
+            self.assertTrue(torch.equal(union_features, torch.cat(expected).half().float()))
+
+    def test_relation_head_store(self):
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cfg = load_relation_config(tmp_dir)
+            cfg.MODEL.PRETRAINED_DETECTOR_CKPT = os.path.join(tmp_dir, "detector.pth")
+            torch.save({}, cfg.MODEL.PRETRAINED_DETECTOR_CKPT)
+            cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED = True
+            cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.DIR = os.path.join(tmp_dir, "feature_store")
+            head = ROIRelationHead(cfg, in_channels=8).eval()
+            # the live features get the float16 rounding of the stored ones
+            for module in head.frozen_feature_modules():
+                module.register_forward_hook(lambda module, inputs, output: output.half().float())
+
+            keys = [31, 4, 17]
+            targets = _gt_boxes((5, 2, 4), cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES)
+            features = [torch.rand(len(keys), 8, 24, 32)]
+            with torch.no_grad():
+                # the store as tools/relation_extract_features.py writes it
+                path = store_dir(cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.DIR, cfg.MODEL.PRETRAINED_DETECTOR_CKPT)
+                writer = FeatureStoreWriter(path, modules_fingerprint(head.frozen_feature_modules()))
+                for i, (key, target) in enumerate(zip(keys, targets)):
+                    writer.add(key, *head.extract_store_features([each[i:i + 1] for each in features], target, 7))
+                writer.close()
+
+                _, expected, _ = head(features, [target.copy_with_fields(["labels"]) for target in targets])
+                _, result, _ = head(None, [target.copy_with_fields(["labels"]) for target in targets],
+                                    store_keys=keys)
+
+                self.assertEqual(len(result), len(keys))
+                for boxlist, expected_boxlist in zip(result, expected):
+                    self.assertTrue(torch.equal(boxlist.get_field("rel_pair_idxs"),
+                                                expected_boxlist.get_field("rel_pair_idxs")))
+                    self.assertTrue(torch.allclose(boxlist.get_field("pred_rel_scores"),
+                                                   expected_boxlist.get_field("pred_rel_scores"), atol=1e-3))
+
+                # the union extractor layers that are not loaded from the detector changed
+                head.feature_store = None
+                next(head.union_feature_extractor.parameters()).add_(1.0)
+                with self.assertRaises(RuntimeError):
+                    head(None, [target.copy_with_fields(["labels"]) for target in targets], store_keys=keys)
+
+    def test_targets_only_transforms(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cfg = load_relation_config(tmp_dir)
+        transforms = build_transforms(cfg, is_train=False)
+        targets_only_transforms = build_transforms(cfg, is_train=False, targets_only=True)
+        for image_size in ((500, 375), (333, 500), (1024, 256)):
+            target = _gt_boxes((4,), cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES, image_size)[0]
+            image, expected = transforms(Image.new("RGB", image_size), target)
+            none, resized = targets_only_transforms(None, target)
+            self.assertIsNone(none)
+            self.assertEqual(resized.size, expected.size)
+            self.assertEqual(resized.size, (image.shape[2], image.shape[1]))
+            self.assertTrue(torch.equal(resized.bbox, expected.bbox))
+
+
+if __name__ == "__main__":
+    unittest.main()
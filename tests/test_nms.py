@@ -4,7 +4,39 @@ import unittest
 
 import numpy as np
 import torch
+from pysgg.layers import batched_nms as box_batched_nms
 from pysgg.layers import nms as box_nms
+from pysgg.modeling.roi_heads.box_head.inference import PostProcessor
+from pysgg.structures.bounding_box import BoxList
+from pysgg.structures.boxes_per_cls import LazyBoxesPerCls, cat_boxes_per_cls
+from pysgg.structures.boxlist_ops import batched_nms
+
+
+def _random_boxes(num_boxes, size=100):
+    # coordinates on a quarter pixel grid, exactly representable after moving the groups
+    boxes = torch.randint(0, size * 4, (num_boxes, 4)).float() / 4
+    boxes[:, 2:] = torch.max(boxes[:, :2], boxes[:, 2:])
+    return boxes
+
+
+def _reference_nms(boxes, scores, thresh, idxs=None):
+    # the greedy suppression of the former single threaded kernel, kept indices in increasing order
+    boxes, scores = boxes.numpy(), scores.numpy()
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    order = np.argsort(-scores, kind="stable")
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    for i in order:
+        if suppressed[i]:
+            continue
+        w = np.maximum(0, np.minimum(boxes[i, 2], boxes[:, 2]) - np.maximum(boxes[i, 0], boxes[:, 0]) + 1)
+        h = np.maximum(0, np.minimum(boxes[i, 3], boxes[:, 3]) - np.maximum(boxes[i, 1], boxes[:, 1]) + 1)
+        inter = w * h
+        overlap = inter / (areas[i] + areas - inter) >= thresh
+        if idxs is not None:
+            overlap &= idxs.numpy() == idxs[i].item()
+        overlap[i] = False
+        suppressed |= overlap & (scores <= scores[i])
+    return np.nonzero(~suppressed)[0]
 
 
 class TestNMS(unittest.TestCase):
@@ -216,6 +248,97 @@ class TestNMS(unittest.TestCase):
 
         np.testing.assert_array_equal(keep_indices, gt_indices)
 
+    def test_batched_nms_cpu(self):
+        boxes = _random_boxes(300)
+        scores = torch.rand(300)
+        idxs = torch.randint(0, 7, (300,)) * 3
+        for max_proposals in (-1, 5):
+            keep = batched_nms(boxes, scores, idxs, 0.5, max_proposals)
+            expected = []
+            for idx in idxs.unique():
+                inds = torch.nonzero(idxs == idx).squeeze(1)
+                keep_idx = box_nms(boxes[inds], scores[inds], 0.5)
+                if max_proposals > 0:
+                    keep_idx = keep_idx[:max_proposals]
+                expected.append(inds[keep_idx])
+            expected = torch.cat(expected)
+            self.assertEqual(keep.tolist(), sorted(expected.tolist()))
+
+    def test_box_post_processor_batched_nms_cpu(self):
+        num_classes = 6
+        boxlists = []
+        for num_boxes in (40, 0, 25):
+            boxlist = BoxList(_random_boxes(num_boxes * num_classes), (100, 100), mode="xyxy")
+            boxlist.add_field("pred_scores", torch.softmax(torch.randn(num_boxes, num_classes) * 3, 1).view(-1))
+            boxlists.append(boxlist)
+
+        for filter_duplicates in (False, True):
+            post_processor = PostProcessor(score_thresh=0.05, nms=0.5, post_nms_per_cls_topn=4,
+                                           nms_filter_duplicates=filter_duplicates, detections_per_img=12)
+            batch_results = post_processor.filter_results_batch(boxlists, num_classes)
+            for boxlist, (result, orig_inds, boxes_per_cls) in zip(boxlists, batch_results):
+                expected, expected_inds, expected_boxes_per_cls = post_processor.filter_results(boxlist,
+                                                                                                 num_classes)
+                self.assertLessEqual(len(result), 12)
+                self.assertTrue(torch.equal(orig_inds, expected_inds))
+                self.assertTrue(torch.equal(result.bbox, expected.bbox))
+                self.assertTrue(torch.equal(boxes_per_cls, expected_boxes_per_cls))
+                for field in ("pred_scores", "pred_labels"):
+                    self.assertTrue(torch.equal(result.get_field(field), expected.get_field(field)))
+
+    def test_box_post_processor_lazy_decode_cpu(self):
+        num_classes = 6
+        proposals, class_logits, box_regression = [], [], []
+        for num_boxes in (40, 0, 25):
+            boxlist = BoxList(_random_boxes(num_boxes) + 10, (120, 110), mode="xyxy")
+            logits = torch.randn(num_boxes, num_classes) * 3
+            boxlist.add_field("predict_logits", logits)
+            proposals.append(boxlist)
+            class_logits.append(logits)
+            box_regression.append(torch.randn(num_boxes, num_classes * 4))
+        features = torch.rand(65, 8)
+        class_logits, box_regression = torch.cat(class_logits), torch.cat(box_regression)
+
+        for batched, cls_agnostic in ((False, False), (True, False), (True, True)):
+            outputs = []
+            for lazy_decode in (False, True):
+                post_processor = PostProcessor(score_thresh=0.05, nms=0.5, post_nms_per_cls_topn=4,
+                                               detections_per_img=12, cls_agnostic_bbox_reg=cls_agnostic,
+                                               batched_nms=batched, lazy_decode=lazy_decode)
+                outputs.append(post_processor((features, class_logits, box_regression), proposals))
+            (dense_features, dense_results), (lazy_features, lazy_results) = outputs
+            self.assertTrue(torch.equal(lazy_features, dense_features))
+            for lazy, dense in zip(lazy_results, dense_results):
+                self.assertTrue(torch.equal(lazy.bbox, dense.bbox))
+                for field in ("pred_scores", "pred_labels", "predict_logits"):
+                    self.assertTrue(torch.equal(lazy.get_field(field), dense.get_field(field)))
+                boxes_per_cls = lazy.get_field("boxes_per_cls")
+                self.assertIsInstance(boxes_per_cls, LazyBoxesPerCls)
+                self.assertEqual(boxes_per_cls.shape, dense.get_field("boxes_per_cls").shape)
+                self.assertTrue(torch.equal(cat_boxes_per_cls([lazy]), dense.get_field("boxes_per_cls")))
+                rows = torch.arange(len(lazy))
+                self.assertTrue(torch.equal(boxes_per_cls[rows, lazy.get_field("pred_labels")], lazy.bbox))
+
+    def test_nms_reference_cpu(self):
+        # over several chunks of rows and blocks of bits of the kernel
+        boxes = _random_boxes(700)
+        scores = torch.randperm(700).float() / 700
+        idxs = torch.randint(0, 5, (700,))
+        for thresh in (0.3, 0.5, 0.7):
+            expected = _reference_nms(boxes, scores, thresh)
+            np.testing.assert_array_equal(box_nms(boxes, scores, thresh).numpy(), expected)
+            # early exit: the kept boxes of highest score
+            top = expected[np.argsort(-scores[expected].numpy())[:50]]
+            np.testing.assert_array_equal(box_nms(boxes, scores, thresh, 50).numpy(), np.sort(top))
+
+            expected = _reference_nms(boxes, scores, thresh, idxs)
+            np.testing.assert_array_equal(box_batched_nms(boxes, scores, idxs, thresh).numpy(), expected)
+            # early exit in each group
+            top = [group_keep[np.argsort(-scores[group_keep].numpy())[:20]]
+                   for group_keep in (expected[idxs[expected].numpy() == idx] for idx in range(5))]
+            np.testing.assert_array_equal(box_batched_nms(boxes, scores, idxs, thresh, 20).numpy(),
+                                          np.sort(np.concatenate(top)))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import torch
+from pysgg.modeling.roi_heads.relation_head.roi_relation_feature_extractors import (
+    pair_rect_masks,
+    unordered_pair_index,
+)
+
+
+class TestRelationFeatureExtractors(unittest.TestCase):
+    def test_unordered_pair_index(self):
+        rel_pair_idx = torch.tensor([[0, 1], [1, 0], [2, 0], [1, 2], [0, 2], [2, 1], [3, 1]])
+        unique_pair_idx, inverse_idx = unordered_pair_index(rel_pair_idx)
+
+        self.assertEqual(len(unique_pair_idx), 4)
+        # every ordered pair maps to the unordered pair built from the same two instances
+        restored = unique_pair_idx[inverse_idx]
+        self.assertTrue((restored == torch.sort(rel_pair_idx, dim=1)[0]).all())
+        self.assertEqual(inverse_idx[0], inverse_idx[1])
+        self.assertEqual(inverse_idx[2], inverse_idx[4])
+        self.assertEqual(inverse_idx[3], inverse_idx[5])
+
+    def test_pair_rect_masks(self):
+        rect_size = 27
+        head_boxes = torch.rand(16, 4) * rect_size
+        head_boxes[:, 2:] += head_boxes[:, :2]
+        tail_boxes = torch.rand(16, 4) * rect_size
+        tail_boxes[:, 2:] += tail_boxes[:, :2]
+
+        # dense reference: broadcast the 4-way coordinate comparisons over the whole grid
+        x_range = torch.arange(rect_size).view(1, 1, -1)
+        y_range = torch.arange(rect_size).view(1, -1, 1)
+        expected = []
+        for boxes in (head_boxes, tail_boxes):
+            expected.append(((x_range >= boxes[:, 0].floor().view(-1, 1, 1).long())
+                             & (x_range <= boxes[:, 2].ceil().view(-1, 1, 1).long())
+                             & (y_range >= boxes[:, 1].floor().view(-1, 1, 1).long())
+                             & (y_range <= boxes[:, 3].ceil().view(-1, 1, 1).long())).float())
+        expected = torch.stack(expected, dim=1)
+
+        rect_masks = pair_rect_masks(head_boxes, tail_boxes, rect_size)
+        self.assertEqual(rect_masks.shape, expected.shape)
+        self.assertTrue(torch.equal(rect_masks, expected))
+        rect_masks_half = pair_rect_masks(head_boxes, tail_boxes, rect_size, dtype=torch.half)
+        self.assertEqual(rect_masks_half.dtype, torch.half)
+        self.assertTrue(torch.equal(rect_masks_half.float(), expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+import math
+import unittest
+
+import torch
+import torch.nn as nn
+from pysgg.modeling.roi_heads.relation_head.model_agcn import prepare_message
+from pysgg.modeling.roi_heads.relation_head.model_gpsnet import MessageGenerator
+from pysgg.modeling.roi_heads.relation_head.utils_graph import (
+    RelationGraphBatch,
+    segment_max,
+    segment_mean,
+    segment_softmax,
+    segment_sum,
+)
+
+
+def _random_graph(num_proposals=(5, 1, 8), num_rels=(7, 0, 20)):
+    rel_pair_idxs = []
+    for num_prop, num_rel in zip(num_proposals, num_rels):
+        rel_pair_idxs.append(torch.randint(0, num_prop, (num_rel, 2)))
+    return RelationGraphBatch.from_rel_pairs(num_proposals, rel_pair_idxs)
+
+
+def _dense_prepare_message(target, source, adj_matrix, trans_fc, att_module):
+    # the dense (num_target, num_source) implementation the edge list version replaced
+    source = torch.relu(trans_fc(source))
+    max_income_edge_num = int(torch.max(adj_matrix.sum(1)).item())
+    att_mask = torch.ones((target.shape[0], max_income_edge_num), dtype=torch.bool)
+    active_nodes_id = []
+    selected_idx = []
+    for f_id in range(target.shape[0]):
+        indices = torch.nonzero(adj_matrix[f_id]).view(-1)
+        if len(indices) > 0:
+            active_nodes_id.append(f_id)
+            att_mask[f_id, torch.arange(len(indices))] = False
+            padding = torch.zeros((max_income_edge_num - len(indices)), dtype=torch.long)
+            selected_idx.append(torch.cat((indices, padding), dim=0))
+    selected_idx = torch.cat(selected_idx, dim=0)
+    att_sources = source[selected_idx].reshape(len(active_nodes_id), max_income_edge_num, -1)
+    vaild_mp_idx = torch.tensor(active_nodes_id, dtype=torch.long)
+    att_res, _ = att_module(query=target[vaild_mp_idx].unsqueeze(0), key=att_sources.transpose(0, 1),
+                            value=att_sources.transpose(0, 1), key_padding_mask=att_mask[vaild_mp_idx])
+    att_res_padded = torch.zeros((target.shape[0], att_res.shape[-1]))
+    att_res_padded[vaild_mp_idx] = att_res.squeeze(0)
+    return att_res_padded, vaild_mp_idx
+
+
+class TestRelationGraph(unittest.TestCase):
+    def test_dense_maps(self):
+        graph = _random_graph()
+        subj_pred_map, obj_pred_map, obj_obj_map = graph.dense_maps()
+
+        # reference: the scatter-based maps of the graph models
+        expected_subj = torch.zeros((graph.num_inst, graph.num_rel))
+        expected_obj = torch.zeros((graph.num_inst, graph.num_rel))
+        expected_subj.scatter_(0, graph.rel_inds[:, 0].view(1, -1), 1)
+        expected_obj.scatter_(0, graph.rel_inds[:, 1].view(1, -1), 1)
+        self.assertTrue(torch.equal(subj_pred_map, expected_subj))
+        self.assertTrue(torch.equal(obj_pred_map, expected_obj))
+
+        target_idx, source_idx = graph.inst2inst_edges()
+        expected_edges = torch.nonzero(obj_obj_map)
+        self.assertTrue(torch.equal(torch.stack((target_idx, source_idx), 1), expected_edges))
+
+        target_idx, source_idx = graph.rel2inst_edges(0)
+        self.assertTrue(torch.equal(torch.stack((target_idx, source_idx), 1), torch.nonzero(subj_pred_map)))
+        target_idx, source_idx = graph.inst2rel_edges(1)
+        self.assertTrue(torch.equal(torch.stack((target_idx, source_idx), 1), torch.nonzero(obj_pred_map.t())))
+
+    def test_segment_aggregation(self):
+        graph = _random_graph()
+        rel_feats = torch.rand(graph.num_rel, 16)
+        subj_pred_map, obj_pred_map, _ = graph.dense_maps()
+
+        # sum, as the IMP vertex context
+        self.assertTrue(torch.allclose(
+            segment_sum(rel_feats, graph.edge_sub_idx, graph.num_inst), subj_pred_map @ rel_feats, atol=1e-6
+        ))
+
+        # mean, as the BGNN message aggregation on the selected relations
+        selected = torch.randperm(graph.num_rel)[: graph.num_rel // 2]
+        mp_graph = graph.select(selected)
+        subj_pred_map, _, _ = mp_graph.dense_maps()
+        avg_factor = subj_pred_map.sum(1, keepdim=True).clamp(min=1)
+        self.assertTrue(torch.allclose(
+            segment_mean(rel_feats[mp_graph.edge_rel_idx], mp_graph.edge_sub_idx, graph.num_inst),
+            (subj_pred_map @ rel_feats) / avg_factor,
+            atol=1e-6,
+        ))
+
+    def test_segment_softmax(self):
+        graph = _random_graph()
+        logits = torch.randn(graph.num_rel, 4) * 10
+        subj_pred_map, _, _ = graph.dense_maps()
+
+        # dense reference: masked softmax of each instance over its relations
+        dense_logits = logits.t().unsqueeze(1).expand(-1, graph.num_inst, -1)
+        dense_logits = dense_logits.masked_fill(subj_pred_map.unsqueeze(0) == 0, float("-inf"))
+        dense_att = torch.softmax(dense_logits, dim=-1)
+        expected = dense_att[:, graph.edge_sub_idx, graph.edge_rel_idx].t()
+
+        att = segment_softmax(logits, graph.edge_sub_idx, graph.num_inst)
+        self.assertTrue(torch.allclose(att, expected, atol=1e-6))
+
+    def test_segment_max(self):
+        graph = _random_graph()
+        # unsorted segment ids
+        perm = torch.randperm(graph.num_rel)
+        segment_ids = graph.edge_sub_idx[perm]
+        src = torch.randn(graph.num_rel, 4)
+
+        out = segment_max(src, segment_ids, graph.num_inst)
+        for seg_id in range(graph.num_inst):
+            members = src[segment_ids == seg_id]
+            if len(members) > 0:
+                self.assertTrue(torch.equal(out[seg_id], members.max(0)[0]))
+            else:
+                self.assertTrue(torch.isinf(out[seg_id]).all())
+
+    def test_segment_softmax_far_segments(self):
+        # the logits of the two segments are ~200 apart, the exp of the lower segment underflows
+        # when shifted by the global max
+        segment_ids = torch.tensor([1, 0, 1, 0, 1])
+        logits = torch.tensor([200.5, 0.3, 199.0, -1.2, 201.0], requires_grad=True)
+
+        att = segment_softmax(logits, segment_ids, 3)
+        self.assertTrue(torch.isfinite(att).all())
+        for seg_id in (0, 1):
+            mask = segment_ids == seg_id
+            self.assertTrue(torch.allclose(att[mask], torch.softmax(logits[mask], 0), atol=1e-6))
+
+        att.pow(2).sum().backward()
+        self.assertTrue(torch.isfinite(logits.grad).all())
+
+    def test_prepare_message(self):
+        graph = _random_graph()
+        dim = 8
+        target = torch.rand(graph.num_inst, dim)
+        source = torch.rand(graph.num_rel, dim)
+        trans_fc = nn.Linear(dim, dim)
+        att_module = nn.MultiheadAttention(num_heads=2, embed_dim=dim)
+        subj_pred_map, _, obj_obj_map = graph.dense_maps()
+
+        with torch.no_grad():
+            for adj_matrix, src, edge_index in (
+                (subj_pred_map, source, graph.rel2inst_edges(0)),
+                (obj_obj_map, target, graph.inst2inst_edges()),
+            ):
+                expected, expected_idx = _dense_prepare_message(target, src, adj_matrix, trans_fc, att_module)
+                message, vaild_mp_idx = prepare_message(target, src, edge_index, trans_fc, att_module)
+                self.assertTrue(torch.equal(vaild_mp_idx, expected_idx))
+                self.assertTrue(torch.allclose(message, expected, atol=1e-6))
+
+    def test_gpsnet_edge_attention(self):
+        n_nodes, input_dims, hidden_dim = 30, 32, 16
+        # unique pairs, as the pairs of the relation proposals
+        all_pairs = torch.nonzero(torch.ones(n_nodes, n_nodes) - torch.eye(n_nodes))
+        rel_pair_idx = all_pairs[torch.randperm(len(all_pairs))[:100]]
+        sub_idx = rel_pair_idx[:, 0]
+        # double precision, so the float rounding does not hide the epsilon of the dense softmax
+        source_features = torch.rand(n_nodes, input_dims, dtype=torch.float64)
+        relness_score = torch.rand(len(rel_pair_idx), dtype=torch.float64)
+        weighting_gate = torch.rand(len(rel_pair_idx), dtype=torch.float64)
+        # the logits of one subject far below the global max
+        far_gate = weighting_gate.clone()
+        far_gate[sub_idx == sub_idx[0]] -= 30.
+
+        msg_gen = MessageGenerator(input_dims, hidden_dim).double()
+        msg_gen.eval()
+        with torch.no_grad():
+            for gate, is_far in ((weighting_gate, False), (far_gate, True)):
+                # the dense softmax shifts by the global max, the 1e-6 epsilon of each row is added
+                # to the sum of exp(logit - global max), the edge softmax has no epsilon
+                row_sum = segment_sum((gate - gate.max()).exp(), sub_idx, n_nodes)
+                row_scale = (row_sum / (row_sum + 1e-6))[sub_idx]
+                if not is_far:
+                    # logits in [0, 1): every row sums to more than e^-1
+                    self.assertGreater(row_scale.min().item(), 1 - 1e-6 * math.e)
+                else:
+                    self.assertLess(row_scale.min().item(), 1e-6)
+
+                for relness in (None, relness_score):
+                    msg_gen.attention_mode = "dense"
+                    expected = msg_gen(source_features, gate, rel_pair_idx, relness)
+                    msg_gen.attention_mode = "edge"
+                    message = msg_gen(source_features, gate, rel_pair_idx, relness)
+                    scaled_relness = row_scale if relness is None else row_scale * relness
+                    scaled_message = msg_gen(source_features, gate, rel_pair_idx, scaled_relness)
+                    # the row scale is the whole difference between the two paths
+                    self.assertTrue(torch.allclose(scaled_message, expected, rtol=0, atol=1e-12))
+                    if not is_far:
+                        self.assertTrue(torch.allclose(message, expected, rtol=0, atol=1e-5))
+                    else:
+                        self.assertFalse(torch.allclose(message, expected, rtol=0, atol=1e-2))
+
+
+if __name__ == "__main__":
+    unittest.main()
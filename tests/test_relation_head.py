@@ -0,0 +1,474 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from pysgg.config import cfg as g_cfg
+from pysgg.data.datasets.visual_genome import pred_dist_statistics
+from pysgg.modeling.roi_heads.relation_head.relation_head import ROIRelationHead
+from pysgg.modeling.roi_heads.relation_head.classifier import DotProductClassifier, WeightNormClassifier
+from pysgg.modeling.roi_heads.relation_head.model_kern import GGNNObj, GGNNRel
+from pysgg.modeling.roi_heads.relation_head.model_motifs import FrequencyBias
+from pysgg.modeling.roi_heads.relation_head.model_transformer import TransformerEncoder
+from pysgg.modeling.roi_heads.relation_head.rel_proposal_network.models import (
+    RelationProposalModel,
+    filter_rel_pairs,
+)
+from pysgg.modeling.roi_heads.relation_head.roi_relation_predictors import (
+    make_roi_relation_predictor,
+    prepare_for_inference,
+)
+from pysgg.modeling.roi_heads.relation_head.sampling import binary_relatedness_matrix
+from pysgg.modeling.roi_heads.relation_head.utils_motifs import encode_box_info, sort_by_score
+from pysgg.modeling.roi_heads.relation_head.utils_relation import (
+    get_box_info,
+    nms_overlaps,
+    packed_label_nms,
+    split_pair_chunks,
+)
+from pysgg.structures.bounding_box import BoxList
+from utils import load_relation_config
+
+
+class _ToyPredictor(nn.Module):
+    # the constant parts of the relation predictors, on a tiny scale
+    def __init__(self, statistics, in_dim=16):
+        super(_ToyPredictor, self).__init__()
+        num_rel_cls = statistics['pred_dist'].size(-1)
+        self.pos_embed = nn.Sequential(nn.Linear(9, in_dim), nn.BatchNorm1d(in_dim), nn.ReLU(inplace=True))
+        self.ctx_compress = WeightNormClassifier(in_dim, num_rel_cls, gamma_init=2.0)
+        self.rel_compress = DotProductClassifier(in_dim, num_rel_cls, learnable_scale=True)
+        self.freq_bias = FrequencyBias(None, statistics)
+        self.freq_lambda = nn.Parameter(torch.Tensor([0.5]), requires_grad=False)
+
+    def forward(self, pos_feats, pair_pred):
+        rel_feats = self.pos_embed(pos_feats)
+        return (self.ctx_compress(rel_feats) + self.rel_compress(rel_feats)
+                + self.freq_bias.index_with_labels(pair_pred, scale=self.freq_lambda))
+
+
+def _random_boxes_per_cls(num_obj, num_cls):
+    boxes = torch.rand(num_obj, num_cls, 4) * 50
+    boxes[:, :, 2:] += boxes[:, :, :2]
+    return boxes
+
+
+def _toy_proposals(num_objs, num_obj_cls, image_size=(128, 96)):
+    # ground truth boxes as the box head gives them in predcls
+    proposals = []
+    for num_obj in num_objs:
+        boxes = torch.rand(num_obj, 4) * 40
+        boxes[:, 2:] += boxes[:, :2] + 8
+        proposal = BoxList(boxes, image_size, mode="xyxy")
+        labels = torch.randint(1, num_obj_cls, (num_obj,))
+        proposal.add_field("labels", labels)
+        proposal.add_field("pred_labels", labels)
+        proposal.add_field("predict_logits", torch.randn(num_obj, num_obj_cls))
+        proposals.append(proposal)
+    return proposals
+
+
+def _all_pairs(num_obj):
+    idxs = torch.arange(num_obj)
+    pairs = torch.stack((idxs.view(-1, 1).expand(num_obj, num_obj), idxs.view(1, -1).expand(num_obj, num_obj)), 2)
+    pairs = pairs.view(-1, 2)
+    return pairs[pairs[:, 0] != pairs[:, 1]]
+
+
+def _reference_relness(rel_pn, proposals, roi_features, rel_pair_idxs):
+    # the relatedness image by image, the visual term from the k x k inner products
+    relness_scores = []
+    roi_features = roi_features.split([len(proposal) for proposal in proposals], dim=0)
+    for proposal, roi_feat, pair_idx in zip(proposals, roi_features, rel_pair_idxs):
+        if len(pair_idx) == 0:
+            relness_scores.append(roi_feat.new_zeros((0,)))
+            continue
+        pos_embed = rel_pn.obj_pos_embed(encode_box_info([proposal]))
+        obj_sem_embed = F.softmax(proposal.get_field("predict_logits"), dim=1) @ rel_pn.obj_sem_embed.weight
+        relness = rel_pn.proposal_relness_cls_fc(torch.cat(
+            (pos_embed[pair_idx[:, 0]], obj_sem_embed[pair_idx[:, 0]],
+             pos_embed[pair_idx[:, 1]], obj_sem_embed[pair_idx[:, 1]]), dim=1)).view(-1)
+        sub_roi_feat = rel_pn.sub_vis_embed(roi_feat)
+        sub_roi_feat = rel_pn.subj_self_att(sub_roi_feat, sub_roi_feat, sub_roi_feat).squeeze(1)
+        obj_roi_feat = rel_pn.obj_vis_embed(roi_feat)
+        obj_roi_feat = rel_pn.obj_self_att(obj_roi_feat, obj_roi_feat, obj_roi_feat).squeeze(1)
+        relness = relness + torch.mm(sub_roi_feat, obj_roi_feat.t())[pair_idx[:, 0], pair_idx[:, 1]]
+        relness_scores.append(torch.sigmoid(relness))
+    return relness_scores
+
+
+def _reference_effect_logits(predictor, proposals, rel_pair_idxs, roi_features, union_features):
+    # the causal effect with separate factual / counterfactual passes, one calculate_logits per branch
+    num_objs = [len(proposal) for proposal in proposals]
+    obj_boxs = [get_box_info(p.bbox, need_norm=True, proposal=p) for p in proposals]
+    post_ctx_rep, _, pair_bbox, pair_obj_probs = predictor.pair_feature_generate(
+        roi_features, proposals, rel_pair_idxs, num_objs, obj_boxs, None)[:4]
+    avg_ctx_rep, _, _, avg_frq_rep = predictor.pair_feature_generate(
+        roi_features, proposals, rel_pair_idxs, num_objs, obj_boxs, None, ctx_average=True)[:4]
+    if predictor.spatial_for_vision:
+        post_ctx_rep = post_ctx_rep * predictor.spt_emb(pair_bbox)
+        avg_ctx_rep = avg_ctx_rep * predictor.spt_emb(predictor.untreated_spt.view(1, -1))
+
+    def logits(ctx_rep, frq_rep):
+        return predictor.calculate_logits(union_features, ctx_rep, frq_rep)
+
+    if predictor.effect_type == "TDE":
+        rel_dists = logits(post_ctx_rep, pair_obj_probs) - logits(avg_ctx_rep, pair_obj_probs)
+    elif predictor.effect_type == "NIE":
+        rel_dists = logits(avg_ctx_rep, pair_obj_probs) - logits(avg_ctx_rep, avg_frq_rep)
+    else:
+        rel_dists = logits(post_ctx_rep, pair_obj_probs) - logits(avg_ctx_rep, avg_frq_rep)
+    return rel_dists.split([len(pairs) for pairs in rel_pair_idxs], dim=0)
+
+
+class TestRelationHead(unittest.TestCase):
+    def test_split_pair_chunks(self):
+        rel_pair_idxs = [torch.randint(0, 10, (num_rel, 2)) for num_rel in (5, 1, 0, 12, 0, 3)]
+        for chunk_size in (1, 4, 7, 100):
+            restored = [[] for _ in rel_pair_idxs]
+            for img_ids, chunk_pair_idxs in split_pair_chunks(rel_pair_idxs, chunk_size):
+                self.assertEqual(len(img_ids), len(chunk_pair_idxs))
+                self.assertEqual(img_ids, sorted(set(img_ids)))
+                self.assertLessEqual(sum(len(each) for each in chunk_pair_idxs), chunk_size)
+                for img_id, pair_idx in zip(img_ids, chunk_pair_idxs):
+                    self.assertGreater(len(pair_idx), 0)
+                    restored[img_id].append(pair_idx)
+            for pair_idx, chunks in zip(rel_pair_idxs, restored):
+                if len(pair_idx) == 0:
+                    self.assertEqual(chunks, [])
+                else:
+                    self.assertTrue(torch.equal(torch.cat(chunks, dim=0), pair_idx))
+
+    def test_chunked_inference(self):
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cfg = load_relation_config(tmp_dir)
+            head = ROIRelationHead(cfg, in_channels=8).eval()
+        num_obj_cls = cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES
+        # the image without pairs is between two images with pairs
+        num_objs = (5, 4, 6, 3)
+        proposals = _toy_proposals(num_objs, num_obj_cls)
+        rel_pair_idxs = [_all_pairs(num_obj) for num_obj in num_objs]
+        rel_pair_idxs[1] = rel_pair_idxs[1][:0]
+        features = [torch.rand(len(num_objs), 8, 24, 32)]
+
+        with torch.no_grad():
+            roi_features = head.box_feature_extractor(features, proposals)
+            union_features = head.union_feature_extractor(features, proposals, rel_pair_idxs)
+            expected_obj_logits, expected_rel_logits, _ = head.predictor(
+                proposals, rel_pair_idxs, None, None, roi_features, union_features)
+
+            pair_bytes = head.predictor.pair_memory_bytes() + head.union_feature_extractor.pair_memory_bytes()
+            # 7 pairs per chunk, the pairs of the first and third images are split across the chunks
+            head.chunk_memory_budget = 7.5 * pair_bytes / 1024 ** 2
+            obj_logits, rel_logits = head.chunked_inference(features, proposals, rel_pair_idxs, roi_features)
+
+        self.assertEqual(len(rel_logits), len(num_objs))
+        for logits, expected in zip(obj_logits, expected_obj_logits):
+            self.assertTrue(torch.equal(logits, expected))
+        for logits, expected, pair_idx in zip(rel_logits, expected_rel_logits, rel_pair_idxs):
+            self.assertEqual(logits.shape, (len(pair_idx), cfg.MODEL.ROI_RELATION_HEAD.NUM_CLASSES))
+            self.assertTrue(torch.allclose(logits, expected, atol=1e-6))
+
+    def test_chunked_inference_unsupported(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cfg = load_relation_config(tmp_dir, "VCTreePredictor")
+            cfg.TEST.RELATION.CHUNK_MEMORY_BUDGET = 64
+            with self.assertLogs("pysgg.modeling.roi_heads.relation_head.relation_head", level="WARNING") as logs:
+                head = ROIRelationHead(cfg, in_channels=8)
+        self.assertFalse(head.support_chunked_inference)
+        self.assertIn("CHUNK_MEMORY_BUDGET", logs.output[0])
+
+    def test_binary_relatedness_matrix(self):
+        num_tgt, num_prp = 6, 20
+        is_match = torch.rand(num_tgt, num_prp) > 0.7
+        tgt_pair_idxs = torch.tensor([[0, 1], [2, 3], [1, 4], [5, 0]])
+
+        # reference: mark the matched pairs relation by relation
+        expected = torch.zeros((num_prp, num_prp), dtype=torch.int64)
+        for head, tail in tgt_pair_idxs.tolist():
+            for i in torch.nonzero(is_match[head]).view(-1).tolist():
+                for j in torch.nonzero(is_match[tail]).view(-1).tolist():
+                    expected[i, j] = 1
+                    expected[j, i] = 1
+
+        binary_rel_mat = binary_relatedness_matrix(is_match, tgt_pair_idxs[:, 0], tgt_pair_idxs[:, 1])
+        self.assertTrue(torch.equal(binary_rel_mat, expected))
+
+    def test_sort_by_score(self):
+        num_rois = [3, 7, 5, 7]
+        proposals = [[None] * num_roi for num_roi in num_rois]
+        img_ids = torch.cat([torch.full((num_roi,), i, dtype=torch.int64) for i, num_roi in enumerate(num_rois)])
+        perm, inv_perm, ls_transposed = sort_by_score(proposals, torch.rand(sum(num_rois)))
+
+        # every sequence of the packed batch holds the rois of one image
+        packed_img_ids = img_ids[perm]
+        seq_ids = torch.cat([torch.arange(int(l)) for l in ls_transposed])
+        for seq_id in range(int(ls_transposed[0])):
+            self.assertEqual(len(packed_img_ids[seq_ids == seq_id].unique()), 1)
+        self.assertTrue(torch.equal(perm[inv_perm], torch.arange(sum(num_rois))))
+        self.assertEqual(int(packed_img_ids[0]), 3)
+
+        # the original order puts the image with the fewest rois first
+        perm, inv_perm, _ = sort_by_score(proposals, torch.rand(sum(num_rois)), group_images=False)
+        self.assertTrue(torch.equal(perm[inv_perm], torch.arange(sum(num_rois))))
+        self.assertEqual(int(img_ids[perm][0]), 0)
+
+    def test_packed_label_nms(self):
+        num_cls, nms_thresh = 6, 0.3
+        seq_lens = [9, 6, 6, 2]
+        pred_logits = [torch.randn(seq_len, num_cls) for seq_len in seq_lens]
+        boxes_per_cls = [_random_boxes_per_cls(seq_len, num_cls) for seq_len in seq_lens]
+
+        # reference: the numpy greedy nms of the decoder on each sequence alone
+        expected = []
+        for logits, boxes in zip(pred_logits, boxes_per_cls):
+            is_overlap = nms_overlaps(boxes).numpy() >= nms_thresh
+            out_dists_sampled = torch.softmax(logits, 1).numpy()
+            out_dists_sampled[:, 0] = 0
+            labels = torch.zeros(len(logits), dtype=torch.int64)
+            for _ in range(len(logits)):
+                box_ind, cls_ind = np.unravel_index(out_dists_sampled.argmax(), out_dists_sampled.shape)
+                labels[int(box_ind)] = int(cls_ind)
+                out_dists_sampled[is_overlap[box_ind, :, cls_ind], cls_ind] = 0.0
+                out_dists_sampled[box_ind] = -1.0
+            expected.append(labels)
+
+        # pack the sequences in the TxB order of the decoder
+        batch_lengths = [sum(seq_len > t for seq_len in seq_lens) for t in range(seq_lens[0])]
+        packed = [[], [], []]
+        for t, l_batch in enumerate(batch_lengths):
+            for seq_id in range(l_batch):
+                packed[0].append(pred_logits[seq_id][t])
+                packed[1].append(boxes_per_cls[seq_id][t])
+                packed[2].append(expected[seq_id][t])
+
+        labels = packed_label_nms(torch.stack(packed[0]), torch.stack(packed[1]),
+                                  torch.tensor(batch_lengths), nms_thresh)
+        self.assertTrue(torch.equal(labels, torch.stack(packed[2])))
+
+    def test_packed_transformer_encoder(self):
+        num_objs = [5, 1, 17, 3]
+        input_feats = torch.rand(sum(num_objs), 32)
+        encoder = TransformerEncoder(n_layers=2, n_head=4, d_k=8, d_v=8, d_model=32, d_inner=64).eval()
+
+        with torch.no_grad():
+            expected = encoder(input_feats, num_objs)
+            encoder.attention = "packed"
+            for chunk_size in (0, 4):
+                encoder.chunk_size = chunk_size
+                enc_output = encoder(input_feats, num_objs)
+                self.assertEqual(enc_output.shape, expected.shape)
+                self.assertTrue(torch.allclose(enc_output, expected, atol=1e-5))
+
+    def test_kern_ggnn(self):
+        num_obj_cls, num_rel_cls, hidden_dim = 6, 5, 8
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            obj_matrix_path = os.path.join(tmp_dir, "obj_matrix.npy")
+            rel_matrix_path = os.path.join(tmp_dir, "rel_matrix.npy")
+            np.save(obj_matrix_path, np.random.rand(num_obj_cls, num_obj_cls))
+            np.save(rel_matrix_path, np.random.rand(num_obj_cls, num_obj_cls, num_rel_cls))
+            ggnn_obj = GGNNObj(num_obj_cls, time_step_num=2, hidden_dim=hidden_dim, output_dim=hidden_dim,
+                               prior_matrix=obj_matrix_path).eval()
+            ggnn_rel = GGNNRel(num_rel_cls, time_step_num=2, hidden_dim=hidden_dim, output_dim=hidden_dim,
+                               prior_matrix=rel_matrix_path).eval()
+
+        # instance propagation: reference per node aggregation of a single image
+        num_objs = [4, 1, 7]
+        instance_feats = torch.rand(sum(num_objs), hidden_dim)
+        with torch.no_grad():
+            hidden = torch.rand(num_objs[0], num_obj_cls, hidden_dim)
+            hidden_sum = torch.sum(hidden, 0)
+            expected = torch.cat(
+                [torch.cat([ggnn_obj.matrix.transpose(0, 1) @ (hidden_sum - hidden_i) for hidden_i in hidden], 0),
+                 torch.cat([ggnn_obj.matrix @ (hidden_sum - hidden_i) for hidden_i in hidden], 0)], 1)
+            av = ggnn_obj.aggregate(hidden, torch.zeros(num_objs[0], dtype=torch.int64), 1)
+            self.assertTrue(torch.allclose(av, expected, atol=1e-5))
+
+            expected = torch.cat([ggnn_obj(feats) for feats in instance_feats.split(num_objs)], 0)
+            self.assertTrue(torch.allclose(ggnn_obj(instance_feats, num_objs), expected, atol=1e-5))
+
+        # the prior follows the module, e.g. to the device of the inputs
+        self.assertIs(dict(ggnn_rel.named_buffers())["matrix"], ggnn_rel.matrix)
+
+        # relation prior adjacency: reference loop over the relations
+        sub_obj_preds = torch.randint(0, num_obj_cls, (10, 2))
+        input_ggnn = torch.rand(10, num_rel_cls + 2, hidden_dim)
+        expected = np.zeros((10, 2, num_rel_cls), dtype=np.float32)
+        matrix = ggnn_rel.matrix.numpy()
+        for index in range(len(sub_obj_preds)):
+            expected[index][0] = matrix[sub_obj_preds[index, 0], sub_obj_preds[index, 1]]
+            expected[index][1] = expected[index][0]
+        self.assertTrue(torch.equal(ggnn_rel.prior_adjacency(sub_obj_preds, input_ggnn), torch.from_numpy(expected)))
+
+    def test_sparse_frequency_bias(self):
+        num_obj_cls, num_rel_cls = 12, 7
+        # the triplets of a few subject-object pairs, most pairs are never seen
+        sub_obj = np.random.randint(0, num_obj_cls, (15, 2))
+        triplets = np.concatenate((sub_obj[np.random.randint(0, 15, 200)],
+                                   np.random.randint(1, num_rel_cls, (200, 1))), 1)
+        fg_keys = (triplets[:, 0] * num_obj_cls + triplets[:, 1]) * num_rel_cls + triplets[:, 2]
+        bg_matrix = np.random.randint(0, 5, (num_obj_cls, num_obj_cls))
+        fg_matrix = np.zeros((num_obj_cls, num_obj_cls, num_rel_cls), dtype=np.int64)
+        np.add.at(fg_matrix, tuple(triplets.T), 1)
+        seen = torch.from_numpy(fg_matrix.sum(2) > 0)
+
+        dense = pred_dist_statistics(fg_matrix, bg_matrix, num_obj_cls, num_rel_cls)
+        sparse = pred_dist_statistics(np.unique(fg_keys, return_counts=True), bg_matrix, num_obj_cls, num_rel_cls)
+        self.assertTrue(torch.equal(sparse['fg_matrix'].to_dense()[seen], dense['fg_matrix'][seen]))
+        self.assertTrue(torch.equal(sparse['pred_dist'].to_dense()[seen], dense['pred_dist'][seen]))
+        self.assertTrue(torch.equal(sparse['pred_dist_default'].expand(int((~seen).sum()), -1),
+                                    dense['pred_dist'][~seen]))
+
+        dense_bias = FrequencyBias(None, dense)
+        sparse_bias = FrequencyBias(None, sparse)
+        self.assertLess(sparse_bias.obj_baseline.weight.numel(), dense_bias.obj_baseline.weight.numel())
+        labels = torch.nonzero(torch.ones(num_obj_cls, num_obj_cls))
+        pair_prob = torch.softmax(torch.randn(4, num_obj_cls, 2), 1)
+        with torch.no_grad():
+            self.assertTrue(torch.equal(sparse_bias.index_with_labels(labels), dense_bias.index_with_labels(labels)))
+            self.assertTrue(torch.allclose(sparse_bias.index_with_probability(pair_prob),
+                                           dense_bias.index_with_probability(pair_prob), atol=1e-5))
+
+    def test_prepare_for_inference(self):
+        num_obj_cls, num_rel_cls = 6, 5
+        fg_matrix = np.random.randint(0, 4, (num_obj_cls, num_obj_cls, num_rel_cls))
+        statistics = pred_dist_statistics(fg_matrix, np.random.randint(0, 4, (num_obj_cls, num_obj_cls)),
+                                          num_obj_cls, num_rel_cls)
+        predictor = _ToyPredictor(statistics)
+        bn = predictor.pos_embed[1]
+        bn.running_mean.uniform_(-1, 1)
+        bn.running_var.uniform_(0.5, 2)
+        nn.init.uniform_(bn.weight)
+        nn.init.uniform_(predictor.rel_compress.scales, 0.5, 2)
+        predictor.eval()
+
+        pos_feats = torch.rand(20, 9)
+        pair_pred = torch.randint(0, num_obj_cls, (20, 2))
+        state_keys = set(predictor.state_dict().keys())
+        with torch.no_grad():
+            expected = predictor(pos_feats, pair_pred)
+            prepare_for_inference(predictor)
+            rel_dists = predictor(pos_feats, pair_pred)
+            with self.assertRaises(AssertionError):
+                predictor.freq_bias.index_with_labels(pair_pred, scale=2 * predictor.freq_lambda)
+        self.assertIsInstance(predictor.pos_embed[1], nn.Identity)
+        self.assertTrue(predictor.ctx_compress.frozen and predictor.freq_bias.frozen)
+        self.assertFalse(any(param.requires_grad for param in predictor.parameters()))
+        # only the folded batch norm leaves the state dict
+        self.assertEqual(set(predictor.state_dict().keys()),
+                         {key for key in state_keys if not key.startswith("pos_embed.1.")})
+        self.assertTrue(torch.allclose(rel_dists, expected, atol=1e-5))
+
+    def test_prepare_for_inference_predictors(self):
+        torch.manual_seed(0)
+        num_objs = (5, 3, 4)
+        for predictor_name in ("MotifPredictor", "VCTreePredictor", "TransformerPredictor"):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                cfg = load_relation_config(tmp_dir, predictor_name)
+                predictor = make_roi_relation_predictor(cfg, cfg.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM)
+            # non trivial statistics for the batch norms of the position embeddings
+            for module in predictor.modules():
+                if isinstance(module, nn.BatchNorm1d):
+                    module.running_mean.uniform_(-1, 1)
+                    module.running_var.uniform_(0.5, 2)
+                    nn.init.uniform_(module.weight, 0.5, 1.5)
+            predictor.eval()
+
+            proposals = _toy_proposals(num_objs, cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES)
+            rel_pair_idxs = [_all_pairs(num_obj) for num_obj in num_objs]
+            roi_features = torch.rand(sum(num_objs), cfg.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM)
+            union_features = torch.rand(sum(len(pairs) for pairs in rel_pair_idxs), cfg.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM)
+            with torch.no_grad():
+                expected_obj_dists, expected_rel_dists, _ = predictor(
+                    proposals, rel_pair_idxs, None, None, roi_features, union_features)
+                prepare_for_inference(predictor)
+                obj_dists, rel_dists, _ = predictor(proposals, rel_pair_idxs, None, None, roi_features, union_features)
+
+            self.assertFalse(any(isinstance(module, nn.BatchNorm1d) for module in predictor.modules()),
+                             predictor_name)
+            self.assertTrue(predictor.freq_bias.frozen, predictor_name)
+            for dists, expected in zip(obj_dists, expected_obj_dists):
+                self.assertTrue(torch.allclose(dists, expected, atol=1e-5), predictor_name)
+            for dists, expected in zip(rel_dists, expected_rel_dists):
+                self.assertTrue(torch.allclose(dists, expected, atol=1e-5), predictor_name)
+
+    def test_causal_effect_logits(self):
+        torch.manual_seed(0)
+        num_objs = (5, 3, 4)
+        for fusion_type, effect_type in (("sum", "TDE"), ("sum", "NIE"), ("gate", "TE"), ("features", "TDE")):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                cfg = load_relation_config(tmp_dir, "CausalAnalysisPredictor")
+                cfg.MODEL.ROI_RELATION_HEAD.CAUSAL.EFFECT_ANALYSIS = True
+                cfg.MODEL.ROI_RELATION_HEAD.CAUSAL.FUSION_TYPE = fusion_type
+                cfg.MODEL.ROI_RELATION_HEAD.CAUSAL.EFFECT_TYPE = effect_type
+                predictor = make_roi_relation_predictor(cfg, cfg.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM)
+            # non trivial untreated averages for the counterfactual branch
+            for name, buffer in predictor.named_buffers():
+                if "untreated" in name or "avg_post_ctx" in name:
+                    buffer.uniform_(0, 1)
+            predictor.eval()
+
+            proposals = _toy_proposals(num_objs, cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES)
+            rel_pair_idxs = [_all_pairs(num_obj) for num_obj in num_objs]
+            roi_features = torch.rand(sum(num_objs), cfg.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM)
+            union_features = torch.rand(sum(len(pairs) for pairs in rel_pair_idxs), cfg.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM)
+            with torch.no_grad():
+                expected_rel_dists = _reference_effect_logits(
+                    predictor, proposals, rel_pair_idxs, roi_features, union_features)
+                _, rel_dists, _ = predictor(proposals, rel_pair_idxs, None, None, roi_features, union_features)
+
+            case = "{} {}".format(fusion_type, effect_type)
+            self.assertEqual(len(rel_dists), len(num_objs), case)
+            for dists, expected in zip(rel_dists, expected_rel_dists):
+                self.assertTrue(torch.allclose(dists, expected, atol=1e-5), case)
+
+    def test_relation_proposal_model(self):
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cfg = load_relation_config(tmp_dir)
+            cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL.VISUAL_FEATURES_ON = True
+            rel_pn = RelationProposalModel(cfg)
+        for module in rel_pn.modules():
+            if isinstance(module, nn.BatchNorm1d):
+                module.running_mean.uniform_(-1, 1)
+                module.running_var.uniform_(0.5, 2)
+        rel_pn.eval()
+
+        # the second image has boxes but no pair, the third a single box
+        num_objs = (5, 3, 1, 4)
+        proposals = _toy_proposals(num_objs, cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES)
+        rel_pair_idxs = [_all_pairs(num_obj) for num_obj in num_objs]
+        rel_pair_idxs[1] = rel_pair_idxs[1][:0]
+        rel_labels = [torch.randint(0, cfg.MODEL.ROI_RELATION_HEAD.NUM_CLASSES, (len(pairs),))
+                      for pairs in rel_pair_idxs]
+        roi_features = torch.rand(sum(num_objs), cfg.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM)
+        with torch.no_grad():
+            expected_scores = _reference_relness(rel_pn, proposals, roi_features, rel_pair_idxs)
+            relness_scores, relness_matrixs, losses = rel_pn(proposals, roi_features, rel_pair_idxs)
+        self.assertIsNone(relness_matrixs)
+        self.assertIsNone(losses)
+        self.assertEqual(len(relness_scores), len(num_objs))
+        for scores, expected in zip(relness_scores, expected_scores):
+            self.assertEqual(scores.shape, expected.shape)
+            self.assertTrue(torch.allclose(scores, expected, atol=1e-5))
+
+        filter_cfg = g_cfg.MODEL.ROI_RELATION_HEAD.RELATION_PROPOSAL_MODEL
+        pair_nums = filter_cfg.PAIR_NUMS_AFTER_FILTERING
+        filter_cfg.PAIR_NUMS_AFTER_FILTERING = 7
+        try:
+            pairs, labels, scores = filter_rel_pairs(relness_scores, rel_pair_idxs, rel_labels)
+        finally:
+            filter_cfg.PAIR_NUMS_AFTER_FILTERING = pair_nums
+        for img_id, expected in enumerate(expected_scores):
+            keep = torch.sort(expected, descending=True)[1][:7]
+            self.assertTrue(torch.equal(pairs[img_id], rel_pair_idxs[img_id][keep]))
+            self.assertTrue(torch.equal(labels[img_id], rel_labels[img_id][keep]))
+            self.assertTrue(torch.allclose(scores[img_id], expected[keep], atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
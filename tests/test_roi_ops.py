@@ -0,0 +1,153 @@
+import math
+import unittest
+
+import torch
+from pysgg.layers import roi_align, roi_pool
+from pysgg.modeling.poolers import Pooler
+from pysgg.structures.bounding_box import BoxList
+
+
+def _random_rois(num_rois, batch_size, size):
+    boxes = torch.rand(num_rois, 4, dtype=torch.float64) * size
+    boxes[:, 2:] = boxes[:, :2] + torch.rand(num_rois, 2, dtype=torch.float64) * size / 2
+    # a few degenerate and out of image rois
+    boxes[0, 2:] = boxes[0, :2]
+    boxes[1] = torch.tensor([size - 4., size - 4., size * 1.5, size * 1.5])
+    batch_inds = torch.randint(0, batch_size, (num_rois, 1)).to(torch.float64)
+    return torch.cat([batch_inds, boxes], 1)
+
+
+def _bilinear_weights(start, bin_size, grid, pooled, size):
+    # (pooled, size) weights averaging the bilinear samples of each bin along one axis
+    weights = torch.zeros(pooled, size, dtype=torch.float64)
+    for p in range(pooled):
+        for i in range(grid):
+            v = start + p * bin_size + (i + .5) * bin_size / grid
+            if v < -1.0 or v > size:
+                continue
+            v = max(v, 0.)
+            low = int(v)
+            if low >= size - 1:
+                high = low = size - 1
+                v = float(low)
+            else:
+                high = low + 1
+            weights[p, low] += (1. - (v - low)) / grid
+            weights[p, high] += (v - low) / grid
+    return weights
+
+
+def _reference_roi_align(features, rois, output_size, spatial_scale, sampling_ratio):
+    # the samples are separable, a bin is the product of its row and column weights
+    height, width = features.shape[2:]
+    outputs = []
+    for roi in rois.tolist():
+        start_w, start_h, end_w, end_h = [v * spatial_scale for v in roi[1:]]
+        roi_w, roi_h = max(end_w - start_w, 1.), max(end_h - start_h, 1.)
+        grid_h = sampling_ratio if sampling_ratio > 0 else math.ceil(roi_h / output_size[0])
+        grid_w = sampling_ratio if sampling_ratio > 0 else math.ceil(roi_w / output_size[1])
+        weights_h = _bilinear_weights(start_h, roi_h / output_size[0], grid_h, output_size[0], height)
+        weights_w = _bilinear_weights(start_w, roi_w / output_size[1], grid_w, output_size[1], width)
+        weights_h, weights_w = weights_h.to(features.dtype), weights_w.to(features.dtype)
+        outputs.append(weights_h @ features[int(roi[0])] @ weights_w.t())
+    return torch.stack(outputs)
+
+
+def _c_round(v):
+    return int(math.floor(abs(v) + .5)) * (1 if v >= 0 else -1)
+
+
+def _reference_roi_pool(features, rois, output_size, spatial_scale):
+    height, width = features.shape[2:]
+    outputs = []
+    for roi in rois.tolist():
+        start_w, start_h, end_w, end_h = [_c_round(v * spatial_scale) for v in roi[1:]]
+        bin_h = max(end_h - start_h + 1, 1) / output_size[0]
+        bin_w = max(end_w - start_w + 1, 1) / output_size[1]
+        bins = []
+        for ph in range(output_size[0]):
+            h0 = min(max(math.floor(ph * bin_h) + start_h, 0), height)
+            h1 = min(max(math.ceil((ph + 1) * bin_h) + start_h, 0), height)
+            for pw in range(output_size[1]):
+                w0 = min(max(math.floor(pw * bin_w) + start_w, 0), width)
+                w1 = min(max(math.ceil((pw + 1) * bin_w) + start_w, 0), width)
+                region = features[int(roi[0]), :, h0:h1, w0:w1]
+                if region.numel() == 0:
+                    bins.append(features.new_zeros(features.shape[1]))
+                else:
+                    bins.append(region.reshape(features.shape[1], -1).max(1)[0])
+        outputs.append(torch.stack(bins, 1).view(-1, *output_size))
+    return torch.stack(outputs)
+
+
+class TestROIOps(unittest.TestCase):
+    def _check(self, op, reference, dtype, atol):
+        torch.manual_seed(0)
+        features = torch.rand(2, 5, 24, 32, dtype=dtype)
+        rois = _random_rois(40, 2, 96).to(dtype)
+        for num_threads in (1, torch.get_num_threads()):
+            torch.set_num_threads(num_threads)
+            features_ref = features.clone().requires_grad_()
+            features_cpu = features.clone().requires_grad_()
+            expected = reference(features_ref, rois)
+            output = op(features_cpu, rois)
+            self.assertEqual(output.shape, expected.shape)
+            self.assertTrue(torch.allclose(output, expected, atol=atol))
+
+            grad_output = torch.rand_like(expected)
+            expected.backward(grad_output)
+            output.backward(grad_output)
+            self.assertTrue(torch.allclose(features_cpu.grad, features_ref.grad, atol=atol))
+
+    def test_roi_align_cpu(self):
+        for sampling_ratio in (0, 2):
+            for dtype, atol in ((torch.float64, 1e-10), (torch.float32, 1e-5)):
+                self._check(
+                    lambda features, rois: roi_align(features, rois, (7, 7), 0.25, sampling_ratio),
+                    lambda features, rois: _reference_roi_align(features, rois, (7, 7), 0.25, sampling_ratio),
+                    dtype, atol)
+
+    def test_roi_pool_cpu(self):
+        # in double only, the bin edges of the reference are not rounded as in float
+        self._check(
+            lambda features, rois: roi_pool(features, rois, (7, 7), 0.25),
+            lambda features, rois: _reference_roi_pool(features, rois, (7, 7), 0.25),
+            torch.float64, 1e-10)
+
+    def test_empty_rois_cpu(self):
+        features = torch.rand(1, 3, 8, 8, requires_grad=True)
+        rois = torch.zeros(0, 5)
+        for output in (roi_align(features, rois, (7, 7), 0.25, 2), roi_pool(features, rois, (7, 7), 0.25)):
+            self.assertEqual(output.shape, (0, 3, 7, 7))
+            output.sum().backward()
+            self.assertTrue((features.grad == 0).all())
+
+    def test_fused_pooler_cpu(self):
+        torch.manual_seed(0)
+        scales = (0.25, 0.125, 0.0625, 0.03125)
+        features = [torch.rand(2, 4, int(128 * scale), int(96 * scale)) for scale in scales]
+        boxes = []
+        for _ in range(2):
+            rois = _random_rois(30, 1, 96).float()
+            # a few large boxes so that all the levels get some rois
+            rois[-4:, 3:] = rois[-4:, 1:3] + torch.tensor([[200., 300.]])
+            boxes.append(BoxList(rois[:, 1:], (96, 128), mode="xyxy"))
+        for cat_all_levels in (False, True):
+            pooler = Pooler((7, 7), scales, 2, in_channels=4, cat_all_levels=cat_all_levels)
+            results = []
+            for fused in (False, True):
+                pooler.fused = fused
+                inputs = [feature.clone().requires_grad_() for feature in features]
+                output = pooler(inputs, boxes)
+                output.backward(torch.ones_like(output))
+                results.append((output, [input.grad for input in inputs]))
+            (expected, expected_grads), (output, grads) = results
+            self.assertTrue(torch.equal(output, expected))
+            for grad, expected_grad in zip(grads, expected_grads):
+                self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-6))
+            if not cat_all_levels:
+                self.assertGreater(len(pooler.map_levels(boxes).unique()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
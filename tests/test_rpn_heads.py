@@ -7,6 +7,10 @@ import torch
 from pysgg.modeling.backbone import build_backbone # NoQA
 from pysgg.modeling.rpn.rpn import build_rpn # NoQA
 from pysgg.modeling import registry
+from pysgg.modeling.rpn.anchor_generator import AnchorGenerator
+from pysgg.modeling.rpn.inference import RPNPostProcessor
+from pysgg.structures.bounding_box import BoxList
+from pysgg.structures.image_list import ImageList
 from pysgg.config import cfg as g_cfg
 from utils import load_config
 
@@ -57,6 +61,54 @@ class TestRPNHeads(unittest.TestCase):
                     ]),
                 )
 
+    def test_anchor_generator_cache(self):
+        strides = (4, 8, 16)
+        for straddle_thresh in (0, -1):
+            generators = [AnchorGenerator((32, 64, 128), (0.5, 1.0, 2.0), strides, straddle_thresh, cache_size)
+                          for cache_size in (0, 2)]
+            # the padded sizes repeat, the image sizes inside them do not
+            for padded, image_sizes in (((64, 96), [(60, 90), (64, 71)]), ((96, 64), [(96, 50)]),
+                                        ((64, 96), [(33, 96), (64, 96)]), ((32, 32), [(30, 31)]),
+                                        ((64, 96), [(64, 80)])):
+                image_list = ImageList(torch.zeros(len(image_sizes), 3, *padded), image_sizes)
+                feature_maps = [torch.zeros(1, 1, padded[0] // stride, padded[1] // stride) for stride in strides]
+                expected, cached = [generator(image_list, feature_maps) for generator in generators]
+                for expected_per_img, cached_per_img in zip(expected, cached):
+                    for expected_boxlist, boxlist in zip(expected_per_img, cached_per_img):
+                        self.assertEqual(boxlist.size, expected_boxlist.size)
+                        self.assertTrue(torch.equal(boxlist.bbox, expected_boxlist.bbox))
+                        self.assertTrue(torch.equal(boxlist.get_field("visibility"),
+                                                    expected_boxlist.get_field("visibility")))
+            self.assertEqual(len(generators[0]._cache), 0)
+            self.assertEqual(len(generators[1]._cache), 2)
+
+    def test_batched_rpn_post_processor(self):
+        N, A, image_size = 2, 3, (120, 90)
+        anchors, objectness, box_regression = [[] for _ in range(N)], [], []
+        for H, W in ((16, 20), (8, 10), (4, 5)):
+            num_anchors = A * H * W
+            boxes = torch.rand(num_anchors, 4) * 60
+            boxes[:, 2:] += boxes[:, :2] + 4
+            for anchors_per_img in anchors:
+                anchors_per_img.append(BoxList(boxes, image_size, mode="xyxy"))
+            objectness.append(torch.randn(N, A, H, W))
+            box_regression.append(torch.randn(N, A * 4, H, W) * 0.2)
+
+        for training, per_batch in ((False, True), (True, True), (True, False)):
+            processors = [RPNPostProcessor(pre_nms_top_n=100, post_nms_top_n=40, nms_thresh=0.7, min_size=2,
+                                           fpn_post_nms_top_n=50, fpn_post_nms_per_batch=per_batch,
+                                           batched=batched).train(training) for batched in (False, True)]
+            for num_levels in (1, 3):
+                expected, results = [
+                    processor([anchors_per_img[:num_levels] for anchors_per_img in anchors],
+                              objectness[:num_levels], box_regression[:num_levels])
+                    for processor in processors
+                ]
+                for expected_boxlist, boxlist in zip(expected, results):
+                    self.assertTrue(torch.equal(boxlist.bbox, expected_boxlist.bbox))
+                    self.assertTrue(torch.equal(boxlist.get_field("objectness"),
+                                                expected_boxlist.get_field("objectness")))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+
+import numpy as np
+import torch
+import torch.nn as nn
+from pysgg.modeling.roi_heads.relation_head.utils_treelstm import (
+    BiTreeLSTM_Backward,
+    BiTreeLSTM_Foreward,
+    MultiLayer_BTreeLSTM,
+    TreeLSTM_IO,
+)
+from pysgg.modeling.roi_heads.relation_head.utils_vctree import (
+    arbForest_to_biForest,
+    generate_array_forest,
+    generate_forest,
+    greedy_tree_parents,
+)
+from pysgg.structures.bounding_box import BoxList
+
+
+def _reference_tree_parents(pair_score):
+    # the node by node greedy growing the vectorized builder replaced
+    num_obj = pair_score.shape[0]
+    root_idx = int(pair_score.mean(1).view(-1).max(-1)[1])
+    parent = [-1] * num_obj
+    select_index = [root_idx]
+    remain_index = [idx for idx in range(num_obj) if idx != root_idx]
+    while len(remain_index) > 0:
+        wid = len(remain_index)
+        select_score_map = pair_score[torch.tensor(select_index)][:, torch.tensor(remain_index)].reshape(-1)
+        best_id = int(select_score_map.max(0)[1])
+        insert_idx = remain_index[best_id % wid]
+        parent[insert_idx] = select_index[best_id // wid]
+        select_index.append(insert_idx)
+        remain_index.remove(insert_idx)
+    return parent, select_index
+
+
+def _random_pair_scores(num_objs=(6, 1, 13, 9)):
+    pair_scores = [torch.rand(num_obj, num_obj) for num_obj in num_objs]
+    # coarse scores, so the ties have to be broken in the same order
+    pair_scores.append(torch.randint(0, 3, (10, 10)).float())
+    return pair_scores
+
+
+def _proposals(pair_scores):
+    proposals = []
+    for pair_score in pair_scores:
+        num_obj = pair_score.shape[0]
+        boxes = torch.rand(num_obj, 4) * 50
+        boxes[:, 2:] += boxes[:, :2]
+        proposal = BoxList(boxes, (100, 100))
+        proposal.add_field("labels", torch.randint(1, 151, (num_obj,)))
+        proposals.append(proposal)
+    return proposals
+
+
+class TestVCTree(unittest.TestCase):
+    def test_greedy_tree_parents(self):
+        pair_scores = _random_pair_scores()
+        for pair_score, (parent, insert_order) in zip(pair_scores, greedy_tree_parents(pair_scores)):
+            expected_parent, expected_order = _reference_tree_parents(pair_score)
+            self.assertEqual(parent.tolist(), expected_parent)
+            self.assertEqual(np.argsort(insert_order).tolist(), expected_order)
+
+    def test_array_forest(self):
+        pair_scores = _random_pair_scores()
+        bi_forest = arbForest_to_biForest(generate_forest(pair_scores, _proposals(pair_scores), "predcls"))
+        forest = generate_array_forest(pair_scores)
+
+        offset = 0
+        for img_id, (pair_score, bi_tree) in enumerate(zip(pair_scores, bi_forest)):
+            self.assertEqual(forest.roots[img_id], bi_tree.index + offset)
+            nodes = [bi_tree]
+            while len(nodes) > 0:
+                node = nodes.pop()
+                idx = node.index + offset
+                for child, array_child in ((node.left_child, forest.left_child[idx]),
+                                           (node.right_child, forest.right_child[idx])):
+                    if child is None:
+                        self.assertEqual(array_child, -1)
+                    else:
+                        self.assertEqual(array_child, child.index + offset)
+                        self.assertEqual(forest.parent[array_child], idx)
+                        nodes.append(child)
+                self.assertEqual(forest.depth[idx], node.depth() - 1)
+            offset += pair_score.shape[0]
+
+        levels = forest.levels()
+        self.assertEqual(sorted(np.concatenate(levels).tolist()), list(range(offset)))
+        for depth, level in enumerate(levels):
+            self.assertTrue((forest.depth[level] == depth).all())
+
+    def test_level_treelstm(self):
+        pair_scores = _random_pair_scores()
+        num_objs = [pair_score.shape[0] for pair_score in pair_scores]
+        bi_forest = arbForest_to_biForest(generate_forest(pair_scores, _proposals(pair_scores), "predcls"))
+        forest = generate_array_forest(pair_scores)
+        in_dim, out_dim, embed_dim, num_classes = 12, 8, 6, 5
+
+        features = torch.rand(sum(num_objs), in_dim)
+        tree_lstm = MultiLayer_BTreeLSTM(in_dim, out_dim, num_layer=2).eval()
+        with torch.no_grad():
+            expected = torch.cat([tree_lstm(tree, feat, len(feat))
+                                  for tree, feat in zip(bi_forest, features.split(num_objs))], 0)
+            output = tree_lstm.forward_levels(forest, features)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+
+        # the decoders, which pass the predicted label embedding along the tree
+        embed_layer = nn.Embedding(num_classes + 1, embed_dim)
+        embed_out_layer = nn.Linear(out_dim, num_classes)
+        for decoder_cls, num_embed in ((BiTreeLSTM_Foreward, 2), (BiTreeLSTM_Backward, 1)):
+            decoder = decoder_cls(in_dim + embed_dim * num_embed, out_dim, is_pass_embed=True,
+                                  embed_layer=embed_layer, embed_out_layer=embed_out_layer).eval()
+            expected_dists, expected_commitments = [], []
+            with torch.no_grad():
+                for tree, feat in zip(bi_forest, features.split(num_objs)):
+                    lstm_io = TreeLSTM_IO(None, torch.zeros(len(feat), dtype=torch.int64), 0, None, None, None)
+                    decoder(tree, feat, lstm_io)
+                    expected_dists.append(lstm_io.dists[lstm_io.order])
+                    expected_commitments.append(lstm_io.commitments[lstm_io.order])
+                _, dists, commitments = decoder.forward_levels(forest, features)
+            self.assertTrue(torch.allclose(dists, torch.cat(expected_dists, 0), atol=1e-6))
+            self.assertTrue(torch.equal(commitments, torch.cat(expected_commitments, 0)))
+
+
+if __name__ == "__main__":
+    unittest.main()
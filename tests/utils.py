@@ -26,3 +26,55 @@ def load_config_from_file(file_path):
     ret = copy.deepcopy(g_cfg)
     ret.merge_from_file(file_path)
     return ret
+
+
+def load_relation_config(tmp_dir, predictor="MotifPredictor", num_obj_cls=6, num_rel_cls=5, num_att_cls=3):
+    '''
+    Tiny FPN relation head config in predcls, the dataset statistics and the word vectors
+    the relation predictors load are written to tmp_dir
+    '''
+    import numpy as np
+    import torch
+    from pysgg.data.datasets.visual_genome import pred_dist_statistics
+
+    ret = copy.deepcopy(g_cfg)
+    ret.OUTPUT_DIR = tmp_dir
+    ret.GLOVE_DIR = tmp_dir
+    ret.DATASETS.TRAIN = ("toy_train",)
+    ret.MODEL.RELATION_ON = True
+    ret.MODEL.ROI_HEADS.USE_FPN = True
+    ret.MODEL.ROI_BOX_HEAD.FEATURE_EXTRACTOR = "FPN2MLPFeatureExtractor"
+    ret.MODEL.ROI_BOX_HEAD.POOLER_SCALES = (0.25,)
+    ret.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION = 4
+    ret.MODEL.ROI_BOX_HEAD.POOLER_SAMPLING_RATIO = 2
+    ret.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM = 32
+    ret.MODEL.ROI_BOX_HEAD.NUM_CLASSES = num_obj_cls
+    ret.MODEL.ROI_ATTRIBUTE_HEAD.NUM_ATTRIBUTES = num_att_cls
+    ret.MODEL.ROI_RELATION_HEAD.PREDICTOR = predictor
+    ret.MODEL.ROI_RELATION_HEAD.NUM_CLASSES = num_rel_cls
+    ret.MODEL.ROI_RELATION_HEAD.USE_GT_BOX = True
+    ret.MODEL.ROI_RELATION_HEAD.USE_GT_OBJECT_LABEL = True
+    ret.MODEL.ROI_RELATION_HEAD.EMBED_DIM = 8
+    ret.MODEL.ROI_RELATION_HEAD.CONTEXT_HIDDEN_DIM = 16
+    ret.MODEL.ROI_RELATION_HEAD.CONTEXT_POOLING_DIM = 32
+    ret.MODEL.ROI_RELATION_HEAD.TRANSFORMER.OBJ_LAYER = 1
+    ret.MODEL.ROI_RELATION_HEAD.TRANSFORMER.REL_LAYER = 1
+    ret.MODEL.ROI_RELATION_HEAD.TRANSFORMER.NUM_HEAD = 2
+    ret.MODEL.ROI_RELATION_HEAD.TRANSFORMER.INNER_DIM = 32
+    ret.MODEL.ROI_RELATION_HEAD.TRANSFORMER.KEY_DIM = 8
+    ret.MODEL.ROI_RELATION_HEAD.TRANSFORMER.VAL_DIM = 8
+
+    fg_matrix = np.random.randint(0, 4, (num_obj_cls, num_obj_cls, num_rel_cls))
+    bg_matrix = np.random.randint(0, 4, (num_obj_cls, num_obj_cls))
+    statistics = pred_dist_statistics(fg_matrix, bg_matrix, num_obj_cls, num_rel_cls)
+    statistics.update({
+        'obj_classes': ['__background__'] + ['obj{}'.format(i) for i in range(1, num_obj_cls)],
+        'rel_classes': ['__background__'] + ['rel{}'.format(i) for i in range(1, num_rel_cls)],
+        'att_classes': ['att{}'.format(i) for i in range(num_att_cls)],
+    })
+    torch.save(statistics, os.path.join(tmp_dir, "toy_train_statistics.cache"))
+    # no word has a vector, the embeddings are initialized randomly
+    embed_dim = ret.MODEL.ROI_RELATION_HEAD.EMBED_DIM
+    torch.save(({}, torch.zeros(0, embed_dim), embed_dim),
+               os.path.join(tmp_dir, "glove.6B.{}d.pt".format(embed_dim)))
+    return ret
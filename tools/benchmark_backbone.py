@@ -0,0 +1,60 @@
+# Time the backbone on CPU as built, after folding its frozen batch norms, and folded in the
+# channels last memory format, e.g.
+#   python tools/benchmark_backbone.py --conv-body R-50-FPN --image-size 592 800 --threads 8
+import argparse
+import copy
+import time
+
+import torch
+
+from pysgg.config import cfg
+from pysgg.modeling import registry
+from pysgg.modeling.backbone import prepare_for_inference
+
+
+def timeit(fn, iters):
+    with torch.no_grad():
+        fn()  # warm up
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU backbone benchmark")
+    parser.add_argument("--conv-body", default="R-50-FPN")
+    parser.add_argument("--images-per-batch", type=int, default=1)
+    parser.add_argument("--image-size", type=int, nargs=2, default=[592, 800], metavar=("H", "W"))
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--iters", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    cfg.MODEL.BACKBONE.CONV_BODY = args.conv_body
+    backbone = registry.BACKBONES[args.conv_body](cfg).eval()
+    images = torch.rand(args.images_per_batch, 3, *args.image_size)
+
+    variants = [("unfolded", backbone)]
+    folded = copy.deepcopy(backbone)
+    prepare_for_inference(folded)
+    variants.append(("folded", folded))
+    if hasattr(torch, "channels_last"):
+        folded_channels_last = copy.deepcopy(backbone)
+        prepare_for_inference(folded_channels_last, channels_last=True)
+        variants.append(("folded + channels last", folded_channels_last))
+
+    with torch.no_grad():
+        expected = backbone(images)
+    print("{} on {}x{}, {} images, {} threads".format(
+        args.conv_body, args.image_size[0], args.image_size[1], args.images_per_batch, args.threads))
+    for name, model in variants:
+        with torch.no_grad():
+            outputs = model(images)
+        max_diff = max((out - exp).abs().max().item() for out, exp in zip(outputs, expected))
+        print("{:>24}: {:>10.1f} ms  (max abs diff {:.2e})".format(
+            name, timeit(lambda: model(images), args.iters), max_diff))
+
+
+if __name__ == "__main__":
+    main()
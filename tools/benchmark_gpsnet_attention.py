@@ -0,0 +1,61 @@
+# Compare the dense and the edge-only attention of the GPSNet message generator
+# as the number of instances grows, e.g.
+#   python tools/benchmark_gpsnet_attention.py --num-nodes 40 80 160 320 --pairs-per-node 32
+import argparse
+import time
+
+import torch
+
+from pysgg.modeling.roi_heads.relation_head.model_gpsnet import MessageGenerator
+
+
+def benchmark(msg_gen, n_nodes, num_pairs, input_dims, device, iters):
+    all_pairs = torch.nonzero(torch.ones(n_nodes, n_nodes) - torch.eye(n_nodes))
+    rel_pair_idx = all_pairs[torch.randperm(len(all_pairs))[:num_pairs]].to(device)
+    source_features = torch.rand(n_nodes, input_dims, device=device)
+    weighting_gate = torch.rand(len(rel_pair_idx), device=device)
+
+    results = {}
+    for mode in ("dense", "edge"):
+        msg_gen.attention_mode = mode
+        with torch.no_grad():
+            msg_gen(source_features, weighting_gate, rel_pair_idx)  # warm up
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            for _ in range(iters):
+                msg_gen(source_features, weighting_gate, rel_pair_idx)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = (time.perf_counter() - start) / iters * 1000
+        peak_mem = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == "cuda" else float("nan")
+        results[mode] = (elapsed, peak_mem)
+    return len(rel_pair_idx), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPSNet message attention benchmark")
+    parser.add_argument("--num-nodes", type=int, nargs="+", default=[40, 80, 160, 320, 640])
+    parser.add_argument("--pairs-per-node", type=int, default=32)
+    parser.add_argument("--input-dims", type=int, default=4096)
+    parser.add_argument("--hidden-dim", type=int, default=512)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    msg_gen = MessageGenerator(args.input_dims, args.hidden_dim).to(device).eval()
+
+    print("{:>8} {:>8} | {:>12} {:>12} | {:>12} {:>12}".format(
+        "nodes", "pairs", "dense ms", "edge ms", "dense MB", "edge MB"))
+    for n_nodes in args.num_nodes:
+        num_pairs, results = benchmark(msg_gen, n_nodes, n_nodes * args.pairs_per_node,
+                                       args.input_dims, device, args.iters)
+        print("{:>8} {:>8} | {:>12.3f} {:>12.3f} | {:>12.1f} {:>12.1f}".format(
+            n_nodes, num_pairs, results["dense"][0], results["edge"][0],
+            results["dense"][1], results["edge"][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Time the KERN instance and relation GGNN propagation at typical object counts, e.g.
+#   python tools/benchmark_kern_context.py --num-objs 20 40 80 --images-per-batch 8
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from pysgg.modeling.roi_heads.relation_head.model_kern import GGNNObj, GGNNRelReason
+
+
+def timeit(fn, device, iters):
+    with torch.no_grad():
+        fn()  # warm up
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / iters * 1000
+    peak_mem = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == "cuda" else float("nan")
+    return elapsed, peak_mem
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KERN context benchmark")
+    parser.add_argument("--num-objs", type=int, nargs="+", default=[20, 40, 80])
+    parser.add_argument("--images-per-batch", type=int, default=8)
+    parser.add_argument("--rels-per-image", type=int, default=1024)
+    parser.add_argument("--num-obj-cls", type=int, default=151)
+    parser.add_argument("--num-rel-cls", type=int, default=51)
+    parser.add_argument("--feat-dim", type=int, default=4096)
+    parser.add_argument("--hidden-dim", type=int, default=512)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        obj_matrix_path = os.path.join(tmp_dir, "obj_matrix.npy")
+        rel_matrix_path = os.path.join(tmp_dir, "rel_matrix.npy")
+        np.save(obj_matrix_path, np.random.rand(args.num_obj_cls, args.num_obj_cls).astype(np.float32))
+        np.save(rel_matrix_path,
+                np.random.rand(args.num_obj_cls, args.num_obj_cls, args.num_rel_cls).astype(np.float32))
+        ggnn_obj = GGNNObj(args.num_obj_cls, hidden_dim=args.hidden_dim, output_dim=args.hidden_dim,
+                           prior_matrix=obj_matrix_path).to(device).eval()
+        ggnn_rel = GGNNRelReason(args.num_obj_cls, args.num_rel_cls, inst_feat_dim=args.feat_dim,
+                                 rel_feat_dim=args.feat_dim, hidden_dim=args.hidden_dim, output_dim=args.feat_dim,
+                                 knowledge_matrix=rel_matrix_path).to(device).eval()
+
+    print("{:>8} {:>8} | {:>12} {:>12} | {:>12} {:>12}".format(
+        "objs", "rels", "obj ms", "rel ms", "obj MB", "rel MB"))
+    for num_obj in args.num_objs:
+        num_objs = [num_obj] * args.images_per_batch
+        all_pairs = torch.nonzero(torch.ones(num_obj, num_obj) - torch.eye(num_obj))
+        rel_pair_idxs = [all_pairs[torch.randperm(len(all_pairs))[:args.rels_per_image]].to(device)
+                         for _ in num_objs]
+        num_rels = sum(len(pair_idx) for pair_idx in rel_pair_idxs)
+
+        obj_feats = torch.rand(sum(num_objs), args.hidden_dim, device=device)
+        inst_feats = torch.rand(sum(num_objs), args.feat_dim, device=device)
+        union_feats = torch.rand(num_rels, args.feat_dim, device=device)
+        sub_obj_preds = torch.randint(0, args.num_obj_cls, (num_rels, 2), device=device)
+
+        obj_ms, obj_mb = timeit(lambda: ggnn_obj(obj_feats, num_objs), device, args.iters)
+        rel_ms, rel_mb = timeit(lambda: ggnn_rel(inst_feats, union_feats, sub_obj_preds, rel_pair_idxs, num_objs),
+                                device, args.iters)
+        print("{:>8} {:>8} | {:>12.3f} {:>12.3f} | {:>12.1f} {:>12.1f}".format(
+            num_obj, num_rels, obj_ms, rel_ms, obj_mb, rel_mb))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Time the CPU NMS against the numpy greedy loop of the former kernel, and the batched NMS of
+# all the classes of a batch against the NMS class by class, as the number of boxes grows, e.g.
+#   python tools/benchmark_nms.py --num-boxes 1000 2000 4000 6000 --num-groups 600
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from pysgg.layers import batched_nms, nms
+
+
+def timeit(fn, iters):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def reference_nms(boxes, scores, thresh):
+    # the greedy suppression of the former single threaded kernel
+    boxes, scores = boxes.numpy(), scores.numpy()
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    for i in np.argsort(-scores, kind="stable"):
+        if suppressed[i]:
+            continue
+        w = np.maximum(0, np.minimum(boxes[i, 2], boxes[:, 2]) - np.maximum(boxes[i, 0], boxes[:, 0]) + 1)
+        h = np.maximum(0, np.minimum(boxes[i, 3], boxes[:, 3]) - np.maximum(boxes[i, 1], boxes[:, 1]) + 1)
+        inter = w * h
+        overlap = inter / (areas[i] + areas - inter) >= thresh
+        overlap[i] = False
+        suppressed |= overlap & (scores <= scores[i])
+    return np.nonzero(~suppressed)[0]
+
+
+def random_boxes(num_boxes, image_size):
+    boxes = torch.rand(num_boxes, 4) * image_size
+    boxes[:, 2:] = torch.max(boxes[:, :2], boxes[:, 2:]) + 16
+    return boxes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU NMS benchmark")
+    parser.add_argument("--num-boxes", type=int, nargs="+", default=[1000, 2000, 4000, 6000])
+    # the classes of 4 images with 150 classes each
+    parser.add_argument("--num-groups", type=int, default=4 * 150)
+    parser.add_argument("--image-size", type=int, default=800)
+    parser.add_argument("--thresh", type=float, default=0.7)
+    parser.add_argument("--max-output", type=int, default=300)
+    parser.add_argument("--iters", type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>8} | {:>14} {:>12} {:>12} | {:>16} {:>12}".format(
+        "boxes", "reference ms", "nms ms", "top {} ms".format(args.max_output), "per class ms", "batched ms"))
+    for num_boxes in args.num_boxes:
+        boxes = random_boxes(num_boxes, args.image_size)
+        scores = torch.rand(num_boxes)
+        idxs = torch.randint(0, args.num_groups, (num_boxes,))
+
+        reference_ms = timeit(lambda: reference_nms(boxes, scores, args.thresh), args.iters)
+        nms_ms = timeit(lambda: nms(boxes, scores, args.thresh), args.iters)
+        top_ms = timeit(lambda: nms(boxes, scores, args.thresh, args.max_output), args.iters)
+
+        def per_class():
+            for idx in idxs.unique():
+                inds = torch.nonzero(idxs == idx).squeeze(1)
+                nms(boxes[inds], scores[inds], args.thresh)
+        per_class_ms = timeit(per_class, args.iters)
+        batched_ms = timeit(lambda: batched_nms(boxes, scores, idxs, args.thresh), args.iters)
+        print("{:>8} | {:>14.3f} {:>12.3f} {:>12.3f} | {:>16.3f} {:>12.3f}".format(
+            num_boxes, reference_ms, nms_ms, top_ms, per_class_ms, batched_ms))
+
+
+if __name__ == "__main__":
+    main()
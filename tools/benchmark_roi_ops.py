@@ -0,0 +1,69 @@
+# Time the CPU ROIAlign and ROIPool, forward and backward, with one thread and
+# with all the threads as the number of rois grows, e.g.
+#   python tools/benchmark_roi_ops.py --num-rois 64 256 1024 4096 --channels 256
+import argparse
+import time
+
+import torch
+
+from pysgg.layers import roi_align, roi_pool
+
+
+def timeit(fn, iters):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def random_rois(num_rois, batch_size, image_size):
+    boxes = torch.rand(num_rois, 4) * image_size
+    boxes[:, 2:] = boxes[:, :2] + torch.rand(num_rois, 2) * image_size / 2
+    batch_inds = torch.randint(0, batch_size, (num_rois, 1)).float()
+    return torch.cat([batch_inds, boxes], 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU ROIAlign / ROIPool benchmark")
+    parser.add_argument("--num-rois", type=int, nargs="+", default=[64, 256, 1024, 4096])
+    parser.add_argument("--images-per-batch", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=256)
+    parser.add_argument("--image-size", type=int, default=592)
+    parser.add_argument("--spatial-scale", type=float, default=0.25)
+    parser.add_argument("--resolution", type=int, default=7)
+    parser.add_argument("--sampling-ratio", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=5)
+    args = parser.parse_args()
+
+    num_threads = torch.get_num_threads()
+    feat_size = int(args.image_size * args.spatial_scale)
+    features = torch.rand(args.images_per_batch, args.channels, feat_size, feat_size, requires_grad=True)
+    output_size = (args.resolution, args.resolution)
+    ops = {
+        "align": lambda rois: roi_align(features, rois, output_size, args.spatial_scale, args.sampling_ratio),
+        "pool": lambda rois: roi_pool(features, rois, output_size, args.spatial_scale),
+    }
+
+    print("{:>8} {:>6} | {:>12} {:>12} | {:>12} {:>12}".format(
+        "rois", "op", "fwd 1 ms", "fwd {} ms".format(num_threads), "bwd 1 ms", "bwd {} ms".format(num_threads)))
+    for num_rois in args.num_rois:
+        rois = random_rois(num_rois, args.images_per_batch, args.image_size)
+        for name, op in ops.items():
+            timings = []
+            for threads in (1, num_threads):
+                torch.set_num_threads(threads)
+                with torch.no_grad():
+                    forward_ms = timeit(lambda: op(rois), args.iters)
+                output = op(rois)
+                grad_output = torch.rand_like(output)
+                backward_ms = timeit(
+                    lambda: torch.autograd.grad(output, features, grad_output, retain_graph=True), args.iters)
+                timings.append((forward_ms, backward_ms))
+            torch.set_num_threads(num_threads)
+            print("{:>8} {:>6} | {:>12.3f} {:>12.3f} | {:>12.3f} {:>12.3f}".format(
+                num_rois, name, timings[0][0], timings[1][0], timings[0][1], timings[1][1]))
+
+
+if __name__ == "__main__":
+    main()
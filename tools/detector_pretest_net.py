@@ -10,6 +10,7 @@ import torch
 from pysgg.config import cfg
 from pysgg.data import make_data_loader
 from pysgg.engine.inference import inference
+from pysgg.modeling.backbone import prepare_for_inference as prepare_backbone_for_inference
 from pysgg.modeling.detector import build_detection_model
 from pysgg.utils.checkpoint import DetectronCheckpointer
 from pysgg.utils.collect_env import collect_env_info
@@ -70,6 +71,8 @@ def main():
     output_dir = cfg.OUTPUT_DIR
     checkpointer = DetectronCheckpointer(cfg, model, save_dir=output_dir)
     _ = checkpointer.load(cfg.MODEL.WEIGHT)
+    if cfg.TEST.BACKBONE_PREPARE_FOR_INFERENCE:
+        prepare_backbone_for_inference(model.backbone, channels_last=cfg.TEST.BACKBONE_CHANNELS_LAST)
 
     # Initialize mixed-precision if necessary
     use_mixed_precision = cfg.DTYPE == 'float16'
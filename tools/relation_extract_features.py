@@ -0,0 +1,108 @@
+# Run the frozen detector once over the relation datasets and write the ROI features, the
+# union features of all the ordered box pairs and, in sgcls, the box head logits of the ground
+# truth boxes to the feature store of the detector checkpoint, e.g.
+#   python tools/relation_extract_features.py --config-file configs/e2e_relBGNN_vg.yaml \
+#       MODEL.ROI_RELATION_HEAD.USE_GT_BOX True MODEL.ROI_RELATION_HEAD.USE_GT_OBJECT_LABEL True \
+#       MODEL.ROI_RELATION_HEAD.FEATURE_STORE.DIR datasets/feature_store
+# then train or test with MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED True and the same config.
+# The extraction runs on a single device.
+import argparse
+
+import torch
+from tqdm import tqdm
+
+from pysgg.config import cfg
+from pysgg.data.build import build_dataset, make_data_sampler
+from pysgg.data.collate_batch import BatchCollator
+from pysgg.data.transforms import build_transforms
+from pysgg.modeling.detector import build_detection_model
+from pysgg.utils.checkpoint import DetectronCheckpointer
+from pysgg.utils.feature_store import FeatureStoreWriter, image_keys, modules_fingerprint, store_dir
+from pysgg.utils.imports import import_file
+from pysgg.utils.logger import setup_logger
+
+
+def make_extraction_loader(cfg, split):
+    paths_catalog = import_file("pysgg.config.paths_catalog", cfg.PATHS_CATALOG, True)
+    dataset_list = {"train": cfg.DATASETS.TRAIN, "val": cfg.DATASETS.VAL, "test": cfg.DATASETS.TEST}[split]
+    # the images of the split as the training / inference builds them, with the test transforms
+    datasets = build_dataset(cfg, dataset_list, build_transforms(cfg, is_train=False),
+                             paths_catalog.DatasetCatalog, is_train=split == "train")
+    for dataset in datasets:
+        batch_sampler = torch.utils.data.sampler.BatchSampler(
+            make_data_sampler(dataset, shuffle=False, distributed=False), cfg.TEST.IMS_PER_BATCH, drop_last=False
+        )
+        yield torch.utils.data.DataLoader(
+            dataset,
+            num_workers=cfg.DATALOADER.NUM_WORKERS,
+            batch_sampler=batch_sampler,
+            collate_fn=BatchCollator(cfg.DATALOADER.SIZE_DIVISIBILITY),
+        )
+
+
+def extract_image(model, features, proposal, pairs_per_chunk, with_logits):
+    roi_features, union_features = model.roi_heads.relation.extract_store_features(
+        features, proposal, pairs_per_chunk)
+
+    obj_logits = None
+    if with_logits:
+        obj_logits, _ = model.roi_heads.box.predictor(model.roi_heads.box.feature_extractor(features, [proposal]))
+    return roi_features, union_features, obj_logits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relation feature store extraction")
+    parser.add_argument("--config-file", default="", metavar="FILE", help="path to config file")
+    parser.add_argument("--splits", nargs="+", default=["train", "val", "test"], choices=["train", "val", "test"])
+    parser.add_argument("--pairs-per-chunk", type=int, default=1024,
+                        help="union features computed at once, bounds the memory on images with many boxes")
+    parser.add_argument("--seed", type=int, default=666,
+                        help="the seed of relation_train_net.py, the relation feature extractor layers "
+                             "that are not loaded from the detector are initialized with it")
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    logger = setup_logger("pysgg", "", 0)
+    assert cfg.MODEL.ROI_RELATION_HEAD.USE_GT_BOX, "the feature store is for predcls / sgcls"
+    assert cfg.MODEL.PRETRAINED_DETECTOR_CKPT and cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.DIR
+
+    torch.manual_seed(args.seed)
+    model = build_detection_model(cfg)
+    device = torch.device(cfg.MODEL.DEVICE)
+    model.to(device)
+    load_mapping = {
+        "roi_heads.relation.box_feature_extractor": "roi_heads.box.feature_extractor",
+        "roi_heads.relation.union_feature_extractor.feature_extractor": "roi_heads.box.feature_extractor",
+    }
+    checkpointer = DetectronCheckpointer(cfg, model)
+    checkpointer.load(cfg.MODEL.PRETRAINED_DETECTOR_CKPT, with_optim=False, load_mapping=load_mapping)
+    model.eval()
+
+    relation = model.roi_heads.relation
+    path = store_dir(cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.DIR, cfg.MODEL.PRETRAINED_DETECTOR_CKPT)
+    writer = FeatureStoreWriter(path, modules_fingerprint(relation.frozen_feature_modules()))
+    with_logits = not cfg.MODEL.ROI_RELATION_HEAD.USE_GT_OBJECT_LABEL
+    with torch.no_grad():
+        for split in args.splits:
+            for data_loader in make_extraction_loader(cfg, split):
+                logger.info("Extracting the features of {} {} images".format(len(data_loader.dataset), split))
+                for images, targets, indices in tqdm(data_loader):
+                    features = model.backbone(images.to(device).tensors)
+                    keys = image_keys(data_loader.dataset, indices)
+                    for i, (key, target) in enumerate(zip(keys, targets)):
+                        # the resampled datasets repeat images
+                        if key in writer:
+                            continue
+                        proposal = target.to(device).copy_with_fields(["labels"])
+                        writer.add(key, *extract_image(model, [each[i:i + 1] for each in features], proposal,
+                                                       args.pairs_per_chunk, with_logits))
+    writer.close()
+    logger.info("Wrote the feature store {}".format(path))
+
+
+if __name__ == "__main__":
+    main()
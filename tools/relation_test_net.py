@@ -10,7 +10,9 @@ import torch
 from pysgg.config import cfg
 from pysgg.data import make_data_loader
 from pysgg.engine.inference import inference
+from pysgg.modeling.backbone import prepare_for_inference as prepare_backbone_for_inference
 from pysgg.modeling.detector import build_detection_model
+from pysgg.modeling.roi_heads.relation_head.roi_relation_predictors import prepare_for_inference
 from pysgg.utils.checkpoint import DetectronCheckpointer
 from pysgg.utils.collect_env import collect_env_info
 from pysgg.utils.comm import synchronize, get_rank
@@ -86,6 +88,10 @@ def main():
     output_dir = cfg.OUTPUT_DIR
     checkpointer = DetectronCheckpointer(cfg, model, save_dir=output_dir)
     _ = checkpointer.load(cfg.MODEL.WEIGHT)
+    if cfg.MODEL.RELATION_ON and cfg.TEST.RELATION.PREPARE_FOR_INFERENCE:
+        prepare_for_inference(model.roi_heads.relation.predictor)
+    if cfg.TEST.BACKBONE_PREPARE_FOR_INFERENCE:
+        prepare_backbone_for_inference(model.backbone, channels_last=cfg.TEST.BACKBONE_CHANNELS_LAST)
 
 
     if placeholder is not None:
@@ -34,6 +34,7 @@ from pysgg.utils.checkpoint import DetectronCheckpointer
 from pysgg.utils.checkpoint import clip_grad_norm
 from pysgg.utils import visualize_graph as vis_graph
 from pysgg.utils.collect_env import collect_env_info
+from pysgg.utils.feature_store import image_keys
 from pysgg.utils.comm import synchronize, get_rank, all_gather
 from pysgg.utils.logger import setup_logger, debug_print, TFBoardHandler_LEVEL
 from pysgg.utils.metric_logger import MetricLogger
@@ -230,6 +231,10 @@ def train(
                     model.roi_heads.relation.predictor.context_layer.pre_rel_classifier
                 )
 
+    if cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED:
+        # the stored features stand for the outputs of these extractors, which never run
+        eval_modules = list(eval_modules) + model.roi_heads.relation.frozen_feature_modules()
+
     fix_eval_modules(eval_modules)
     set_train_modules(train_modules)
 
@@ -378,10 +383,10 @@ def train(
     model.train()
 
     print_first_grad = True
-    for iteration, (images, targets, _) in enumerate(train_data_loader, start_iter):
+    for iteration, (images, targets, image_ids) in enumerate(train_data_loader, start_iter):
         if any(len(target) < 1 for target in targets):
             logger.error(
-                f"Iteration={iteration + 1} || Image Ids used for training {_} || targets Length={[len(target) for target in targets]}"
+                f"Iteration={iteration + 1} || Image Ids used for training {image_ids} || targets Length={[len(target) for target in targets]}"
             )
         data_time = time.time() - end
         iteration = iteration + 1
@@ -390,10 +395,15 @@ def train(
         model.train()
         fix_eval_modules(eval_modules)
 
-        images = images.to(device, non_blocking=True)
         targets = [target.to(device) for target in targets]
 
-        loss_dict = model(images, targets, logger=logger)
+        store_keys = None
+        if cfg.MODEL.ROI_RELATION_HEAD.FEATURE_STORE.ENABLED:
+            # the loader gives no image, the features are read from the feature store
+            store_keys = image_keys(train_data_loader.dataset, image_ids)
+        else:
+            images = images.to(device, non_blocking=True)
+        loss_dict = model(images, targets, logger=logger, store_keys=store_keys)
 
         losses = sum(loss for loss in loss_dict.values())
 